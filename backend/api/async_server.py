@@ -0,0 +1,168 @@
+"""
+Асинхронный сервер для горячих маршрутов мини-приложения (aiohttp)
+
+Обслуживает /api/user/info, /api/user/devices, /api/user/history,
+/api/subscription/create, /api/subscription/status (long polling)
+и /api/payment/create; остальные маршруты остаются
+во Flask-сервере (backend/api/server.py), nginx направляет сюда только эти пути.
+Логика маршрутов общая (backend/api/miniapp.py): запросы к БД выполняются
+в ограниченном пуле потоков database.run_async, запросы к платежным системам
+идут через aiohttp без блокировки цикла событий, подписки создает в Remnawave
+очередь provisioning (ее диспетчер запускается и в этом процессе).
+
+Запуск: GUNICORN_APP=backend.api.async_server:app GUNICORN_WORKER_CLASS=aiohttp.GunicornWebWorker
+gunicorn -c backend/api/gunicorn.conf.py (или python -m backend.api.async_server для отладки)
+"""
+import os
+import json
+import asyncio
+import logging
+import functools
+from typing import Optional
+import aiohttp
+from aiohttp import web
+from backend.database import database
+from backend.api import miniapp
+from backend.core import provisioning
+
+logger = logging.getLogger(__name__)
+
+ASYNC_API_PORT = int(os.getenv('ASYNC_API_PORT', '8002'))
+ASYNC_HTTP_POOL_LIMIT = int(os.getenv('ASYNC_HTTP_POOL_LIMIT', '100'))
+ASYNC_HTTP_TIMEOUT = float(os.getenv('ASYNC_HTTP_TIMEOUT', '30'))
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+}
+
+_dumps = functools.partial(json.dumps, ensure_ascii=False, default=str)
+
+
+def _json(body, status: int = 200) -> web.Response:
+    return web.json_response(body, status=status, dumps=_dumps)
+
+
+def _query_int(request: web.Request, name: str) -> Optional[int]:
+    """Целочисленный параметр запроса (None, если не передан или не число, как во Flask)"""
+    try:
+        return int(request.query[name])
+    except (KeyError, ValueError):
+        return None
+
+
+async def _read_json(request: web.Request):
+    try:
+        data = await request.json()
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+@web.middleware
+async def cors_middleware(request: web.Request, handler):
+    """CORS для мини-приложения (те же правила, что у Flask-CORS для /api/*)"""
+    if request.method == 'OPTIONS':
+        response = web.Response()
+    else:
+        response = await handler(request)
+    response.headers.update(CORS_HEADERS)
+    return response
+
+
+async def get_user_info(request: web.Request) -> web.Response:
+    """Получить информацию о пользователе"""
+    body, status = await database.run_async(
+        miniapp.user_info,
+        _query_int(request, 'telegram_id'),
+        request.query.get('username', ''),
+        request.query.get('first_name', ''),
+        _query_int(request, 'ref'),
+    )
+    return _json(body, status)
+
+
+async def get_user_devices(request: web.Request) -> web.Response:
+    """Получить список устройств пользователя"""
+    body, status = await database.run_async(miniapp.user_devices, _query_int(request, 'telegram_id'))
+    return _json(body, status)
+
+
+async def get_user_history(request: web.Request) -> web.Response:
+    """Получить историю транзакций пользователя"""
+    body, status = await database.run_async(miniapp.user_history, _query_int(request, 'telegram_id'))
+    return _json(body, status)
+
+
+async def create_payment(request: web.Request) -> web.Response:
+    """Создать платеж"""
+    data = await _read_json(request)
+    if data is None:
+        return _json({'error': 'Invalid JSON'}, 400)
+    body, status = await miniapp.create_payment_async(data, request.app['http_session'])
+    return _json(body, status)
+
+
+async def create_subscription(request: web.Request) -> web.Response:
+    """Создать подписку"""
+    data = await _read_json(request)
+    if data is None:
+        return _json({'error': 'Invalid JSON'}, 400)
+    body, status = await miniapp.create_subscription_async(data, request.app['http_session'])
+    return _json(body, status)
+
+
+async def get_subscription_status(request: web.Request) -> web.Response:
+    """Статус создания подписки (wait - секунд ждать завершения, long polling)"""
+    try:
+        wait = float(request.query.get('wait', 0))
+    except ValueError:
+        wait = 0
+    body, status = await miniapp.subscription_status_async(
+        _query_int(request, 'job_id'), _query_int(request, 'user_id'), wait
+    )
+    return _json(body, status)
+
+
+async def health_check(request: web.Request) -> web.Response:
+    """Проверка здоровья сервиса"""
+    return _json({'status': 'ok', 'database': await database.run_async(database.check_pool_health)})
+
+
+async def on_startup(app: web.Application):
+    """Общие сессии на время жизни цикла событий воркера"""
+    app['http_session'] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=ASYNC_HTTP_POOL_LIMIT),
+        timeout=aiohttp.ClientTimeout(total=ASYNC_HTTP_TIMEOUT),
+    )
+    # Задачи, поставленные этим процессом, берутся в работу без ожидания опроса
+    provisioning.start_provisioning_dispatcher()
+    logger.info(f"Async API started (pid={os.getpid()}, db workers={database.DB_ASYNC_WORKERS})")
+
+
+async def on_cleanup(app: web.Application):
+    await app['http_session'].close()
+    await asyncio.get_running_loop().run_in_executor(None, provisioning.stop_provisioning_dispatcher)
+    database.close_pool()
+
+
+def create_app() -> web.Application:
+    app = web.Application(middlewares=[cors_middleware])
+    app.router.add_get('/api/user/info', get_user_info)
+    app.router.add_get('/api/user/devices', get_user_devices)
+    app.router.add_get('/api/user/history', get_user_history)
+    app.router.add_post('/api/subscription/create', create_subscription)
+    app.router.add_get('/api/subscription/status', get_subscription_status)
+    app.router.add_post('/api/payment/create', create_payment)
+    app.router.add_get('/health', health_check)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+app = create_app()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(app, host='0.0.0.0', port=ASYNC_API_PORT)
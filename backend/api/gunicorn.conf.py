@@ -0,0 +1,61 @@
+"""
+Конфигурация gunicorn для API (backend.api.server) и webhook'ов (backend.api.webhook)
+
+    gunicorn -c backend/api/gunicorn.conf.py
+    GUNICORN_APP=backend.api.webhook:app GUNICORN_BIND=0.0.0.0:5000 gunicorn -c backend/api/gunicorn.conf.py
+    GUNICORN_APP=backend.api.async_server:app GUNICORN_WORKER_CLASS=aiohttp.GunicornWebWorker \
+        GUNICORN_BIND=0.0.0.0:8002 gunicorn -c backend/api/gunicorn.conf.py
+
+Приложение загружается в мастер-процессе (preload_app): схема БД создается один
+раз, клиент Remnawave и пул соединений создаются лениво в каждом воркере после fork.
+Фоновые задачи запускаются в каждом воркере, но работает одна копия - задачи
+и диспетчеры берут аренду в БД, при падении воркера ее подхватывает другой.
+"""
+import os
+import importlib
+import multiprocessing
+
+wsgi_app = os.getenv('GUNICORN_APP', 'backend.api.server:app')
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+
+# SQLite пишет один процесс за раз: больше 4 воркеров обычно не ускоряет запись,
+# потоки закрывают ожидание Remnawave и платежных API
+workers = int(os.getenv('GUNICORN_WORKERS', str(min(4, multiprocessing.cpu_count() * 2))))
+# aiohttp.GunicornWebWorker для асинхронного сервера мини-приложения (backend.api.async_server)
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+# Не больше DB_POOL_SIZE, иначе потоки будут ждать соединение из пула (только gthread)
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '60'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+# Перезапуск воркеров ограничивает рост памяти
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '5000'))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', '500'))
+preload_app = True
+
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-') or None
+errorlog = '-'
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
+
+
+def _app_module():
+    return importlib.import_module(wsgi_app.split(':', 1)[0])
+
+
+def pre_fork(server, worker):
+    """Соединения мастера не должны наследоваться воркерами"""
+    from backend.database import database
+    database.close_pool()
+
+
+def post_fork(server, worker):
+    start = getattr(_app_module(), 'start_background_workers', None)
+    if start:
+        start()
+
+
+def worker_exit(server, worker):
+    """Graceful shutdown: остановить фоновые задачи и закрыть соединения воркера"""
+    stop = getattr(_app_module(), 'stop_background_workers', None)
+    if stop:
+        stop()
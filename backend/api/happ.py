@@ -0,0 +1,216 @@
+"""
+API модуль для шифрования ссылок подписки через crypto.happ.su
+
+Для одной и той же ссылки (key_config) результат не меняется, а мини-приложение
+запрашивает его при каждом открытии, поэтому ответы кешируются:
+- в памяти процесса (LRU с TTL) - повторные открытия обслуживаются без сети и БД;
+- в SQLite (happ_link_cache) - кеш переживает перезапуск и общий для всех воркеров.
+Ключ кеша - SHA-256 от ссылки. Одновременные запросы одной ссылки объединяются
+(single-flight): в crypto.happ.su уходит один запрос, остальные ждут его результат.
+Запросы идут через общую requests.Session с пулом keep-alive соединений.
+"""
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any
+import requests
+from requests.adapters import HTTPAdapter
+from backend.database import database
+
+logger = logging.getLogger(__name__)
+
+HAPP_CRYPTO_URL = os.getenv('HAPP_CRYPTO_URL', 'https://crypto.happ.su/api.php')
+HAPP_CRYPTO_TIMEOUT = float(os.getenv('HAPP_CRYPTO_TIMEOUT', '10'))
+HAPP_LINK_CACHE_SIZE = int(os.getenv('HAPP_LINK_CACHE_SIZE', '10000'))
+HAPP_LINK_CACHE_TTL = int(os.getenv('HAPP_LINK_CACHE_TTL', str(30 * 24 * 3600)))
+HAPP_POOL_SIZE = int(os.getenv('HAPP_POOL_SIZE', '10'))
+
+
+class _InFlight:
+    """Запрос к crypto.happ.su, результат которого ждут остальные потоки"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[str] = None
+
+
+class HappCryptoAPI:
+    """Шифрование ссылок Happ с кешем и объединением одинаковых запросов"""
+
+    def __init__(self, max_size: int = HAPP_LINK_CACHE_SIZE, ttl: int = HAPP_LINK_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._cache: 'OrderedDict[str, tuple]' = OrderedDict()  # url_hash -> (encrypted_link, expires_at)
+        self._inflight: Dict[str, _InFlight] = {}
+        self._lock = threading.Lock()
+        self._session: Optional[requests.Session] = None
+        self._session_pid: Optional[int] = None
+        self._stats = dict.fromkeys(('memory_hits', 'db_hits', 'misses', 'coalesced', 'errors'), 0)
+
+    def _get_session(self) -> requests.Session:
+        """Сессия с пулом соединений (своя в каждом процессе после fork)"""
+        with self._lock:
+            if self._session is None or self._session_pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HAPP_POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session = session
+                self._session_pid = os.getpid()
+            return self._session
+
+    @staticmethod
+    def url_hash(url: str) -> str:
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _memory_get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            self._stats['memory_hits'] += 1
+            return entry[0]
+
+    def _memory_put(self, key: str, encrypted_link: str, expires_at: float):
+        with self._lock:
+            self._cache[key] = (encrypted_link, expires_at)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def _db_get(self, key: str) -> Optional[tuple]:
+        with database.db_connection() as conn:
+            row = conn.execute(
+                "SELECT encrypted_link, expires_at FROM happ_link_cache WHERE url_hash = ? AND expires_at > ?",
+                (key, time.time())
+            ).fetchone()
+        return (row['encrypted_link'], row['expires_at']) if row else None
+
+    def _db_put(self, key: str, encrypted_link: str, expires_at: float):
+        with database.transaction() as conn:
+            conn.execute("""
+                INSERT INTO happ_link_cache (url_hash, encrypted_link, created_at, expires_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(url_hash) DO UPDATE SET
+                    encrypted_link = excluded.encrypted_link,
+                    created_at = excluded.created_at,
+                    expires_at = excluded.expires_at
+            """, (key, encrypted_link, time.time(), expires_at))
+
+    def _fetch(self, url: str) -> Optional[str]:
+        """Зашифровать ссылку в crypto.happ.su"""
+        try:
+            response = self._get_session().post(
+                HAPP_CRYPTO_URL,
+                json={'url': url},
+                headers={'Content-Type': 'application/json'},
+                timeout=HAPP_CRYPTO_TIMEOUT
+            )
+            if response.ok:
+                result = response.json()
+                if result and result.get('encrypted_link'):
+                    return result['encrypted_link']
+            logger.error(f"Happ encryption API failed: {response.status_code} - {response.text}")
+        except (requests.RequestException, ValueError) as e:
+            logger.error(f"Happ encryption API error: {e}")
+        return None
+
+    def _load(self, key: str, url: str) -> Optional[str]:
+        """Промах кеша памяти: SQLite, затем crypto.happ.su"""
+        try:
+            cached = self._db_get(key)
+        except Exception as e:
+            logger.warning(f"Happ link cache read failed: {e}")
+            cached = None
+        if cached:
+            self._count('db_hits')
+            self._memory_put(key, *cached)
+            return cached[0]
+
+        self._count('misses')
+        encrypted_link = self._fetch(url)
+        if not encrypted_link:
+            # Ошибки не кешируются: следующий запрос попробует снова
+            self._count('errors')
+            return None
+        expires_at = time.time() + self.ttl
+        self._memory_put(key, encrypted_link, expires_at)
+        try:
+            self._db_put(key, encrypted_link, expires_at)
+        except Exception as e:
+            logger.warning(f"Happ link cache write failed: {e}")
+        return encrypted_link
+
+    def encrypt_link(self, url: str) -> Optional[str]:
+        """
+        Зашифрованная ссылка для Happ.
+
+        Returns:
+            Зашифрованная ссылка или None, если crypto.happ.su не ответил
+        """
+        key = self.url_hash(url)
+        encrypted_link = self._memory_get(key)
+        if encrypted_link:
+            return encrypted_link
+
+        with self._lock:
+            inflight = self._inflight.get(key)
+            leader = inflight is None
+            if leader:
+                inflight = self._inflight[key] = _InFlight()
+            else:
+                self._stats['coalesced'] += 1
+
+        if not leader:
+            inflight.done.wait(HAPP_CRYPTO_TIMEOUT * 2)
+            return inflight.result
+
+        try:
+            inflight.result = self._load(key, url)
+            return inflight.result
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            inflight.done.set()
+
+    def stats(self) -> Dict[str, Any]:
+        """Попадания в кеш памяти и SQLite, запросы в crypto.happ.su и объединенные запросы (с запуска процесса)"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_size'] = len(self._cache)
+        requests_total = stats['memory_hits'] + stats['db_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['memory_hits'] + stats['db_hits']) / requests_total, 4) if requests_total else None
+        with database.db_connection() as conn:
+            stats['db_size'] = conn.execute("SELECT COUNT(*) FROM happ_link_cache").fetchone()[0]
+        stats['max_size'] = self.max_size
+        stats['ttl_seconds'] = self.ttl
+        return stats
+
+
+happ_api = HappCryptoAPI()
+
+
+def cleanup_link_cache() -> Dict[str, int]:
+    """Удалить просроченные зашифрованные ссылки из SQLite"""
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM happ_link_cache WHERE expires_at <= ?", (time.time(),))
+        deleted = cursor.rowcount
+    return {'deleted': deleted}
+
+
+def register_jobs():
+    """Зарегистрировать очистку кеша ссылок в планировщике"""
+    from backend.core import scheduler
+    scheduler.register_job('happ_link_cache_cleanup', cleanup_link_cache, 6 * 3600, initial_delay=900)
@@ -7,7 +7,9 @@ import json
 import hashlib
 import base64
 import hmac
+import asyncio
 import requests
+import aiohttp
 import logging
 import time
 import secrets
@@ -71,12 +73,8 @@ class HeleketAPI:
         raw = f"{encoded}{api_key}"
         return hashlib.md5(raw.encode('utf-8')).hexdigest()
     
-    def _request(self, endpoint: str, payload: Dict[str, Any]) -> Optional[Dict]:
-        """Выполнить запрос к Heleket API"""
-        if not self.is_configured:
-            logger.error("Heleket не настроен: отсутствуют MERCHANT или API_KEY")
-            return None
-        
+    def _signed_request(self, endpoint: str, payload: Dict[str, Any]):
+        """URL, тело и заголовки подписанного запроса"""
         body = self._prepare_body(payload, ignore_none=True, sort_keys=True)
         signature = self._generate_signature(body)
         
@@ -86,56 +84,71 @@ class HeleketAPI:
             'sign': signature,
             'Content-Type': 'application/json'
         }
+        return url, body.encode('utf-8'), headers
+    
+    def _parse_response(self, endpoint: str, status_code: int, content_type: str, text: str) -> Optional[Dict]:
+        """Разобрать ответ Heleket (общий для синхронного и асинхронного запроса)"""
+        if content_type.find('application/json') == -1:
+            logger.error(f"Heleket вернул не JSON: {text}")
+            return None
+        
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError:
+            logger.error(f"Ошибка парсинга JSON от Heleket: {text}")
+            return None
+        
+        if status_code >= 400:
+            logger.error(f"Heleket API {endpoint} вернул статус {status_code}: {data}")
+            return None
+        
+        # Heleket возвращает state=0 при успехе
+        if isinstance(data, dict) and data.get('state') == 0:
+            return data
+        
+        logger.error(f"Heleket API вернул ошибку: {data}")
+        return None
+    
+    def _request(self, endpoint: str, payload: Dict[str, Any]) -> Optional[Dict]:
+        """Выполнить запрос к Heleket API"""
+        if not self.is_configured:
+            logger.error("Heleket не настроен: отсутствуют MERCHANT или API_KEY")
+            return None
         
+        url, body, headers = self._signed_request(endpoint, payload)
         try:
             response = requests.post(
                 url,
-                data=body.encode('utf-8'),
+                data=body,
                 headers=headers,
                 timeout=30
             )
-            
-            if response.headers.get('Content-Type', '').find('application/json') == -1:
-                logger.error(f"Heleket вернул не JSON: {response.text}")
-                return None
-            
-            try:
-                data = response.json()
-            except json.JSONDecodeError:
-                logger.error(f"Ошибка парсинга JSON от Heleket: {response.text}")
-                return None
-            
-            if response.status_code >= 400:
-                logger.error(f"Heleket API {endpoint} вернул статус {response.status_code}: {data}")
-                return None
-            
-            # Heleket возвращает state=0 при успехе
-            if isinstance(data, dict) and data.get('state') == 0:
-                return data
-            
-            logger.error(f"Heleket API вернул ошибку: {data}")
-            return None
-            
+            return self._parse_response(endpoint, response.status_code,
+                                        response.headers.get('Content-Type', ''), response.text)
         except requests.exceptions.RequestException as e:
             logger.error(f"Ошибка запроса к Heleket API: {e}")
             return None
     
-    def create_payment(self, amount: float, user_id: int, 
-                      currency: str = 'RUB',
-                      to_currency: str = None,
-                      network: str = None) -> Optional[Dict]:
-        """Создать криптоплатеж через Heleket
-        
-        Args:
-            amount: Сумма в рублях
-            user_id: ID пользователя
-            currency: Валюта счета (RUB)
-            to_currency: Криптовалюта (USDT, BTC, ETH и т.д.)
-            network: Сеть блокчейна (tron, ethereum, bitcoin и т.д.)
-        """
+    async def _request_async(self, session: aiohttp.ClientSession, endpoint: str,
+                             payload: Dict[str, Any]) -> Optional[Dict]:
+        """Выполнить запрос к Heleket API через общую сессию aiohttp"""
         if not self.is_configured:
+            logger.error("Heleket не настроен: отсутствуют MERCHANT или API_KEY")
             return None
         
+        url, body, headers = self._signed_request(endpoint, payload)
+        try:
+            async with session.post(url, data=body, headers=headers,
+                                    timeout=aiohttp.ClientTimeout(total=30)) as response:
+                return self._parse_response(endpoint, response.status,
+                                            response.headers.get('Content-Type', ''), await response.text())
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка запроса к Heleket API: {e}")
+            return None
+    
+    def _payment_payload(self, amount: float, user_id: int, currency: str,
+                         to_currency: str, network: str) -> Dict[str, Any]:
+        """Тело запроса на создание платежа"""
         order_id = f"heleket_{user_id}_{int(time.time())}_{secrets.token_hex(3)}"
         
         payload: Dict[str, Any] = {
@@ -162,9 +175,11 @@ class HeleketAPI:
             payload['url_return'] = HELEKET_RETURN_URL
         if HELEKET_SUCCESS_URL:
             payload['url_success'] = HELEKET_SUCCESS_URL
-        
-        result = self._request('v1/payment', payload)
-        
+        return payload
+    
+    def _payment_result(self, result: Optional[Dict], amount: float, user_id: int,
+                        order_id: str) -> Optional[Dict]:
+        """Данные созданного платежа из ответа Heleket"""
         if not result:
             return None
         
@@ -209,6 +224,37 @@ class HeleketAPI:
             'exchange_rate': exchange_rate_value
         }
     
+    def create_payment(self, amount: float, user_id: int, 
+                      currency: str = 'RUB',
+                      to_currency: str = None,
+                      network: str = None) -> Optional[Dict]:
+        """Создать криптоплатеж через Heleket
+        
+        Args:
+            amount: Сумма в рублях
+            user_id: ID пользователя
+            currency: Валюта счета (RUB)
+            to_currency: Криптовалюта (USDT, BTC, ETH и т.д.)
+            network: Сеть блокчейна (tron, ethereum, bitcoin и т.д.)
+        """
+        if not self.is_configured:
+            return None
+        
+        payload = self._payment_payload(amount, user_id, currency, to_currency, network)
+        result = self._request('v1/payment', payload)
+        return self._payment_result(result, amount, user_id, payload['order_id'])
+    
+    async def create_payment_async(self, session: aiohttp.ClientSession, amount: float, user_id: int,
+                                   currency: str = 'RUB', to_currency: str = None,
+                                   network: str = None) -> Optional[Dict]:
+        """Создать криптоплатеж через Heleket (асинхронно, общая сессия aiohttp)"""
+        if not self.is_configured:
+            return None
+        
+        payload = self._payment_payload(amount, user_id, currency, to_currency, network)
+        result = await self._request_async(session, 'v1/payment', payload)
+        return self._payment_result(result, amount, user_id, payload['order_id'])
+    
     def get_payment_info(self, uuid: str = None, order_id: str = None) -> Optional[Dict]:
         """Получить информацию о платеже"""
         if not uuid and not order_id:
@@ -0,0 +1,126 @@
+"""
+Нагрузочный прогон горячих маршрутов API: запросы/с и задержки p50/p95/p99 по маршрутам
+
+    python -m backend.api.loadtest --base-url http://127.0.0.1:8000 --duration 30 --concurrency 32
+    python -m backend.api.loadtest --route user_info --route panel_users --telegram-ids 1000-1999
+
+Запускать против тестового стенда: /api/user/info создает пользователей
+из диапазона --telegram-ids, если их еще нет.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+# Маршрут -> (путь, нужна ли авторизация панели)
+ROUTES = {
+    'user_info': ('/api/user/info?telegram_id={telegram_id}', False),
+    'user_devices': ('/api/user/devices?telegram_id={telegram_id}', False),
+    'user_history': ('/api/user/history?telegram_id={telegram_id}', False),
+    'user_referrals': ('/api/user/referrals?telegram_id={telegram_id}', False),
+    'public_pages': ('/api/public-pages', False),
+    'panel_users': ('/api/panel/users?limit=100', True),
+    'panel_transactions': ('/api/panel/transactions?limit=100', True),
+    'panel_stats_summary': ('/api/panel/stats/summary', True),
+}
+DEFAULT_ROUTES = ['user_info', 'user_devices', 'user_history', 'panel_users', 'panel_stats_summary']
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _request(url: str, headers: Dict[str, str], timeout: float) -> Optional[int]:
+    """Статус ответа или None при сетевой ошибке"""
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except (urllib.error.URLError, OSError):
+        return None
+
+
+def run(base_url: str, routes: List[str], duration: float, concurrency: int,
+        telegram_ids: range, panel_secret: str, timeout: float = 10.0) -> Dict[str, Dict]:
+    """Гонять маршруты по кругу duration секунд в concurrency потоков"""
+    deadline = time.monotonic() + duration
+    lock = threading.Lock()
+    results = {route: {'latencies': [], 'errors': 0, 'statuses': {}} for route in routes}
+
+    def worker(index: int):
+        rng = random.Random(index)
+        position = index
+        while time.monotonic() < deadline:
+            route = routes[position % len(routes)]
+            position += 1
+            path, needs_auth = ROUTES[route]
+            headers = {'Authorization': f'Bearer {panel_secret}'} if needs_auth else {}
+            url = base_url + path.format(telegram_id=rng.choice(telegram_ids))
+            started = time.perf_counter()
+            status = _request(url, headers, timeout)
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                stats = results[route]
+                stats['latencies'].append(elapsed)
+                stats['statuses'][str(status)] = stats['statuses'].get(str(status), 0) + 1
+                if status is None or status >= 500:
+                    stats['errors'] += 1
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    elapsed = time.monotonic() - started
+
+    report = {}
+    for route, stats in results.items():
+        latencies = sorted(stats['latencies'])
+        report[route] = {
+            'requests': len(latencies),
+            'rps': round(len(latencies) / elapsed, 1),
+            'errors': stats['errors'],
+            'statuses': stats['statuses'],
+            'p50_ms': round(_percentile(latencies, 0.50), 2),
+            'p95_ms': round(_percentile(latencies, 0.95), 2),
+            'p99_ms': round(_percentile(latencies, 0.99), 2),
+        }
+    total = sum(route['requests'] for route in report.values())
+    report['total'] = {'requests': total, 'rps': round(total / elapsed, 1), 'seconds': round(elapsed, 1)}
+    return report
+
+
+def _parse_ids(value: str) -> range:
+    start, _, end = value.partition('-')
+    return range(int(start), int(end or start) + 1)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m backend.api.loadtest')
+    parser.add_argument('--base-url', default='http://127.0.0.1:8000')
+    parser.add_argument('--route', action='append', choices=sorted(ROUTES),
+                        help='Маршрут (можно несколько; по умолчанию основные маршруты мини-приложения и панели)')
+    parser.add_argument('--duration', type=float, default=30.0, help='Длительность прогона, секунды')
+    parser.add_argument('--concurrency', type=int, default=32, help='Число параллельных клиентов')
+    parser.add_argument('--telegram-ids', type=_parse_ids, default=_parse_ids('100000-100999'),
+                        help='Диапазон Telegram ID для маршрутов мини-приложения, например 1000-1999')
+    parser.add_argument('--panel-secret', default=os.getenv('PANEL_SECRET', 'change_this_secret'))
+    args = parser.parse_args(argv)
+
+    report = run(args.base_url.rstrip('/'), args.route or DEFAULT_ROUTES, args.duration,
+                 args.concurrency, args.telegram_ids, args.panel_secret)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 1 if any(route.get('errors') for route in report.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,478 @@
+"""
+Логика маршрутов мини-приложения, общая для Flask-сервера (backend/api/server.py)
+и асинхронного сервера (backend/api/async_server.py)
+
+Функции не зависят от веб-фреймворка: принимают разобранные параметры запроса
+и возвращают (тело ответа, HTTP-статус). Синхронные функции работы с БД
+асинхронный сервер выполняет через database.run_async, для платежей и подписок
+есть асинхронные варианты, которые ходят в платежные системы через aiohttp.
+Подписка создается в Remnawave фоновой очередью (backend/core/provisioning.py).
+"""
+import os
+import logging
+from datetime import datetime
+from typing import Optional, Dict, Any, Tuple
+from backend.database import database
+from backend.core import abuse_detected, provisioning
+from backend.core.whitelist_billing import calculate_whitelist_price
+from backend.api import yookassa, heleket, platega
+
+logger = logging.getLogger(__name__)
+
+Response = Tuple[Any, int]
+
+PAYMENT_METHODS = ('yookassa', 'yookassa_card', 'yookassa_sbp', 'heleket', 'platega_card', 'platega_sbp')
+TRIAL_TRAFFIC_BYTES = int(10 * (1024 ** 3))
+
+# Маппинг типов транзакций для истории
+HISTORY_TYPES = {
+    'deposit': 'deposit',
+    'withdrawal': 'withdrawal',
+    'subscription': 'sub_off',
+    'device_purchase': 'buy_dev',
+    'trial': 'trial'
+}
+MONTHS = ['янв', 'фев', 'мар', 'апр', 'май', 'июн', 'июл', 'авг', 'сен', 'окт', 'ноя', 'дек']
+
+
+# ========== Пользователь ==========
+
+def user_info(telegram_id: Optional[int], username: str = '', first_name: str = '',
+              ref: Optional[int] = None) -> Response:
+    """Создание/загрузка пользователя, реферал, проверка бана и статистика рефералов за один проход"""
+    if not telegram_id:
+        return {'error': 'telegram_id required'}, 400
+    
+    # Нельзя быть своим собственным рефералом
+    if ref == telegram_id:
+        ref = None
+    
+    user = database.bootstrap_user(
+        telegram_id,
+        username or f'user_{telegram_id}',
+        full_name=first_name or None,
+        referrer_telegram_id=ref,
+        referral_limit=25,
+        referral_window_seconds=60,
+        max_banned_keys=abuse_detected.MAX_BANNED_KEYS_FOR_BAN,
+    )
+    if not user:
+        return {'error': 'Failed to create user'}, 500
+    
+    # Проверка бана
+    if user.get('is_banned'):
+        reason = 'Аккаунт заблокирован из-за превышения лимита забаненных ключей (3+)' if user['newly_banned'] else 'Account banned'
+        return {'banned': True, 'reason': reason}, 403
+    
+    partner_rate = user.get('partner_rate', 20)
+    referral_earned = (user.get('referrals_spent') or 0) * partner_rate / 100
+
+    return {
+        'id': user['id'],
+        'telegram_id': user['telegram_id'],
+        'username': user.get('username'),
+        'full_name': user.get('full_name'),  # First name из Telegram
+        'balance': user.get('balance', 0),
+        'status': user.get('status', 'Trial'),
+        'referral_code': user.get('referral_code'),
+        'partner_balance': user.get('partner_balance', 0),
+        'referrals_count': user.get('referrals_count', 0),
+        'referral_earned': referral_earned,
+        'referral_rate': partner_rate,
+        'is_new_user': user['is_new_user'],
+        'trial_used': user.get('trial_used', 0),  # Был ли использован пробный период
+    }, 200
+
+
+def _parse_date(value) -> Optional[datetime]:
+    if isinstance(value, str):
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return value
+
+
+def user_devices(telegram_id: Optional[int]) -> Response:
+    """Активные устройства пользователя с ключами"""
+    if not telegram_id:
+        return {'error': 'telegram_id required'}, 400
+    
+    with database.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
+        user = cursor.fetchone()
+        if not user:
+            return {'error': 'User not found'}, 404
+        
+        cursor.execute("""
+            SELECT d.id, d.name, d.platform, d.added_date, d.is_active,
+                   vk.key_config, vk.key_uuid, vk.status as key_status
+            FROM devices d
+            LEFT JOIN vpn_keys vk ON d.vpn_key_id = vk.id
+            WHERE d.user_id = ? AND d.is_active = 1
+            ORDER BY d.added_date DESC
+        """, (user['id'],))
+        rows = cursor.fetchall()
+    
+    devices = []
+    for row in rows:
+        added_date = row['added_date']
+        if added_date:
+            try:
+                added_formatted = _parse_date(added_date).strftime('%d.%m.%Y')
+            except (ValueError, AttributeError):
+                added_formatted = str(added_date)[:10]
+        else:
+            added_formatted = datetime.now().strftime('%d.%m.%Y')
+        
+        devices.append({
+            'id': row['id'],
+            'name': row['name'] or 'Устройство',
+            'type': row['platform'] or 'unknown',
+            'added': added_formatted,
+            'key_config': row['key_config'],
+            'key_uuid': row['key_uuid'],
+            'key_status': row['key_status']
+        })
+    return devices, 200
+
+
+def user_history(telegram_id: Optional[int]) -> Response:
+    """Последние 100 транзакций пользователя"""
+    if not telegram_id:
+        return {'error': 'telegram_id required'}, 400
+    
+    with database.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM users WHERE telegram_id = ?", (telegram_id,))
+        user = cursor.fetchone()
+        if not user:
+            return {'error': 'User not found'}, 404
+        
+        cursor.execute("""
+            SELECT id, type, amount, description, created_at, status, payment_method
+            FROM transactions
+            WHERE user_id = ?
+            ORDER BY created_at DESC
+            LIMIT 100
+        """, (user['id'],))
+        rows = cursor.fetchall()
+    
+    history = []
+    for row in rows:
+        title_map = {
+            'deposit': f'Пополнение баланса ({row["payment_method"] or ""})',
+            'withdrawal': 'Вывод средств',
+            'subscription': 'Списание за подписку',
+            'device_purchase': 'Покупка устройства',
+            'trial': 'Активация пробного периода'
+        }
+        
+        trans_type = HISTORY_TYPES.get(row['type'], row['type'])
+        title = row['description'] or title_map.get(row['type'], row['type'])
+        
+        # Форматирование даты (месяцы на русском)
+        date_str = row['created_at']
+        if date_str:
+            try:
+                dt = _parse_date(date_str)
+                date_formatted = f"{dt.day} {MONTHS[dt.month - 1]} {dt.year}"
+            except (ValueError, AttributeError):
+                date_formatted = str(date_str)[:10]
+        else:
+            date_formatted = datetime.now().strftime('%d %b %Y')
+        
+        history.append({
+            'id': row['id'],
+            'type': trans_type,
+            'title': title,
+            'amount': float(row['amount']),
+            'date': date_formatted
+        })
+    return history, 200
+
+
+# ========== Платежи ==========
+
+def prepare_payment(data: Dict[str, Any]) -> Response:
+    """Проверка запроса на платеж: (параметры платежа, 200) или (ошибка, статус)"""
+    user_id = data.get('user_id')
+    amount = data.get('amount')
+    method = data.get('method')  # 'yookassa', 'yookassa_sbp', 'heleket', 'platega_card', 'platega_sbp'
+    
+    if not user_id or not amount or not method:
+        return {'error': 'Missing required fields'}, 400
+    
+    if not database.get_user_by_id(user_id):
+        return {'error': 'User not found'}, 404
+    
+    if method not in PAYMENT_METHODS:
+        return {'error': f'Unknown payment method: {method}'}, 400
+    
+    metadata = {'user_id': str(user_id)}
+    if method != 'yookassa_sbp' and data.get('subscription_id'):
+        metadata['subscription_id'] = str(data.get('subscription_id'))
+    return {
+        'user_id': user_id,
+        'amount': amount,
+        'method': method,
+        'metadata': metadata,
+        'return_url': f"{os.getenv('MINIAPP_URL', '')}/success",
+        'save_payment_method': data.get('save_payment_method', False),
+        'payment_method_id': data.get('payment_method_id'),  # Для автоплатежа
+    }, 200
+
+
+def payment_response(method: str, payment: Optional[Dict[str, Any]]) -> Response:
+    """Ответ мини-приложению по созданному платежу"""
+    if not payment:
+        return {'error': 'Payment creation failed'}, 500
+    
+    if method in ('yookassa', 'yookassa_card', 'yookassa_sbp'):
+        result = {
+            'payment_id': payment['id'],
+            'confirmation_url': payment.get('confirmation_url'),
+            'payment_url': payment.get('confirmation_url'),
+            'status': payment['status']
+        }
+        # Если способ оплаты сохранен, возвращаем его ID
+        if method != 'yookassa_sbp' and payment.get('payment_method_saved'):
+            result['payment_method_id'] = payment.get('payment_method_id')
+            result['card_last4'] = payment.get('card_last4')
+        return result, 200
+    
+    if method == 'heleket':
+        return {
+            'payment_id': payment.get('uuid') or payment.get('order_id'),
+            'payment_url': payment.get('payment_url'),
+            'status': payment.get('status', 'pending'),
+            'payer_amount': payment.get('payer_amount'),
+            'payer_currency': payment.get('payer_currency')
+        }, 200
+    
+    return {
+        'payment_id': payment.get('id'),
+        'payment_url': payment.get('redirect_url'),
+        'status': payment.get('status', 'pending')
+    }, 200
+
+
+def _create_provider_payment(params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    method, amount, user_id = params['method'], params['amount'], params['user_id']
+    if method in ('yookassa', 'yookassa_card'):
+        # Банковская карта через YooKassa
+        return yookassa.yookassa_api.create_payment(
+            amount, "Пополнение баланса BlinVPN", params['return_url'], user_id,
+            metadata=params['metadata'],
+            save_payment_method=params['save_payment_method'],
+            payment_method_id=params['payment_method_id'],
+            payment_type='bank_card'
+        )
+    if method == 'yookassa_sbp':
+        return yookassa.yookassa_api.create_sbp_payment(
+            amount, "Пополнение баланса BlinVPN (СБП)", params['return_url'], user_id,
+            metadata=params['metadata']
+        )
+    if method == 'heleket':
+        return heleket.heleket_api.create_payment(amount, user_id)
+    if method == 'platega_card':
+        return platega.platega_api.create_card_payment(amount, user_id)
+    return platega.platega_api.create_sbp_payment(amount, user_id)
+
+
+async def _create_provider_payment_async(session, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    method, amount, user_id = params['method'], params['amount'], params['user_id']
+    if method in ('yookassa', 'yookassa_card', 'yookassa_sbp'):
+        sbp = method == 'yookassa_sbp'
+        return await yookassa.yookassa_api.create_payment_async(
+            session, amount, "Пополнение баланса BlinVPN (СБП)" if sbp else "Пополнение баланса BlinVPN",
+            params['return_url'], user_id,
+            metadata=params['metadata'],
+            save_payment_method=False if sbp else params['save_payment_method'],
+            payment_method_id=None if sbp else params['payment_method_id'],
+            payment_type='sbp' if sbp else 'bank_card'
+        )
+    if method == 'heleket':
+        return await heleket.heleket_api.create_payment_async(session, amount, user_id)
+    return await platega.platega_api.create_payment_async(
+        session, amount, user_id,
+        payment_method=platega.PLATEGA_METHOD_CARD if method == 'platega_card' else platega.PLATEGA_METHOD_SBP
+    )
+
+
+def create_payment(data: Dict[str, Any]) -> Response:
+    """Создать платеж у провайдера"""
+    params, status = prepare_payment(data)
+    if status != 200:
+        return params, status
+    try:
+        payment = _create_provider_payment(params)
+    except Exception as e:
+        logger.error(f"Payment creation error for method {params['method']}: {e}")
+        payment = None
+    return payment_response(params['method'], payment)
+
+
+async def create_payment_async(data: Dict[str, Any], session) -> Response:
+    """Создать платеж у провайдера через общую сессию aiohttp"""
+    params, status = await database.run_async(prepare_payment, data)
+    if status != 200:
+        return params, status
+    try:
+        payment = await _create_provider_payment_async(session, params)
+    except Exception as e:
+        logger.error(f"Payment creation error for method {params['method']}: {e}")
+        payment = None
+    return payment_response(params['method'], payment)
+
+
+# ========== Подписки ==========
+
+def prepare_subscription(data: Dict[str, Any]) -> Response:
+    """Проверка запроса на подписку и расчет цены: (план, 200) или (ошибка, статус)"""
+    user_id = data.get('user_id')
+    days = data.get('days')
+    plan_type = data.get('type')  # 'vpn' or 'whitelist'
+    whitelist_gb = data.get('whitelist_gb', 0)  # Для whitelist подписки
+    is_trial = data.get('is_trial', False)  # Пробный период
+    
+    if not user_id or not days:
+        return {'error': 'Missing required fields'}, 400
+    
+    user = database.get_user_by_id(user_id)
+    if not user:
+        return {'error': 'User not found'}, 404
+    
+    # Проверка пробного периода
+    if is_trial:
+        if user.get('trial_used', 0) == 1:
+            return {'error': 'Пробный период уже использован'}, 400
+        # Триальные настройки
+        days = 1
+        price = 0
+    elif plan_type == 'whitelist':
+        # Рассчитываем цену для whitelist
+        if whitelist_gb < 5 or whitelist_gb > 500:
+            return {'error': 'Whitelist GB must be between 5 and 500'}, 400
+        price = calculate_whitelist_price(whitelist_gb)
+    else:
+        # VPN подписка - используем фиксированные цены из планов
+        price = data.get('price', days * 3.3)
+    
+    if is_trial:
+        # Пробный период - 10 ГБ трафика
+        traffic_limit, subscription_plan = TRIAL_TRAFFIC_BYTES, 'vpn'
+    elif plan_type == 'whitelist':
+        # Для whitelist - лимит трафика по выбору пользователя
+        traffic_limit, subscription_plan = int(whitelist_gb * (1024 ** 3)), 'whitelist'
+    else:
+        # Обычный VPN - безлимитный трафик (0 = unlimited)
+        traffic_limit, subscription_plan = 0, 'vpn'
+    
+    return {
+        'user_id': user_id,
+        'telegram_id': user['telegram_id'],
+        'username': user.get('username', ''),
+        'days': days,
+        'price': price,
+        'plan_type': plan_type,
+        'subscription_plan': subscription_plan,
+        'traffic_limit': traffic_limit,
+        'whitelist_gb': whitelist_gb,
+        'is_trial': is_trial,
+        # Автоплатеж с сохраненного способа оплаты (только whitelist)
+        'auto_pay': bool(data.get('use_auto_pay') and data.get('payment_method_id') and plan_type == 'whitelist'),
+        'payment_method_id': data.get('payment_method_id'),
+    }, 200
+
+
+def _auto_pay_args(plan: Dict[str, Any]) -> Tuple[tuple, Dict[str, Any]]:
+    """Аргументы автоплатежа YooKassa за whitelist подписку"""
+    args = (
+        plan['price'],
+        f"Автоплатеж: Whitelist подписка ({plan['days']} дней, {plan['whitelist_gb']} ГБ)",
+        f"{os.getenv('MINIAPP_URL')}/success",
+        plan['user_id'],
+    )
+    kwargs = {
+        'metadata': {'user_id': str(plan['user_id']), 'subscription_type': 'whitelist',
+                     'days': plan['days'], 'whitelist_gb': plan['whitelist_gb']},
+        'payment_method_id': plan['payment_method_id'],
+    }
+    return args, kwargs
+
+
+def _subscription_description(plan: Dict[str, Any]) -> str:
+    if plan['is_trial']:
+        return "Активация пробного периода (1 день)"
+    description = f"{'Whitelist' if plan['plan_type'] == 'whitelist' else 'VPN'} подписка ({plan['days']} дней)"
+    if plan['plan_type'] == 'whitelist':
+        description += f" - {plan['whitelist_gb']} ГБ"
+    return description
+
+
+def enqueue_subscription(plan: Dict[str, Any], payment_source: str = None) -> Response:
+    """Списать оплату и поставить создание подписки в очередь; клиент опрашивает /api/subscription/status"""
+    if payment_source is None:
+        payment_source = provisioning.SOURCE_TRIAL if plan['is_trial'] else provisioning.SOURCE_BALANCE
+    try:
+        job_id = provisioning.enqueue(
+            plan['user_id'], plan['telegram_id'], plan['username'], plan['days'],
+            plan_type=plan['subscription_plan'],
+            traffic_limit=plan['traffic_limit'],
+            price=plan['price'],
+            payment_source=payment_source,
+            description=_subscription_description(plan),
+        )
+    except provisioning.ProvisioningError as e:
+        return {'error': str(e)}, 400
+    return {'success': True, 'job_id': job_id, 'status': 'pending'}, 202
+
+
+def create_subscription(data: Dict[str, Any]) -> Response:
+    """Создать подписку: списание с баланса (или автоплатеж) и задача в очереди provisioning"""
+    plan, status = prepare_subscription(data)
+    if status != 200:
+        return plan, status
+    
+    if plan['auto_pay']:
+        args, kwargs = _auto_pay_args(plan)
+        payment = yookassa.yookassa_api.create_payment(*args, **kwargs)
+        if not payment or payment.get('status') != 'succeeded':
+            return {'error': 'Auto payment failed'}, 400
+        # Платеж успешен, создаем подписку
+        return enqueue_subscription(plan, provisioning.SOURCE_AUTO_PAY)
+    return enqueue_subscription(plan)
+
+
+async def create_subscription_async(data: Dict[str, Any], session) -> Response:
+    """Создать подписку без блокировки цикла событий (автоплатеж YooKassa через aiohttp)"""
+    plan, status = await database.run_async(prepare_subscription, data)
+    if status != 200:
+        return plan, status
+    
+    if plan['auto_pay']:
+        args, kwargs = _auto_pay_args(plan)
+        payment = await yookassa.yookassa_api.create_payment_async(session, *args, **kwargs)
+        if not payment or payment.get('status') != 'succeeded':
+            return {'error': 'Auto payment failed'}, 400
+        return await database.run_async(enqueue_subscription, plan, provisioning.SOURCE_AUTO_PAY)
+    return await database.run_async(enqueue_subscription, plan)
+
+
+def subscription_status(job_id: Optional[int], user_id: Optional[int], wait: float = 0) -> Response:
+    """Статус создания подписки; wait > 0 - ждать завершения задачи (long polling)"""
+    if not job_id or not user_id:
+        return {'error': 'job_id and user_id required'}, 400
+    job = provisioning.wait_for_job(job_id, user_id, wait)
+    if not job:
+        return {'error': 'Job not found'}, 404
+    return job, 200
+
+
+async def subscription_status_async(job_id: Optional[int], user_id: Optional[int], wait: float = 0) -> Response:
+    """Статус создания подписки без блокировки цикла событий"""
+    if not job_id or not user_id:
+        return {'error': 'job_id and user_id required'}, 400
+    job = await provisioning.wait_for_job_async(job_id, user_id, wait)
+    if not job:
+        return {'error': 'Job not found'}, 404
+    return job, 200
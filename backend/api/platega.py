@@ -3,7 +3,9 @@ API модуль для работы с Platega
 Интеграция платежной системы Platega для банковских карт и СБП
 """
 import os
+import asyncio
 import requests
+import aiohttp
 import logging
 import hmac
 import hashlib
@@ -59,6 +61,14 @@ class PlategaAPI:
         ).hexdigest()
         return signature
     
+    def _headers(self, data: Dict) -> Dict[str, str]:
+        """Заголовки с подписью запроса"""
+        return {
+            'Merchant-ID': self.merchant_id,
+            'Signature': self._generate_signature(data),
+            'Content-Type': 'application/json'
+        }
+    
     def _request(self, method: str, endpoint: str, data: Dict = None) -> Optional[Dict]:
         """Базовый метод для выполнения запросов"""
         if not self.is_configured:
@@ -69,12 +79,7 @@ class PlategaAPI:
         data = data or {}
         
         try:
-            signature = self._generate_signature(data)
-            headers = {
-                'Merchant-ID': self.merchant_id,
-                'Signature': signature,
-                'Content-Type': 'application/json'
-            }
+            headers = self._headers(data)
             
             if method == 'POST':
                 response = requests.post(url, headers=headers, json=data, timeout=30)
@@ -91,19 +96,31 @@ class PlategaAPI:
                 logger.error(f"Response: {e.response.text}")
             return None
     
-    def create_payment(self, amount: float, user_id: int, description: str = None,
-                      payment_method: int = PLATEGA_METHOD_CARD) -> Optional[Dict]:
-        """Создать платеж через Platega
-        
-        Args:
-            amount: Сумма платежа в рублях
-            user_id: ID пользователя
-            description: Описание платежа
-            payment_method: Метод оплаты (0 - карта, 1 - СБП)
-        """
+    async def _request_async(self, session: aiohttp.ClientSession, method: str, endpoint: str,
+                             data: Dict = None) -> Optional[Dict]:
+        """Запрос к Platega через общую сессию aiohttp"""
         if not self.is_configured:
+            logger.error("Platega не настроен: отсутствуют MERCHANT_ID или SECRET_KEY")
             return None
-            
+        
+        url = f"{self.base_url}{endpoint}"
+        data = data or {}
+        kwargs = {'json': data} if method == 'POST' else {'params': data}
+        try:
+            async with session.request(method, url, headers=self._headers(data),
+                                       timeout=aiohttp.ClientTimeout(total=30), **kwargs) as response:
+                text = await response.text()
+                if response.status >= 400:
+                    logger.error(f"Platega API error: HTTP {response.status}")
+                    logger.error(f"Response: {text}")
+                    return None
+                return json.loads(text) if text else None
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.error(f"Platega API error: {e}")
+            return None
+    
+    def _payment_data(self, amount: float, user_id: int, description: str, payment_method: int) -> Dict:
+        """Тело запроса на создание платежа"""
         # Platega принимает сумму в копейках
         amount_kopeks = int(amount * 100)
         
@@ -125,23 +142,52 @@ class PlategaAPI:
             data['failed_url'] = self.failed_url
         if self.callback_url:
             data['callback_url'] = self.callback_url
-        
-        result = self._request('POST', '/api/v1/payments', data)
-        
+        return data
+    
+    def _payment_result(self, result: Optional[Dict], data: Dict, amount: float, user_id: int) -> Optional[Dict]:
+        """Данные созданного платежа из ответа Platega"""
         if result:
             logger.info(f"Platega платеж создан для пользователя {user_id} на сумму {amount}₽")
             return {
                 'id': result.get('transactionId') or result.get('id'),
                 'redirect_url': result.get('redirect'),
                 'status': str(result.get('status', 'PENDING')).upper(),
-                'correlation_id': correlation_id,
-                'payload': payload_token,
+                'correlation_id': data['payload'].replace('platega:', '', 1),
+                'payload': data['payload'],
                 'amount': amount,
-                'amount_kopeks': amount_kopeks
+                'amount_kopeks': data['amount']
             }
         
         return None
     
+    def create_payment(self, amount: float, user_id: int, description: str = None,
+                      payment_method: int = PLATEGA_METHOD_CARD) -> Optional[Dict]:
+        """Создать платеж через Platega
+        
+        Args:
+            amount: Сумма платежа в рублях
+            user_id: ID пользователя
+            description: Описание платежа
+            payment_method: Метод оплаты (0 - карта, 1 - СБП)
+        """
+        if not self.is_configured:
+            return None
+        
+        data = self._payment_data(amount, user_id, description, payment_method)
+        result = self._request('POST', '/api/v1/payments', data)
+        return self._payment_result(result, data, amount, user_id)
+    
+    async def create_payment_async(self, session: aiohttp.ClientSession, amount: float, user_id: int,
+                                   description: str = None,
+                                   payment_method: int = PLATEGA_METHOD_CARD) -> Optional[Dict]:
+        """Создать платеж через Platega (асинхронно, общая сессия aiohttp)"""
+        if not self.is_configured:
+            return None
+        
+        data = self._payment_data(amount, user_id, description, payment_method)
+        result = await self._request_async(session, 'POST', '/api/v1/payments', data)
+        return self._payment_result(result, data, amount, user_id)
+    
     def create_card_payment(self, amount: float, user_id: int, description: str = None) -> Optional[Dict]:
         """Создать платеж банковской картой"""
         return self.create_payment(amount, user_id, description, PLATEGA_METHOD_CARD)
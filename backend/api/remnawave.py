@@ -8,8 +8,10 @@ import asyncio
 import json
 import ssl
 import base64 
+import threading
+import concurrent.futures
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Union, Any
+from typing import Dict, List, Optional, Union, Any, Callable, Awaitable
 import aiohttp
 import logging
 from dataclasses import dataclass
@@ -18,6 +20,15 @@ from urllib.parse import urlparse, urljoin
 
 logger = logging.getLogger(__name__)
 
+# Пул соединений долгоживущей сессии (см. RemnawaveClientLoop)
+REMWAVE_POOL_LIMIT = int(os.getenv('REMWAVE_POOL_LIMIT', '50'))
+REMWAVE_POOL_LIMIT_PER_HOST = int(os.getenv('REMWAVE_POOL_LIMIT_PER_HOST', '20'))
+REMWAVE_KEEPALIVE_TIMEOUT = float(os.getenv('REMWAVE_KEEPALIVE_TIMEOUT', '60'))
+REMWAVE_CALL_TIMEOUT = float(os.getenv('REMWAVE_CALL_TIMEOUT', '60'))
+# Массовые операции (все страницы, тысячи обновлений) - 0: без общего лимита,
+# каждый запрос внутри ограничен таймаутом сессии
+REMWAVE_BULK_CALL_TIMEOUT = float(os.getenv('REMWAVE_BULK_CALL_TIMEOUT', '0'))
+
 
 class UserStatus(Enum):
     ACTIVE = "ACTIVE"
@@ -185,7 +196,9 @@ class RemnaWaveAPI:
 
         return headers
         
-    async def __aenter__(self):
+    async def open(self, limit: int = 100, limit_per_host: int = 0,
+                   keepalive_timeout: float = 15.0) -> 'RemnaWaveAPI':
+        """Создать сессию с пулом соединений (keep-alive, лимиты на хост)"""
         conn_type = self._detect_connection_type()
         
         logger.debug(f"Подключение к Remnawave: {self.base_url} (тип: {conn_type})")
@@ -202,7 +215,11 @@ class RemnaWaveAPI:
                 cookies = {self.secret_key: self.secret_key}
                 logger.debug(f"Используем куки: {self.secret_key}=***")
         
-        connector_kwargs = {}
+        connector_kwargs = {
+            'limit': limit,
+            'limit_per_host': limit_per_host,
+            'keepalive_timeout': keepalive_timeout,
+        }
         
         if conn_type == "local":
             logger.debug("Используют локальные заголовки proxy")
@@ -237,10 +254,18 @@ class RemnaWaveAPI:
         self.authenticated = True 
                 
         return self
-        
-    async def __aexit__(self, exc_type, exc_val, exc_tb):
+    
+    async def close(self):
         if self.session:
             await self.session.close()
+            self.session = None
+            self.authenticated = False
+        
+    async def __aenter__(self):
+        return await self.open()
+        
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
             
     async def _make_request(
         self, 
@@ -406,6 +431,88 @@ class RemnaWaveAPI:
             'total': response['response']['total']
         }
     
+    async def _fetch_all_pages(self, extract: Callable[[List[Dict]], Any], page_size: int,
+                               concurrency: int) -> Dict[str, Any]:
+        """
+        Загрузить все страницы /api/users: первая страница дает total,
+        остальные загружаются параллельно (не более concurrency запросов).
+        extract вызывается для сырого списка пользователей каждой страницы.
+        """
+        async def fetch_page(start: int) -> Dict:
+            response = await self._make_request('GET', '/api/users', params={'start': start, 'size': page_size})
+            return response['response']
+        
+        first_page = await fetch_page(0)
+        total = first_page.get('total', 0)
+        extract(first_page.get('users', []))
+        
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def collect(start: int):
+            async with semaphore:
+                page = await fetch_page(start)
+            extract(page.get('users', []))
+        
+        starts = range(page_size, total, page_size)
+        await asyncio.gather(*(collect(start) for start in starts))
+        return {'total': total, 'pages': len(starts) + 1}
+    
+    async def get_all_user_uuids(self, page_size: int = 100, concurrency: int = 8) -> Dict[str, Any]:
+        """UUID всех пользователей без разбора полных объектов"""
+        uuids = set()
+        result = await self._fetch_all_pages(
+            lambda users: uuids.update(user['uuid'] for user in users), page_size, concurrency
+        )
+        return {'uuids': uuids, **result}
+    
+    async def get_all_users_concurrently(self, page_size: int = 100, concurrency: int = 8) -> Dict[str, Any]:
+        """Все пользователи (полные объекты) параллельной постраничной загрузкой"""
+        users: List[RemnaWaveUser] = []
+        result = await self._fetch_all_pages(
+            lambda page: users.extend(self._parse_user(user) for user in page), page_size, concurrency
+        )
+        return {'users': users, **result}
+    
+    async def _update_users(self, updates: Dict[str, Dict[str, Any]], concurrency: int) -> Dict[str, Optional[str]]:
+        """
+        Параллельно обновить пользователей (не более concurrency запросов одновременно).
+        
+        Args:
+            updates: uuid -> аргументы update_user
+        
+        Returns:
+            Dict uuid -> None при успехе или текст ошибки
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def push(uuid: str, fields: Dict[str, Any]) -> Optional[str]:
+            async with semaphore:
+                try:
+                    await self.update_user(uuid, **fields)
+                    return None
+                except Exception as e:
+                    return str(e) or e.__class__.__name__
+        
+        uuids = list(updates)
+        errors = await asyncio.gather(*(push(uuid, updates[uuid]) for uuid in uuids))
+        return dict(zip(uuids, errors))
+    
+    async def set_traffic_limits(self, limits: Dict[str, int], concurrency: int = 8) -> Dict[str, Optional[str]]:
+        """Параллельно обновить лимиты трафика пользователей (uuid -> None или текст ошибки)"""
+        return await self._update_users(
+            {uuid: {'traffic_limit_bytes': limit} for uuid, limit in limits.items()}, concurrency
+        )
+    
+    async def set_expire_dates(self, expiries: Dict[str, datetime], concurrency: int = 8) -> Dict[str, Optional[str]]:
+        """Параллельно обновить сроки действия пользователей (uuid -> None или текст ошибки)"""
+        return await self._update_users(
+            {uuid: {'expire_at': expire_at} for uuid, expire_at in expiries.items()}, concurrency
+        )
+    
+    async def disable_users(self, uuids: List[str], concurrency: int = 8) -> Dict[str, Optional[str]]:
+        """Параллельно отключить пользователей (uuid -> None или текст ошибки)"""
+        return await self._update_users({uuid: {'status': UserStatus.DISABLED} for uuid in uuids}, concurrency)
+    
     def _parse_user(self, user_data: Dict) -> RemnaWaveUser:
         status_str = user_data.get('status') or 'ACTIVE'
         try:
@@ -516,61 +623,131 @@ def sanitize_remnawave_username(username: str, telegram_id: int) -> str:
     return sanitized
 
 
+class RemnawaveClientLoop:
+    """
+    Фоновый цикл событий с одной долгоживущей сессией RemnaWaveAPI.
+    
+    Синхронный код передает корутины в цикл через run_coroutine_threadsafe,
+    поэтому соединения (и TLS) переиспользуются между вызовами. Цикл запускается
+    при первом вызове и пересоздается в дочернем процессе после fork.
+    """
+    
+    def __init__(self, api_factory: Callable[[], RemnaWaveAPI] = get_remnawave_api):
+        self._api_factory = api_factory
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._api: Optional[RemnaWaveAPI] = None
+        self._pid: Optional[int] = None
+    
+    def _run_loop(self, loop: asyncio.AbstractEventLoop, ready: threading.Event):
+        asyncio.set_event_loop(loop)
+        loop.call_soon(ready.set)
+        loop.run_forever()
+    
+    def _ensure_started(self) -> asyncio.AbstractEventLoop:
+        if self._loop is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return self._loop
+        with self._lock:
+            if self._loop is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return self._loop
+            
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+            thread = threading.Thread(target=self._run_loop, args=(loop, ready),
+                                      name='remnawave-loop', daemon=True)
+            thread.start()
+            ready.wait()
+            
+            api = self._api_factory()
+            asyncio.run_coroutine_threadsafe(api.open(
+                limit=REMWAVE_POOL_LIMIT,
+                limit_per_host=REMWAVE_POOL_LIMIT_PER_HOST,
+                keepalive_timeout=REMWAVE_KEEPALIVE_TIMEOUT,
+            ), loop).result()
+            
+            self._loop, self._thread, self._api, self._pid = loop, thread, api, os.getpid()
+            logger.info(f"Remnawave client loop started (limit={REMWAVE_POOL_LIMIT}, per_host={REMWAVE_POOL_LIMIT_PER_HOST})")
+            return loop
+    
+    def run(self, call: Callable[[RemnaWaveAPI], Awaitable], timeout: float = None):
+        """
+        Выполнить call(api) в фоновом цикле и дождаться результата.
+        
+        Args:
+            timeout: Секунд ожидания (None - REMWAVE_CALL_TIMEOUT, 0 - без ограничения);
+                     по истечении корутина отменяется, чтобы запросы не продолжались в фоне
+        """
+        if self._thread is not None and threading.current_thread() is self._thread:
+            raise RuntimeError("RemnawaveClientLoop.run() нельзя вызывать из самого цикла")
+        loop = self._ensure_started()
+        future = asyncio.run_coroutine_threadsafe(call(self._api), loop)
+        if timeout is None:
+            timeout = REMWAVE_CALL_TIMEOUT
+        try:
+            return future.result(timeout or None)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+    
+    def close(self, timeout: float = 5.0):
+        """Закрыть сессию и остановить цикл"""
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                self._loop = self._thread = self._api = None
+                return
+            loop, thread, api = self._loop, self._thread, self._api
+            self._loop = self._thread = self._api = None
+        try:
+            asyncio.run_coroutine_threadsafe(api.close(), loop).result(timeout)
+        except Exception as e:
+            logger.warning(f"Ошибка закрытия сессии Remnawave: {e}")
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout)
+
+
 class RemnawaveAPI:
     """Обёртка для синхронного использования"""
     
     def __init__(self):
-        self._api = get_remnawave_api()
+        self._client = RemnawaveClientLoop(get_remnawave_api)
     
     def create_user(self, telegram_id: int, username: str = None, email: str = None):
         """Создать пользователя (синхронная обёртка)"""
         # Санитизируем username
         safe_username = sanitize_remnawave_username(username, telegram_id)
-        
-        async def _create():
-            async with self._api as api:
-                expire_at = datetime.now() + timedelta(days=30)
-                return await api.create_user(
-                    safe_username,
-                    expire_at,
-                    telegram_id=telegram_id,
-                    email=email
-                )
-        return asyncio.run(_create())
+        expire_at = datetime.now() + timedelta(days=30)
+        return self._client.run(lambda api: api.create_user(
+            safe_username,
+            expire_at,
+            telegram_id=telegram_id,
+            email=email
+        ))
     
     def get_user_by_telegram_id(self, telegram_id: int):
         """Получить пользователя по Telegram ID (синхронная обёртка)"""
-        async def _get():
-            async with self._api as api:
-                return await api.get_user_by_telegram_id(telegram_id)
-        return asyncio.run(_get())
+        return self._client.run(lambda api: api.get_user_by_telegram_id(telegram_id))
     
     def create_subscription(self, user_uuid: str, days: int, traffic_limit: int = None):
         """Создать подписку (синхронная обёртка)"""
-        async def _create():
-            async with self._api as api:
-                expire_at = datetime.now() + timedelta(days=days)
-                return await api.update_user(
-                    user_uuid,
-                    expire_at=expire_at,
-                    traffic_limit_bytes=traffic_limit
-                )
-        return asyncio.run(_create())
+        expire_at = datetime.now() + timedelta(days=days)
+        return self._client.run(lambda api: api.update_user(
+            user_uuid,
+            expire_at=expire_at,
+            traffic_limit_bytes=traffic_limit
+        ))
     
     def update_user_sync(self, uuid: str, expire_at: datetime = None, 
                         traffic_limit_bytes: int = None, hwid_device_limit: int = None,
                         active_internal_squads: List[str] = None):
         """Обновить пользователя (синхронная обёртка)"""
-        async def _update():
-            async with self._api as api:
-                return await api.update_user(
-                    uuid,
-                    expire_at=expire_at,
-                    traffic_limit_bytes=traffic_limit_bytes,
-                    hwid_device_limit=hwid_device_limit,
-                    active_internal_squads=active_internal_squads
-                )
-        return asyncio.run(_update())
+        return self._client.run(lambda api: api.update_user(
+            uuid,
+            expire_at=expire_at,
+            traffic_limit_bytes=traffic_limit_bytes,
+            hwid_device_limit=hwid_device_limit,
+            active_internal_squads=active_internal_squads
+        ))
     
     def create_user_with_params(self, telegram_id: int, username: str, days: int,
                                traffic_limit_bytes: int = 0, hwid_device_limit: int = None,
@@ -578,40 +755,56 @@ class RemnawaveAPI:
         """Создать пользователя с полными параметрами (синхронная обёртка)"""
         # Санитизируем username
         safe_username = sanitize_remnawave_username(username, telegram_id)
-        
-        async def _create():
-            async with self._api as api:
-                expire_at = datetime.now() + timedelta(days=days)
-                return await api.create_user(
-                    safe_username,
-                    expire_at,
-                    telegram_id=telegram_id,
-                    traffic_limit_bytes=traffic_limit_bytes,
-                    hwid_device_limit=hwid_device_limit,
-                    active_internal_squads=active_internal_squads
-                )
-        return asyncio.run(_create())
+        expire_at = datetime.now() + timedelta(days=days)
+        return self._client.run(lambda api: api.create_user(
+            safe_username,
+            expire_at,
+            telegram_id=telegram_id,
+            traffic_limit_bytes=traffic_limit_bytes,
+            hwid_device_limit=hwid_device_limit,
+            active_internal_squads=active_internal_squads
+        ))
     
     def get_internal_squads(self):
         """Получить список внутренних сквадов (синхронная обёртка)"""
-        async def _get():
-            async with self._api as api:
-                return await api.get_internal_squads()
-        return asyncio.run(_get())
+        return self._client.run(lambda api: api.get_internal_squads())
     
     def delete_user_sync(self, uuid: str) -> bool:
         """Удалить пользователя (синхронная обёртка)"""
-        async def _delete():
-            async with self._api as api:
-                return await api.delete_user(uuid)
-        return asyncio.run(_delete())
+        return self._client.run(lambda api: api.delete_user(uuid))
     
     def get_all_users_sync(self, start: int = 0, size: int = 100):
         """Получить всех пользователей (синхронная обёртка)"""
-        async def _get():
-            async with self._api as api:
-                return await api.get_all_users(start, size)
-        return asyncio.run(_get())
+        return self._client.run(lambda api: api.get_all_users(start, size))
+    
+    def get_all_user_uuids_sync(self, page_size: int = 100, concurrency: int = 8):
+        """Получить UUID всех пользователей параллельной постраничной загрузкой (синхронная обёртка)"""
+        return self._client.run(lambda api: api.get_all_user_uuids(page_size, concurrency),
+                                timeout=REMWAVE_BULK_CALL_TIMEOUT)
+    
+    def get_all_users_concurrently_sync(self, page_size: int = 100, concurrency: int = 8):
+        """Получить всех пользователей параллельной постраничной загрузкой (синхронная обёртка)"""
+        return self._client.run(lambda api: api.get_all_users_concurrently(page_size, concurrency),
+                                timeout=REMWAVE_BULK_CALL_TIMEOUT)
+    
+    def set_traffic_limits_sync(self, limits: Dict[str, int], concurrency: int = 8) -> Dict[str, Optional[str]]:
+        """Параллельно обновить лимиты трафика (синхронная обёртка)"""
+        return self._client.run(lambda api: api.set_traffic_limits(limits, concurrency),
+                                timeout=REMWAVE_BULK_CALL_TIMEOUT)
+    
+    def set_expire_dates_sync(self, expiries: Dict[str, datetime], concurrency: int = 8) -> Dict[str, Optional[str]]:
+        """Параллельно обновить сроки действия (синхронная обёртка)"""
+        return self._client.run(lambda api: api.set_expire_dates(expiries, concurrency),
+                                timeout=REMWAVE_BULK_CALL_TIMEOUT)
+    
+    def disable_users_sync(self, uuids: List[str], concurrency: int = 8) -> Dict[str, Optional[str]]:
+        """Параллельно отключить пользователей (синхронная обёртка)"""
+        return self._client.run(lambda api: api.disable_users(uuids, concurrency),
+                                timeout=REMWAVE_BULK_CALL_TIMEOUT)
+    
+    def close(self):
+        """Закрыть сессию и фоновый цикл"""
+        self._client.close()
 
 
 # Глобальный экземпляр для обратной совместимости
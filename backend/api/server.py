@@ -4,16 +4,16 @@ REST API сервер для мини-приложения и панели
 import os
 import logging
 from datetime import datetime, timedelta
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 import sys
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
 
-from backend.database import database
-from backend.core import core, abuse_detected
-from backend.core.whitelist_billing import calculate_whitelist_price
-from backend.api import remnawave, yookassa, heleket, platega
+from backend.database import database, pagination, search, export, archive
+from backend.core import core, abuse_detected, stats, scheduler, mailing, reconcile, notifications, provisioning
+from backend.core import whitelist_billing, mass_actions, backups
+from backend.api import remnawave, yookassa, miniapp, happ
 
 app = Flask(__name__)
 
@@ -21,6 +21,7 @@ app = Flask(__name__)
 CORS(
     app,
     resources={r"/api/*": {"origins": "*"}},
+    expose_headers=[pagination.NEXT_CURSOR_HEADER],
 )
 
 logging.basicConfig(level=logging.INFO)
@@ -29,6 +30,17 @@ logger = logging.getLogger(__name__)
 # Секретный ключ для аутентификации панели
 PANEL_SECRET = os.getenv('PANEL_SECRET', 'change_this_secret')
 
+@app.teardown_request
+def release_db_connection(exc):
+    """Вернуть соединение потока в пул после обработки запроса"""
+    database.release_thread_connection()
+
+def _with_next_cursor(response, next_cursor):
+    """Передать курсор следующей страницы в заголовке (тело остается списком)"""
+    if next_cursor:
+        response.headers[pagination.NEXT_CURSOR_HEADER] = next_cursor
+    return response
+
 def require_auth(f):
     """Декоратор для проверки аутентификации"""
     def wrapper(*args, **kwargs):
@@ -43,33 +55,17 @@ def require_auth(f):
 
 @app.route('/api/encrypt-link', methods=['POST'])
 def encrypt_link_for_happ():
-    """Проксирует запрос на шифрование ссылки через crypto.happ.su"""
-    import requests as req
-    
-    data = request.get_json()
+    """Шифрует ссылку через crypto.happ.su (с кешем, см. backend/api/happ.py)"""
+    data = request.get_json(silent=True)
     url = data.get('url') if data else None
     
     if not url:
         return jsonify({'error': 'URL is required'}), 400
     
-    try:
-        response = req.post(
-            'https://crypto.happ.su/api.php',
-            json={'url': url},
-            headers={'Content-Type': 'application/json'},
-            timeout=10
-        )
-        
-        if response.ok:
-            result = response.json()
-            if result and result.get('encrypted_link'):
-                return jsonify({'encrypted_link': result['encrypted_link']})
-        
-        logger.error(f"Happ encryption API failed: {response.status_code} - {response.text}")
+    encrypted_link = happ.happ_api.encrypt_link(url)
+    if not encrypted_link:
         return jsonify({'error': 'Encryption failed'}), 500
-    except Exception as e:
-        logger.error(f"Happ encryption API error: {e}")
-        return jsonify({'error': str(e)}), 500
+    return jsonify({'encrypted_link': encrypted_link})
 
 # ========== Редирект для открытия Happ ==========
 
@@ -191,195 +187,19 @@ def redirect_to_happ():
 @app.route('/api/user/info', methods=['GET'])
 def get_user_info():
     """Получить информацию о пользователе"""
-    telegram_id = request.args.get('telegram_id', type=int)
-    username = request.args.get('username', '')
-    first_name = request.args.get('first_name', '')  # Имя пользователя из Telegram
-    ref = request.args.get('ref', type=int)  # Telegram ID реферера
-    
-    if not telegram_id:
-        return jsonify({'error': 'telegram_id required'}), 400
-    
-    # Нельзя быть своим собственным рефералом
-    if ref == telegram_id:
-        ref = None
-    
-    user = database.get_user_by_telegram_id(telegram_id)
-    is_new_user = False
-    
-    # Автоматически создаем пользователя если его нет
-    if not user:
-        is_new_user = True
-        
-        # Обрабатываем реферала
-        referred_by = None
-        if ref:
-            # Проверяем, существует ли реферер
-            referrer = database.get_user_by_telegram_id(ref)
-            if referrer:
-                # Проверяем рейт-лимит (25 рефералов в минуту)
-                if database.check_referral_rate_limit(ref, limit=25, window_seconds=60):
-                    referred_by = referrer['id']
-                    logger.info(f"Referral accepted: user {telegram_id} referred by {ref}")
-                else:
-                    logger.warning(f"Referral rate limit exceeded for referrer {ref}")
-        
-        # Создаем пользователя с full_name = first_name
-        user_id = database.create_user(
-            telegram_id, 
-            username or f'user_{telegram_id}',
-            full_name=first_name or None,
-            referred_by=referred_by
-        )
-        user = database.get_user_by_id(user_id)
-        if not user:
-            return jsonify({'error': 'Failed to create user'}), 500
-    else:
-        # Пользователь уже существует - попробуем установить реферера, если его нет
-        if ref and user.get('referred_by') is None:
-            referrer = database.get_user_by_telegram_id(ref)
-            if referrer:
-                # Проверяем рейт-лимит
-                if database.check_referral_rate_limit(ref, limit=25, window_seconds=60):
-                    if database.set_referrer_for_user(user['id'], referrer['id']):
-                        logger.info(f"Referral set for existing user {telegram_id} -> {ref}")
-                        # Обновляем user для получения актуальных данных
-                        user = database.get_user_by_telegram_id(telegram_id)
-                else:
-                    logger.warning(f"Referral rate limit exceeded for referrer {ref}")
-        
-        # Обновляем first_name если он был передан и еще не сохранен
-        if first_name and not user.get('full_name'):
-            database.update_user_full_name(telegram_id, first_name)
-            user = database.get_user_by_telegram_id(telegram_id)
-    
-    # Проверка бана
-    ban_status = abuse_detected.check_user_ban_status(user['id'])
-    if ban_status.get('banned'):
-        return jsonify({
-            'banned': True,
-            'reason': ban_status.get('reason', 'Account banned')
-        }), 403
-    
-    stats = core.get_referral_stats(user['id'])
-
-    return jsonify({
-        'id': user['id'],
-        'telegram_id': user['telegram_id'],
-        'username': user.get('username'),
-        'full_name': user.get('full_name'),  # First name из Telegram
-        'balance': user.get('balance', 0),
-        'status': user.get('status', 'Trial'),
-        'referral_code': user.get('referral_code'),
-        'partner_balance': user.get('partner_balance', 0),
-        'referrals_count': stats.get('referrals_count', 0),
-        'referral_earned': stats.get('total_earned', 0),
-        'referral_rate': stats.get('rate', 20),
-        'is_new_user': is_new_user,
-        'trial_used': user.get('trial_used', 0),  # Был ли использован пробный период
-    })
+    body, status = miniapp.user_info(
+        request.args.get('telegram_id', type=int),
+        request.args.get('username', ''),
+        request.args.get('first_name', ''),  # Имя пользователя из Telegram
+        request.args.get('ref', type=int),  # Telegram ID реферера
+    )
+    return jsonify(body), status
 
 @app.route('/api/payment/create', methods=['POST'])
 def create_payment():
     """Создать платеж"""
-    data = request.json
-    user_id = data.get('user_id')
-    amount = data.get('amount')
-    method = data.get('method')  # 'yookassa', 'yookassa_sbp', 'heleket', 'platega_card', 'platega_sbp'
-    
-    if not user_id or not amount or not method:
-        return jsonify({'error': 'Missing required fields'}), 400
-    
-    user = database.get_user_by_id(user_id)
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    
-    return_url = f"{os.getenv('MINIAPP_URL', '')}/success"
-    
-    try:
-        if method == 'yookassa' or method == 'yookassa_card':
-            # Банковская карта через YooKassa
-            save_payment_method = data.get('save_payment_method', False)
-            payment_method_id = data.get('payment_method_id')  # Для автоплатежа
-            
-            metadata = {'user_id': str(user_id)}
-            if data.get('subscription_id'):
-                metadata['subscription_id'] = str(data.get('subscription_id'))
-            
-            payment = yookassa.yookassa_api.create_payment(
-                amount, f"Пополнение баланса BlinVPN", return_url, user_id, 
-                metadata=metadata,
-                save_payment_method=save_payment_method,
-                payment_method_id=payment_method_id,
-                payment_type='bank_card'
-            )
-            if payment:
-                result = {
-                    'payment_id': payment['id'],
-                    'confirmation_url': payment.get('confirmation_url'),
-                    'payment_url': payment.get('confirmation_url'),
-                    'status': payment['status']
-                }
-                # Если способ оплаты сохранен, возвращаем его ID
-                if payment.get('payment_method_saved'):
-                    result['payment_method_id'] = payment.get('payment_method_id')
-                    result['card_last4'] = payment.get('card_last4')
-                return jsonify(result)
-        
-        elif method == 'yookassa_sbp':
-            # СБП через YooKassa
-            metadata = {'user_id': str(user_id)}
-            
-            payment = yookassa.yookassa_api.create_sbp_payment(
-                amount, f"Пополнение баланса BlinVPN (СБП)", return_url, user_id,
-                metadata=metadata
-            )
-            if payment:
-                return jsonify({
-                    'payment_id': payment['id'],
-                    'confirmation_url': payment.get('confirmation_url'),
-                    'payment_url': payment.get('confirmation_url'),
-                    'status': payment['status']
-                })
-        
-        elif method == 'heleket':
-            # Криптовалюта через Heleket
-            payment = heleket.heleket_api.create_payment(amount, user_id)
-            if payment:
-                return jsonify({
-                    'payment_id': payment.get('uuid') or payment.get('order_id'),
-                    'payment_url': payment.get('payment_url'),
-                    'status': payment.get('status', 'pending'),
-                    'payer_amount': payment.get('payer_amount'),
-                    'payer_currency': payment.get('payer_currency')
-                })
-        
-        elif method == 'platega_card':
-            # Банковская карта через Platega
-            payment = platega.platega_api.create_card_payment(amount, user_id)
-            if payment:
-                return jsonify({
-                    'payment_id': payment.get('id'),
-                    'payment_url': payment.get('redirect_url'),
-                    'status': payment.get('status', 'pending')
-                })
-        
-        elif method == 'platega_sbp':
-            # СБП через Platega
-            payment = platega.platega_api.create_sbp_payment(amount, user_id)
-            if payment:
-                return jsonify({
-                    'payment_id': payment.get('id'),
-                    'payment_url': payment.get('redirect_url'),
-                    'status': payment.get('status', 'pending')
-                })
-        
-        else:
-            return jsonify({'error': f'Unknown payment method: {method}'}), 400
-        
-    except Exception as e:
-        logger.error(f"Payment creation error for method {method}: {e}")
-    
-    return jsonify({'error': 'Payment creation failed'}), 500
+    body, status = miniapp.create_payment(request.json)
+    return jsonify(body), status
 
 @app.route('/api/promocode/apply', methods=['POST'])
 def apply_promocode():
@@ -397,133 +217,14 @@ def apply_promocode():
 @app.route('/api/user/devices', methods=['GET'])
 def get_user_devices():
     """Получить список устройств пользователя"""
-    telegram_id = request.args.get('telegram_id', type=int)
-    if not telegram_id:
-        return jsonify({'error': 'telegram_id required'}), 400
-    
-    user = database.get_user_by_telegram_id(telegram_id)
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    
-    conn = database.get_db_connection()
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute("""
-            SELECT d.id, d.name, d.platform, d.added_date, d.is_active,
-                   vk.key_config, vk.key_uuid, vk.status as key_status
-            FROM devices d
-            LEFT JOIN vpn_keys vk ON d.vpn_key_id = vk.id
-            WHERE d.user_id = ? AND d.is_active = 1
-            ORDER BY d.added_date DESC
-        """, (user['id'],))
-        
-        rows = cursor.fetchall()
-        devices = []
-        for row in rows:
-            from datetime import datetime
-            added_date = row['added_date']
-            if added_date:
-                try:
-                    if isinstance(added_date, str):
-                        dt = datetime.fromisoformat(added_date.replace('Z', '+00:00'))
-                    else:
-                        dt = added_date
-                    added_formatted = dt.strftime('%d.%m.%Y')
-                except:
-                    added_formatted = str(added_date)[:10]
-            else:
-                added_formatted = datetime.now().strftime('%d.%m.%Y')
-            
-            devices.append({
-                'id': row['id'],
-                'name': row['name'] or 'Устройство',
-                'type': row['platform'] or 'unknown',
-                'added': added_formatted,
-                'key_config': row['key_config'],
-                'key_uuid': row['key_uuid'],
-                'key_status': row['key_status']
-            })
-        
-        return jsonify(devices)
-    finally:
-        conn.close()
+    body, status = miniapp.user_devices(request.args.get('telegram_id', type=int))
+    return jsonify(body), status
 
 @app.route('/api/user/history', methods=['GET'])
 def get_user_history():
     """Получить историю транзакций пользователя"""
-    telegram_id = request.args.get('telegram_id', type=int)
-    if not telegram_id:
-        return jsonify({'error': 'telegram_id required'}), 400
-    
-    user = database.get_user_by_telegram_id(telegram_id)
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    
-    conn = database.get_db_connection()
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute("""
-            SELECT id, type, amount, description, created_at, status, payment_method
-            FROM transactions
-            WHERE user_id = ?
-            ORDER BY created_at DESC
-            LIMIT 100
-        """, (user['id'],))
-        
-        rows = cursor.fetchall()
-        history = []
-        for row in rows:
-            # Маппинг типов транзакций
-            type_map = {
-                'deposit': 'deposit',
-                'withdrawal': 'withdrawal',
-                'subscription': 'sub_off',
-                'device_purchase': 'buy_dev',
-                'trial': 'trial'
-            }
-            
-            title_map = {
-                'deposit': f'Пополнение баланса ({row["payment_method"] or ""})',
-                'withdrawal': 'Вывод средств',
-                'subscription': 'Списание за подписку',
-                'device_purchase': 'Покупка устройства',
-                'trial': 'Активация пробного периода'
-            }
-            
-            trans_type = type_map.get(row['type'], row['type'])
-            title = row['description'] or title_map.get(row['type'], row['type'])
-            
-            # Форматирование даты
-            from datetime import datetime
-            date_str = row['created_at']
-            if date_str:
-                try:
-                    if isinstance(date_str, str):
-                        dt = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
-                    else:
-                        dt = date_str
-                    # Месяцы на русском
-                    months = ['янв', 'фев', 'мар', 'апр', 'май', 'июн', 'июл', 'авг', 'сен', 'окт', 'ноя', 'дек']
-                    month_idx = dt.month - 1
-                    date_formatted = f"{dt.day} {months[month_idx]} {dt.year}"
-                except:
-                    date_formatted = str(date_str)[:10]
-            else:
-                date_formatted = datetime.now().strftime('%d %b %Y')
-            
-            history.append({
-                'id': row['id'],
-                'type': trans_type,
-                'title': title,
-                'amount': float(row['amount']),
-                'date': date_formatted
-            })
-        
-        return jsonify(history)
-    finally:
-        conn.close()
+    body, status = miniapp.user_history(request.args.get('telegram_id', type=int))
+    return jsonify(body), status
 
 @app.route('/api/user/payment-methods', methods=['GET'])
 def get_user_payment_methods():
@@ -638,135 +339,48 @@ def delete_user_device(device_id: int):
 @app.route('/api/subscription/create', methods=['POST'])
 def create_subscription():
     """Создать подписку"""
-    data = request.json
-    user_id = data.get('user_id')
-    days = data.get('days')
-    plan_type = data.get('type')  # 'vpn' or 'whitelist'
-    whitelist_gb = data.get('whitelist_gb', 0)  # Для whitelist подписки
-    use_auto_pay = data.get('use_auto_pay', False)  # Использовать автоплатеж
-    payment_method_id = data.get('payment_method_id')  # ID сохраненного способа оплаты
-    is_trial = data.get('is_trial', False)  # Пробный период
-    
-    if not user_id or not days:
-        return jsonify({'error': 'Missing required fields'}), 400
-    
-    user = database.get_user_by_id(user_id)
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
-    
-    # Проверка пробного периода
-    if is_trial:
-        if user.get('trial_used', 0) == 1:
-            return jsonify({'error': 'Пробный период уже использован'}), 400
-        # Триальные настройки
-        days = 1
-        price = 0
-    elif plan_type == 'whitelist':
-        # Рассчитываем цену для whitelist
-        if whitelist_gb < 5 or whitelist_gb > 500:
-            return jsonify({'error': 'Whitelist GB must be between 5 and 500'}), 400
-        from backend.core.whitelist_billing import calculate_whitelist_price
-        price = calculate_whitelist_price(whitelist_gb)
-    else:
-        # VPN подписка - используем фиксированные цены из планов
-        price = data.get('price', days * 3.3)
-    
-    # Если используется автоплатеж, создаем платеж через YooKassa
-    if use_auto_pay and payment_method_id and plan_type == 'whitelist':
-        # Автоплатеж для whitelist подписки
-        payment = yookassa.yookassa_api.create_payment(
-            price, f"Автоплатеж: Whitelist подписка ({days} дней, {whitelist_gb} ГБ)", 
-            f"{os.getenv('MINIAPP_URL')}/success", user_id,
-            metadata={'user_id': str(user_id), 'subscription_type': 'whitelist', 'days': days, 'whitelist_gb': whitelist_gb},
-            payment_method_id=payment_method_id
-        )
-        if payment and payment.get('status') == 'succeeded':
-            # Платеж успешен, создаем подписку
-            traffic_limit_bytes = int(whitelist_gb * (1024 ** 3))
-            result = core.create_user_and_subscription(
-                user['telegram_id'], user.get('username', ''), days,
-                traffic_limit=traffic_limit_bytes,
-                plan_type='whitelist'
-            )
-            if result:
-                return jsonify({'success': True, 'subscription': result})
-            return jsonify({'error': 'Failed to create subscription'}), 500
-        else:
-            return jsonify({'error': 'Auto payment failed'}), 400
-    
-    # Для пробного периода не списываем баланс
-    if not is_trial:
-        deducted = database.update_user_balance(user_id, -price, ensure_non_negative=True)
-        if not deducted:
-            return jsonify({'error': 'Insufficient balance'}), 400
-    
-    # Создаем подписку
-    if is_trial:
-        # Пробный период - 10 ГБ трафика
-        traffic_limit_bytes = int(10 * (1024 ** 3))
-        result = core.create_user_and_subscription(
-            user['telegram_id'], user.get('username', ''), days,
-            traffic_limit=traffic_limit_bytes,
-            plan_type='vpn'
-        )
-    elif plan_type == 'whitelist':
-        # Для whitelist - лимит трафика по выбору пользователя
-        traffic_limit_bytes = int(whitelist_gb * (1024 ** 3))
-        result = core.create_user_and_subscription(
-            user['telegram_id'], user.get('username', ''), days,
-            traffic_limit=traffic_limit_bytes,
-            plan_type='whitelist'
-        )
-    else:
-        # Обычный VPN - безлимитный трафик (0 = unlimited)
-        result = core.create_user_and_subscription(
-            user['telegram_id'], user.get('username', ''), days,
-            traffic_limit=0,
-            plan_type='vpn'
-        )
-    
-    if result:
-        conn = database.get_db_connection()
-        cursor = conn.cursor()
-        
-        if is_trial:
-            # Помечаем пробный период как использованный
-            cursor.execute("UPDATE users SET trial_used = 1 WHERE id = ?", (user_id,))
-            description = "Активация пробного периода (1 день)"
-            trans_type = 'trial'
-        else:
-            description = f"{'Whitelist' if plan_type == 'whitelist' else 'VPN'} подписка ({days} дней)"
-            if plan_type == 'whitelist':
-                description += f" - {whitelist_gb} ГБ"
-            trans_type = 'subscription'
-        
-        # Создаем транзакцию
-        cursor.execute("""
-            INSERT INTO transactions (user_id, type, amount, status, description, payment_method)
-            VALUES (?, ?, ?, 'Success', ?, 'Balance')
-        """, (user_id, trans_type, -price, description))
-        conn.commit()
-        conn.close()
-        
-        return jsonify({'success': True, 'subscription': result})
-    
-    # Откат баланса, если создание не удалось (только для не-триала)
-    if not is_trial:
-        database.update_user_balance(user_id, price)
-    return jsonify({'error': 'Failed to create subscription'}), 500
+    body, status = miniapp.create_subscription(request.json)
+    return jsonify(body), status
+
+@app.route('/api/subscription/status', methods=['GET'])
+def get_subscription_status():
+    """Статус создания подписки (wait - секунд ждать завершения, long polling)"""
+    body, status = miniapp.subscription_status(
+        request.args.get('job_id', type=int),
+        request.args.get('user_id', type=int),
+        request.args.get('wait', 0, type=float),
+    )
+    return jsonify(body), status
 
 # ========== API для панели ==========
 
 @app.route('/api/panel/users', methods=['GET'])
 @require_auth
 def get_users():
-    """Получить список пользователей"""
-    limit = request.args.get('limit', 100, type=int)
-    offset = request.args.get('offset', 0, type=int)
-    raw_users = database.get_all_users(limit, offset)
+    """
+    Получить список пользователей.
+    Фильтры: status, date_from, date_to (по дате создания); страницы - по курсору (?cursor=)
+    """
+    conditions, params = [], []
+    if request.args.get('status'):
+        conditions.append("status = ?")
+        params.append(request.args['status'])
+    try:
+        date_conditions, date_params = pagination.date_range(
+            'created_at', request.args.get('date_from'), request.args.get('date_to'))
+        conditions += date_conditions
+        params += date_params
+        with database.db_connection() as conn:
+            raw_users, next_cursor = pagination.fetch_page(
+                conn.cursor(), "SELECT * FROM users", [('created_at', 'created_at'), ('id', 'id')],
+                conditions, params, request.args.get('cursor'),
+                pagination.page_size(request.args.get('limit', type=int)),
+                request.args.get('offset', 0, type=int))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
     # Небольшой маппинг под фронтенд (оставляем столбцы как есть, чтобы панель могла сама адаптировать)
-    return jsonify(raw_users)
+    return _with_next_cursor(jsonify(raw_users), next_cursor)
 
 @app.route('/api/panel/promocodes', methods=['GET'])
 @require_auth
@@ -868,10 +482,10 @@ def update_promocode(promo_id: int):
 @app.route('/api/panel/mailing', methods=['POST'])
 @require_auth
 def send_mailing():
-    """Отправить рассылку"""
+    """Поставить рассылку в очередь (отправляется фоновым процессом)"""
     data = request.json
     message = data.get('message')
-    target_users = data.get('target_users', 'all')  # 'all' or list/int user_ids
+    target_users = data.get('target_users', 'all')  # 'all', 'active', 'expired', 'no_subscription', user_id или список user_id
     button_type = data.get('button_type')
     button_value = data.get('button_value')
     image_url = data.get('image_url')
@@ -879,42 +493,28 @@ def send_mailing():
     if not message:
         return jsonify({'success': False, 'error': 'Message is required'}), 400
 
-    conn = database.get_db_connection()
-    cursor = conn.cursor()
-
     try:
-        # Определяем список получателей
-        user_rows = []
-        if target_users == 'all':
-            cursor.execute("SELECT id, telegram_id FROM users")
-            user_rows = cursor.fetchall()
-        elif isinstance(target_users, list):
-            placeholders = ",".join("?" for _ in target_users)
-            cursor.execute(
-                f"SELECT id, telegram_id FROM users WHERE id IN ({placeholders})",
-                tuple(target_users),
-            )
-            user_rows = cursor.fetchall()
-
-        sent = 0
-        for row in user_rows:
-            telegram_id = row['telegram_id']
-            if core.send_notification_to_user(telegram_id, message):
-                sent += 1
-
-        # Сохраняем запись о рассылке
-        cursor.execute(
-            """
-            INSERT INTO mailings (title, message_text, target_users, sent_count, status, sent_at, button_type, button_value, image_url)
-            VALUES (?, ?, ?, ?, 'Completed', CURRENT_TIMESTAMP, ?, ?, ?)
-            """,
-            (data.get('title', ''), message, str(target_users), sent, button_type, button_value, image_url),
+        result = mailing.create_mailing(
+            message,
+            target_users=target_users,
+            title=data.get('title', ''),
+            button_type=button_type,
+            button_value=button_value,
+            image_url=image_url,
         )
-        conn.commit()
-    finally:
-        conn.close()
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
 
-    return jsonify({'success': True, 'sent': sent})
+    return jsonify({'success': True, 'mailing_id': result['id'], 'queued': result['total']})
+
+@app.route('/api/panel/mailing/<int:mailing_id>/status', methods=['GET'])
+@require_auth
+def get_mailing_status(mailing_id):
+    """Прогресс рассылки: доставлено, ошибок, в очереди"""
+    status = mailing.get_mailing_status(mailing_id)
+    if not status:
+        return jsonify({'error': 'Mailing not found'}), 404
+    return jsonify(status)
 
 @app.route('/api/panel/mailing/stats', methods=['GET'])
 @require_auth
@@ -924,21 +524,17 @@ def get_mailing_stats():
     cursor = conn.cursor()
     
     try:
-        # Общее количество отправленных сообщений
-        cursor.execute("SELECT COALESCE(SUM(sent_count), 0) AS total FROM mailings WHERE status = 'Completed'")
-        total_sent = cursor.fetchone()['total'] or 0
-        
-        # Доставляемость - считаем по реальным данным
+        # Доставлено и не доставлено по всем рассылкам
         cursor.execute("""
-            SELECT COALESCE(SUM(sent_count), 0) as total_sent, 
-                   COALESCE(SUM(CASE WHEN status = 'Completed' THEN sent_count ELSE 0 END), 0) as delivered
+            SELECT COALESCE(SUM(sent_count), 0) AS delivered,
+                   COALESCE(SUM(failed_count), 0) AS failed
             FROM mailings
         """)
         delivery_row = cursor.fetchone()
-        total_sent_for_rate = delivery_row['total_sent'] or 0
-        delivered_count = delivery_row['delivered'] or 0
-        # Если все успешно отправлены - 100%
-        delivered_rate = (delivered_count / total_sent_for_rate * 100) if total_sent_for_rate > 0 else 100
+        total_sent = delivery_row['delivered'] or 0
+        failed_count = delivery_row['failed'] or 0
+        attempted = total_sent + failed_count
+        delivered_rate = round(total_sent / attempted * 100, 1) if attempted > 0 else 100
         
         # Переходы (пока нет трекинга, возвращаем 0)
         clicks = 0
@@ -956,6 +552,7 @@ def get_mailing_stats():
         return jsonify({
             'totalSent': total_sent,
             'delivered': delivered_rate,
+            'failed': failed_count,
             'clicks': clicks,
             'lastCampaign': last_campaign,
             'lastCampaignDate': last_campaign_date
@@ -972,7 +569,7 @@ def get_mailing_history():
     
     try:
         cursor.execute("""
-            SELECT id, title, message_text, sent_count, status, sent_at, created_at
+            SELECT id, title, message_text, sent_count, failed_count, total_count, status, sent_at, created_at
             FROM mailings
             ORDER BY created_at DESC
             LIMIT 50
@@ -998,6 +595,8 @@ def get_mailing_history():
                 'id': row['id'],
                 'title': row['title'] or row['message_text'][:50] if row['message_text'] else 'Без названия',
                 'sent_count': row['sent_count'] or 0,
+                'failed_count': row['failed_count'] or 0,
+                'total_count': row['total_count'] or 0,
                 'status': row['status'],
                 'date': date_formatted
             })
@@ -1010,28 +609,44 @@ def get_mailing_history():
 @app.route('/api/panel/tickets', methods=['GET'])
 @require_auth
 def get_tickets():
-    """Список тикетов для панели"""
-    conn = database.get_db_connection()
-    cursor = conn.cursor()
-
-    cursor.execute(
-        """
-        SELECT
-            t.id,
-            u.username,
-            u.balance,
-            u.status AS user_status,
-            t.status,
-            t.last_message,
-            t.last_message_time,
-            t.unread_count
-        FROM tickets t
-        JOIN users u ON t.user_id = u.id
-        ORDER BY t.last_message_time DESC NULLS LAST, t.created_at DESC
-        """
-    )
-    rows = cursor.fetchall()
-    conn.close()
+    """
+    Список тикетов для панели (сначала с последней активностью).
+    Фильтры: status, user_id, date_from, date_to; страницы - по курсору (?cursor=)
+    """
+    conditions, params = [], []
+    if request.args.get('status'):
+        conditions.append("t.status = ?")
+        params.append(request.args['status'])
+    if request.args.get('user_id'):
+        conditions.append("t.user_id = ?")
+        params.append(request.args.get('user_id', type=int))
+    try:
+        date_conditions, date_params = pagination.date_range(
+            'COALESCE(t.last_message_time, t.created_at)', request.args.get('date_from'), request.args.get('date_to'))
+        conditions += date_conditions
+        params += date_params
+        with database.db_connection() as conn:
+            rows, next_cursor = pagination.fetch_page(
+                conn.cursor(),
+                """
+                SELECT
+                    t.id,
+                    u.username,
+                    u.balance,
+                    u.status AS user_status,
+                    t.status,
+                    t.last_message,
+                    t.last_message_time,
+                    t.unread_count,
+                    COALESCE(t.last_message_time, t.created_at) AS activity_time
+                FROM tickets t
+                JOIN users u ON t.user_id = u.id
+                """,
+                [('COALESCE(t.last_message_time, t.created_at)', 'activity_time'), ('t.id', 'id')],
+                conditions, params, request.args.get('cursor'),
+                pagination.page_size(request.args.get('limit', type=int)))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
     tickets = []
     for r in rows:
@@ -1049,7 +664,7 @@ def get_tickets():
             }
         )
 
-    return jsonify(tickets)
+    return _with_next_cursor(jsonify(tickets), next_cursor)
 
 @app.route('/api/panel/tickets/<int:ticket_id>/messages', methods=['GET'])
 @require_auth
@@ -1070,7 +685,15 @@ def get_ticket_messages(ticket_id: int):
             ORDER BY tm.created_at ASC
         """, (ticket_id,))
         
-        rows = cursor.fetchall()
+        rows = [dict(row) for row in cursor.fetchall()]
+        # Сообщения закрытых тикетов старше границы архивации лежат в архиве
+        if archive.archived_before('ticket_messages'):
+            cursor.execute("SELECT 1 FROM tickets WHERE id = ? AND status = 'Closed'", (ticket_id,))
+            if cursor.fetchone():
+                archived = archive.query('ticket_messages', ['ticket_id = ?'], [ticket_id], limit=pagination.MAX_PAGE_SIZE)
+                hot_ids = {row['id'] for row in rows}
+                rows = sorted([row for row in archived if row['id'] not in hot_ids] + rows,
+                              key=lambda row: (str(row['created_at'] or ''), row['id']))
         messages = []
         for row in rows:
             messages.append({
@@ -1146,15 +769,26 @@ def reply_to_ticket(ticket_id: int):
 @app.route('/api/panel/transactions', methods=['GET'])
 @require_auth
 def get_transactions():
-    """Получить список транзакций"""
-    limit = request.args.get('limit', 100, type=int)
-    offset = request.args.get('offset', 0, type=int)
+    """
+    Получить список транзакций.
+    Фильтры: status, type, provider, user_id, date_from, date_to; страницы - по курсору (?cursor=)
+    """
+    conditions, params = [], []
+    for arg, column in (('status', 't.status'), ('type', 't.type'), ('provider', 't.payment_provider')):
+        if request.args.get(arg):
+            conditions.append(f"{column} = ?")
+            params.append(request.args[arg])
+    if request.args.get('user_id'):
+        conditions.append("t.user_id = ?")
+        params.append(request.args.get('user_id', type=int))
     
     conn = database.get_db_connection()
     cursor = conn.cursor()
     
     try:
-        cursor.execute("""
+        date_conditions, date_params = pagination.date_range(
+            't.created_at', request.args.get('date_from'), request.args.get('date_to'))
+        rows, next_cursor = pagination.fetch_page(cursor, """
             SELECT 
                 t.id,
                 t.user_id,
@@ -1169,11 +803,11 @@ def get_transactions():
                 t.created_at
             FROM transactions t
             LEFT JOIN users u ON t.user_id = u.id
-            ORDER BY t.created_at DESC
-            LIMIT ? OFFSET ?
-        """, (limit, offset))
+        """, [('t.created_at', 'created_at'), ('t.id', 'id')],
+            conditions + date_conditions, params + date_params, request.args.get('cursor'),
+            pagination.page_size(request.args.get('limit', type=int)),
+            request.args.get('offset', 0, type=int))
         
-        rows = cursor.fetchall()
         transactions = []
         for row in rows:
             username = row['username'] or f"user_{row['user_id']}"
@@ -1191,7 +825,9 @@ def get_transactions():
                 'created_at': row['created_at']
             })
         
-        return jsonify(transactions)
+        return _with_next_cursor(jsonify(transactions), next_cursor)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     finally:
         conn.close()
 
@@ -1325,15 +961,25 @@ def unban_user(user_id: int):
 @app.route('/api/panel/keys', methods=['GET'])
 @require_auth
 def get_keys():
-    """Получить список ключей VPN"""
-    limit = request.args.get('limit', 100, type=int)
-    offset = request.args.get('offset', 0, type=int)
+    """
+    Получить список ключей VPN.
+    Фильтры: status, user_id, date_from, date_to (по дате создания); страницы - по курсору (?cursor=)
+    """
+    conditions, params = [], []
+    if request.args.get('status'):
+        conditions.append("vk.status = ?")
+        params.append(request.args['status'])
+    if request.args.get('user_id'):
+        conditions.append("vk.user_id = ?")
+        params.append(request.args.get('user_id', type=int))
     
     conn = database.get_db_connection()
     cursor = conn.cursor()
     
     try:
-        cursor.execute("""
+        date_conditions, date_params = pagination.date_range(
+            'vk.created_at', request.args.get('date_from'), request.args.get('date_to'))
+        rows, next_cursor = pagination.fetch_page(cursor, """
             SELECT 
                 vk.id,
                 vk.user_id,
@@ -1349,11 +995,11 @@ def get_keys():
                 vk.created_at
             FROM vpn_keys vk
             LEFT JOIN users u ON vk.user_id = u.id
-            ORDER BY vk.created_at DESC
-            LIMIT ? OFFSET ?
-        """, (limit, offset))
+        """, [('vk.created_at', 'created_at'), ('vk.id', 'id')],
+            conditions + date_conditions, params + date_params, request.args.get('cursor'),
+            pagination.page_size(request.args.get('limit', type=int)),
+            request.args.get('offset', 0, type=int))
         
-        rows = cursor.fetchall()
         keys = []
         for row in rows:
             username = row['username'] or f"user_{row['user_id']}"
@@ -1396,11 +1042,35 @@ def get_keys():
                 'server_location': row['server_location'] or 'Unknown'
             })
         
-        return jsonify(keys)
+        return _with_next_cursor(jsonify(keys), next_cursor)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     finally:
         conn.close()
 
 
+@app.route('/api/panel/export/<name>', methods=['GET'])
+@require_auth
+def export_table(name: str):
+    """
+    Потоковая выгрузка users, keys или transactions целиком.
+    Параметры: format (csv | ndjson), gzip=1, date_from, date_to и фильтры списка (status, type, provider, user_id)
+    """
+    fmt = request.args.get('format', 'csv')
+    gzip = request.args.get('gzip') in ('1', 'true')
+    try:
+        chunks = export.stream_export(name, request.args.to_dict(), fmt, gzip)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # stream_with_context: соединение с БД возвращается в пул (teardown) только после выгрузки
+    response = Response(stream_with_context(chunks),
+                        content_type='application/gzip' if gzip else export.FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="{export.export_filename(name, fmt, gzip)}"'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @app.route('/api/panel/keys', methods=['POST'])
 @require_auth
 def create_key():
@@ -1570,54 +1240,25 @@ def get_user_referrals():
     if not user:
         return jsonify({'error': 'User not found'}), 404
 
-    conn = database.get_db_connection()
-    cursor = conn.cursor()
+    # Сумма пополнений каждого реферала берется из агрегатов одним запросом
+    rate = user.get("partner_rate", 20) / 100
 
-    try:
-        cursor.execute(
-            """
-            SELECT id, username, full_name, registration_date
-            FROM users
-            WHERE referred_by = ?
-            ORDER BY registration_date DESC
-            """,
-            (user["id"],),
+    referrals = []
+    for r in database.get_referrals_with_spend(user["id"]):
+        ref_id = r["id"]
+        total_spent = float(r["spent"] or 0)
+        referrals.append(
+            {
+                "id": ref_id,
+                "name": r["full_name"] or r["username"] or f"id{ref_id}",
+                "date": r["registration_date"] or "",
+                "spent": total_spent,
+                "myProfit": total_spent * rate,
+                "history": [],  # История можно дополнить при необходимости
+            }
         )
-        referrals_rows = cursor.fetchall()
 
-        # Загружаем ставки
-        rate = user.get("partner_rate", 20) / 100
-
-        referrals = []
-        for r in referrals_rows:
-            ref_id = r["id"]
-            # Сумма пополнений реферала
-            cursor.execute(
-                """
-                SELECT COALESCE(SUM(amount), 0) as total
-                FROM transactions
-                WHERE user_id = ? AND type = 'deposit'
-                """,
-                (ref_id,),
-            )
-            spent_row = cursor.fetchone()
-            total_spent = float(spent_row["total"] or 0)
-            profit = total_spent * rate
-
-            referrals.append(
-                {
-                    "id": ref_id,
-                    "name": r["full_name"] or r["username"] or f"id{ref_id}",
-                    "date": r["registration_date"] or "",
-                    "spent": total_spent,
-                    "myProfit": profit,
-                    "history": [],  # История можно дополнить при необходимости
-                }
-            )
-
-        return jsonify(referrals)
-    finally:
-        conn.close()
+    return jsonify(referrals)
 
 
 @app.route('/api/user/withdraw', methods=['POST'])
@@ -1732,46 +1373,13 @@ def request_withdrawal():
 @require_auth
 def get_stats_charts():
     """Графики для дашборда панели (последние 14 дней)"""
-    conn = database.get_db_connection()
-    cursor = conn.cursor()
-    from datetime import datetime, timedelta
-
-    try:
-        # Подготовим даты
-        days = []
-        today = datetime.utcnow().date()
-        for i in range(14):
-            days.append(today - timedelta(days=13 - i))
-
-        # Пользователи по дням
-        cursor.execute(
-            """
-            SELECT DATE(registration_date) as d, COUNT(*) as cnt
-            FROM users
-            GROUP BY DATE(registration_date)
-            """
-        )
-        users_map = {row["d"]: row["cnt"] for row in cursor.fetchall()}
-        users_series = [users_map.get(str(d), 0) for d in days]
-
-        # Ключи по дням
-        cursor.execute(
-            """
-            SELECT DATE(created_at) as d, COUNT(*) as cnt
-            FROM vpn_keys
-            GROUP BY DATE(created_at)
-            """
-        )
-        keys_map = {row["d"]: row["cnt"] for row in cursor.fetchall()}
-        keys_series = [keys_map.get(str(d), 0) for d in days]
+    days = stats.last_days(14)
 
-        return jsonify({
-            "users": users_series,
-            "keys": keys_series,
-            "labels": [d.strftime("%d.%m") for d in days],
-        })
-    finally:
-        conn.close()
+    return jsonify({
+        "users": stats.event_daily_series('user_registered', days),
+        "keys": stats.event_daily_series('key_created', days),
+        "labels": [d.strftime("%d.%m") for d in days],
+    })
 
 
 @app.route('/api/panel/stats/summary', methods=['GET'])
@@ -1784,110 +1392,52 @@ def get_stats_summary():
     - monthly_revenue: сумма депозитов за текущий месяц
     - open_tickets: открытых тикетов
     """
-    conn = database.get_db_connection()
-    cursor = conn.cursor()
     from datetime import datetime
 
-    try:
-        # Всего пользователей
-        cursor.execute("SELECT COUNT(*) AS cnt FROM users")
-        total_users = cursor.fetchone()["cnt"] or 0
-
-        # Активные ключи
-        cursor.execute("SELECT COUNT(*) AS cnt FROM vpn_keys WHERE status = 'Active'")
-        active_keys = cursor.fetchone()["cnt"] or 0
-
-        # Доход за текущий месяц (по депозитам)
-        now = datetime.utcnow()
-        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        cursor.execute(
-            """
-            SELECT COALESCE(SUM(amount), 0) AS total
-            FROM transactions
-            WHERE type = 'deposit'
-              AND created_at >= ?
-              AND status = 'Success'
-            """,
-            (month_start.isoformat(),),
-        )
-        monthly_revenue = float(cursor.fetchone()["total"] or 0)
+    counters = stats.get_counters()
 
-        # Открытые тикеты
-        cursor.execute("SELECT COUNT(*) AS cnt FROM tickets WHERE status = 'Open'")
-        open_tickets = cursor.fetchone()["cnt"] or 0
+    # Доход за текущий месяц (по депозитам)
+    month_start = datetime.utcnow().date().replace(day=1)
+    monthly_revenue = stats.tx_totals(['deposit'], 'Success', since=month_start)['amount']
 
-        return jsonify(
-            {
-                "total_users": total_users,
-                "active_keys": active_keys,
-                "monthly_revenue": monthly_revenue,
-                "open_tickets": open_tickets,
-            }
-        )
-    finally:
-        conn.close()
+    return jsonify(
+        {
+            "total_users": int(counters.get('users_total', 0)),
+            "active_keys": int(counters.get('keys_status:Active', 0)),
+            "monthly_revenue": monthly_revenue,
+            "open_tickets": int(counters.get('tickets_status:Open', 0)),
+        }
+    )
 
 @app.route('/api/panel/finance/stats', methods=['GET'])
 @require_auth
 def get_finance_stats():
     """Статистика финансов (пополнения, списания, успешные операции)"""
-    conn = database.get_db_connection()
-    cursor = conn.cursor()
     from datetime import datetime, timedelta
     
-    try:
-        # Пополнения (все депозиты)
-        cursor.execute("""
-            SELECT COALESCE(SUM(amount), 0) AS total, COUNT(*) AS cnt
-            FROM transactions
-            WHERE type = 'deposit' AND status = 'Success'
-        """)
-        deposits_row = cursor.fetchone()
-        deposits_total = float(deposits_row['total'] or 0)
-        deposits_count = deposits_row['cnt'] or 0
-        
-        # Списания (все расходы)
-        cursor.execute("""
-            SELECT COALESCE(SUM(ABS(amount)), 0) AS total, COUNT(*) AS cnt
-            FROM transactions
-            WHERE type IN ('subscription', 'whitelist_overage', 'withdrawal') AND amount < 0
-        """)
-        withdrawals_row = cursor.fetchone()
-        withdrawals_total = float(withdrawals_row['total'] or 0)
-        withdrawals_count = withdrawals_row['cnt'] or 0
-        
-        # Успешные операции
-        cursor.execute("""
-            SELECT COUNT(*) AS cnt
-            FROM transactions
-            WHERE status = 'Success'
-        """)
-        successful_ops = cursor.fetchone()['cnt'] or 0
-        
-        # Изменение за период (сравнение с предыдущим месяцем)
-        now = datetime.utcnow()
-        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        prev_month_start = (month_start - timedelta(days=1)).replace(day=1)
-        
-        cursor.execute("""
-            SELECT COALESCE(SUM(amount), 0) AS total
-            FROM transactions
-            WHERE type = 'deposit' AND status = 'Success'
-              AND created_at >= ? AND created_at < ?
-        """, (prev_month_start.isoformat(), month_start.isoformat()))
-        prev_deposits = float(cursor.fetchone()['total'] or 0)
-        
-        deposits_change = ((deposits_total - prev_deposits) / prev_deposits * 100) if prev_deposits > 0 else 0
-        
-        return jsonify({
-            'deposits': deposits_total,
-            'depositsChange': f"+{deposits_change:.1f}%" if deposits_change >= 0 else f"{deposits_change:.1f}%",
-            'withdrawals': withdrawals_total,
-            'withdrawalsChange': '+2.1%',  # Упрощенно
-            'successfulOps': successful_ops
-        })
-    finally:
-        conn.close()
+    # Пополнения (все депозиты)
+    deposits_total = stats.tx_totals(['deposit'], 'Success')['amount']
+    
+    # Списания (все расходы)
+    withdrawals_total = stats.tx_totals(['subscription', 'whitelist_overage', 'withdrawal'])['debit_amount']
+    
+    # Успешные операции
+    successful_ops = stats.tx_totals(status='Success')['cnt']
+    
+    # Изменение за период (сравнение с предыдущим месяцем)
+    month_start = datetime.utcnow().date().replace(day=1)
+    prev_month_start = (month_start - timedelta(days=1)).replace(day=1)
+    prev_deposits = stats.tx_totals(['deposit'], 'Success', since=prev_month_start, until=month_start)['amount']
+    
+    deposits_change = ((deposits_total - prev_deposits) / prev_deposits * 100) if prev_deposits > 0 else 0
+    
+    return jsonify({
+        'deposits': deposits_total,
+        'depositsChange': f"+{deposits_change:.1f}%" if deposits_change >= 0 else f"{deposits_change:.1f}%",
+        'withdrawals': withdrawals_total,
+        'withdrawalsChange': '+2.1%',  # Упрощенно
+        'successfulOps': successful_ops
+    })
 
 @app.route('/api/panel/statistics/full', methods=['GET'])
 @require_auth
@@ -1898,51 +1448,28 @@ def get_full_statistics():
     from datetime import datetime, timedelta
     
     try:
-        # Основные метрики
-        cursor.execute("SELECT COUNT(*) AS cnt FROM users")
-        total_users = cursor.fetchone()['cnt'] or 0
-        
-        cursor.execute("SELECT COUNT(*) AS cnt FROM vpn_keys WHERE status = 'Active'")
-        active_subscriptions = cursor.fetchone()['cnt'] or 0
+        counters = stats.get_counters()
         
-        today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-        cursor.execute("""
-            SELECT COUNT(*) AS cnt FROM transactions
-            WHERE type = 'deposit' AND status = 'Success' AND created_at >= ?
-        """, (today_start.isoformat(),))
-        payments_today = cursor.fetchone()['cnt'] or 0
+        # Основные метрики
+        total_users = int(counters.get('users_total', 0))
+        active_subscriptions = int(counters.get('keys_status:Active', 0))
         
-        cursor.execute("SELECT COUNT(*) AS cnt FROM tickets WHERE status = 'Open'")
-        open_tickets = cursor.fetchone()['cnt'] or 0
+        today = datetime.utcnow().date()
+        payments_today = stats.tx_totals(['deposit'], 'Success', since=today)['cnt']
         
-        cursor.execute("SELECT COALESCE(SUM(balance), 0) AS total FROM users")
-        clients_balance = float(cursor.fetchone()['total'] or 0)
+        open_tickets = int(counters.get('tickets_status:Open', 0))
+        clients_balance = float(counters.get('users_balance', 0))
         
         # Выручка по дням (последние 30 дней)
-        revenue_data = []
-        revenue_labels = []
-        for i in range(30):
-            day = (datetime.utcnow() - timedelta(days=29-i)).date()
-            day_start = datetime.combine(day, datetime.min.time())
-            day_end = day_start + timedelta(days=1)
-            cursor.execute("""
-                SELECT COALESCE(SUM(amount), 0) AS total
-                FROM transactions
-                WHERE type = 'deposit' AND status = 'Success'
-                  AND created_at >= ? AND created_at < ?
-            """, (day_start.isoformat(), day_end.isoformat()))
-            revenue_data.append(float(cursor.fetchone()['total'] or 0))
-            revenue_labels.append(day.strftime('%d.%m.%Y'))
+        revenue_days = stats.last_days(30)
+        revenue_data = stats.tx_daily_amounts('deposit', 'Success', revenue_days)
+        revenue_labels = [day.strftime('%d.%m.%Y') for day in revenue_days]
         
         # Распределение пользователей
-        cursor.execute("SELECT COUNT(*) AS cnt FROM users WHERE status = 'Active'")
-        active_users = cursor.fetchone()['cnt'] or 0
-        cursor.execute("SELECT COUNT(*) AS cnt FROM users WHERE status = 'Trial'")
-        trial_users = cursor.fetchone()['cnt'] or 0
-        cursor.execute("SELECT COUNT(*) AS cnt FROM users WHERE is_banned = 1")
-        banned_users = cursor.fetchone()['cnt'] or 0
-        cursor.execute("SELECT COUNT(*) AS cnt FROM users WHERE status = 'Expired'")
-        expired_users = cursor.fetchone()['cnt'] or 0
+        active_users = int(counters.get('users_status:Active', 0))
+        trial_users = int(counters.get('users_status:Trial', 0))
+        banned_users = int(counters.get('users_banned', 0))
+        expired_users = int(counters.get('users_status:Expired', 0))
         sleeping_users = max(0, total_users - active_users - trial_users - banned_users - expired_users)
         
         user_dist_data = [
@@ -1954,17 +1481,11 @@ def get_full_statistics():
         ]
         
         # Способы оплаты
-        cursor.execute("""
-            SELECT payment_method, COUNT(*) AS cnt
-            FROM transactions
-            WHERE type = 'deposit' AND status = 'Success'
-            GROUP BY payment_method
-        """)
-        payment_methods_raw = cursor.fetchall()
+        payment_methods_raw = stats.tx_by_method('deposit', 'Success')
         total_payments = sum(row['cnt'] for row in payment_methods_raw) or 1
         payment_methods_data = []
         for row in payment_methods_raw:
-            method = row['payment_method'] or 'Other'
+            method = row['method'] or 'Other'
             count = row['cnt']
             payment_methods_data.append({
                 'label': method,
@@ -1972,43 +1493,30 @@ def get_full_statistics():
             })
         
         # Подписки
-        cursor.execute("SELECT COUNT(*) AS cnt FROM vpn_keys")
-        total_subscriptions = cursor.fetchone()['cnt'] or 0
+        total_subscriptions = int(counters.get('keys_total', 0))
         cursor.execute("SELECT COUNT(*) AS cnt FROM vpn_keys WHERE status = 'Active' AND expiry_date > datetime('now')")
         paid_subscriptions = cursor.fetchone()['cnt'] or 0
         
-        week_start = datetime.utcnow() - timedelta(days=7)
-        cursor.execute("""
-            SELECT COUNT(*) AS cnt FROM vpn_keys
-            WHERE created_at >= ?
-        """, (week_start.isoformat(),))
-        bought_this_week = cursor.fetchone()['cnt'] or 0
+        bought_this_week = stats.event_count_since('key_created', datetime.utcnow() - timedelta(days=7))
         
         # Конверсия Trial -> Paid
-        cursor.execute("SELECT COUNT(*) AS cnt FROM users WHERE trial_used = 1")
-        used_trial = cursor.fetchone()['cnt'] or 0
-        cursor.execute("SELECT COUNT(*) AS cnt FROM users WHERE trial_used = 1 AND status = 'Active'")
-        converted = cursor.fetchone()['cnt'] or 0
+        used_trial = int(counters.get('users_trial_used', 0))
+        converted = int(counters.get('users_trial_converted', 0))
         conversion_rate = (converted / used_trial * 100) if used_trial > 0 else 0
         
         # Рефералы
-        cursor.execute("SELECT COUNT(*) AS cnt FROM users WHERE referred_by IS NOT NULL")
-        total_invited = cursor.fetchone()['cnt'] or 0
-        cursor.execute("SELECT COUNT(*) AS cnt FROM users WHERE is_partner = 1")
-        partners = cursor.fetchone()['cnt'] or 0
-        cursor.execute("SELECT COALESCE(SUM(total_earned), 0) AS total FROM users")
-        total_paid = float(cursor.fetchone()['total'] or 0)
+        total_invited = int(counters.get('users_referred', 0))
+        partners = int(counters.get('users_partners', 0))
+        total_paid = float(counters.get('users_total_earned', 0))
         
         # Топ рефералов
         cursor.execute("""
             SELECT u.id, u.username, u.partner_rate,
-                   COUNT(r.id) AS referrals_count,
-                   COALESCE(SUM(t.amount), 0) AS total_spent
+                   COALESCE(ra.referrals_count, 0) AS referrals_count,
+                   COALESCE(ra.referrals_spent, 0) AS total_spent
             FROM users u
-            LEFT JOIN users r ON r.referred_by = u.id
-            LEFT JOIN transactions t ON t.user_id = r.id AND t.type = 'deposit'
+            LEFT JOIN referral_aggregates ra ON ra.referrer_id = u.id
             WHERE u.is_partner = 1
-            GROUP BY u.id
             ORDER BY total_spent DESC
             LIMIT 10
         """)
@@ -2085,30 +1593,18 @@ def get_promocodes_stats():
 @require_auth
 def get_tariffs():
     """Получить тарифные планы"""
-    conn = database.get_db_connection()
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute("""
-            SELECT * FROM tariff_plans
-            WHERE is_active = 1
-            ORDER BY plan_type, sort_order
-        """)
-        rows = cursor.fetchall()
-        plans = []
-        for row in rows:
-            plans.append({
-                'id': row['id'],
-                'plan_type': row['plan_type'],
-                'name': row['name'],
-                'price': float(row['price']),
-                'duration_days': row['duration_days'],
-                'is_active': bool(row['is_active']),
-                'sort_order': row['sort_order']
-            })
-        return jsonify(plans)
-    finally:
-        conn.close()
+    plans = []
+    for row in database.get_tariff_plans():
+        plans.append({
+            'id': row['id'],
+            'plan_type': row['plan_type'],
+            'name': row['name'],
+            'price': float(row['price']),
+            'duration_days': row['duration_days'],
+            'is_active': bool(row['is_active']),
+            'sort_order': row['sort_order']
+        })
+    return jsonify(plans)
 
 @app.route('/api/panel/tariffs', methods=['POST'])
 @require_auth
@@ -2131,6 +1627,7 @@ def create_tariff():
             data.get('sort_order', 0)
         ))
         conn.commit()
+        database.invalidate_config_cache()
         plan_id = cursor.lastrowid
         cursor.execute("SELECT * FROM tariff_plans WHERE id = ?", (plan_id,))
         return jsonify({'success': True, 'plan': dict(cursor.fetchone())})
@@ -2162,6 +1659,7 @@ def update_tariff(plan_id: int):
         values.append(plan_id)
         cursor.execute(f"UPDATE tariff_plans SET {', '.join(fields)}, updated_at = CURRENT_TIMESTAMP WHERE id = ?", tuple(values))
         conn.commit()
+        database.invalidate_config_cache()
         cursor.execute("SELECT * FROM tariff_plans WHERE id = ?", (plan_id,))
         row = cursor.fetchone()
         if not row:
@@ -2206,6 +1704,7 @@ def update_whitelist_tariff():
             ))
         
         conn.commit()
+        database.invalidate_config_cache()
         return jsonify({'success': True})
     finally:
         conn.close()
@@ -2220,6 +1719,7 @@ def delete_tariff(plan_id: int):
     try:
         cursor.execute("UPDATE tariff_plans SET is_active = 0 WHERE id = ?", (plan_id,))
         conn.commit()
+        database.invalidate_config_cache()
         return jsonify({'success': True})
     finally:
         conn.close()
@@ -2228,24 +1728,17 @@ def delete_tariff(plan_id: int):
 @require_auth
 def get_whitelist_settings():
     """Получить настройки whitelist bypass"""
-    conn = database.get_db_connection()
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute("SELECT * FROM whitelist_settings ORDER BY id DESC LIMIT 1")
-        row = cursor.fetchone()
-        if row:
-            return jsonify(dict(row))
-        return jsonify({
-            'subscription_fee': 100.0,
-            'price_per_gb': 15.0,
-            'min_gb': 5,
-            'max_gb': 500,
-            'auto_pay_enabled': True,
-            'auto_pay_threshold_mb': 100
-        })
-    finally:
-        conn.close()
+    settings = database.get_whitelist_settings()
+    if settings:
+        return jsonify(settings)
+    return jsonify({
+        'subscription_fee': 100.0,
+        'price_per_gb': 15.0,
+        'min_gb': 5,
+        'max_gb': 500,
+        'auto_pay_enabled': True,
+        'auto_pay_threshold_mb': 100
+    })
 
 @app.route('/api/panel/whitelist/settings', methods=['PUT'])
 @require_auth
@@ -2285,6 +1778,7 @@ def update_whitelist_settings():
                 data.get('auto_pay_threshold_mb', 100)
             ))
         conn.commit()
+        database.invalidate_config_cache()
         return jsonify({'success': True})
     finally:
         conn.close()
@@ -2390,22 +1884,7 @@ def delete_auto_discount(discount_id: int):
 @require_auth
 def get_public_pages():
     """Получить публичные страницы"""
-    conn = database.get_db_connection()
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute("SELECT * FROM public_pages")
-        rows = cursor.fetchall()
-        pages = {}
-        for row in rows:
-            pages[row['page_type']] = {
-                'id': row['id'],
-                'content': row['content'],
-                'updated_at': row['updated_at']
-            }
-        return jsonify(pages)
-    finally:
-        conn.close()
+    return jsonify(database.get_public_pages())
 
 @app.route('/api/panel/public-pages/<page_type>', methods=['PUT'])
 @require_auth
@@ -2429,6 +1908,7 @@ def update_public_page(page_type: str):
                 VALUES (?, ?)
             """, (page_type, data.get('content', '')))
         conn.commit()
+        database.invalidate_config_cache()
         return jsonify({'success': True})
     finally:
         conn.close()
@@ -2436,45 +1916,24 @@ def update_public_page(page_type: str):
 @app.route('/api/public-pages', methods=['GET'])
 def get_all_public_pages():
     """Получить все публичные страницы (публичный эндпоинт для мини-приложения)"""
-    conn = database.get_db_connection()
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute("SELECT page_type, content, updated_at FROM public_pages")
-        rows = cursor.fetchall()
-        pages = {}
-        for row in rows:
-            pages[row['page_type']] = {
-                'content': row['content'],
-                'updated_at': row['updated_at']
-            }
-        return jsonify(pages)
-    finally:
-        conn.close()
+    pages = {
+        page_type: {'content': page['content'], 'updated_at': page['updated_at']}
+        for page_type, page in database.get_public_pages().items()
+    }
+    return jsonify(pages)
 
 
 @app.route('/api/public-pages/<page_type>', methods=['GET'])
 def get_public_page(page_type: str):
     """Получить публичную страницу (публичный эндпоинт для мини-приложения)"""
-    conn = database.get_db_connection()
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute("SELECT content FROM public_pages WHERE page_type = ?", (page_type,))
-        row = cursor.fetchone()
-        if row:
-            return jsonify({'content': row['content']})
-        return jsonify({'content': ''})
-    finally:
-        conn.close()
+    page = database.get_public_pages().get(page_type)
+    return jsonify({'content': page['content'] if page else ''})
 
 @app.route('/api/panel/settings', methods=['GET'])
 @require_auth
 def get_settings():
     """Получить настройки системы"""
     import os
-    conn = database.get_db_connection()
-    cursor = conn.cursor()
     
     def mask_token(token: str) -> str:
         """Маскирует токен, показывая только первые и последние 4 символа"""
@@ -2482,36 +1941,32 @@ def get_settings():
             return token
         return token[:4] + '...' + token[-4:]
     
-    try:
-        # Настройки из БД
-        cursor.execute("SELECT setting_key, setting_value FROM system_settings")
-        db_settings = {row['setting_key']: row['setting_value'] for row in cursor.fetchall()}
-        
-        # Добавляем сквады по умолчанию
-        db_settings['default_squads'] = database.get_default_squads()
-        
-        # Настройки из .env
-        env_settings = {
-            'MINIAPP_URL': os.getenv('MINIAPP_URL', ''),
-            'PANEL_URL': os.getenv('PANEL_URL', ''),
-            'API_URL': os.getenv('API_URL', ''),
-            'BOT_USERNAME': os.getenv('BOT_USERNAME', 'blnnnbot'),
-            'TRIAL_HOURS': os.getenv('TRIAL_HOURS', '24'),
-            'MIN_TOPUP_AMOUNT': os.getenv('MIN_TOPUP_AMOUNT', '50'),
-            'MAX_TOPUP_AMOUNT': os.getenv('MAX_TOPUP_AMOUNT', '100000'),
-            # Токены (частично замаскированные для безопасности)
-            'TELEGRAM_BOT_TOKEN': mask_token(os.getenv('TELEGRAM_BOT_TOKEN', '')),
-            'SUPPORT_BOT_TOKEN': mask_token(os.getenv('SUPPORT_BOT_TOKEN', '')),
-            'TELEGRAM_ADMIN_ID': os.getenv('TELEGRAM_ADMIN_ID', ''),
-            'TELEGRAM_SUPPORT_GROUP_ID': os.getenv('TELEGRAM_SUPPORT_GROUP_ID', ''),
-            # Remnawave
-            'REMWAVE_PANEL_URL': os.getenv('REMWAVE_PANEL_URL', os.getenv('REMWAVE_API_URL', '')),
-            'REMWAVE_API_KEY': mask_token(os.getenv('REMWAVE_API_KEY', '')),
-        }
-        
-        return jsonify({**db_settings, **env_settings})
-    finally:
-        conn.close()
+    # Настройки из БД
+    db_settings = database.get_system_settings()
+    
+    # Добавляем сквады по умолчанию
+    db_settings['default_squads'] = database.get_default_squads()
+    
+    # Настройки из .env
+    env_settings = {
+        'MINIAPP_URL': os.getenv('MINIAPP_URL', ''),
+        'PANEL_URL': os.getenv('PANEL_URL', ''),
+        'API_URL': os.getenv('API_URL', ''),
+        'BOT_USERNAME': os.getenv('BOT_USERNAME', 'blnnnbot'),
+        'TRIAL_HOURS': os.getenv('TRIAL_HOURS', '24'),
+        'MIN_TOPUP_AMOUNT': os.getenv('MIN_TOPUP_AMOUNT', '50'),
+        'MAX_TOPUP_AMOUNT': os.getenv('MAX_TOPUP_AMOUNT', '100000'),
+        # Токены (частично замаскированные для безопасности)
+        'TELEGRAM_BOT_TOKEN': mask_token(os.getenv('TELEGRAM_BOT_TOKEN', '')),
+        'SUPPORT_BOT_TOKEN': mask_token(os.getenv('SUPPORT_BOT_TOKEN', '')),
+        'TELEGRAM_ADMIN_ID': os.getenv('TELEGRAM_ADMIN_ID', ''),
+        'TELEGRAM_SUPPORT_GROUP_ID': os.getenv('TELEGRAM_SUPPORT_GROUP_ID', ''),
+        # Remnawave
+        'REMWAVE_PANEL_URL': os.getenv('REMWAVE_PANEL_URL', os.getenv('REMWAVE_API_URL', '')),
+        'REMWAVE_API_KEY': mask_token(os.getenv('REMWAVE_API_KEY', '')),
+    }
+    
+    return jsonify({**db_settings, **env_settings})
 
 @app.route('/api/panel/settings', methods=['PUT'])
 @require_auth
@@ -2532,6 +1987,7 @@ def update_settings():
                 """, (key, str(value)))
         
         conn.commit()
+        database.invalidate_config_cache()
         return jsonify({'success': True})
     finally:
         conn.close()
@@ -2573,21 +2029,7 @@ def set_default_squads():
 @require_auth
 def get_payment_fees():
     """Получить комиссии платежных систем"""
-    conn = database.get_db_connection()
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute("SELECT * FROM payment_fees")
-        rows = cursor.fetchall()
-        fees = {}
-        for row in rows:
-            fees[row['payment_method']] = {
-                'fee_percent': float(row['fee_percent']),
-                'fee_fixed': float(row['fee_fixed'])
-            }
-        return jsonify(fees)
-    finally:
-        conn.close()
+    return jsonify(database.get_payment_fees())
 
 @app.route('/api/panel/payment-fees', methods=['PUT'])
 @require_auth
@@ -2604,6 +2046,7 @@ def update_payment_fees():
                 VALUES (?, ?, ?, CURRENT_TIMESTAMP)
             """, (method, fees.get('fee_percent', 0), fees.get('fee_fixed', 0)))
         conn.commit()
+        database.invalidate_config_cache()
         return jsonify({'success': True})
     finally:
         conn.close()
@@ -2680,24 +2123,24 @@ def update_payment_settings(provider: str):
 @app.route('/api/panel/backups/status', methods=['GET'])
 @require_auth
 def get_backup_status():
-    """Получить статус резервного копирования"""
+    """Получить статус резервного копирования, последние запуски и архивы на диске"""
     conn = database.get_db_connection()
     cursor = conn.cursor()
     
     try:
         cursor.execute("SELECT * FROM backup_settings ORDER BY id DESC LIMIT 1")
         row = cursor.fetchone()
-        if row:
-            return jsonify({
-                'enabled': bool(row['enabled']),
-                'interval_hours': row['interval_hours'],
-                'last_backup': row['last_backup']
-            })
-        return jsonify({
-            'enabled': False,
-            'interval_hours': 12,
-            'last_backup': None
-        })
+        history = backups.get_history()
+        status = {
+            'enabled': bool(row['enabled']) if row else False,
+            'interval_hours': row['interval_hours'] if row else 12,
+            'last_backup': row['last_backup'] if row else None,
+            'last_run': history[0] if history else None,
+            'history': history,
+            'files': backups.list_backups(),
+            'keep': backups.BACKUP_KEEP,
+        }
+        return jsonify(status)
     finally:
         conn.close()
 
@@ -2732,81 +2175,81 @@ def update_backup_settings():
 @app.route('/api/panel/backups/create', methods=['POST'])
 @require_auth
 def create_backup():
-    """Создать резервную копию и отправить администратору"""
-    import os
-    import shutil
-    import tempfile
-    from datetime import datetime
-    
+    """Создать резервную копию в фоне и отправить администратору (прогресс - /api/panel/backups/status)"""
     try:
-        db_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'data', 'blinvpn.db')
-        
-        if not os.path.exists(db_path):
-            return jsonify({'error': 'Database file not found'}), 404
-        
-        # Создаем временный файл с копией БД
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        backup_name = f'blinvpn_backup_{timestamp}.db'
-        
-        with tempfile.TemporaryDirectory() as temp_dir:
-            backup_path = os.path.join(temp_dir, backup_name)
-            shutil.copy2(db_path, backup_path)
-            
-            # Создаем zip архив
-            zip_path = os.path.join(temp_dir, f'{backup_name}.zip')
-            shutil.make_archive(backup_path, 'zip', temp_dir, backup_name)
-            
-            # Отправляем файл администратору
-            admin_id = os.getenv('TELEGRAM_ADMIN_ID')
-            bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
-            
-            if admin_id and bot_token:
-                import requests
-                with open(f'{backup_path}.zip', 'rb') as f:
-                    url = f"https://api.telegram.org/bot{bot_token}/sendDocument"
-                    response = requests.post(
-                        url,
-                        data={
-                            'chat_id': admin_id,
-                            'caption': f'🗄️ Резервная копия БД\n📅 {datetime.now().strftime("%d.%m.%Y %H:%M")}'
-                        },
-                        files={'document': (f'{backup_name}.zip', f, 'application/zip')},
-                        timeout=30
-                    )
-                    if response.status_code != 200:
-                        logger.error(f"Failed to send backup: {response.text}")
-                        return jsonify({'error': 'Failed to send backup to admin'}), 500
-        
-        # Обновляем время последнего бекапа
-        conn = database.get_db_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute("UPDATE backup_settings SET last_backup = CURRENT_TIMESTAMP")
-            conn.commit()
-        finally:
-            conn.close()
-        
-        return jsonify({'success': True})
+        return jsonify(backups.start_backup('manual')), 202
+    except backups.BackupInProgress as e:
+        return jsonify({'error': str(e)}), 409
     except Exception as e:
         logger.error(f"Backup creation error: {e}")
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/panel/history/<table>', methods=['GET'])
+@require_auth
+def get_history(table: str):
+    """
+    Строки transactions, traffic_stats или ticket_messages вместе с архивом, новые первыми.
+    Фильтры: user_id, type, status, payment_provider, vpn_key_id, ticket_id (по таблице), date_from, date_to, limit
+    """
+    try:
+        conditions, params = archive.build_conditions(table, request.args)
+        rows = archive.query(table, conditions, params, request.args.get('date_from'), request.args.get('date_to'),
+                             pagination.page_size(request.args.get('limit', type=int)))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(rows)
+
+
+@app.route('/api/panel/system/archive', methods=['GET'])
+@require_auth
+def get_archive_status():
+    """Архивация по месяцам: граница, строки в основной БД и в партициях, размер файлов"""
+    return jsonify(archive.get_status())
+
+
+@app.route('/api/panel/system/db-pool', methods=['GET'])
+@require_auth
+def get_db_pool_status():
+    """Состояние пула соединений с БД (hit rate, время ожидания, занятые соединения)"""
+    return jsonify(database.check_pool_health())
+
+
+@app.route('/api/panel/system/jobs', methods=['GET'])
+@require_auth
+def get_background_jobs():
+    """Состояние периодических фоновых задач"""
+    return jsonify(scheduler.get_jobs_status())
+
+
+@app.route('/api/panel/system/notifications', methods=['GET'])
+@require_auth
+def get_notification_outbox():
+    """Очередь уведомлений: ожидают отправки, отправлены, не доставлены (dead letters)"""
+    return jsonify(notifications.get_outbox_stats())
+
+
+@app.route('/api/panel/system/provisioning', methods=['GET'])
+@require_auth
+def get_provisioning_queue():
+    """Очередь создания подписок: ожидают, выполняются, созданы, не созданы (оплата возвращена)"""
+    return jsonify(provisioning.get_queue_stats())
+
+
+@app.route('/api/panel/system/happ-cache', methods=['GET'])
+@require_auth
+def get_happ_link_cache_stats():
+    """Кеш зашифрованных ссылок Happ: попадания в память и SQLite, запросы в crypto.happ.su"""
+    return jsonify(happ.happ_api.stats())
+
+
 @app.route('/api/panel/remnawave/squads', methods=['GET'])
 @require_auth
 def get_remnawave_squads():
     """Получить список сквадов из Remnawave"""
     try:
-        import asyncio
-        from backend.api.remnawave import get_remnawave_api, RemnaWaveAPI
-        
-        async def fetch_squads():
-            api = get_remnawave_api()
-            async with api as connected_api:
-                internal_squads = await connected_api.get_internal_squads()
-                return [{'uuid': s.uuid, 'name': s.name, 'members_count': s.members_count} for s in internal_squads]
-        
-        squads = asyncio.run(fetch_squads())
+        internal_squads = remnawave.remnawave_api.get_internal_squads()
+        squads = [{'uuid': s.uuid, 'name': s.name, 'members_count': s.members_count} for s in internal_squads]
         return jsonify(squads)
     except Exception as e:
         logger.error(f"Error fetching Remnawave squads: {e}")
@@ -2817,129 +2260,78 @@ def get_remnawave_squads():
 @require_auth
 def sync_remnawave_keys():
     """Синхронизировать ключи с Remnawave - удалить из БД ключи, которых нет в Remnawave"""
+    dry_run = request.args.get('dry_run', '').lower() in ('1', 'true', 'yes')
     try:
-        result = core.sync_keys_with_remnawave()
+        result = core.sync_keys_with_remnawave(dry_run=dry_run)
         return jsonify(result)
     except Exception as e:
         logger.error(f"Error syncing with Remnawave: {e}")
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/panel/users/mass-action', methods=['POST'])
+@app.route('/api/panel/remnawave/reconcile', methods=['POST'])
 @require_auth
-def mass_user_action():
-    """Массовые действия над пользователями"""
-    data = request.get_json()
-    action_type = data.get('action')
-    value = data.get('value', '')
-    notify = data.get('notify', False)
-    user_ids = data.get('user_ids', [])  # Если пустой - применить ко всем
-    
-    conn = database.get_db_connection()
-    cursor = conn.cursor()
-    
+def reconcile_remnawave_keys():
+    """Сверить срок, трафик, лимит и статус ключей с Remnawave (?full=1 - без водяного знака)"""
+    full = request.args.get('full', '').lower() in ('1', 'true', 'yes')
+    dry_run = request.args.get('dry_run', '').lower() in ('1', 'true', 'yes')
     try:
-        # Получаем список пользователей
-        if user_ids:
-            placeholders = ','.join('?' * len(user_ids))
-            cursor.execute(f"SELECT id, telegram_id, balance FROM users WHERE id IN ({placeholders})", user_ids)
-        else:
-            cursor.execute("SELECT id, telegram_id, balance FROM users")
-        users = cursor.fetchall()
-        
-        affected = 0
-        notifications = []
-        
-        for user in users:
-            user_id = user['id']
-            telegram_id = user['telegram_id']
-            
-            if action_type == 'MASS_ADD_BALANCE':
-                amount = float(value)
-                cursor.execute("UPDATE users SET balance = balance + ? WHERE id = ?", (amount, user_id))
-                cursor.execute("""
-                    INSERT INTO transactions (user_id, amount, type, status, description)
-                    VALUES (?, ?, 'deposit', 'Success', 'Начисление от администрации')
-                """, (user_id, amount))
-                if notify:
-                    notifications.append((telegram_id, f"💰 Вам начислено {amount} ₽ на баланс!"))
-                affected += 1
-                
-            elif action_type == 'MASS_ADD_DAYS':
-                days = int(value)
-                cursor.execute("""
-                    UPDATE vpn_keys SET expiry_date = datetime(
-                        CASE WHEN expiry_date > datetime('now') THEN expiry_date ELSE datetime('now') END,
-                        '+' || ? || ' days'
-                    ) WHERE user_id = ?
-                """, (days, user_id))
-                if notify:
-                    notifications.append((telegram_id, f"⏰ Ваша подписка продлена на {days} дней!"))
-                affected += 1
-                
-            elif action_type == 'MASS_BAN':
-                cursor.execute("UPDATE users SET is_banned = 1 WHERE id = ?", (user_id,))
-                if notify:
-                    notifications.append((telegram_id, f"⛔ Ваш аккаунт заблокирован. Причина: {value or 'Не указана'}"))
-                affected += 1
-                
-            elif action_type == 'MASS_UNBAN':
-                cursor.execute("UPDATE users SET is_banned = 0 WHERE id = ?", (user_id,))
-                if notify:
-                    notifications.append((telegram_id, "✅ Ваш аккаунт разблокирован!"))
-                affected += 1
-                
-            elif action_type == 'MASS_RESET_TRIAL':
-                cursor.execute("UPDATE users SET trial_used = 0 WHERE id = ?", (user_id,))
-                if notify:
-                    notifications.append((telegram_id, "🎁 Ваш пробный период сброшен! Вы можете снова воспользоваться триалом."))
-                affected += 1
-                
-            elif action_type == 'MASS_DELETE_KEYS':
-                cursor.execute("DELETE FROM vpn_keys WHERE user_id = ?", (user_id,))
-                if notify:
-                    notifications.append((telegram_id, "🔑 Ваши VPN ключи были удалены."))
-                affected += 1
-                
-            elif action_type == 'MASS_SET_PARTNER':
-                rate = int(value) if value else 20
-                cursor.execute("UPDATE users SET is_partner = 1, partner_rate = ? WHERE id = ?", (rate, user_id))
-                if notify:
-                    notifications.append((telegram_id, f"🤝 Вы стали партнером! Ваша комиссия: {rate}%"))
-                affected += 1
-                
-            elif action_type == 'MASS_REMOVE_PARTNER':
-                cursor.execute("UPDATE users SET is_partner = 0, partner_rate = 0 WHERE id = ?", (user_id,))
-                if notify:
-                    notifications.append((telegram_id, "👤 Ваш партнерский статус отменен."))
-                affected += 1
-        
-        conn.commit()
-        
-        # Отправляем уведомления через бота (асинхронно)
-        if notifications:
-            from threading import Thread
-            def send_notifications():
-                import asyncio
-                from aiogram import Bot
-                bot = Bot(token=os.getenv('TELEGRAM_BOT_TOKEN', ''))
-                async def send_all():
-                    for tg_id, msg in notifications:
-                        try:
-                            await bot.send_message(tg_id, msg)
-                        except Exception as e:
-                            logger.warning(f"Failed to send notification to {tg_id}: {e}")
-                    await bot.session.close()
-                asyncio.run(send_all())
-            Thread(target=send_notifications, daemon=True).start()
-        
-        return jsonify({'success': True, 'affected': affected})
+        return jsonify(reconcile.reconcile_keys_with_remnawave(full=full, dry_run=dry_run))
     except Exception as e:
-        conn.rollback()
-        logger.error(f"Mass action error: {e}")
+        logger.error(f"Error reconciling keys with Remnawave: {e}")
         return jsonify({'error': str(e)}), 500
-    finally:
-        conn.close()
+
+
+@app.route('/api/panel/remnawave/reconcile', methods=['GET'])
+@require_auth
+def get_reconcile_state():
+    """Водяной знак и отчет последней сверки с Remnawave"""
+    return jsonify(database.get_sync_state(reconcile.SYNC_NAME) or {})
+
+
+@app.route('/api/panel/search', methods=['GET'])
+@require_auth
+def search_panel():
+    """Поиск по пользователям, ключам, транзакциям и тикетам (?q=...&types=user,key&limit=20)"""
+    query = request.args.get('q', '').strip()
+    if len(query) < search.MIN_QUERY_LENGTH:
+        return jsonify({'error': f'Query must be at least {search.MIN_QUERY_LENGTH} characters'}), 400
+    types = [t for t in request.args.get('types', '').split(',') if t]
+    unknown = [t for t in types if t not in database.SEARCH_KINDS]
+    if unknown:
+        return jsonify({'error': f"Unknown types: {', '.join(unknown)}"}), 400
+    try:
+        return jsonify(search.search(query, request.args.get('limit', search.DEFAULT_LIMIT, type=int), types))
+    except database.sqlite3.OperationalError as e:
+        logger.error(f"Search failed: {e}")
+        return jsonify({'error': 'Search index is unavailable'}), 503
+
+
+@app.route('/api/panel/users/mass-action', methods=['POST'])
+@require_auth
+def mass_user_action():
+    """Массовые действия над пользователями (выполняются в фоне пачками, прогресс - GET /mass-action/<id>)"""
+    data = request.get_json() or {}
+    try:
+        result = mass_actions.start_mass_action(
+            data.get('action'),
+            data.get('value', ''),
+            notify=data.get('notify', False),
+            user_ids=data.get('user_ids', []),  # Если пустой - применить ко всем
+        )
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'success': True, 'action_id': result['id'], 'status': result['status']}), 202
+
+
+@app.route('/api/panel/users/mass-action/<int:action_id>', methods=['GET'])
+@require_auth
+def get_mass_action_status(action_id: int):
+    """Прогресс массового действия"""
+    status = mass_actions.get_mass_action_status(action_id)
+    if not status:
+        return jsonify({'error': 'Mass action not found'}), 404
+    return jsonify(status)
 
 
 @app.route('/api/panel/users/<int:user_id>/action', methods=['POST'])
@@ -3047,6 +2439,36 @@ def single_user_action(user_id):
         conn.close()
 
 
+def start_background_workers():
+    """Зарегистрировать и запустить периодические фоновые задачи"""
+    stats.register_jobs()
+    reconcile.register_jobs()
+    abuse_detected.register_jobs()
+    whitelist_billing.register_jobs()
+    notifications.register_jobs()
+    provisioning.register_jobs()
+    happ.register_jobs()
+    backups.register_jobs()
+    archive.register_jobs()
+    mass_actions.register_jobs()
+    scheduler.start_scheduler()
+    mailing.start_mailing_dispatcher()
+    notifications.start_notification_dispatcher()
+    provisioning.start_provisioning_dispatcher()
+
+
+def stop_background_workers():
+    """Остановить фоновые задачи и закрыть соединения (graceful shutdown воркера)"""
+    scheduler.stop_scheduler()
+    mailing.stop_mailing_dispatcher()
+    notifications.stop_notification_dispatcher()
+    provisioning.stop_provisioning_dispatcher()
+    remnawave.remnawave_api.close()
+    database.close_pool()
+
+
 if __name__ == '__main__':
+    # Сервер разработки; в продакшене: gunicorn -c backend/api/gunicorn.conf.py
+    start_background_workers()
     app.run(host='0.0.0.0', port=int(os.getenv('API_PORT', 8000)))
 
@@ -7,12 +7,17 @@ from typing import Dict, Any, Optional
 from flask import Flask, request, jsonify
 from backend.api import yookassa, heleket, platega
 from backend.database import database
-from backend.core import core
+from backend.core import core, notifications
 
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
+@app.teardown_request
+def release_db_connection(exc):
+    """Вернуть соединение потока в пул после обработки запроса"""
+    database.release_thread_connection()
+
 def notify_admin_about_deposit(user: Dict, amount: float, method: str, provider: str):
     """Уведомить администратора только о успешном пополнении баланса"""
     username = user.get('username', 'N/A')
@@ -29,6 +34,30 @@ def notify_admin_about_deposit(user: Dict, amount: float, method: str, provider:
     
     core.send_notification_to_admin(message)
 
+def deposit_not_credited(deposit: Dict, provider: str, payment_id: str, user_id: int, amount: float) -> bool:
+    """
+    Разобрать отказ record_deposit: повтор - в лог, платеж для неизвестного пользователя -
+    ошибка и уведомление администратору (деньги получены, но не зачислены).
+
+    Returns:
+        True, если платеж не зачислен и обработку webhook'а надо завершить
+    """
+    if deposit['status'] == 'duplicate':
+        logger.info(f"{provider} платеж {payment_id} уже обработан")
+        return True
+    if deposit['status'] == 'user_not_found':
+        logger.error(f"{provider} платеж {payment_id} на {amount}₽ не зачислен: пользователь {user_id} не найден")
+        core.send_notification_to_admin(
+            f"⚠️ <b>Платеж не зачислен</b>\n\n"
+            f"🆔 Пользователь {user_id} не найден\n"
+            f"💵 Сумма: {amount}₽\n"
+            f"🏦 Провайдер: {provider}\n"
+            f"🧾 Платеж: {payment_id}\n\n"
+            f"Проверьте платеж и зачислите вручную."
+        )
+        return True
+    return False
+
 @app.route('/yookassa', methods=['POST'])
 def yookassa_webhook():
     """Обработка webhook от YooKassa"""
@@ -51,66 +80,31 @@ def yookassa_webhook():
             
             user_id = int(user_id)
             
-            # Проверяем, не был ли уже обработан этот платеж
-            conn = database.get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT id FROM transactions WHERE payment_id = ? AND payment_provider = 'YooKassa'",
-                (payment_id,)
-            )
-            existing = cursor.fetchone()
-            conn.close()
-            
-            if existing:
-                logger.info(f"YooKassa платеж {payment_id} уже обработан")
-                return jsonify({'status': 'ok'}), 200
-            
-            # Проверяем, сохранен ли способ оплаты для рекуррентных платежей
             payment_method = object_data.get('payment_method', {})
             payment_method_id = payment_method.get('id')
             payment_method_saved = payment_method.get('saved', False)
             payment_method_type = payment_method.get('type', 'bank_card')
-            
-            # Сохраняем способ оплаты, если он был сохранен
+            card_info = payment_method.get('card', {})
+            saved_method = None
+            # Способ оплаты сохраняется для рекуррентных платежей в той же транзакции, что и зачисление
             if payment_method_saved and payment_method_id:
-                conn = database.get_db_connection()
-                cursor = conn.cursor()
-                try:
-                    card_info = payment_method.get('card', {})
-                    cursor.execute("""
-                        INSERT OR REPLACE INTO saved_payment_methods 
-                        (user_id, payment_provider, payment_method_id, payment_method_type, 
-                         card_last4, card_brand, is_active)
-                        VALUES (?, 'YooKassa', ?, ?, ?, ?, 1)
-                    """, (
-                        user_id,
-                        payment_method_id,
-                        payment_method_type,
-                        card_info.get('last4'),
-                        card_info.get('card_type')
-                    ))
-                    conn.commit()
-                    logger.info(f"Сохранен способ оплаты {payment_method_id} для пользователя {user_id}")
-                except Exception as e:
-                    logger.error(f"Ошибка сохранения способа оплаты: {e}")
-                finally:
-                    conn.close()
-            
-            # Обновляем баланс пользователя
-            database.update_user_balance(user_id, amount)
-            
-            # Создаем транзакцию
-            conn = database.get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO transactions (user_id, type, amount, status, payment_method, payment_provider, payment_id)
-                VALUES (?, 'deposit', ?, 'Success', ?, 'YooKassa', ?)
-            """, (user_id, amount, 'СБП' if payment_method_type == 'sbp' else 'Карта', payment_id))
-            conn.commit()
-            conn.close()
-            
-            # Уведомление пользователю
-            user = database.get_user_by_id(user_id)
+                saved_method = {
+                    'payment_method_id': payment_method_id,
+                    'payment_method_type': payment_method_type,
+                    'card_last4': card_info.get('last4'),
+                    'card_brand': card_info.get('card_type'),
+                }
+
+            deposit = database.record_deposit(
+                'YooKassa', payment_id, user_id, amount,
+                'СБП' if payment_method_type == 'sbp' else 'Карта',
+                saved_method=saved_method,
+            )
+            if deposit_not_credited(deposit, 'YooKassa', payment_id, user_id, amount):
+                return jsonify({'status': 'ok'}), 200
+
+            # Уведомления - после коммита
+            user = deposit['user']
             if user:
                 msg = f"✅ Баланс пополнен на {amount}₽ через YooKassa"
                 if payment_method_saved:
@@ -161,39 +155,18 @@ def heleket_webhook():
             if len(parts) >= 2 and parts[0] == 'heleket':
                 user_id = int(parts[1])
                 
-                # Проверяем, не был ли уже обработан этот платеж
-                conn = database.get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute(
-                    "SELECT id FROM transactions WHERE payment_id = ? AND payment_provider = 'Heleket'",
-                    (uuid or order_id,)
-                )
-                existing = cursor.fetchone()
-                conn.close()
-                
-                if existing:
-                    logger.info(f"Heleket платеж {uuid or order_id} уже обработан")
-                    return jsonify({'status': 'ok'}), 200
-                
-                # Обновляем баланс
-                database.update_user_balance(user_id, amount)
-                
-                # Создаем транзакцию
-                conn = database.get_db_connection()
-                cursor = conn.cursor()
                 description = f"Пополнение через Heleket"
                 if payer_amount and payer_currency:
                     description += f" ({payer_amount} {payer_currency})"
-                    
-                cursor.execute("""
-                    INSERT INTO transactions (user_id, type, amount, status, payment_method, payment_provider, payment_id, description)
-                    VALUES (?, 'deposit', ?, 'Success', 'Crypto', 'Heleket', ?, ?)
-                """, (user_id, amount, uuid or order_id, description))
-                conn.commit()
-                conn.close()
-                
-                # Уведомление пользователю
-                user = database.get_user_by_id(user_id)
+
+                deposit = database.record_deposit(
+                    'Heleket', uuid or order_id, user_id, amount, 'Crypto', description=description
+                )
+                if deposit_not_credited(deposit, 'Heleket', uuid or order_id, user_id, amount):
+                    return jsonify({'status': 'ok'}), 200
+
+                # Уведомления - после коммита
+                user = deposit['user']
                 if user:
                     msg = f"✅ Баланс пополнен на {amount}₽ через Heleket"
                     if payer_amount and payer_currency:
@@ -245,39 +218,20 @@ def platega_webhook():
                 logger.error(f"Platega webhook: не удалось извлечь user_id из payload {payload}")
                 return jsonify({'status': 'ok'}), 200
             
-            # Проверяем, не был ли уже обработан этот платеж
-            conn = database.get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT id FROM transactions WHERE payment_id = ? AND payment_provider = 'Platega'",
-                (transaction_id,)
-            )
-            existing = cursor.fetchone()
-            conn.close()
-            
-            if existing:
-                logger.info(f"Platega платеж {transaction_id} уже обработан")
+            if not transaction_id:
+                logger.error(f"Platega webhook без transactionId: {data}")
                 return jsonify({'status': 'ok'}), 200
-            
+
             # Определяем метод оплаты из данных
             payment_method = data.get('paymentMethod', 0)
             method_name = 'СБП' if payment_method == 1 else 'Карта'
-            
-            # Обновляем баланс
-            database.update_user_balance(user_id, amount)
-            
-            # Создаем транзакцию
-            conn = database.get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO transactions (user_id, type, amount, status, payment_method, payment_provider, payment_id)
-                VALUES (?, 'deposit', ?, 'Success', ?, 'Platega', ?)
-            """, (user_id, amount, method_name, transaction_id))
-            conn.commit()
-            conn.close()
-            
-            # Уведомление пользователю
-            user = database.get_user_by_id(user_id)
+
+            deposit = database.record_deposit('Platega', str(transaction_id), user_id, amount, method_name)
+            if deposit_not_credited(deposit, 'Platega', transaction_id, user_id, amount):
+                return jsonify({'status': 'ok'}), 200
+
+            # Уведомления - после коммита
+            user = deposit['user']
             if user:
                 core.send_notification_to_user(
                     user['telegram_id'], 
@@ -301,8 +255,20 @@ def health_check():
         'status': 'ok',
         'yookassa_configured': yookassa.yookassa_api.is_configured(),
         'heleket_configured': heleket.heleket_api.is_configured,
-        'platega_configured': platega.platega_api.is_configured
+        'platega_configured': platega.platega_api.is_configured,
+        'database': database.check_pool_health()
     })
 
+def start_background_workers():
+    """Запустить фоновую отправку уведомлений о платежах (аренда в БД - один отправитель на все процессы)"""
+    notifications.start_notification_dispatcher()
+
+def stop_background_workers():
+    """Остановить отправку уведомлений и закрыть соединения"""
+    notifications.stop_notification_dispatcher()
+    database.close_pool()
+
 if __name__ == '__main__':
+    # Сервер разработки; в продакшене: GUNICORN_APP=backend.api.webhook:app gunicorn -c backend/api/gunicorn.conf.py
+    start_background_workers()
     app.run(host='0.0.0.0', port=int(os.getenv('WEBHOOK_PORT', 5000)))
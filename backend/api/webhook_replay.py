@@ -0,0 +1,133 @@
+"""
+Бенчмарк "шторма повторов" webhook'ов: параллельные дубликаты одного платежа
+через маршрут /yookassa, проверка однократного зачисления и пропускная способность
+
+    python -m backend.api.webhook_replay --db /tmp/replay.db --duplicates 1000 --concurrency 50
+    python -m backend.api.webhook_replay --db /tmp/replay.db --payments 20 --duplicates 200
+
+Запросы идут в приложение webhook.app в процессе (test client) и пишут
+синтетических пользователей и платежи, поэтому бенчмарк работает только
+с отдельным файлом БД (--db).
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _callback(payment_id: str, user_id: int, amount: float) -> Dict[str, Any]:
+    """Тело webhook'а YooKassa payment.succeeded с сохраненным способом оплаты"""
+    return {
+        'event': 'payment.succeeded',
+        'object': {
+            'id': payment_id,
+            'amount': {'value': f"{amount:.2f}", 'currency': 'RUB'},
+            'metadata': {'user_id': str(user_id)},
+            'payment_method': {'id': f"pm-{payment_id}", 'saved': True, 'type': 'bank_card', 'card': {'last4': '4242'}},
+        },
+    }
+
+
+def run(payments: int, duplicates: int, concurrency: int, amount: float = 100.0) -> Dict[str, Any]:
+    """
+    Отправить duplicates одинаковых callback'ов для каждого из payments платежей
+    в concurrency потоков и сверить результат с ожидаемым (одно зачисление на платеж).
+    """
+    from backend.api import webhook
+    from backend.database import database
+
+    telegram_id = int(time.time() * 1000) % 10 ** 9
+    user_id = database.bootstrap_user(telegram_id, f"replay_{telegram_id}")['id']
+    balance_before = database.get_user_by_id(user_id)['balance'] or 0
+    payment_ids = [f"replay-{uuid.uuid4()}" for _ in range(payments)]
+    bodies = [_callback(payment_id, user_id, amount) for payment_id in payment_ids for _ in range(duplicates)]
+
+    lock = threading.Lock()
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    local = threading.local()
+
+    def send(body: Dict[str, Any]):
+        if not hasattr(local, 'client'):
+            local.client = webhook.app.test_client()
+        started = time.perf_counter()
+        response = local.client.post('/yookassa', json=body)
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            latencies.append(elapsed)
+            statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, bodies))
+    elapsed = time.monotonic() - started
+
+    with database.db_connection() as conn:
+        ids = json.dumps(payment_ids)
+        ledger = conn.execute(
+            "SELECT COUNT(*) FROM payment_ledger WHERE payment_provider = 'YooKassa' AND payment_id IN (SELECT value FROM json_each(?))",
+            (ids,)
+        ).fetchone()[0]
+        transactions = conn.execute(
+            "SELECT COUNT(*) FROM transactions WHERE payment_provider = 'YooKassa' AND payment_id IN (SELECT value FROM json_each(?))",
+            (ids,)
+        ).fetchone()[0]
+        saved_methods = conn.execute(
+            "SELECT COUNT(*) FROM saved_payment_methods WHERE user_id = ?", (user_id,)
+        ).fetchone()[0]
+    balance = database.get_user_by_id(user_id)['balance'] or 0
+    credited = round(balance - balance_before, 2)
+
+    latencies.sort()
+    return {
+        'ok': ledger == payments and transactions == payments and credited == round(amount * payments, 2)
+              and saved_methods == payments and statuses == {'200': len(bodies)},
+        'requests': len(bodies),
+        'payments': payments,
+        'duplicates_per_payment': duplicates,
+        'concurrency': concurrency,
+        'statuses': statuses,
+        'ledger_rows': ledger,
+        'transactions': transactions,
+        'saved_methods': saved_methods,
+        'credited': credited,
+        'expected_credit': round(amount * payments, 2),
+        'seconds': round(elapsed, 2),
+        'rps': round(len(bodies) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(_percentile(latencies, 0.50), 2),
+        'p95_ms': round(_percentile(latencies, 0.95), 2),
+        'p99_ms': round(_percentile(latencies, 0.99), 2),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m backend.api.webhook_replay')
+    parser.add_argument('--db', required=True, help='Отдельный файл БД для бенчмарка (не рабочая БД)')
+    parser.add_argument('--payments', type=int, default=1, help='Число разных платежей')
+    parser.add_argument('--duplicates', type=int, default=1000, help='Одинаковых callback\'ов на платеж')
+    parser.add_argument('--concurrency', type=int, default=50, help='Число параллельных отправителей')
+    args = parser.parse_args(argv)
+    # БД задается до импорта database: импорт выполняет init_database() по DB_PATH
+    os.environ['DB_PATH'] = args.db
+    from backend.database import database
+    database.DB_PATH = args.db
+    database.init_database()
+
+    report = run(args.payments, args.duplicates, args.concurrency)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0 if report['ok'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,7 +4,9 @@ API модуль для работы с YooKassa
 """
 import os
 import uuid
+import asyncio
 import logging
+import aiohttp
 from typing import Optional, Dict, Any
 from yookassa import Configuration, Payment, Refund
 
@@ -12,6 +14,7 @@ logger = logging.getLogger(__name__)
 
 YOOKASSA_SHOP_ID = os.getenv('YOOKASSA_SHOP_ID', '')
 YOOKASSA_SECRET_KEY = os.getenv('YOOKASSA_SECRET_KEY', '')
+YOOKASSA_API_URL = os.getenv('YOOKASSA_API_URL', 'https://api.yookassa.ru/v3').rstrip('/')
 
 # Настройка YooKassa
 if YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY:
@@ -26,6 +29,53 @@ class YooKassaAPI:
         """Проверить, настроен ли YooKassa"""
         return bool(YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY)
     
+    @staticmethod
+    def _payment_data(amount: float, description: str, return_url: str,
+                      user_id: int = None, metadata: Dict = None,
+                      save_payment_method: bool = False,
+                      payment_method_id: str = None,
+                      payment_type: str = 'bank_card') -> Dict[str, Any]:
+        """Тело запроса на создание платежа (общее для SDK и асинхронного клиента)"""
+        payment_data = {
+            "amount": {
+                "value": f"{amount:.2f}",
+                "currency": "RUB"
+            },
+            "capture": True,
+            "description": description
+        }
+        
+        # Если используется сохраненный способ оплаты - автоплатеж
+        if payment_method_id:
+            payment_data["payment_method_id"] = payment_method_id
+        else:
+            # Обычный платеж с подтверждением
+            if payment_type == 'sbp':
+                # СБП платеж через YooKassa
+                payment_data["confirmation"] = {
+                    "type": "redirect",
+                    "return_url": return_url
+                }
+                payment_data["payment_method_data"] = {
+                    "type": "sbp"
+                }
+            else:
+                # Банковская карта
+                payment_data["confirmation"] = {
+                    "type": "redirect",
+                    "return_url": return_url
+                }
+                
+            # Сохранение способа оплаты для будущих автоплатежей
+            if save_payment_method:
+                payment_data["save_payment_method"] = True
+        
+        if metadata:
+            payment_data["metadata"] = metadata
+        elif user_id:
+            payment_data["metadata"] = {"user_id": str(user_id)}
+        return payment_data
+    
     @staticmethod
     def create_payment(amount: float, description: str, return_url: str, 
                       user_id: int = None, metadata: Dict = None, 
@@ -49,44 +99,10 @@ class YooKassaAPI:
             return None
             
         try:
-            payment_data = {
-                "amount": {
-                    "value": f"{amount:.2f}",
-                    "currency": "RUB"
-                },
-                "capture": True,
-                "description": description
-            }
-            
-            # Если используется сохраненный способ оплаты - автоплатеж
-            if payment_method_id:
-                payment_data["payment_method_id"] = payment_method_id
-            else:
-                # Обычный платеж с подтверждением
-                if payment_type == 'sbp':
-                    # СБП платеж через YooKassa
-                    payment_data["confirmation"] = {
-                        "type": "redirect",
-                        "return_url": return_url
-                    }
-                    payment_data["payment_method_data"] = {
-                        "type": "sbp"
-                    }
-                else:
-                    # Банковская карта
-                    payment_data["confirmation"] = {
-                        "type": "redirect",
-                        "return_url": return_url
-                    }
-                    
-                # Сохранение способа оплаты для будущих автоплатежей
-                if save_payment_method:
-                    payment_data["save_payment_method"] = True
-            
-            if metadata:
-                payment_data["metadata"] = metadata
-            elif user_id:
-                payment_data["metadata"] = {"user_id": str(user_id)}
+            payment_data = YooKassaAPI._payment_data(
+                amount, description, return_url, user_id, metadata,
+                save_payment_method, payment_method_id, payment_type
+            )
             
             idempotence_key = str(uuid.uuid4())
             payment = Payment.create(payment_data, idempotence_key)
@@ -119,6 +135,55 @@ class YooKassaAPI:
             logger.error(f"YooKassa payment creation error: {e}")
             return None
     
+    @staticmethod
+    async def create_payment_async(session: aiohttp.ClientSession, amount: float, description: str,
+                                   return_url: str, user_id: int = None, metadata: Dict = None,
+                                   save_payment_method: bool = False, payment_method_id: str = None,
+                                   payment_type: str = 'bank_card') -> Optional[Dict]:
+        """Создать платеж в YooKassa через REST API (асинхронно, общая сессия aiohttp)"""
+        if not YooKassaAPI.is_configured():
+            logger.error("YooKassa не настроен: отсутствуют SHOP_ID или SECRET_KEY")
+            return None
+        
+        payment_data = YooKassaAPI._payment_data(
+            amount, description, return_url, user_id, metadata,
+            save_payment_method, payment_method_id, payment_type
+        )
+        try:
+            async with session.post(
+                f"{YOOKASSA_API_URL}/payments",
+                json=payment_data,
+                auth=aiohttp.BasicAuth(YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY),
+                headers={'Idempotence-Key': str(uuid.uuid4())},
+                timeout=aiohttp.ClientTimeout(total=30),
+            ) as response:
+                payment = await response.json(content_type=None)
+                if response.status >= 400:
+                    logger.error(f"YooKassa payment creation error: HTTP {response.status}: {payment}")
+                    return None
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.error(f"YooKassa payment creation error: {e}")
+            return None
+        
+        result = {
+            'id': payment['id'],
+            'status': payment['status'],
+            'confirmation_url': (payment.get('confirmation') or {}).get('confirmation_url'),
+            'amount': float(payment['amount']['value']),
+            'paid': payment.get('paid', False)
+        }
+        payment_method = payment.get('payment_method') or {}
+        if payment_method.get('saved'):
+            result['payment_method_id'] = payment_method.get('id')
+            result['payment_method_saved'] = True
+            card = payment_method.get('card') or {}
+            if card:
+                result['card_last4'] = card.get('last4')
+                result['card_brand'] = card.get('card_type')
+        
+        logger.info(f"YooKassa платеж создан: {payment['id']} на сумму {amount}₽")
+        return result
+    
     @staticmethod
     def create_sbp_payment(amount: float, description: str, return_url: str,
                           user_id: int = None, metadata: Dict = None) -> Optional[Dict]:
@@ -1,9 +1,14 @@
 """
 Алгоритм определения злоупотреблений трафиком
 """
+import os
+import json
+import time
 import logging
+from collections import Counter
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Iterable
 from backend.database import database
 
 logger = logging.getLogger(__name__)
@@ -12,6 +17,10 @@ logger = logging.getLogger(__name__)
 MAX_SIMULTANEOUS_DEVICES = 1
 MAX_DAILY_TRAFFIC_GB = 80
 MAX_BANNED_KEYS_FOR_BAN = 3
+TRAFFIC_INGEST_BATCH_SIZE = int(os.getenv('TRAFFIC_INGEST_BATCH_SIZE', '1000'))
+TRAFFIC_INGEST_INTERVAL = int(os.getenv('TRAFFIC_INGEST_INTERVAL', '300'))
+# Автоматически банить нарушителей при приеме трафика (0 - только отчет to_ban в логе)
+TRAFFIC_AUTO_BAN = os.getenv('TRAFFIC_AUTO_BAN', '0') == '1'
 
 def check_device_limit(user_id: int, hwid: str) -> Dict[str, Any]:
     """
@@ -186,3 +195,249 @@ def update_key_hwid(vpn_key_id: int, hwid: str):
     finally:
         conn.close()
 
+
+
+# ========== Пакетный прием показаний трафика ==========
+
+@dataclass
+class TrafficSnapshot:
+    """Показание счетчика трафика ключа (накопительное, как отдает Remnawave)"""
+    vpn_key_id: int
+    user_id: int
+    used_bytes: float
+    hwid: Optional[str] = None
+
+
+def _ingest_batch(cursor, batch: List[TrafficSnapshot], day: str) -> Dict[str, float]:
+    """Приросты трафика одного пакета: одна выборка прошлых показаний и executemany на запись"""
+    cursor.execute(
+        "SELECT vpn_key_id, used_bytes FROM traffic_snapshots WHERE vpn_key_id IN (SELECT value FROM json_each(?))",
+        (json.dumps([snapshot.vpn_key_id for snapshot in batch]),)
+    )
+    previous = {row[0]: row[1] for row in cursor.fetchall()}
+
+    deltas = []
+    total = 0.0
+    for snapshot in batch:
+        before = previous.get(snapshot.vpn_key_id)
+        if before is None:
+            # Первое показание - точка отсчета, накопленный ранее трафик не относится к сегодняшнему дню
+            continue
+        # Счетчик меньше прошлого - трафик был сброшен, весь текущий объем набран после сброса
+        delta = snapshot.used_bytes - before if snapshot.used_bytes >= before else snapshot.used_bytes
+        if delta > 0:
+            deltas.append((snapshot.vpn_key_id, snapshot.user_id, day, delta))
+            total += delta
+
+    cursor.executemany("""
+        INSERT INTO traffic_stats (vpn_key_id, user_id, date, traffic_bytes)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(vpn_key_id, date) DO UPDATE SET
+            traffic_bytes = traffic_bytes + excluded.traffic_bytes
+    """, deltas)
+    cursor.executemany("""
+        INSERT INTO traffic_snapshots (vpn_key_id, used_bytes, taken_at)
+        VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(vpn_key_id) DO UPDATE SET
+            used_bytes = excluded.used_bytes,
+            taken_at = excluded.taken_at
+    """, [(snapshot.vpn_key_id, snapshot.used_bytes) for snapshot in batch])
+    cursor.executemany("""
+        UPDATE vpn_keys SET hwid_hash = ?, last_used = CURRENT_TIMESTAMP WHERE id = ?
+    """, [(database.hash_hwid(snapshot.hwid), snapshot.vpn_key_id) for snapshot in batch if snapshot.hwid])
+    return {'deltas': len(deltas), 'bytes': total}
+
+
+def find_traffic_abusers(day: str = None) -> List[Dict[str, Any]]:
+    """
+    Ключи, превысившие MAX_DAILY_TRAFFIC_GB за сутки и еще не забаненные.
+    Правило проверяется одним запросом по traffic_stats за день.
+    """
+    day = day or datetime.now().date().isoformat()
+    with database.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT t.vpn_key_id, t.user_id, k.key_uuid, t.traffic_bytes
+            FROM traffic_stats t
+            JOIN vpn_keys k ON k.id = t.vpn_key_id
+            WHERE t.date = ? AND t.traffic_bytes > ? AND k.status != 'Banned'
+            ORDER BY t.traffic_bytes DESC
+        """, (day, MAX_DAILY_TRAFFIC_GB * 1024 ** 3))
+        return [
+            {
+                'vpn_key_id': row['vpn_key_id'],
+                'user_id': row['user_id'],
+                'key_uuid': row['key_uuid'],
+                'traffic_gb': round(row['traffic_bytes'] / (1024 ** 3), 2),
+            }
+            for row in cursor.fetchall()
+        ]
+
+
+def ingest_traffic_snapshots(snapshots: Iterable[TrafficSnapshot], day: str = None) -> Dict[str, Any]:
+    """
+    Принять показания трафика по ключам.
+
+    Приросты считаются относительно прошлых показаний (traffic_snapshots),
+    traffic_stats обновляется одним executemany на пакет, каждый пакет -
+    одна транзакция. После записи лимит MAX_DAILY_TRAFFIC_GB проверяется
+    одним запросом.
+
+    Returns:
+        Dict с количеством ключей, приростов, байт и списком ключей на бан (to_ban)
+    """
+    day = day or datetime.now().date().isoformat()
+    started = time.monotonic()
+    keys = 0
+    deltas = 0
+    total_bytes = 0.0
+    batch: List[TrafficSnapshot] = []
+
+    def flush():
+        nonlocal deltas, total_bytes
+        with database.transaction() as conn:
+            result = _ingest_batch(conn.cursor(), batch, day)
+        deltas += result['deltas']
+        total_bytes += result['bytes']
+        batch.clear()
+
+    for snapshot in snapshots:
+        batch.append(snapshot)
+        keys += 1
+        if len(batch) >= TRAFFIC_INGEST_BATCH_SIZE:
+            flush()
+    if batch:
+        flush()
+
+    to_ban = find_traffic_abusers(day)
+    duration = time.monotonic() - started
+    return {
+        'keys': keys,
+        'deltas': deltas,
+        'traffic_gb': round(total_bytes / (1024 ** 3), 2),
+        'to_ban': to_ban,
+        'duration_ms': int(duration * 1000),
+        'keys_per_second': int(keys / duration) if duration > 0 else keys,
+    }
+
+
+def apply_traffic_bans(to_ban: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Забанить ключи из списка find_traffic_abusers одной транзакцией.
+    Счетчики banned_keys_count увеличиваются только для реально забаненных ключей,
+    аккаунты с MAX_BANNED_KEYS_FOR_BAN и более забаненных ключей блокируются.
+    """
+    if not to_ban:
+        return {'banned_keys': 0, 'banned_key_ids': [], 'banned_users': []}
+
+    key_ids = json.dumps([item['vpn_key_id'] for item in to_ban])
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, user_id FROM vpn_keys
+            WHERE id IN (SELECT value FROM json_each(?)) AND status != 'Banned'
+        """, (key_ids,))
+        keys = cursor.fetchall()
+        per_user = Counter(row['user_id'] for row in keys)
+
+        cursor.execute("""
+            UPDATE vpn_keys SET status = 'Banned'
+            WHERE id IN (SELECT value FROM json_each(?)) AND status != 'Banned'
+        """, (key_ids,))
+        cursor.executemany(
+            "UPDATE users SET banned_keys_count = banned_keys_count + ? WHERE id = ?",
+            [(count, user_id) for user_id, count in per_user.items()]
+        )
+
+        user_ids = json.dumps(list(per_user))
+        cursor.execute("""
+            SELECT id FROM users
+            WHERE id IN (SELECT value FROM json_each(?)) AND banned_keys_count >= ? AND is_banned = 0
+        """, (user_ids, MAX_BANNED_KEYS_FOR_BAN))
+        banned_users = [row['id'] for row in cursor.fetchall()]
+        cursor.execute("""
+            UPDATE users
+            SET is_banned = 1, ban_reason = 'Превышен лимит забаненных ключей (3+)'
+            WHERE id IN (SELECT value FROM json_each(?))
+        """, (json.dumps(banned_users),))
+
+    return {'banned_keys': len(keys), 'banned_key_ids': [row['id'] for row in keys], 'banned_users': banned_users}
+
+
+def disable_banned_in_remnawave(key_ids: List[int], user_ids: List[int]) -> Dict[str, Optional[str]]:
+    """
+    Отключить в Remnawave забаненные ключи и все ключи заблокированных аккаунтов,
+    иначе VPN продолжает работать при бане в БД.
+
+    Returns:
+        Dict key_uuid -> None при успехе или текст ошибки
+    """
+    from backend.api import remnawave
+    with database.db_connection() as conn:
+        uuids = [row['key_uuid'] for row in conn.execute("""
+            SELECT key_uuid FROM vpn_keys
+            WHERE key_uuid IS NOT NULL
+              AND (id IN (SELECT value FROM json_each(?)) OR user_id IN (SELECT value FROM json_each(?)))
+        """, (json.dumps(key_ids), json.dumps(user_ids)))]
+    if not uuids:
+        return {}
+    errors = remnawave.remnawave_api.disable_users_sync(uuids)
+    failed = {uuid: error for uuid, error in errors.items() if error}
+    if failed:
+        logger.error(f"Traffic abuse: failed to disable {len(failed)} keys in Remnawave: {failed}")
+    return errors
+
+
+def snapshots_from_remnawave(users) -> List[TrafficSnapshot]:
+    """Показания трафика из пользователей Remnawave (RemnaWaveUser.user_traffic) для ключей из БД"""
+    with database.db_connection() as conn:
+        key_map = {
+            row['key_uuid']: (row['id'], row['user_id'])
+            for row in conn.execute("SELECT id, user_id, key_uuid FROM vpn_keys WHERE key_uuid IS NOT NULL")
+        }
+    snapshots = []
+    for user in users:
+        key = key_map.get(user.uuid)
+        if key and user.user_traffic:
+            snapshots.append(TrafficSnapshot(key[0], key[1], float(user.user_traffic.used_traffic_bytes)))
+    return snapshots
+
+
+def run_traffic_ingestion() -> Dict[str, Any]:
+    """
+    Задача планировщика: загрузить показания из Remnawave и записать приросты.
+    Нарушители (to_ban) попадают в лог; банятся (в БД и в Remnawave) только при TRAFFIC_AUTO_BAN=1.
+    """
+    from backend.api import remnawave
+    from backend.core import core
+    result = remnawave.remnawave_api.get_all_users_concurrently_sync(
+        page_size=core.REMWAVE_SYNC_PAGE_SIZE, concurrency=core.REMWAVE_SYNC_CONCURRENCY
+    )
+    report = ingest_traffic_snapshots(snapshots_from_remnawave(result['users']))
+    if not report['to_ban']:
+        return report
+    if not TRAFFIC_AUTO_BAN:
+        logger.warning(
+            f"Traffic abuse: {len(report['to_ban'])} keys over {MAX_DAILY_TRAFFIC_GB} GB/day "
+            f"(TRAFFIC_AUTO_BAN disabled): {[item['vpn_key_id'] for item in report['to_ban'][:50]]}"
+        )
+        return report
+
+    bans = apply_traffic_bans(report['to_ban'])
+    if bans['banned_keys']:
+        errors = disable_banned_in_remnawave(bans['banned_key_ids'], bans['banned_users'])
+        bans['remnawave_failed'] = sum(1 for error in errors.values() if error)
+        logger.warning(
+            f"Traffic abuse: banned {bans['banned_keys']} keys, {len(bans['banned_users'])} accounts: "
+            f"{bans['banned_key_ids'][:50]}"
+        )
+    report.update(bans)
+    return report
+
+
+def register_jobs():
+    """Зарегистрировать прием трафика в планировщике (TRAFFIC_INGEST_INTERVAL=0 отключает)"""
+    if TRAFFIC_INGEST_INTERVAL <= 0:
+        return
+    from backend.core import scheduler
+    scheduler.register_job('traffic_ingest', run_traffic_ingestion, TRAFFIC_INGEST_INTERVAL, initial_delay=90)
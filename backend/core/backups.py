@@ -0,0 +1,313 @@
+"""
+Онлайн-резервное копирование БД через SQLite backup API
+
+Копия снимается sqlite3.Connection.backup пачками по BACKUP_PAGES_PER_STEP
+страниц с паузой BACKUP_STEP_SLEEP между пачками, поэтому диск не
+занимается целиком и API продолжает работать. На исходном соединении на все
+время копирования держится читающая транзакция: в режиме WAL она не мешает
+писателям, а копия получается согласованной на момент начала и не
+перезапускается при каждой записи в БД.
+
+Готовая копия проверяется PRAGMA integrity_check (BACKUP_VERIFY), потоково
+сжимается gzip в BACKUP_DIR и, если помещается в лимит Bot API, отправляется
+администратору. Хранятся последние BACKUP_KEEP архивов. Длительность этапов,
+размер и скорость (байт/с) пишутся в backup_runs.
+"""
+import os
+import gzip
+import time
+import shutil
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from typing import Optional, Dict, Any, List
+import requests
+from backend.database import database
+
+logger = logging.getLogger(__name__)
+
+BACKUP_DIR = os.getenv('BACKUP_DIR') or os.path.join(os.path.dirname(os.path.abspath(database.DB_PATH)), 'backups')
+BACKUP_PAGES_PER_STEP = int(os.getenv('BACKUP_PAGES_PER_STEP', '1024'))
+BACKUP_STEP_SLEEP = float(os.getenv('BACKUP_STEP_SLEEP', '0.005'))
+BACKUP_VERIFY = os.getenv('BACKUP_VERIFY', 'full')  # full - integrity_check, quick - quick_check, off
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '7'))
+BACKUP_SEND_TO_ADMIN = os.getenv('BACKUP_SEND_TO_ADMIN', '1') == '1'
+BACKUP_SEND_MAX_BYTES = int(os.getenv('BACKUP_SEND_MAX_BYTES', str(50 * 1024 * 1024)))  # Лимит sendDocument
+BACKUP_CHECK_INTERVAL = 300
+COMPRESS_CHUNK_SIZE = 1024 * 1024
+FILE_PREFIX = 'blinvpn_backup_'
+FILE_SUFFIX = '.db.gz'
+LEASE_NAME = 'database_backup_run'
+LEASE_TTL = 6 * 3600
+HISTORY_SIZE = 10
+
+_lock = threading.Lock()
+
+
+class BackupInProgress(Exception):
+    """Резервная копия уже создается"""
+
+
+def _copy(dest_path: str) -> Dict[str, int]:
+    """Онлайн-копия БД в dest_path пачками страниц"""
+    source = sqlite3.connect(database.DB_PATH, timeout=30, isolation_level=None)
+    dest = sqlite3.connect(dest_path, isolation_level=None)
+    steps = 0
+
+    def progress(status, remaining, total):
+        nonlocal steps
+        steps += 1
+        if remaining and BACKUP_STEP_SLEEP > 0:
+            time.sleep(BACKUP_STEP_SLEEP)
+
+    try:
+        # Снимок на все время копирования: иначе любая запись другим соединением перезапускает backup
+        source.execute("BEGIN")
+        source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        source.backup(dest, pages=BACKUP_PAGES_PER_STEP, progress=progress)
+        source.execute("COMMIT")
+        # Копия - один самодостаточный файл: без WAL проверка и сжатие не оставляют -wal/-shm
+        dest.execute("PRAGMA journal_mode=DELETE")
+        return {'steps': steps}
+    finally:
+        dest.close()
+        source.close()
+
+
+def _verify(path: str) -> str:
+    """Проверка целостности копии; 'ok' или текст первых ошибок"""
+    if BACKUP_VERIFY == 'off':
+        return 'skipped'
+    pragma = 'quick_check' if BACKUP_VERIFY == 'quick' else 'integrity_check'
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = [row[0] for row in conn.execute(f"PRAGMA {pragma}(20)").fetchall()]
+    finally:
+        conn.close()
+    return 'ok' if rows == ['ok'] else '; '.join(rows)
+
+
+def _compress(source_path: str, dest_path: str):
+    """Потоковое сжатие gzip кусками по COMPRESS_CHUNK_SIZE (файл не читается в память целиком)"""
+    partial_path = dest_path + '.partial'
+    with open(source_path, 'rb') as source, gzip.open(partial_path, 'wb', compresslevel=6) as dest:
+        shutil.copyfileobj(source, dest, COMPRESS_CHUNK_SIZE)
+    os.replace(partial_path, dest_path)
+
+
+def _send_to_admin(path: str, file_name: str, caption: str) -> bool:
+    """Отправить архив администратору в Telegram"""
+    admin_id = os.getenv('TELEGRAM_ADMIN_ID')
+    bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
+    if not BACKUP_SEND_TO_ADMIN or not admin_id or not bot_token:
+        return False
+    size = os.path.getsize(path)
+    if size > BACKUP_SEND_MAX_BYTES:
+        logger.warning(f"Backup {file_name} is {size} bytes, over the Telegram limit; kept on disk only")
+        return False
+    from backend.core import telegram_client
+    with open(path, 'rb') as f:
+        response = requests.post(
+            f"{telegram_client.TELEGRAM_API_URL}/bot{bot_token}/sendDocument",
+            data={'chat_id': admin_id, 'caption': caption},
+            files={'document': (file_name, f, 'application/gzip')},
+            timeout=120
+        )
+    if response.status_code != 200:
+        logger.error(f"Failed to send backup: {response.text}")
+        return False
+    return True
+
+
+def list_backups() -> List[Dict[str, Any]]:
+    """Архивы в BACKUP_DIR, новые первыми"""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    files = []
+    for name in os.listdir(BACKUP_DIR):
+        if name.startswith(FILE_PREFIX) and name.endswith(FILE_SUFFIX):
+            stat = os.stat(os.path.join(BACKUP_DIR, name))
+            files.append({'file_name': name, 'size': stat.st_size, 'modified_at': stat.st_mtime})
+    return sorted(files, key=lambda item: item['file_name'], reverse=True)
+
+
+def rotate_backups(keep: int = BACKUP_KEEP) -> int:
+    """Удалить архивы сверх последних keep; количество удаленных"""
+    removed = 0
+    for item in list_backups()[max(keep, 1):]:
+        try:
+            os.remove(os.path.join(BACKUP_DIR, item['file_name']))
+            removed += 1
+        except OSError as e:
+            logger.warning(f"Failed to remove old backup {item['file_name']}: {e}")
+    return removed
+
+
+def _start_run(trigger: str) -> int:
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO backup_runs (trigger) VALUES (?)", (trigger,))
+        return cursor.lastrowid
+
+
+def _finish_run(run_id: int, **fields):
+    fields['finished_at'] = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    columns = ', '.join(f"{name} = ?" for name in fields)
+    with database.transaction() as conn:
+        conn.execute(f"UPDATE backup_runs SET {columns} WHERE id = ?", (*fields.values(), run_id))
+        if fields.get('status') == 'ok':
+            conn.execute("UPDATE backup_settings SET last_backup = CURRENT_TIMESTAMP")
+
+
+def run_backup(trigger: str = 'manual', run_id: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Создать резервную копию в текущем потоке.
+
+    Args:
+        trigger: Источник запуска ('manual' или 'schedule')
+        run_id: Уже созданная запись backup_runs (для запуска из API)
+
+    Returns:
+        Запись backup_runs; BackupInProgress, если копия уже создается
+    """
+    from backend.core import scheduler
+    if not _lock.acquire(blocking=False):
+        raise BackupInProgress("Backup is already running")
+    try:
+        if not scheduler.acquire_lease(LEASE_NAME, LEASE_TTL):
+            raise BackupInProgress("Backup is already running in another process")
+        try:
+            return _run(trigger, run_id)
+        finally:
+            scheduler.release_lease(LEASE_NAME)
+    finally:
+        _lock.release()
+
+
+def _run(trigger: str, run_id: Optional[int]) -> Dict[str, Any]:
+    run_id = run_id or _start_run(trigger)
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    now = datetime.now()
+    file_name = f"{FILE_PREFIX}{now.strftime('%Y%m%d_%H%M%S')}{FILE_SUFFIX}"
+    archive_path = os.path.join(BACKUP_DIR, file_name)
+    copy_path = os.path.join(BACKUP_DIR, f".{file_name[:-len('.gz')]}.tmp")
+    started = time.monotonic()
+    try:
+        stage = time.monotonic()
+        copy_info = _copy(copy_path)
+        copy_ms = int((time.monotonic() - stage) * 1000)
+        db_bytes = os.path.getsize(copy_path)
+
+        stage = time.monotonic()
+        integrity = _verify(copy_path)
+        verify_ms = int((time.monotonic() - stage) * 1000)
+        if integrity not in ('ok', 'skipped'):
+            raise RuntimeError(f"Integrity check failed: {integrity}")
+
+        stage = time.monotonic()
+        _compress(copy_path, archive_path)
+        compress_ms = int((time.monotonic() - stage) * 1000)
+        os.remove(copy_path)
+
+        duration_ms = int((time.monotonic() - started) * 1000)
+        bytes_per_second = int(db_bytes / max(copy_ms, 1) * 1000)
+        compressed_bytes = os.path.getsize(archive_path)
+        logger.info(f"Backup {file_name}: {db_bytes} bytes in {copy_info['steps']} steps, copy {copy_ms} ms "
+                    f"({bytes_per_second} B/s), verify {verify_ms} ms, compress {compress_ms} ms -> "
+                    f"{compressed_bytes} bytes")
+
+        sent = False
+        try:
+            sent = _send_to_admin(archive_path, file_name,
+                                  f'🗄️ Резервная копия БД\n📅 {now.strftime("%d.%m.%Y %H:%M")}')
+        except Exception as e:
+            logger.error(f"Failed to send backup: {e}")
+        rotate_backups()
+
+        _finish_run(run_id, status='ok', file_name=file_name, db_bytes=db_bytes, compressed_bytes=compressed_bytes,
+                    copy_ms=copy_ms, verify_ms=verify_ms, compress_ms=compress_ms, duration_ms=duration_ms,
+                    bytes_per_second=bytes_per_second, integrity=integrity, sent_to_admin=1 if sent else 0)
+    except Exception as e:
+        logger.error(f"Backup error: {e}")
+        for path in (copy_path, archive_path + '.partial'):
+            if os.path.exists(path):
+                os.remove(path)
+        _finish_run(run_id, status='failed', error=str(e),
+                    duration_ms=int((time.monotonic() - started) * 1000))
+        raise
+    return get_run(run_id)
+
+
+def start_backup(trigger: str = 'manual') -> Dict[str, Any]:
+    """Создать резервную копию в фоновом потоке; BackupInProgress, если копия уже создается"""
+    if _lock.locked():
+        raise BackupInProgress("Backup is already running")
+    run_id = _start_run(trigger)
+    threading.Thread(target=_run_in_thread, args=(trigger, run_id), name=f"backup-{run_id}", daemon=True).start()
+    return {'id': run_id, 'status': 'running'}
+
+
+def _run_in_thread(trigger: str, run_id: int):
+    try:
+        run_backup(trigger, run_id)
+    except BackupInProgress as e:
+        _finish_run(run_id, status='skipped', error=str(e))
+    except Exception:
+        pass
+    finally:
+        database.release_thread_connection()
+
+
+def get_run(run_id: int) -> Optional[Dict[str, Any]]:
+    with database.db_connection() as conn:
+        row = conn.execute("SELECT * FROM backup_runs WHERE id = ?", (run_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def get_history(limit: int = HISTORY_SIZE) -> List[Dict[str, Any]]:
+    """Последние запуски резервного копирования"""
+    with database.db_connection() as conn:
+        rows = conn.execute("SELECT * FROM backup_runs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def run_scheduled_backup() -> Dict[str, Any]:
+    """Создать копию, если резервное копирование включено и с последней прошло interval_hours"""
+    with database.db_connection() as conn:
+        row = conn.execute("""
+            SELECT enabled, interval_hours,
+                   last_backup IS NULL OR last_backup <= datetime('now', '-' || interval_hours || ' hours') AS due
+            FROM backup_settings ORDER BY id DESC LIMIT 1
+        """).fetchone()
+    if not row or not row['enabled']:
+        return {'skipped': 'disabled'}
+    if not row['due']:
+        return {'skipped': 'not_due'}
+    try:
+        run = run_backup('schedule')
+    except BackupInProgress:
+        return {'skipped': 'in_progress'}
+    return {'file_name': run['file_name'], 'duration_ms': run['duration_ms'],
+            'bytes_per_second': run['bytes_per_second']}
+
+
+def cleanup_runs() -> Dict[str, int]:
+    """Пометить зависшие запуски (процесс завершился во время копии) и удалить старую историю"""
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE backup_runs SET status = 'failed', error = 'Interrupted', finished_at = CURRENT_TIMESTAMP
+            WHERE status = 'running' AND started_at < datetime('now', ?)
+        """, (f'-{LEASE_TTL} seconds',))
+        interrupted = cursor.rowcount
+        cursor.execute("DELETE FROM backup_runs WHERE started_at < datetime('now', '-90 days')")
+        deleted = cursor.rowcount
+    return {'interrupted': interrupted, 'deleted': deleted}
+
+
+def register_jobs():
+    """Зарегистрировать проверку расписания резервного копирования в планировщике"""
+    from backend.core import scheduler
+    scheduler.register_job('database_backup', run_scheduled_backup, BACKUP_CHECK_INTERVAL, initial_delay=120)
+    scheduler.register_job('backup_runs_cleanup', cleanup_runs, 24 * 3600, initial_delay=1800)
@@ -1,53 +1,138 @@
 """
 Модуль для автоматического обновления черного списка
 Обновляется раз в 60 минут из GitHub
+
+Список хранится в памяти процесса как frozenset и подменяется целиком,
+поэтому проверка не обращается к БД. Загрузка условная (ETag /
+If-Modified-Since): неизменившийся список не скачивается и не пишется.
+В БД применяется только разница (добавленные и удаленные ID) одной транзакцией.
+Другие процессы замечают обновление по отпечатку списка в sync_state.
 """
 import os
+import hashlib
 import requests
 import logging
 import time
 import threading
+from typing import Dict, Any, FrozenSet, Optional
 from backend.database import database
 
 logger = logging.getLogger(__name__)
 
-BLACKLIST_URL = "https://raw.githubusercontent.com/Blin4ickUSE/ban-vpn/refs/heads/main/blacklist.txt"
+BLACKLIST_URL = os.getenv('BLACKLIST_URL', "https://raw.githubusercontent.com/Blin4ickUSE/ban-vpn/refs/heads/main/blacklist.txt")
 UPDATE_INTERVAL = 3600  # 60 минут
+# Как часто процессы сверяют отпечаток списка в БД с версией в памяти (секунды)
+BLACKLIST_REFRESH_INTERVAL = float(os.getenv('BLACKLIST_REFRESH_INTERVAL', '60'))
+SYNC_NAME = 'blacklist'
+
+_blacklist: Optional[FrozenSet[int]] = None
+_blacklist_digest: Optional[str] = None
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def _digest(telegram_ids) -> str:
+    """Отпечаток списка (не зависит от порядка строк в файле)"""
+    return hashlib.sha1(','.join(map(str, sorted(telegram_ids))).encode()).hexdigest()
+
+
+def _load_from_db() -> FrozenSet[int]:
+    with database.db_connection() as conn:
+        return frozenset(row[0] for row in conn.execute("SELECT telegram_id FROM blacklist"))
+
+
+def _swap(telegram_ids: FrozenSet[int], digest: str):
+    """Атомарно подменить список в памяти"""
+    global _blacklist, _blacklist_digest, _checked_at
+    _blacklist = telegram_ids
+    _blacklist_digest = digest
+    _checked_at = time.monotonic()
+
+
+def _refresh_if_changed():
+    """Перечитать список из БД, если его обновил другой процесс"""
+    state = database.get_sync_state(SYNC_NAME)
+    digest = state['watermark'] if state else None
+    if _blacklist is None or digest != _blacklist_digest:
+        telegram_ids = _load_from_db()
+        _swap(telegram_ids, digest or _digest(telegram_ids))
+    else:
+        global _checked_at
+        _checked_at = time.monotonic()
+
+
+def is_blacklisted(telegram_id: int) -> bool:
+    """Проверить ID по списку в памяти (отпечаток в БД сверяется не чаще BLACKLIST_REFRESH_INTERVAL)"""
+    if _blacklist is None or time.monotonic() - _checked_at >= BLACKLIST_REFRESH_INTERVAL:
+        with _lock:
+            if _blacklist is None or time.monotonic() - _checked_at >= BLACKLIST_REFRESH_INTERVAL:
+                _refresh_if_changed()
+    return telegram_id in _blacklist
+
+
+def _parse(text: str) -> FrozenSet[int]:
+    telegram_ids = set()
+    for line in text.strip().split('\n'):
+        line = line.strip()
+        if line and line.isdigit():
+            telegram_ids.add(int(line))
+    return frozenset(telegram_ids)
+
 
-def update_blacklist():
-    """Обновить черный список из GitHub"""
+def update_blacklist() -> Dict[str, Any]:
+    """
+    Обновить черный список из GitHub.
+
+    Returns:
+        Dict с количеством записей, добавленных и удаленных ID и признаком not_modified
+    """
     try:
-        response = requests.get(BLACKLIST_URL, timeout=10)
+        state = database.get_sync_state(SYNC_NAME) or {}
+        details = state.get('details') or {}
+        headers = {}
+        if details.get('etag'):
+            headers['If-None-Match'] = details['etag']
+        if details.get('last_modified'):
+            headers['If-Modified-Since'] = details['last_modified']
+
+        response = requests.get(BLACKLIST_URL, headers=headers, timeout=10)
+        if response.status_code == 304:
+            with _lock:
+                _refresh_if_changed()
+            logger.info(f"Blacklist not modified: {len(_blacklist)} entries")
+            return {'count': len(_blacklist), 'added': 0, 'removed': 0, 'not_modified': True}
         response.raise_for_status()
-        
-        telegram_ids = []
-        for line in response.text.strip().split('\n'):
-            line = line.strip()
-            if line and line.isdigit():
-                telegram_ids.append(int(line))
-        
-        # Обновляем БД
-        conn = database.get_db_connection()
-        cursor = conn.cursor()
-        
-        # Очищаем старый список
-        cursor.execute("DELETE FROM blacklist")
-        
-        # Добавляем новые записи
-        for telegram_id in telegram_ids:
-            try:
-                cursor.execute("INSERT OR IGNORE INTO blacklist (telegram_id) VALUES (?)", (telegram_id,))
-            except Exception as e:
-                logger.warning(f"Failed to add {telegram_id} to blacklist: {e}")
-        
-        conn.commit()
-        conn.close()
-        
-        logger.info(f"Blacklist updated: {len(telegram_ids)} entries")
-        return len(telegram_ids)
+
+        telegram_ids = _parse(response.text)
+        if not telegram_ids:
+            # Пустой ответ скорее означает сбой источника, чем пустой список - не стираем БД
+            logger.warning("Blacklist source returned no IDs, keeping current list")
+            return {'count': len(_blacklist or ()), 'added': 0, 'removed': 0, 'not_modified': False}
+
+        # Обновляем БД только разницей
+        with database.transaction() as conn:
+            cursor = conn.cursor()
+            current = frozenset(row[0] for row in cursor.execute("SELECT telegram_id FROM blacklist"))
+            added = telegram_ids - current
+            removed = current - telegram_ids
+            cursor.executemany("DELETE FROM blacklist WHERE telegram_id = ?", ((telegram_id,) for telegram_id in removed))
+            cursor.executemany("INSERT OR IGNORE INTO blacklist (telegram_id) VALUES (?)", ((telegram_id,) for telegram_id in added))
+
+            digest = _digest(telegram_ids)
+            database.set_sync_state(SYNC_NAME, digest, {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'count': len(telegram_ids),
+            })
+
+        with _lock:
+            _swap(telegram_ids, digest)
+
+        logger.info(f"Blacklist updated: {len(telegram_ids)} entries (+{len(added)} / -{len(removed)})")
+        return {'count': len(telegram_ids), 'added': len(added), 'removed': len(removed), 'not_modified': False}
     except Exception as e:
         logger.error(f"Failed to update blacklist: {e}")
-        return 0
+        return {'count': len(_blacklist or ()), 'added': 0, 'removed': 0, 'error': str(e)}
 
 def blacklist_updater_worker():
     """Рабочий поток для обновления черного списка"""
@@ -68,4 +153,3 @@ def start_blacklist_updater():
     thread = threading.Thread(target=blacklist_updater_worker, daemon=True)
     thread.start()
     logger.info("Blacklist updater started")
-
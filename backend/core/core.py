@@ -4,12 +4,12 @@
 import os
 import logging
 import asyncio
-import requests
+import time
 from typing import Optional, Dict, Any, List
 from datetime import datetime, timedelta
 from backend.database import database
 from backend.api import remnawave, yookassa, heleket, platega
-from backend.core import abuse_detected
+from backend.core import abuse_detected, blacklist_updater, notifications
 
 logger = logging.getLogger(__name__)
 
@@ -20,51 +20,16 @@ TELEGRAM_ADMIN_ID = os.getenv('TELEGRAM_ADMIN_ID', '')
 TELEGRAM_SUPPORT_GROUP_ID = os.getenv('TELEGRAM_SUPPORT_GROUP_ID', '')
 
 def send_notification_via_support_bot(telegram_id: int, message: str) -> bool:
-    """Отправить сообщение через бот поддержки (приоритет для тикетов)"""
-    if not SUPPORT_BOT_TOKEN:
-        return False
-    
-    try:
-        url = f"https://api.telegram.org/bot{SUPPORT_BOT_TOKEN}/sendMessage"
-        data = {
-            'chat_id': telegram_id,
-            'text': message,
-            'parse_mode': 'HTML'
-        }
-        response = requests.post(url, json=data, timeout=5)
-        if response.status_code == 200:
-            return True
-        logger.warning(f"Support bot failed to send to {telegram_id}: {response.text}")
-        return False
-    except Exception as e:
-        logger.error(f"Failed to send via support bot to {telegram_id}: {e}")
-        return False
+    """Поставить в очередь сообщение от бота поддержки"""
+    return notifications.enqueue(telegram_id, message, bot='support')
 
 def send_support_message_to_user(telegram_id: int, message: str) -> bool:
-    """Отправить сообщение поддержки - сначала через бот поддержки, потом через основной"""
-    # Сначала пробуем бот поддержки
-    if send_notification_via_support_bot(telegram_id, message):
-        return True
-    # Если не удалось - через основной бот
-    return send_notification_to_user(telegram_id, message)
+    """Отправить сообщение поддержки - через бот поддержки, при неудаче через основной"""
+    return notifications.enqueue(telegram_id, message, bot='support', fallback_bot='main')
 
 def send_notification_to_user(telegram_id: int, message: str) -> bool:
-    """Отправить уведомление пользователю в Telegram"""
-    if not TELEGRAM_BOT_TOKEN:
-        return False
-    
-    try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        data = {
-            'chat_id': telegram_id,
-            'text': message,
-            'parse_mode': 'HTML'
-        }
-        response = requests.post(url, json=data, timeout=5)
-        return response.status_code == 200
-    except Exception as e:
-        logger.error(f"Failed to send notification to user {telegram_id}: {e}")
-        return False
+    """Поставить уведомление пользователю в очередь отправки (не ждет Telegram)"""
+    return notifications.enqueue(telegram_id, message)
 
 def send_notification_to_admin(message: str) -> bool:
     """Отправить уведомление администратору"""
@@ -78,18 +43,7 @@ def send_notification_to_support_group(message: str) -> bool:
     if not TELEGRAM_SUPPORT_GROUP_ID or not TELEGRAM_BOT_TOKEN:
         return False
     
-    try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-        data = {
-            'chat_id': TELEGRAM_SUPPORT_GROUP_ID,
-            'text': message,
-            'parse_mode': 'HTML'
-        }
-        response = requests.post(url, json=data, timeout=5)
-        return response.status_code == 200
-    except Exception as e:
-        logger.error(f"Failed to send notification to support group: {e}")
-        return False
+    return notifications.enqueue(TELEGRAM_SUPPORT_GROUP_ID, message)
 
 def sanitize_username(username: str, telegram_id: int) -> str:
     """Санитизация username для Remnawave - только буквы, цифры, _ и -"""
@@ -111,147 +65,154 @@ def sanitize_username(username: str, telegram_id: int) -> str:
     return sanitized
 
 
+def _prepare_subscription(telegram_id: int, username: str, referred_by: int = None,
+                          squad_uuids: list = None, plan_type: str = 'vpn') -> Dict[str, Any]:
+    """Пользователь в БД, сквады и уникальный username для новой подписки в Remnawave"""
+    # Создаем пользователя в БД
+    user_id = database.create_user(telegram_id, username, referred_by=referred_by)
+    
+    # Получаем сквады по умолчанию для типа подписки, если не указаны явно
+    if squad_uuids is None:
+        squad_uuids = database.get_default_squads(plan_type)
+    
+    logger.info(f"Creating subscription for {telegram_id}, plan_type={plan_type}, squads={squad_uuids}")
+    
+    # Генерируем уникальный username для каждой новой подписки
+    # Формат: username_telegramid_timestamp
+    timestamp = int(time.time() * 1000) % 1000000  # Последние 6 цифр timestamp
+    base_username = sanitize_username(username, telegram_id)
+    return {
+        'user_id': user_id,
+        'squad_uuids': squad_uuids,
+        'base_username': base_username,
+        'username': f"{base_username}_{timestamp}",
+    }
+
+def _is_username_collision(error: Exception) -> bool:
+    error_msg = str(error).lower()
+    return 'already exists' in error_msg or 'a019' in error_msg
+
+def _collision_username(base_username: str, telegram_id: int) -> str:
+    """Еще более уникальный username, если такой уже существует в Remnawave"""
+    import random
+    unique_username = f"{base_username}_{telegram_id}_{random.randint(1000, 9999)}"
+    logger.info(f"Username collision, trying {unique_username}")
+    return unique_username
+
+def _save_subscription(user_id: int, remnawave_user, days: int, traffic_limit: int = None,
+                       plan_type: str = 'vpn') -> Dict[str, Any]:
+    """Сохранить ключ и устройство созданной в Remnawave подписки"""
+    # Получаем uuid - может быть dataclass или dict
+    user_uuid = remnawave_user.uuid if hasattr(remnawave_user, 'uuid') else remnawave_user.get('uuid')
+    
+    # Подписка создана при создании пользователя
+    subscription = remnawave_user
+    subscription_url = subscription.subscription_url if hasattr(subscription, 'subscription_url') else (subscription.get('subscription_url') if isinstance(subscription, dict) else '')
+    
+    # Конвертируем subscription в JSON-сериализуемый формат
+    subscription_data = None
+    if subscription:
+        if hasattr(subscription, '__dict__'):
+            # Это dataclass - конвертируем в dict
+            subscription_data = {
+                'uuid': subscription.uuid if hasattr(subscription, 'uuid') else None,
+                'username': subscription.username if hasattr(subscription, 'username') else None,
+                'status': subscription.status.value if hasattr(subscription, 'status') and hasattr(subscription.status, 'value') else str(subscription.status) if hasattr(subscription, 'status') else None,
+                'subscription_url': subscription.subscription_url if hasattr(subscription, 'subscription_url') else None,
+                'expire_at': subscription.expire_at.isoformat() if hasattr(subscription, 'expire_at') and subscription.expire_at else None,
+                'traffic_limit_bytes': subscription.traffic_limit_bytes if hasattr(subscription, 'traffic_limit_bytes') else None,
+            }
+        elif isinstance(subscription, dict):
+            subscription_data = subscription
+        else:
+            subscription_data = str(subscription)
+    
+    # Сохраняем ключ в БД
+    conn = database.get_db_connection()
+    cursor = conn.cursor()
+    expiry_date = (datetime.now() + timedelta(days=days)).isoformat()
+    
+    # Проверяем существует ли уже ключ для этого пользователя
+    cursor.execute("SELECT id FROM vpn_keys WHERE user_id = ? AND key_uuid = ?", (user_id, user_uuid))
+    existing_key = cursor.fetchone()
+    
+    vpn_key_id = None
+    if existing_key:
+        # Обновляем существующий ключ
+        vpn_key_id = existing_key['id']
+        cursor.execute("""
+            UPDATE vpn_keys SET status = 'Active', expiry_date = ?, traffic_limit = ?, key_config = ?, plan_type = ?
+            WHERE id = ?
+        """, (expiry_date, traffic_limit, subscription_url, plan_type, vpn_key_id))
+    else:
+        # Создаем новый ключ
+        cursor.execute("""
+            INSERT INTO vpn_keys (user_id, key_uuid, key_config, status, expiry_date, devices_limit, traffic_limit, plan_type)
+            VALUES (?, ?, ?, 'Active', ?, 1, ?, ?)
+        """, (user_id, user_uuid, subscription_url, expiry_date, traffic_limit, plan_type))
+        vpn_key_id = cursor.lastrowid
+    
+    # Создаем или обновляем устройство для отображения в приложении
+    device_name = f"{'Whitelist' if plan_type == 'whitelist' else 'VPN'} подписка"
+    cursor.execute("""
+        SELECT id FROM devices WHERE user_id = ? AND vpn_key_id = ?
+    """, (user_id, vpn_key_id))
+    existing_device = cursor.fetchone()
+    
+    device_id = None
+    if existing_device:
+        device_id = existing_device['id']
+        cursor.execute("""
+            UPDATE devices SET is_active = 1, name = ?
+            WHERE id = ?
+        """, (device_name, device_id))
+    else:
+        cursor.execute("""
+            INSERT INTO devices (user_id, name, platform, vpn_key_id, is_active, added_date)
+            VALUES (?, ?, 'universal', ?, 1, CURRENT_TIMESTAMP)
+        """, (user_id, device_name, vpn_key_id))
+        device_id = cursor.lastrowid
+    
+    conn.commit()
+    conn.close()
+    
+    return {
+        'user_id': user_id,
+        'remnawave_uuid': user_uuid,
+        'subscription_url': subscription_url,
+        'subscription': subscription_data
+    }
+
 def create_user_and_subscription(telegram_id: int, username: str, days: int, 
                                  referred_by: int = None, traffic_limit: int = None,
                                  squad_uuids: list = None, plan_type: str = 'vpn') -> Optional[Dict]:
     """Создать пользователя и подписку"""
     try:
-        # Создаем пользователя в БД
-        user_id = database.create_user(telegram_id, username, referred_by=referred_by)
-        
-        # Получаем сквады по умолчанию для типа подписки, если не указаны явно
-        if squad_uuids is None:
-            squad_uuids = database.get_default_squads(plan_type)
+        prepared = _prepare_subscription(telegram_id, username, referred_by, squad_uuids, plan_type)
         
-        logger.info(f"Creating subscription for {telegram_id}, plan_type={plan_type}, squads={squad_uuids}")
-        
-        # Генерируем уникальный username для каждой новой подписки
-        # Формат: username_telegramid_timestamp
-        import time
-        timestamp = int(time.time() * 1000) % 1000000  # Последние 6 цифр timestamp
-        base_username = sanitize_username(username, telegram_id)
-        unique_username = f"{base_username}_{timestamp}"
-        
-        # Создаем нового пользователя в Remnawave с уникальным username
-        try:
-            remnawave_user = remnawave.remnawave_api.create_user_with_params(
+        def create(remnawave_username: str):
+            return remnawave.remnawave_api.create_user_with_params(
                 telegram_id=telegram_id,
-                username=unique_username,
+                username=remnawave_username,
                 days=days,
                 traffic_limit_bytes=traffic_limit or 0,
-                active_internal_squads=squad_uuids if squad_uuids else None
+                active_internal_squads=prepared['squad_uuids'] if prepared['squad_uuids'] else None
             )
+        
+        # Создаем нового пользователя в Remnawave с уникальным username
+        try:
+            remnawave_user = create(prepared['username'])
         except Exception as create_error:
-            error_msg = str(create_error).lower()
-            # Если username уже существует, пробуем с еще более уникальным именем
-            if 'already exists' in error_msg or 'a019' in error_msg:
-                import random
-                unique_username = f"{base_username}_{telegram_id}_{random.randint(1000, 9999)}"
-                logger.info(f"Username collision, trying {unique_username}")
-                remnawave_user = remnawave.remnawave_api.create_user_with_params(
-                    telegram_id=telegram_id,
-                    username=unique_username,
-                    days=days,
-                    traffic_limit_bytes=traffic_limit or 0,
-                    active_internal_squads=squad_uuids if squad_uuids else None
-                )
-            else:
-                raise create_error
+            if not _is_username_collision(create_error):
+                raise
+            remnawave_user = create(_collision_username(prepared['base_username'], telegram_id))
         
         if not remnawave_user:
             logger.error(f"Failed to create user in Remnawave: {telegram_id}")
             return None
         
-        # Получаем uuid - может быть dataclass или dict
-        user_uuid = remnawave_user.uuid if hasattr(remnawave_user, 'uuid') else remnawave_user.get('uuid')
-        subscription_url = remnawave_user.subscription_url if hasattr(remnawave_user, 'subscription_url') else remnawave_user.get('subscription_url', '')
-        
-        # Подписка создана при создании пользователя
-        subscription = remnawave_user
-        
-        if not subscription:
-            logger.error(f"Failed to create subscription: {user_uuid}")
-            return None
-        
-        # Получаем subscription_url из subscription если доступен
-        if subscription:
-            subscription_url = subscription.subscription_url if hasattr(subscription, 'subscription_url') else (subscription.get('subscription_url') if isinstance(subscription, dict) else subscription_url)
-        
-        # Конвертируем subscription в JSON-сериализуемый формат
-        subscription_data = None
-        if subscription:
-            if hasattr(subscription, '__dict__'):
-                # Это dataclass - конвертируем в dict
-                subscription_data = {
-                    'uuid': subscription.uuid if hasattr(subscription, 'uuid') else None,
-                    'username': subscription.username if hasattr(subscription, 'username') else None,
-                    'status': subscription.status.value if hasattr(subscription, 'status') and hasattr(subscription.status, 'value') else str(subscription.status) if hasattr(subscription, 'status') else None,
-                    'subscription_url': subscription.subscription_url if hasattr(subscription, 'subscription_url') else None,
-                    'expire_at': subscription.expire_at.isoformat() if hasattr(subscription, 'expire_at') and subscription.expire_at else None,
-                    'traffic_limit_bytes': subscription.traffic_limit_bytes if hasattr(subscription, 'traffic_limit_bytes') else None,
-                }
-            elif isinstance(subscription, dict):
-                subscription_data = subscription
-            else:
-                subscription_data = str(subscription)
-        
-        # Сохраняем ключ в БД
-        conn = database.get_db_connection()
-        cursor = conn.cursor()
-        expiry_date = (datetime.now() + timedelta(days=days)).isoformat()
-        
-        # Проверяем существует ли уже ключ для этого пользователя
-        cursor.execute("SELECT id FROM vpn_keys WHERE user_id = ? AND key_uuid = ?", (user_id, user_uuid))
-        existing_key = cursor.fetchone()
-        
-        vpn_key_id = None
-        if existing_key:
-            # Обновляем существующий ключ
-            vpn_key_id = existing_key['id']
-            cursor.execute("""
-                UPDATE vpn_keys SET status = 'Active', expiry_date = ?, traffic_limit = ?, key_config = ?
-                WHERE id = ?
-            """, (expiry_date, traffic_limit, subscription_url, vpn_key_id))
-        else:
-            # Создаем новый ключ
-            cursor.execute("""
-                INSERT INTO vpn_keys (user_id, key_uuid, key_config, status, expiry_date, devices_limit, traffic_limit)
-                VALUES (?, ?, ?, 'Active', ?, 1, ?)
-            """, (user_id, user_uuid, subscription_url, expiry_date, traffic_limit))
-            vpn_key_id = cursor.lastrowid
-        
-        # Создаем или обновляем устройство для отображения в приложении
-        device_name = f"{'Whitelist' if plan_type == 'whitelist' else 'VPN'} подписка"
-        cursor.execute("""
-            SELECT id FROM devices WHERE user_id = ? AND vpn_key_id = ?
-        """, (user_id, vpn_key_id))
-        existing_device = cursor.fetchone()
-        
-        device_id = None
-        if existing_device:
-            device_id = existing_device['id']
-            cursor.execute("""
-                UPDATE devices SET is_active = 1, name = ?
-                WHERE id = ?
-            """, (device_name, device_id))
-        else:
-            cursor.execute("""
-                INSERT INTO devices (user_id, name, platform, vpn_key_id, is_active, added_date)
-                VALUES (?, ?, 'universal', ?, 1, CURRENT_TIMESTAMP)
-            """, (user_id, device_name, vpn_key_id))
-            device_id = cursor.lastrowid
-        
-        conn.commit()
-        conn.close()
-        
         # Уведомление администратору убрано - оставляем только для пополнений и запросов на вывод
-        
-        return {
-            'user_id': user_id,
-            'remnawave_uuid': user_uuid,
-            'subscription_url': subscription_url,
-            'subscription': subscription_data
-        }
+        return _save_subscription(prepared['user_id'], remnawave_user, days, traffic_limit, plan_type)
     except Exception as e:
         logger.error(f"Error creating user and subscription: {e}")
         import traceback
@@ -291,15 +252,8 @@ def process_payment(user_id: int, amount: float, payment_method: str,
         return None
 
 def check_blacklist(telegram_id: int) -> bool:
-    """Проверить, находится ли пользователь в черном списке"""
-    conn = database.get_db_connection()
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute("SELECT id FROM blacklist WHERE telegram_id = ?", (telegram_id,))
-        return cursor.fetchone() is not None
-    finally:
-        conn.close()
+    """Проверить, находится ли пользователь в черном списке (по списку в памяти)"""
+    return blacklist_updater.is_blacklisted(telegram_id)
 
 def apply_promocode(user_id: int, code: str) -> Dict[str, Any]:
     """Применить промокод"""
@@ -376,108 +330,119 @@ def apply_promocode(user_id: int, code: str) -> Dict[str, Any]:
 
 def get_referral_stats(user_id: int) -> Dict[str, Any]:
     """Получить статистику рефералов"""
-    conn = database.get_db_connection()
-    cursor = conn.cursor()
+    user = database.get_user_by_id(user_id)
+    if not user:
+        return {}
     
-    try:
-        user = database.get_user_by_id(user_id)
-        if not user:
-            return {}
-        
-        # Получаем всех рефералов
-        cursor.execute("""
-            SELECT COUNT(*) as count
-            FROM users
-            WHERE referred_by = ?
-        """, (user_id,))
-        
-        result = cursor.fetchone()
-        referrals_count = result[0] if result else 0
-        
-        # Получаем общую сумму транзакций рефералов
-        cursor.execute("""
-            SELECT COALESCE(SUM(amount), 0) as total_spent
-            FROM transactions
-            WHERE user_id IN (SELECT id FROM users WHERE referred_by = ?)
-            AND type = 'deposit'
-        """, (user_id,))
-        
-        result = cursor.fetchone()
-        total_spent = result[0] if result else 0
-        
-        # Вычисляем доход (20% от потраченного)
-        referral_rate = user.get('partner_rate', 20) / 100
-        total_earned = total_spent * referral_rate
-        
-        return {
-            'referrals_count': referrals_count,
-            'total_spent': total_spent or 0,
-            'total_earned': total_earned,
-            'rate': user.get('partner_rate', 20)
-        }
-    finally:
-        conn.close()
+    # Количество рефералов и сумма их пополнений из материализованных агрегатов
+    aggregate = database.get_referral_aggregate(user_id)
+    total_spent = aggregate['referrals_spent']
+    
+    # Вычисляем доход (20% от потраченного)
+    referral_rate = user.get('partner_rate', 20) / 100
+    total_earned = total_spent * referral_rate
+    
+    return {
+        'referrals_count': aggregate['referrals_count'],
+        'total_spent': total_spent or 0,
+        'total_earned': total_earned,
+        'rate': user.get('partner_rate', 20)
+    }
 
 
-def sync_keys_with_remnawave() -> Dict:
+REMWAVE_SYNC_PAGE_SIZE = int(os.getenv('REMWAVE_SYNC_PAGE_SIZE', '100'))
+REMWAVE_SYNC_CONCURRENCY = int(os.getenv('REMWAVE_SYNC_CONCURRENCY', '8'))
+
+def sync_keys_with_remnawave(dry_run: bool = False) -> Dict:
     """
     Синхронизировать ключи с Remnawave.
     Удаляет из БД бота ключи, которых нет в Remnawave.
+    
+    UUID из Remnawave загружаются параллельно (первая страница дает total),
+    сверка и удаление выполняются set-based запросами через временную таблицу.
+    Ключи, созданные после начала загрузки, не трогаются.
+    
+    Args:
+        dry_run: Только посчитать расхождения, ничего не удалять
     """
+    timings = {}
+    started = time.monotonic()
+    sync_started_at = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
     try:
-        # Получаем все ключи из Remnawave (постранично)
-        remnawave_uuids = set()
-        start = 0
-        size = 100
-        
-        while True:
-            result = remnawave.remnawave_api.get_all_users_sync(start=start, size=size)
-            users = result.get('users', [])
-            total = result.get('total', 0)
-            
-            for user in users:
-                if hasattr(user, 'uuid'):
-                    remnawave_uuids.add(user.uuid)
-                elif isinstance(user, dict):
-                    remnawave_uuids.add(user.get('uuid'))
-            
-            start += size
-            if start >= total:
-                break
-        
-        logger.info(f"Found {len(remnawave_uuids)} users in Remnawave")
-        
-        # Получаем все ключи из БД
-        conn = database.get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, key_uuid, user_id FROM vpn_keys WHERE key_uuid IS NOT NULL")
-        db_keys = cursor.fetchall()
+        # Получаем все UUID из Remnawave (параллельно, постранично)
+        result = remnawave.remnawave_api.get_all_user_uuids_sync(
+            page_size=REMWAVE_SYNC_PAGE_SIZE, concurrency=REMWAVE_SYNC_CONCURRENCY
+        )
+        remnawave_uuids = result['uuids']
+        timings['fetch_ms'] = int((time.monotonic() - started) * 1000)
+        
+        logger.info(f"Found {len(remnawave_uuids)} users in Remnawave ({result['pages']} pages, {timings['fetch_ms']} ms)")
+        
+        # Если за время загрузки список сдвинулся и часть страниц потерялась, удалять нельзя
+        if len(remnawave_uuids) < result['total']:
+            raise RuntimeError(
+                f"Получено {len(remnawave_uuids)} из {result['total']} пользователей Remnawave, синхронизация прервана"
+            )
         
-        deleted_count = 0
-        for key in db_keys:
-            key_id = key['id']
-            key_uuid = key['key_uuid']
-            user_id = key['user_id']
+        step = time.monotonic()
+        with database.db_connection() as conn:
+            cursor = conn.cursor()
+            # Временные таблицы живут в соединении; их заполнение не блокирует основную БД
+            with database.transaction(immediate=False):
+                cursor.execute("DROP TABLE IF EXISTS temp.remnawave_sync_uuids")
+                cursor.execute("CREATE TEMP TABLE remnawave_sync_uuids (uuid TEXT PRIMARY KEY) WITHOUT ROWID")
+                cursor.executemany(
+                    "INSERT OR IGNORE INTO temp.remnawave_sync_uuids (uuid) VALUES (?)",
+                    ((uuid,) for uuid in remnawave_uuids)
+                )
             
-            if key_uuid and key_uuid not in remnawave_uuids:
-                # Ключ не найден в Remnawave - удаляем из БД
-                logger.info(f"Key {key_uuid} not found in Remnawave, deleting from DB")
-                
-                # Удаляем связанные устройства
-                cursor.execute("DELETE FROM devices WHERE vpn_key_id = ?", (key_id,))
-                
-                # Удаляем ключ
-                cursor.execute("DELETE FROM vpn_keys WHERE id = ?", (key_id,))
-                deleted_count += 1
-        
-        conn.commit()
-        conn.close()
-        
-        logger.info(f"Sync completed: deleted {deleted_count} keys from DB")
+            try:
+                with database.transaction(immediate=not dry_run):
+                    # Ключи, которых нет в Remnawave
+                    cursor.execute("DROP TABLE IF EXISTS temp.remnawave_sync_stale")
+                    cursor.execute("""
+                        CREATE TEMP TABLE remnawave_sync_stale AS
+                        SELECT k.id, k.key_uuid, k.user_id
+                        FROM vpn_keys k
+                        WHERE k.key_uuid IS NOT NULL
+                          AND k.created_at < ?
+                          AND NOT EXISTS (SELECT 1 FROM temp.remnawave_sync_uuids r WHERE r.uuid = k.key_uuid)
+                    """, (sync_started_at,))
+                    cursor.execute("SELECT id, key_uuid, user_id FROM temp.remnawave_sync_stale ORDER BY id LIMIT 100")
+                    stale_sample = [dict(row) for row in cursor.fetchall()]
+                    cursor.execute("SELECT COUNT(*) FROM temp.remnawave_sync_stale")
+                    stale_count = cursor.fetchone()[0]
+                    timings['diff_ms'] = int((time.monotonic() - step) * 1000)
+                    
+                    deleted_count = 0
+                    deleted_devices = 0
+                    step = time.monotonic()
+                    if not dry_run and stale_count:
+                        # Удаляем связанные устройства и ключи одним запросом каждое
+                        cursor.execute("DELETE FROM devices WHERE vpn_key_id IN (SELECT id FROM temp.remnawave_sync_stale)")
+                        deleted_devices = cursor.rowcount
+                        cursor.execute("DELETE FROM vpn_keys WHERE id IN (SELECT id FROM temp.remnawave_sync_stale)")
+                        deleted_count = cursor.rowcount
+                    timings['apply_ms'] = int((time.monotonic() - step) * 1000)
+            finally:
+                cursor.execute("DROP TABLE IF EXISTS temp.remnawave_sync_stale")
+                cursor.execute("DROP TABLE IF EXISTS temp.remnawave_sync_uuids")
+        
+        timings['total_ms'] = int((time.monotonic() - started) * 1000)
+        if dry_run:
+            logger.info(f"Sync dry run: {stale_count} keys would be deleted ({timings})")
+        else:
+            logger.info(f"Sync completed: deleted {deleted_count} keys from DB ({timings})")
         return {
             'success': True,
+            'dry_run': dry_run,
             'remnawave_users': len(remnawave_uuids),
-            'deleted_keys': deleted_count
+            'pages': result['pages'],
+            'stale_keys': stale_count,
+            'stale_sample': stale_sample,
+            'deleted_keys': deleted_count,
+            'deleted_devices': deleted_devices,
+            'timings': timings
         }
     except Exception as e:
         logger.error(f"Error syncing with Remnawave: {e}")
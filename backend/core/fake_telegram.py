@@ -0,0 +1,165 @@
+"""
+Локальный фейковый сервер Telegram Bot API для проверки рассылок и очереди уведомлений
+
+Принимает POST /bot<token>/<method> (sendMessage, sendPhoto и любые другие
+методы), запоминает сообщения и отвечает как Telegram: 429 с retry_after
+при превышении лимита, 403 для "заблокировавших бота" чатов, 500 с заданной
+вероятностью. Диспетчеры направляются на него через TELEGRAM_API_URL:
+
+    python -m backend.core.fake_telegram --port 8081 --rate-limit 30 --blocked-chats 13,14 --error-rate 0.05
+    TELEGRAM_API_URL=http://127.0.0.1:8081 TELEGRAM_BOT_TOKEN=test python -m backend.api.server
+
+Принятые сообщения и счетчики: GET /fake/messages, GET /fake/stats, сброс - POST /fake/reset.
+"""
+import time
+import random
+import asyncio
+import logging
+import argparse
+import threading
+from collections import Counter, deque
+from typing import Any, Dict, Iterable, Optional, Tuple
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+class FakeTelegram:
+    """Состояние фейкового сервера: принятые сообщения, счетчики ответов и лимит скорости"""
+
+    def __init__(self, rate_limit: float = 30.0, retry_after: int = 1, blocked_chats: Iterable[str] = (),
+                 error_rate: float = 0.0, latency: float = 0.0):
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.blocked_chats = {str(chat_id) for chat_id in blocked_chats}
+        self.error_rate = error_rate
+        self.latency = latency
+        self.reset()
+
+    def reset(self):
+        self.messages = []
+        self.responses = Counter()
+        self._window = deque()
+
+    def _rate_limited(self) -> bool:
+        """Скользящее окно в 1 секунду, как общий лимит бота в Telegram"""
+        if self.rate_limit <= 0:
+            return False
+        now = time.monotonic()
+        while self._window and now - self._window[0] >= 1.0:
+            self._window.popleft()
+        if len(self._window) >= self.rate_limit:
+            return True
+        self._window.append(now)
+        return False
+
+    def handle(self, token: str, method: str, payload: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        """Ответ Bot API на вызов метода: (HTTP статус, тело)"""
+        chat_id = str(payload.get('chat_id', ''))
+        if self._rate_limited():
+            status, body = 429, {
+                'ok': False, 'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after},
+            }
+        elif chat_id in self.blocked_chats:
+            status, body = 403, {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'}
+        elif self.error_rate and random.random() < self.error_rate:
+            status, body = 500, {'ok': False, 'error_code': 500, 'description': 'Internal Server Error'}
+        else:
+            self.messages.append({'token': token, 'method': method, 'payload': payload, 'at': time.time()})
+            status, body = 200, {'ok': True, 'result': {'message_id': len(self.messages), 'chat': {'id': payload.get('chat_id')}}}
+        self.responses[status] += 1
+        return status, body
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'delivered': len(self.messages),
+            'chats': len({message['payload'].get('chat_id') for message in self.messages}),
+            'responses': {str(status): count for status, count in sorted(self.responses.items())},
+        }
+
+
+def create_app(fake: FakeTelegram) -> web.Application:
+    async def bot_method(request: web.Request) -> web.Response:
+        if fake.latency:
+            await asyncio.sleep(fake.latency)
+        try:
+            payload = await request.json()
+        except ValueError:
+            payload = dict(await request.post())
+        status, body = fake.handle(request.match_info['token'], request.match_info['method'], payload)
+        return web.json_response(body, status=status)
+
+    async def messages(request: web.Request) -> web.Response:
+        return web.json_response(fake.messages)
+
+    async def stats(request: web.Request) -> web.Response:
+        return web.json_response(fake.stats())
+
+    async def reset(request: web.Request) -> web.Response:
+        fake.reset()
+        return web.json_response({'ok': True})
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', bot_method)
+    app.router.add_get('/fake/messages', messages)
+    app.router.add_get('/fake/stats', stats)
+    app.router.add_post('/fake/reset', reset)
+    return app
+
+
+def start_in_background(fake: Optional[FakeTelegram] = None, host: str = '127.0.0.1',
+                        port: int = 0) -> Tuple[FakeTelegram, str, threading.Event]:
+    """
+    Запустить сервер в фоновом потоке (для проверок из Python).
+
+    Returns:
+        (состояние сервера, базовый URL для TELEGRAM_API_URL, событие остановки)
+    """
+    fake = fake or FakeTelegram()
+    ready = threading.Event()
+    stop = threading.Event()
+    address = {}
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        runner = web.AppRunner(create_app(fake))
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, host, port)
+        loop.run_until_complete(site.start())
+        address['port'] = runner.addresses[0][1]
+        ready.set()
+        while not stop.is_set():
+            loop.run_until_complete(asyncio.sleep(0.1))
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+
+    threading.Thread(target=serve, name='fake-telegram', daemon=True).start()
+    ready.wait()
+    return fake, f"http://{host}:{address['port']}", stop
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Фейковый сервер Telegram Bot API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--rate-limit', type=float, default=30.0, help="Сообщений в секунду до ответа 429 (0 - без лимита)")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after в ответе 429")
+    parser.add_argument('--blocked-chats', default='', help="chat_id через запятую, которым отвечать 403")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Доля ответов 500")
+    parser.add_argument('--latency', type=float, default=0.0, help="Задержка ответа, секунд")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    fake = FakeTelegram(
+        rate_limit=args.rate_limit,
+        retry_after=args.retry_after,
+        blocked_chats=[chat_id.strip() for chat_id in args.blocked_chats.split(',') if chat_id.strip()],
+        error_rate=args.error_rate,
+        latency=args.latency,
+    )
+    web.run_app(create_app(fake), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
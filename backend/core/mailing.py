@@ -0,0 +1,374 @@
+"""
+Рассылки: постановка в очередь и фоновая отправка
+
+Рассылка сохраняется в mailings, получатели - в mailing_recipients (одна
+строка на получателя). Фоновый поток с собственным циклом asyncio отправляет
+сообщения пачками с ограничением скорости (token bucket), учитывает ответы
+429 retry_after и повторяет временные ошибки с экспоненциальной задержкой.
+Забранная пачка помечается 'sending' с блокировкой locked_until, которая вместе
+с арендой продлевается, пока пачка отправляется (пауза 429 может быть дольше
+аренды), поэтому другой процесс не отправит тех же получателей повторно.
+Все состояние хранится в БД, поэтому после перезапуска отправка продолжается
+с места остановки (пачка упавшего процесса забирается снова после истечения
+блокировки и может быть частично отправлена повторно).
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from typing import Optional, Dict, Any, List, Union
+from backend.database import database
+from backend.core import telegram_client
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', '')
+MINIAPP_URL = os.getenv('MINIAPP_URL', '')
+
+MAILING_RATE_PER_SECOND = float(os.getenv('MAILING_RATE_PER_SECOND', '25'))  # Лимит Telegram ~30 сообщений/с
+MAILING_BATCH_SIZE = int(os.getenv('MAILING_BATCH_SIZE', '100'))
+MAILING_MAX_ATTEMPTS = int(os.getenv('MAILING_MAX_ATTEMPTS', '3'))
+IDLE_POLL_INTERVAL = 5.0
+LEASE_NAME = 'mailing_dispatcher'
+LEASE_TTL = 60
+MAILING_LOCK_TTL = 120  # Блокировка забранной пачки; продлевается каждые CLAIM_RENEW_INTERVAL
+CLAIM_RENEW_INTERVAL = LEASE_TTL / 3
+
+# Фильтры получателей по значению target_users из панели
+TARGET_FILTERS = {
+    'all': "",
+    'active': "WHERE u.status = 'Active'",
+    'expired': "WHERE u.status = 'Expired'",
+    'no_subscription': "WHERE NOT EXISTS (SELECT 1 FROM vpn_keys k WHERE k.user_id = u.id AND k.status = 'Active')",
+}
+
+_wakeup = threading.Event()
+_stop_event = threading.Event()
+_thread: Optional[threading.Thread] = None
+
+
+def build_reply_markup(button_type: str, button_value: str) -> Optional[Dict[str, Any]]:
+    """Inline-кнопка рассылки по типу из панели"""
+    if not button_type or not button_value:
+        return None
+
+    if button_type == 'external_link':
+        button = {'text': '🔗 Перейти', 'url': button_value}
+    elif button_type == 'open_miniapp':
+        if not MINIAPP_URL:
+            return None
+        button = {'text': button_value, 'web_app': {'url': MINIAPP_URL}}
+    elif button_type == 'activate_promo':
+        if not MINIAPP_URL:
+            return None
+        button = {'text': f'🎁 Активировать {button_value}', 'web_app': {'url': f"{MINIAPP_URL}?promo={button_value}"}}
+    elif button_type == 'add_balance':
+        if not MINIAPP_URL:
+            return None
+        button = {'text': f'💳 Пополнить на {button_value}₽', 'web_app': {'url': f"{MINIAPP_URL}?topup={button_value}"}}
+    else:
+        return None
+    return {'inline_keyboard': [[button]]}
+
+
+def create_mailing(message: str, target_users: Union[str, List[int]] = 'all', title: str = '',
+                   button_type: str = None, button_value: str = None, image_url: str = None) -> Dict[str, Any]:
+    """
+    Создать рассылку и поставить получателей в очередь одним INSERT ... SELECT.
+
+    Args:
+        target_users: Ключ TARGET_FILTERS, user_id или список user_id
+
+    Returns:
+        Dict с id рассылки и total (количество получателей); ValueError при неизвестном target_users
+    """
+    if isinstance(target_users, int) and not isinstance(target_users, bool):
+        target_users = [target_users]
+    if isinstance(target_users, list):
+        try:
+            user_ids = [int(user_id) for user_id in target_users]
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid target_users: {target_users}")
+    elif target_users not in TARGET_FILTERS:
+        raise ValueError(f"Unknown target_users: {target_users}")
+
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO mailings (title, message_text, target_users, sent_count, status, button_type, button_value, image_url)
+            VALUES (?, ?, ?, 0, 'Queued', ?, ?, ?)
+        """, (title, message, str(target_users), button_type, button_value, image_url))
+        mailing_id = cursor.lastrowid
+
+        if isinstance(target_users, list):
+            cursor.execute("""
+                INSERT OR IGNORE INTO mailing_recipients (mailing_id, user_id, telegram_id)
+                SELECT ?, u.id, u.telegram_id FROM users u
+                WHERE u.id IN (SELECT value FROM json_each(?))
+            """, (mailing_id, json.dumps(user_ids)))
+        else:
+            where = TARGET_FILTERS[target_users]
+            cursor.execute(f"""
+                INSERT OR IGNORE INTO mailing_recipients (mailing_id, user_id, telegram_id)
+                SELECT ?, u.id, u.telegram_id FROM users u {where}
+            """, (mailing_id,))
+        total = cursor.rowcount
+
+        if total > 0:
+            cursor.execute("UPDATE mailings SET total_count = ? WHERE id = ?", (total, mailing_id))
+        else:
+            cursor.execute("""
+                UPDATE mailings SET total_count = 0, status = 'Completed',
+                    sent_at = CURRENT_TIMESTAMP, finished_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            """, (mailing_id,))
+
+    logger.info(f"Рассылка #{mailing_id} поставлена в очередь: {total} получателей")
+    _wakeup.set()
+    return {'id': mailing_id, 'total': total}
+
+
+def get_mailing_status(mailing_id: int) -> Optional[Dict[str, Any]]:
+    """Прогресс рассылки"""
+    with database.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, title, status, total_count, sent_count, failed_count,
+                   created_at, started_at, finished_at
+            FROM mailings WHERE id = ?
+        """, (mailing_id,))
+        row = cursor.fetchone()
+    if not row:
+        return None
+
+    total = row['total_count'] or 0
+    delivered = row['sent_count'] or 0
+    failed = row['failed_count'] or 0
+    pending = max(0, total - delivered - failed)
+    return {
+        'id': row['id'],
+        'title': row['title'],
+        'status': row['status'],
+        'total': total,
+        'delivered': delivered,
+        'failed': failed,
+        'pending': pending,
+        'progress': round((delivered + failed) / total * 100, 1) if total else 100.0,
+        'eta_seconds': int(pending / MAILING_RATE_PER_SECOND) if pending else 0,
+        'created_at': row['created_at'],
+        'started_at': row['started_at'],
+        'finished_at': row['finished_at'],
+    }
+
+
+def _next_mailing() -> Optional[Dict[str, Any]]:
+    with database.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, message_text, button_type, button_value, image_url, status
+            FROM mailings
+            WHERE status IN ('Queued', 'Sending')
+            ORDER BY id
+            LIMIT 1
+        """)
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+
+def _claim_batch(mailing_id: int) -> List[Dict[str, Any]]:
+    """Забрать очередную пачку получателей, которым пора отправлять, и пачки с истекшей блокировкой"""
+    now = time.time()
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, telegram_id, attempts FROM mailing_recipients
+            WHERE mailing_id = ? AND (
+                (status = 'pending' AND next_attempt_at <= ?) OR (status = 'sending' AND locked_until <= ?)
+            )
+            ORDER BY id
+            LIMIT ?
+        """, (mailing_id, now, now, MAILING_BATCH_SIZE))
+        recipients = [dict(row) for row in cursor.fetchall()]
+        cursor.executemany("UPDATE mailing_recipients SET status = 'sending', locked_until = ? WHERE id = ?",
+                           [(now + MAILING_LOCK_TTL, recipient['id']) for recipient in recipients])
+    return recipients
+
+
+def _extend_claim(recipient_ids: List[int]):
+    with database.transaction() as conn:
+        conn.execute("""
+            UPDATE mailing_recipients SET locked_until = ?
+            WHERE id IN (SELECT value FROM json_each(?)) AND status = 'sending'
+        """, (time.time() + MAILING_LOCK_TTL, json.dumps(recipient_ids)))
+
+
+async def _keep_claimed(recipient_ids: List[int], done: asyncio.Event):
+    """Продлевать аренду и блокировку пачки, пока она отправляется"""
+    while True:
+        try:
+            await asyncio.wait_for(done.wait(), CLAIM_RENEW_INTERVAL)
+            return
+        except asyncio.TimeoutError:
+            pass
+        try:
+            _acquire_lease()
+            _extend_claim(recipient_ids)
+        except Exception as e:
+            logger.warning(f"Не удалось продлить блокировку пачки рассылки: {e}")
+
+
+def _finish_if_done(mailing_id: int) -> bool:
+    """Завершить рассылку, если в очереди не осталось получателей"""
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE mailings
+            SET status = 'Completed', sent_at = CURRENT_TIMESTAMP, finished_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND NOT EXISTS (
+                SELECT 1 FROM mailing_recipients WHERE mailing_id = ? AND status IN ('pending', 'sending')
+            )
+        """, (mailing_id, mailing_id))
+        done = cursor.rowcount == 1
+    if done:
+        logger.info(f"Рассылка #{mailing_id} завершена")
+    return done
+
+
+def _save_results(mailing_id: int, results: List[tuple]):
+    """Сохранить результаты пачки и счетчики рассылки в одной транзакции"""
+    sent = [(recipient_id,) for recipient_id, status, _, _ in results if status == 'sent']
+    failed = [(attempts, error, recipient_id) for recipient_id, status, attempts, error in results if status == 'failed']
+    retry = [(attempts, error, time.time() + min(300, 2 ** attempts), recipient_id)
+             for recipient_id, status, attempts, error in results if status == 'retry']
+    # 429: повторить без увеличения числа попыток
+    deferred = [(recipient_id,) for recipient_id, status, _, _ in results if status == 'deferred']
+
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("""
+            UPDATE mailing_recipients SET status = 'sent', attempts = attempts + 1, sent_at = CURRENT_TIMESTAMP,
+                locked_until = 0
+            WHERE id = ?
+        """, sent)
+        cursor.executemany("""
+            UPDATE mailing_recipients SET status = 'failed', attempts = ?, error = ?, locked_until = 0 WHERE id = ?
+        """, failed)
+        cursor.executemany("""
+            UPDATE mailing_recipients SET status = 'pending', attempts = ?, error = ?, next_attempt_at = ?,
+                locked_until = 0
+            WHERE id = ?
+        """, retry)
+        cursor.executemany("""
+            UPDATE mailing_recipients SET status = 'pending', next_attempt_at = 0, locked_until = 0 WHERE id = ?
+        """, deferred)
+        cursor.execute("""
+            UPDATE mailings SET sent_count = sent_count + ?, failed_count = failed_count + ? WHERE id = ?
+        """, (len(sent), len(failed), mailing_id))
+
+
+async def _send_one(session, bucket: telegram_client.TokenBucket, mailing: Dict[str, Any],
+                    reply_markup: Optional[Dict], recipient: Dict[str, Any]) -> tuple:
+    await bucket.acquire()
+    result = await telegram_client.send_message(
+        session, TELEGRAM_BOT_TOKEN, recipient['telegram_id'], mailing['message_text'],
+        reply_markup=reply_markup, photo=mailing.get('image_url') or None
+    )
+    attempts = recipient['attempts'] + 1
+    if result.ok:
+        return recipient['id'], 'sent', attempts, None
+    if result.retry_after is not None:
+        bucket.pause(result.retry_after)
+        logger.warning(f"Telegram 429 при рассылке, пауза {result.retry_after} с")
+        return recipient['id'], 'deferred', recipient['attempts'], result.error
+    if result.permanent or attempts >= MAILING_MAX_ATTEMPTS:
+        return recipient['id'], 'failed', attempts, result.error
+    return recipient['id'], 'retry', attempts, result.error
+
+
+async def _dispatch_loop():
+    bucket = telegram_client.TokenBucket(MAILING_RATE_PER_SECOND)
+    async with telegram_client.create_session() as session:
+        while not _stop_event.is_set():
+            try:
+                processed = await _dispatch_step(session, bucket)
+            except Exception as e:
+                logger.error(f"Ошибка отправки рассылки: {e}")
+                processed = False
+            finally:
+                database.release_thread_connection()
+
+            if not processed:
+                _wakeup.clear()
+                await asyncio.get_running_loop().run_in_executor(None, _wakeup.wait, IDLE_POLL_INTERVAL)
+
+
+async def _dispatch_step(session, bucket: telegram_client.TokenBucket) -> bool:
+    """Отправить одну пачку. Возвращает False, если работы сейчас нет"""
+    if not TELEGRAM_BOT_TOKEN:
+        return False
+    if not _acquire_lease():
+        return False
+
+    mailing = _next_mailing()
+    if not mailing:
+        return False
+
+    if mailing['status'] == 'Queued':
+        with database.transaction() as conn:
+            conn.execute("""
+                UPDATE mailings SET status = 'Sending', started_at = COALESCE(started_at, CURRENT_TIMESTAMP)
+                WHERE id = ?
+            """, (mailing['id'],))
+
+    recipients = _claim_batch(mailing['id'])
+    if not recipients:
+        # Остались только получатели, ожидающие повтора
+        return _finish_if_done(mailing['id'])
+
+    reply_markup = build_reply_markup(mailing['button_type'], mailing['button_value'])
+    done = asyncio.Event()
+    keeper = asyncio.create_task(_keep_claimed([recipient['id'] for recipient in recipients], done))
+    try:
+        results = await asyncio.gather(*(
+            _send_one(session, bucket, mailing, reply_markup, recipient) for recipient in recipients
+        ))
+    finally:
+        done.set()
+        await keeper
+    _save_results(mailing['id'], results)
+    return True
+
+
+def _acquire_lease() -> bool:
+    """Отправкой занимается только один процесс"""
+    from backend.core import scheduler
+    return scheduler.acquire_lease(LEASE_NAME, LEASE_TTL)
+
+
+def _dispatcher_worker():
+    """Рабочий поток отправки рассылок"""
+    asyncio.run(_dispatch_loop())
+
+
+def start_mailing_dispatcher() -> bool:
+    """Запустить фоновую отправку рассылок (повторный вызов ничего не делает)"""
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return False
+    if not TELEGRAM_BOT_TOKEN:
+        logger.warning("TELEGRAM_BOT_TOKEN не задан: рассылки будут ждать в очереди")
+    _stop_event.clear()
+    _thread = threading.Thread(target=_dispatcher_worker, name='mailing-dispatcher', daemon=True)
+    _thread.start()
+    logger.info("Mailing dispatcher started")
+    return True
+
+
+def stop_mailing_dispatcher(timeout: float = 10.0):
+    """Остановить отправку после текущей пачки"""
+    _stop_event.set()
+    _wakeup.set()
+    if _thread is not None:
+        _thread.join(timeout)
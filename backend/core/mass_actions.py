@@ -0,0 +1,320 @@
+"""
+Массовые действия над пользователями из панели (MASS_*)
+
+Вместо одного-двух запросов на пользователя каждое действие - это несколько
+set-based запросов (UPDATE ... WHERE id IN (SELECT ...), INSERT ... SELECT).
+Список пользователей фиксируется при создании в mass_action_targets, затем
+обрабатывается пачками по MASS_ACTION_CHUNK_SIZE id: каждая пачка - отдельная
+короткая транзакция, поэтому блокировка записи не держится на все время
+действия. Прогресс и позиция (last_id) пишутся в mass_actions в той же
+транзакции, что и пачка, поэтому прерванное перезапуском воркера действие
+задача планировщика продолжает с места остановки, не применяя пачку дважды.
+Уведомления ставятся в очередь notification_outbox одним INSERT ... SELECT,
+новые сроки для MASS_ADD_DAYS отправляются в Remnawave параллельно.
+"""
+import os
+import json
+import html
+import logging
+import threading
+from datetime import datetime
+from typing import Optional, Dict, Any, List
+from backend.database import database
+from backend.api import remnawave
+from backend.core import notifications
+
+logger = logging.getLogger(__name__)
+
+MASS_ACTION_CHUNK_SIZE = int(os.getenv('MASS_ACTION_CHUNK_SIZE', '500'))
+MASS_ACTION_REMWAVE_CONCURRENCY = int(os.getenv('MASS_ACTION_REMWAVE_CONCURRENCY', '8'))
+# Действие без пульса дольше этого считается прерванным и продолжается задачей планировщика
+MASS_ACTION_STALE_SECONDS = int(os.getenv('MASS_ACTION_STALE_SECONDS', '300'))
+MASS_ACTION_RESUME_INTERVAL = int(os.getenv('MASS_ACTION_RESUME_INTERVAL', '60'))
+ERROR_SAMPLE_SIZE = 5
+
+# Подзапрос пользователей текущей пачки: (action_id, после id, до id включительно)
+CHUNK_USERS = "SELECT user_id FROM mass_action_targets WHERE action_id = ? AND user_id > ? AND user_id <= ?"
+
+
+class MassActionSuperseded(Exception):
+    """Пачку уже применил другой исполнитель (действие продолжено задачей планировщика)"""
+
+# Действие -> запросы над пачкой (SQL, нужен ли value первым параметром) и текст уведомления
+ACTIONS: Dict[str, Dict[str, Any]] = {
+    'MASS_ADD_BALANCE': {
+        'statements': [
+            ("UPDATE users SET balance = balance + ?, updated_at = CURRENT_TIMESTAMP WHERE id IN ({chunk})", True),
+            ("""
+                INSERT INTO transactions (user_id, amount, type, status, description)
+                SELECT id, ?, 'deposit', 'Success', 'Начисление от администрации' FROM users WHERE id IN ({chunk})
+            """, True),
+        ],
+        'message': lambda value: f"💰 Вам начислено {value} ₽ на баланс!",
+    },
+    'MASS_ADD_DAYS': {
+        'statements': [
+            ("""
+                UPDATE vpn_keys SET expiry_date = datetime(
+                    CASE WHEN expiry_date > datetime('now') THEN expiry_date ELSE datetime('now') END,
+                    '+' || ? || ' days'
+                ) WHERE user_id IN ({chunk})
+            """, True),
+        ],
+        'message': lambda value: f"⏰ Ваша подписка продлена на {value} дней!",
+        'remnawave': 'expiry',
+    },
+    'MASS_BAN': {
+        'statements': [("UPDATE users SET is_banned = 1 WHERE id IN ({chunk})", False)],
+        'message': lambda value: f"⛔ Ваш аккаунт заблокирован. Причина: {html.escape(value) or 'Не указана'}",
+    },
+    'MASS_UNBAN': {
+        'statements': [("UPDATE users SET is_banned = 0 WHERE id IN ({chunk})", False)],
+        'message': lambda value: "✅ Ваш аккаунт разблокирован!",
+    },
+    'MASS_RESET_TRIAL': {
+        'statements': [("UPDATE users SET trial_used = 0 WHERE id IN ({chunk})", False)],
+        'message': lambda value: "🎁 Ваш пробный период сброшен! Вы можете снова воспользоваться триалом.",
+    },
+    'MASS_DELETE_KEYS': {
+        'statements': [("DELETE FROM vpn_keys WHERE user_id IN ({chunk})", False)],
+        'message': lambda value: "🔑 Ваши VPN ключи были удалены.",
+    },
+    'MASS_SET_PARTNER': {
+        'statements': [("UPDATE users SET is_partner = 1, partner_rate = ? WHERE id IN ({chunk})", True)],
+        'message': lambda value: f"🤝 Вы стали партнером! Ваша комиссия: {value}%",
+    },
+    'MASS_REMOVE_PARTNER': {
+        'statements': [("UPDATE users SET is_partner = 0, partner_rate = 0 WHERE id IN ({chunk})", False)],
+        'message': lambda value: "👤 Ваш партнерский статус отменен.",
+    },
+}
+
+
+def parse_value(action: str, value: Any):
+    """Значение действия нужного типа; ValueError, если действие или значение неверны"""
+    if action not in ACTIONS:
+        raise ValueError(f"Unknown action: {action}")
+    if action == 'MASS_ADD_BALANCE':
+        return float(value)
+    if action == 'MASS_ADD_DAYS':
+        return int(value)
+    if action == 'MASS_SET_PARTNER':
+        return int(value) if value else 20
+    return str(value or '')
+
+
+def start_mass_action(action: str, value: Any = '', notify: bool = False,
+                      user_ids: Optional[List[int]] = None) -> Dict[str, Any]:
+    """
+    Создать массовое действие и выполнить его в фоновом потоке.
+
+    Args:
+        user_ids: ID пользователей; пустой список или None - все пользователи
+
+    Returns:
+        Dict с id действия; ValueError, если действие или значение неверны
+    """
+    value = parse_value(action, value)
+    user_ids = [int(user_id) for user_id in user_ids or []]
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO mass_actions (action, value, notify, heartbeat_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+        """, (action, json.dumps(value, ensure_ascii=False), 1 if notify else 0))
+        action_id = cursor.lastrowid
+        total = _snapshot_targets(conn, action_id, user_ids)
+        cursor.execute("UPDATE mass_actions SET total_count = ? WHERE id = ?", (total, action_id))
+    threading.Thread(
+        target=_run_in_thread, args=(action_id,), name=f"mass-action-{action_id}", daemon=True
+    ).start()
+    return {'id': action_id, 'status': 'Queued'}
+
+
+def get_mass_action_status(action_id: int) -> Optional[Dict[str, Any]]:
+    """Прогресс массового действия"""
+    with database.db_connection() as conn:
+        row = conn.execute("SELECT * FROM mass_actions WHERE id = ?", (action_id,)).fetchone()
+    if not row:
+        return None
+    total = row['total_count'] or 0
+    processed = row['processed_count'] or 0
+    return {
+        'id': row['id'],
+        'action': row['action'],
+        'status': row['status'],
+        'total': total,
+        'processed': processed,
+        'progress': round(processed / total * 100, 1) if total else (100.0 if row['status'] == 'Completed' else 0.0),
+        'notified': row['notified_count'] or 0,
+        'remnawave_total': row['remnawave_total'] or 0,
+        'remnawave_failed': row['remnawave_failed'] or 0,
+        'error': row['error'],
+        'created_at': row['created_at'],
+        'started_at': row['started_at'],
+        'finished_at': row['finished_at'],
+    }
+
+
+def _snapshot_targets(conn, action_id: int, user_ids: List[int]) -> int:
+    """Зафиксировать список пользователей действия в mass_action_targets"""
+    if user_ids:
+        cursor = conn.execute("""
+            INSERT OR IGNORE INTO mass_action_targets (action_id, user_id)
+            SELECT ?, id FROM users WHERE id IN (SELECT value FROM json_each(?))
+        """, (action_id, json.dumps(user_ids)))
+    else:
+        cursor = conn.execute("""
+            INSERT OR IGNORE INTO mass_action_targets (action_id, user_id) SELECT ?, id FROM users
+        """, (action_id,))
+    return cursor.rowcount
+
+
+def _push_expiry(chunk_sql: str, params: tuple) -> Dict[str, int]:
+    """Отправить в Remnawave новые сроки ключей пачки (параллельно)"""
+    with database.db_connection() as conn:
+        rows = conn.execute(f"""
+            SELECT key_uuid, expiry_date FROM vpn_keys
+            WHERE user_id IN ({chunk_sql}) AND key_uuid IS NOT NULL AND expiry_date IS NOT NULL
+        """, params).fetchall()
+    expiries = {row['key_uuid']: datetime.fromisoformat(str(row['expiry_date']).replace('Z', '+00:00')) for row in rows}
+    if not expiries:
+        return {'total': 0, 'failed': 0}
+    errors = remnawave.remnawave_api.set_expire_dates_sync(expiries, concurrency=MASS_ACTION_REMWAVE_CONCURRENCY)
+    failed = {uuid: error for uuid, error in errors.items() if error}
+    if failed:
+        sample = dict(list(failed.items())[:ERROR_SAMPLE_SIZE])
+        logger.warning(f"Remnawave expiry push failed for {len(failed)}/{len(expiries)} keys: {sample}")
+    return {'total': len(expiries), 'failed': len(failed)}
+
+
+def _push_chunk_expiry(action_id: int, bounds: tuple):
+    """Отправить сроки пачки в Remnawave и сдвинуть remnawave_last_id"""
+    pushed = _push_expiry(CHUNK_USERS, bounds)
+    with database.transaction() as tx:
+        tx.execute("""
+            UPDATE mass_actions SET remnawave_total = remnawave_total + ?, remnawave_failed = remnawave_failed + ?,
+                remnawave_last_id = MAX(remnawave_last_id, ?)
+            WHERE id = ?
+        """, (pushed['total'], pushed['failed'], bounds[2], action_id))
+
+
+def _finish(action_id: int, status: str, error: Optional[str] = None):
+    """Завершить действие и удалить его список пользователей"""
+    with database.transaction() as tx:
+        tx.execute("""
+            UPDATE mass_actions SET status = ?, error = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?
+        """, (status, error, action_id))
+        tx.execute("DELETE FROM mass_action_targets WHERE action_id = ?", (action_id,))
+
+
+def run_mass_action(action_id: int) -> Dict[str, Any]:
+    """
+    Выполнить (или продолжить с last_id) массовое действие пачками в текущем потоке.
+    Каждая пачка применяется в одной транзакции с переносом last_id по принципу
+    compare-and-set, поэтому два исполнителя не применят одну пачку дважды.
+    """
+    with database.db_connection() as conn:
+        row = conn.execute("SELECT * FROM mass_actions WHERE id = ?", (action_id,)).fetchone()
+        has_targets = conn.execute("SELECT 1 FROM mass_action_targets WHERE action_id = ? LIMIT 1",
+                                   (action_id,)).fetchone() is not None
+    action = row['action']
+    spec = ACTIONS[action]
+    value = json.loads(row['value'])
+    message = spec['message'](value) if row['notify'] else None
+    last_id = row['last_id'] or 0
+    try:
+        if not has_targets and row['total_count']:
+            # Действие начато до сохранения списка пользователей в БД - продолжить нельзя
+            raise RuntimeError("Список пользователей действия утерян, действие прервано")
+        with database.transaction() as tx:
+            tx.execute("""
+                UPDATE mass_actions SET status = 'Running', heartbeat_at = CURRENT_TIMESTAMP,
+                    started_at = COALESCE(started_at, CURRENT_TIMESTAMP)
+                WHERE id = ?
+            """, (action_id,))
+
+        # Досылка сроков в Remnawave, если процесс прервался между пачкой и отправкой
+        if spec.get('remnawave') == 'expiry' and (row['remnawave_last_id'] or 0) < last_id:
+            _push_chunk_expiry(action_id, (action_id, row['remnawave_last_id'] or 0, last_id))
+
+        while True:
+            with database.db_connection() as conn:
+                chunk = conn.execute("""
+                    SELECT MAX(user_id) AS hi, COUNT(*) AS count FROM (
+                        SELECT user_id FROM mass_action_targets WHERE action_id = ? AND user_id > ?
+                        ORDER BY user_id LIMIT ?
+                    )
+                """, (action_id, last_id, MASS_ACTION_CHUNK_SIZE)).fetchone()
+            if not chunk['count']:
+                break
+            bounds = (action_id, last_id, chunk['hi'])
+
+            with database.transaction() as tx:
+                claimed = tx.execute("""
+                    UPDATE mass_actions SET last_id = ?, processed_count = processed_count + ?,
+                        heartbeat_at = CURRENT_TIMESTAMP
+                    WHERE id = ? AND last_id = ? AND status = 'Running'
+                """, (chunk['hi'], chunk['count'], action_id, last_id)).rowcount
+                if not claimed:
+                    raise MassActionSuperseded()
+                for sql, uses_value in spec['statements']:
+                    tx.execute(sql.format(chunk=CHUNK_USERS), ((value,) if uses_value else ()) + bounds)
+                notified = notifications.enqueue_for_users(CHUNK_USERS, bounds, message) if message else 0
+                tx.execute("UPDATE mass_actions SET notified_count = notified_count + ? WHERE id = ?",
+                           (notified, action_id))
+
+            if spec.get('remnawave') == 'expiry':
+                _push_chunk_expiry(action_id, bounds)
+            last_id = chunk['hi']
+
+        _finish(action_id, 'Completed')
+        status = get_mass_action_status(action_id)
+        logger.info(f"Mass action #{action_id} {action} completed: {status['processed']}/{status['total']} users, "
+                    f"Remnawave failed {status['remnawave_failed']}/{status['remnawave_total']}")
+        return status
+    except MassActionSuperseded:
+        logger.info(f"Mass action #{action_id} {action} is continued by another worker")
+        return get_mass_action_status(action_id)
+    except Exception as e:
+        logger.error(f"Mass action #{action_id} {action} error: {e}")
+        _finish(action_id, 'Failed', str(e))
+        raise
+
+
+def _run_in_thread(action_id: int):
+    try:
+        run_mass_action(action_id)
+    except Exception:
+        pass
+    finally:
+        database.release_thread_connection()
+
+
+def resume_stale_actions() -> Dict[str, Any]:
+    """
+    Задача планировщика: продолжить действия, прерванные перезапуском воркера
+    (статус Queued/Running без пульса дольше MASS_ACTION_STALE_SECONDS).
+    """
+    with database.db_connection() as conn:
+        rows = conn.execute("""
+            SELECT id FROM mass_actions
+            WHERE status IN ('Queued', 'Running') AND COALESCE(heartbeat_at, created_at) < datetime('now', ?)
+            ORDER BY id
+        """, (f'-{MASS_ACTION_STALE_SECONDS} seconds',)).fetchall()
+    resumed, failed = [], []
+    for row in rows:
+        logger.warning(f"Mass action #{row['id']} stalled, resuming")
+        try:
+            run_mass_action(row['id'])
+            resumed.append(row['id'])
+        except Exception:
+            failed.append(row['id'])
+    return {'resumed': resumed, 'failed': failed}
+
+
+def register_jobs():
+    """Зарегистрировать продолжение прерванных действий (MASS_ACTION_RESUME_INTERVAL=0 отключает)"""
+    if MASS_ACTION_RESUME_INTERVAL <= 0:
+        return
+    from backend.core import scheduler
+    scheduler.register_job('mass_actions_resume', resume_stale_actions, MASS_ACTION_RESUME_INTERVAL, initial_delay=60)
@@ -0,0 +1,315 @@
+"""
+Очередь уведомлений в Telegram (outbox) и фоновый диспетчер
+
+Вызывающий код (webhook'и, автоплатежи, выводы, возвраты) только вставляет
+строку в notification_outbox и не ждет Telegram. Диспетчер в отдельном потоке
+с собственным циклом asyncio отправляет сообщения через общую сессию aiohttp:
+- порядок в пределах чата сохраняется (из каждого чата берется только самое
+  раннее неотправленное сообщение);
+- забранные сообщения помечаются 'sending' с блокировкой locked_until, которая
+  вместе с арендой продлевается на время отправки (пауза 429 может быть дольше
+  аренды), поэтому другой процесс не отправит их повторно;
+- общий лимит скорости - token bucket, ответы 429 приостанавливают отправку;
+- временные ошибки повторяются с экспоненциальной задержкой, после
+  NOTIFY_MAX_ATTEMPTS попыток или при постоянной ошибке сообщение
+  переходит в статус 'dead' (dead letter) и видно в статистике очереди.
+Адрес Bot API задается TELEGRAM_API_URL, поэтому диспетчер можно направить
+на локальный фейковый сервер Telegram (backend/core/fake_telegram.py).
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from typing import Optional, Dict, Any, List, Union
+from backend.database import database
+from backend.core import telegram_client
+
+logger = logging.getLogger(__name__)
+
+BOT_TOKENS = {
+    'main': os.getenv('TELEGRAM_BOT_TOKEN', ''),
+    'support': os.getenv('SUPPORT_BOT_TOKEN', ''),
+}
+
+NOTIFY_RATE_PER_SECOND = float(os.getenv('NOTIFY_RATE_PER_SECOND', '5'))  # Рассылки делят с уведомлениями лимит бота
+NOTIFY_BATCH_SIZE = int(os.getenv('NOTIFY_BATCH_SIZE', '50'))
+NOTIFY_MAX_ATTEMPTS = int(os.getenv('NOTIFY_MAX_ATTEMPTS', '8'))
+NOTIFY_MAX_BACKOFF = 3600
+NOTIFY_RETENTION_DAYS = int(os.getenv('NOTIFY_RETENTION_DAYS', '7'))
+IDLE_POLL_INTERVAL = 1.0
+LEASE_NAME = 'notification_dispatcher'
+LEASE_TTL = 30
+NOTIFY_LOCK_TTL = 60  # Блокировка забранной пачки; продлевается каждые CLAIM_RENEW_INTERVAL
+CLAIM_RENEW_INTERVAL = LEASE_TTL / 3
+
+_wakeup = threading.Event()
+_stop_event = threading.Event()
+_thread: Optional[threading.Thread] = None
+
+
+def enqueue(chat_id: Union[int, str], text: str, bot: str = 'main', fallback_bot: str = None,
+            parse_mode: str = 'HTML') -> bool:
+    """
+    Поставить сообщение в очередь отправки.
+
+    Args:
+        chat_id: Telegram ID пользователя или чата
+        bot: Бот-отправитель ('main' или 'support')
+        fallback_bot: Бот, через которого отправить, если основной не смог
+
+    Returns:
+        True, если сообщение поставлено в очередь (для бота задан токен)
+    """
+    if not BOT_TOKENS.get(bot):
+        if not fallback_bot or not BOT_TOKENS.get(fallback_bot):
+            return False
+        bot, fallback_bot = fallback_bot, None
+    with database.transaction() as conn:
+        conn.execute("""
+            INSERT INTO notification_outbox (bot, fallback_bot, chat_id, text, parse_mode)
+            VALUES (?, ?, ?, ?, ?)
+        """, (bot, fallback_bot, str(chat_id), text, parse_mode))
+    _wakeup.set()
+    return True
+
+
+def enqueue_for_users(user_ids_sql: str, params: tuple, text: str, bot: str = 'main',
+                      parse_mode: str = 'HTML') -> int:
+    """
+    Поставить одно сообщение в очередь для многих пользователей одним INSERT ... SELECT.
+
+    Args:
+        user_ids_sql: Подзапрос, возвращающий users.id получателей
+        params: Параметры подзапроса
+
+    Returns:
+        Количество поставленных в очередь сообщений (0, если для бота не задан токен)
+    """
+    if not BOT_TOKENS.get(bot):
+        return 0
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            INSERT INTO notification_outbox (bot, chat_id, text, parse_mode)
+            SELECT ?, CAST(telegram_id AS TEXT), ?, ? FROM users
+            WHERE id IN ({user_ids_sql}) AND telegram_id IS NOT NULL
+        """, (bot, text, parse_mode, *params))
+        queued = cursor.rowcount
+    _wakeup.set()
+    return queued
+
+
+def get_outbox_stats() -> Dict[str, Any]:
+    """Размер очереди по статусам и возраст самого старого неотправленного сообщения"""
+    with database.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT status, COUNT(*) AS count FROM notification_outbox GROUP BY status")
+        counts = {row['status']: row['count'] for row in cursor.fetchall()}
+        cursor.execute("""
+            SELECT CAST(strftime('%s', 'now') - strftime('%s', MIN(created_at)) AS INTEGER)
+            FROM notification_outbox WHERE status IN ('pending', 'sending')
+        """)
+        oldest = cursor.fetchone()[0]
+    return {
+        'pending': counts.get('pending', 0),
+        'sending': counts.get('sending', 0),
+        'sent': counts.get('sent', 0),
+        'dead': counts.get('dead', 0),
+        'oldest_pending_seconds': oldest,
+    }
+
+
+def _claim_batch() -> List[Dict[str, Any]]:
+    """Забрать самое раннее неотправленное сообщение каждого чата, которому пора отправляться"""
+    now = time.time()
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        # Голова чата, которую отправляет другой процесс, блокирует и следующие сообщения чата
+        cursor.execute("""
+            SELECT o.id, o.bot, o.fallback_bot, o.chat_id, o.text, o.parse_mode, o.attempts
+            FROM (
+                SELECT MIN(id) AS id FROM notification_outbox
+                WHERE status IN ('pending', 'sending')
+                GROUP BY chat_id
+            ) head
+            JOIN notification_outbox o ON o.id = head.id
+            WHERE (o.status = 'pending' AND o.next_attempt_at <= ?) OR (o.status = 'sending' AND o.locked_until <= ?)
+            ORDER BY o.id
+            LIMIT ?
+        """, (now, now, NOTIFY_BATCH_SIZE))
+        messages = [dict(row) for row in cursor.fetchall()]
+        cursor.executemany("UPDATE notification_outbox SET status = 'sending', locked_until = ? WHERE id = ?",
+                           [(now + NOTIFY_LOCK_TTL, message['id']) for message in messages])
+    return messages
+
+
+def _extend_claim(message_ids: List[int]):
+    with database.transaction() as conn:
+        conn.execute("""
+            UPDATE notification_outbox SET locked_until = ?
+            WHERE id IN (SELECT value FROM json_each(?)) AND status = 'sending'
+        """, (time.time() + NOTIFY_LOCK_TTL, json.dumps(message_ids)))
+
+
+async def _keep_claimed(message_ids: List[int], done: asyncio.Event):
+    """Продлевать аренду и блокировку пачки, пока она отправляется"""
+    while True:
+        try:
+            await asyncio.wait_for(done.wait(), CLAIM_RENEW_INTERVAL)
+            return
+        except asyncio.TimeoutError:
+            pass
+        try:
+            _acquire_lease()
+            _extend_claim(message_ids)
+        except Exception as e:
+            logger.warning(f"Не удалось продлить блокировку пачки уведомлений: {e}")
+
+
+def _save_results(results: List[tuple]):
+    """Сохранить результаты пачки в одной транзакции"""
+    sent = [(row_id,) for row_id, status, _, _ in results if status == 'sent']
+    dead = [(attempts, error, row_id) for row_id, status, attempts, error in results if status == 'dead']
+    retry = [(attempts, error, time.time() + min(NOTIFY_MAX_BACKOFF, 2 ** attempts), row_id)
+             for row_id, status, attempts, error in results if status == 'retry']
+    # Основной бот не смог доставить: отправить резервным с начала
+    fallback = [(error, row_id) for row_id, status, _, error in results if status == 'fallback']
+    # 429: повторить без увеличения числа попыток
+    deferred = [(row_id,) for row_id, status, _, _ in results if status == 'deferred']
+
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("""
+            UPDATE notification_outbox SET status = 'sent', attempts = attempts + 1, error = NULL,
+                sent_at = CURRENT_TIMESTAMP, locked_until = 0
+            WHERE id = ?
+        """, sent)
+        cursor.executemany("""
+            UPDATE notification_outbox SET status = 'dead', attempts = ?, error = ?, locked_until = 0 WHERE id = ?
+        """, dead)
+        cursor.executemany("""
+            UPDATE notification_outbox SET status = 'pending', attempts = ?, error = ?, next_attempt_at = ?,
+                locked_until = 0
+            WHERE id = ?
+        """, retry)
+        cursor.executemany("""
+            UPDATE notification_outbox SET status = 'pending', bot = fallback_bot, fallback_bot = NULL,
+                attempts = 0, error = ?, next_attempt_at = 0, locked_until = 0
+            WHERE id = ?
+        """, fallback)
+        cursor.executemany("""
+            UPDATE notification_outbox SET status = 'pending', next_attempt_at = 0, locked_until = 0 WHERE id = ?
+        """, deferred)
+    for row_id, status, attempts, error in results:
+        if status == 'dead':
+            logger.error(f"Уведомление #{row_id} не доставлено после {attempts} попыток: {error}")
+
+
+async def _send_one(session, bucket: telegram_client.TokenBucket, message: Dict[str, Any]) -> tuple:
+    token = BOT_TOKENS.get(message['bot'])
+    attempts = message['attempts'] + 1
+    if not token:
+        status = 'fallback' if BOT_TOKENS.get(message['fallback_bot'] or '') else 'dead'
+        return message['id'], status, attempts, f"Токен бота {message['bot']} не задан"
+
+    await bucket.acquire()
+    result = await telegram_client.send_message(
+        session, token, message['chat_id'], message['text'], parse_mode=message['parse_mode']
+    )
+    if result.ok:
+        return message['id'], 'sent', attempts, None
+    if result.retry_after is not None:
+        bucket.pause(result.retry_after)
+        logger.warning(f"Telegram 429 при отправке уведомления, пауза {result.retry_after} с")
+        return message['id'], 'deferred', message['attempts'], result.error
+    if result.permanent or attempts >= NOTIFY_MAX_ATTEMPTS:
+        if message['fallback_bot'] and BOT_TOKENS.get(message['fallback_bot']):
+            return message['id'], 'fallback', attempts, result.error
+        return message['id'], 'dead', attempts, result.error
+    return message['id'], 'retry', attempts, result.error
+
+
+async def _dispatch_loop():
+    bucket = telegram_client.TokenBucket(NOTIFY_RATE_PER_SECOND)
+    async with telegram_client.create_session() as session:
+        while not _stop_event.is_set():
+            try:
+                processed = await _dispatch_step(session, bucket)
+            except Exception as e:
+                logger.error(f"Ошибка отправки уведомлений: {e}")
+                processed = False
+            finally:
+                database.release_thread_connection()
+
+            if not processed:
+                _wakeup.clear()
+                await asyncio.get_running_loop().run_in_executor(None, _wakeup.wait, IDLE_POLL_INTERVAL)
+
+
+async def _dispatch_step(session, bucket: telegram_client.TokenBucket) -> bool:
+    """Отправить одну пачку. Возвращает False, если работы сейчас нет"""
+    if not _acquire_lease():
+        return False
+    messages = _claim_batch()
+    if not messages:
+        return False
+    done = asyncio.Event()
+    keeper = asyncio.create_task(_keep_claimed([message['id'] for message in messages], done))
+    try:
+        results = await asyncio.gather(*(_send_one(session, bucket, message) for message in messages))
+    finally:
+        done.set()
+        await keeper
+    _save_results(results)
+    return True
+
+
+def _acquire_lease() -> bool:
+    """Отправкой занимается только один процесс"""
+    from backend.core import scheduler
+    return scheduler.acquire_lease(LEASE_NAME, LEASE_TTL)
+
+
+def _dispatcher_worker():
+    """Рабочий поток отправки уведомлений"""
+    asyncio.run(_dispatch_loop())
+
+
+def start_notification_dispatcher() -> bool:
+    """Запустить фоновую отправку уведомлений (повторный вызов ничего не делает)"""
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return False
+    _stop_event.clear()
+    _thread = threading.Thread(target=_dispatcher_worker, name='notification-dispatcher', daemon=True)
+    _thread.start()
+    logger.info("Notification dispatcher started")
+    return True
+
+
+def stop_notification_dispatcher(timeout: float = 10.0):
+    """Остановить отправку после текущей пачки"""
+    _stop_event.set()
+    _wakeup.set()
+    if _thread is not None:
+        _thread.join(timeout)
+
+
+def cleanup_outbox() -> Dict[str, int]:
+    """Удалить отправленные сообщения старше NOTIFY_RETENTION_DAYS (dead letters остаются для разбора)"""
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            DELETE FROM notification_outbox
+            WHERE status = 'sent' AND sent_at < datetime('now', ?)
+        """, (f'-{NOTIFY_RETENTION_DAYS} days',))
+        deleted = cursor.rowcount
+    return {'deleted': deleted}
+
+
+def register_jobs():
+    """Зарегистрировать очистку очереди уведомлений в планировщике"""
+    from backend.core import scheduler
+    scheduler.register_job('notification_outbox_cleanup', cleanup_outbox, 3600, initial_delay=300)
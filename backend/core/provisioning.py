@@ -0,0 +1,395 @@
+"""
+Очередь создания подписок в Remnawave (provisioning)
+
+Запрос /api/subscription/create только списывает оплату и ставит задачу
+в provisioning_jobs (одна транзакция), после чего сразу отвечает job_id.
+Фоновый пул воркеров создает пользователя в Remnawave и записывает
+vpn_keys и devices; мини-приложение опрашивает /api/subscription/status
+(long polling).
+
+- Задачи забираются блокировкой строки (locked_until), поэтому диспетчер
+  может работать в каждом процессе: задачу выполняет только один воркер,
+  а задача упавшего воркера забирается снова после истечения блокировки.
+- Username для Remnawave запоминается в задаче до создания пользователя:
+  повторная попытка находит уже созданного пользователя, а не создает второго.
+- Временные ошибки (сеть, 5xx, 429) повторяются с экспоненциальной
+  задержкой; после PROVISION_MAX_ATTEMPTS попыток или при ошибке 4xx задача
+  переходит в 'failed', и в той же транзакции оплата компенсируется
+  (возврат на баланс или повторно доступный пробный период).
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List
+from backend.database import database
+from backend.api import remnawave
+from backend.core import core
+
+logger = logging.getLogger(__name__)
+
+PROVISION_CONCURRENCY = int(os.getenv('PROVISION_CONCURRENCY', '4'))
+PROVISION_MAX_ATTEMPTS = int(os.getenv('PROVISION_MAX_ATTEMPTS', '5'))
+PROVISION_LOCK_TTL = int(os.getenv('PROVISION_LOCK_TTL', '120'))  # Дольше самого медленного запроса к Remnawave
+PROVISION_MAX_BACKOFF = 300
+PROVISION_RETENTION_DAYS = int(os.getenv('PROVISION_RETENTION_DAYS', '30'))
+PROVISION_LONG_POLL_MAX = 25.0  # Меньше proxy_read_timeout nginx (60 с)
+STATUS_POLL_INTERVAL = 0.25
+IDLE_POLL_INTERVAL = 0.5
+
+# Откуда оплачена подписка: от этого зависит компенсация при ошибке
+SOURCE_BALANCE = 'balance'
+SOURCE_TRIAL = 'trial'
+SOURCE_AUTO_PAY = 'auto_pay'
+
+FINAL_STATUSES = ('done', 'failed')
+
+_wakeup = threading.Event()
+_stop_event = threading.Event()
+_thread: Optional[threading.Thread] = None
+
+
+class ProvisioningError(Exception):
+    """Оплату списать не удалось (недостаточно средств, пробный период уже использован)"""
+
+
+def enqueue(user_id: int, telegram_id: int, username: str, days: int, plan_type: str = 'vpn',
+            traffic_limit: int = 0, price: float = 0, payment_source: str = SOURCE_BALANCE,
+            description: str = None) -> int:
+    """
+    Списать оплату и поставить создание подписки в очередь (атомарно).
+
+    Args:
+        plan_type: Тип подписки в Remnawave ('vpn' или 'whitelist')
+        payment_source: 'balance' - списать price с баланса, 'trial' - отметить
+                        пробный период, 'auto_pay' - уже оплачено автоплатежом
+        description: Описание транзакции, которая запишется после создания подписки
+
+    Returns:
+        ID задачи; ProvisioningError, если оплату списать не удалось
+    """
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        if payment_source == SOURCE_BALANCE:
+            if not database.update_user_balance(user_id, -price, ensure_non_negative=True):
+                raise ProvisioningError('Insufficient balance')
+        elif payment_source == SOURCE_TRIAL:
+            # Условный UPDATE: два одновременных запроса не получат два пробных периода
+            cursor.execute("UPDATE users SET trial_used = 1 WHERE id = ? AND COALESCE(trial_used, 0) = 0", (user_id,))
+            if cursor.rowcount == 0:
+                raise ProvisioningError('Пробный период уже использован')
+        cursor.execute("""
+            INSERT INTO provisioning_jobs
+                (user_id, telegram_id, username, plan_type, days, traffic_limit, price, payment_source, description)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (user_id, telegram_id, username, plan_type, days, traffic_limit or 0, price, payment_source, description))
+        job_id = cursor.lastrowid
+    _wakeup.set()
+    logger.info(f"Provisioning job #{job_id} queued for user {user_id} ({plan_type}, {days} days)")
+    return job_id
+
+
+def get_job(job_id: int, user_id: int = None) -> Optional[Dict[str, Any]]:
+    """Статус задачи для мини-приложения (только задачи этого пользователя, если user_id передан)"""
+    with database.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, user_id, status, attempts, payment_source, result, error, created_at, finished_at
+            FROM provisioning_jobs WHERE id = ?
+        """, (job_id,))
+        row = cursor.fetchone()
+    if not row or (user_id is not None and row['user_id'] != user_id):
+        return None
+    job = {
+        'job_id': row['id'],
+        'status': row['status'],
+        'attempts': row['attempts'],
+        'created_at': row['created_at'],
+        'finished_at': row['finished_at'],
+    }
+    if row['status'] == 'done':
+        job['subscription'] = json.loads(row['result']) if row['result'] else None
+    elif row['status'] == 'failed':
+        job['error'] = row['error']
+        job['refunded'] = row['payment_source'] != SOURCE_AUTO_PAY
+    return job
+
+
+def wait_for_job(job_id: int, user_id: int = None, timeout: float = 0) -> Optional[Dict[str, Any]]:
+    """Long polling: вернуть статус, как только задача завершится, но не позже timeout секунд"""
+    deadline = time.monotonic() + min(max(timeout, 0), PROVISION_LONG_POLL_MAX)
+    while True:
+        job = get_job(job_id, user_id)
+        if not job or job['status'] in FINAL_STATUSES or time.monotonic() >= deadline:
+            return job
+        time.sleep(STATUS_POLL_INTERVAL)
+
+
+async def wait_for_job_async(job_id: int, user_id: int = None, timeout: float = 0) -> Optional[Dict[str, Any]]:
+    """Long polling без блокировки цикла событий"""
+    deadline = time.monotonic() + min(max(timeout, 0), PROVISION_LONG_POLL_MAX)
+    while True:
+        job = await database.run_async(get_job, job_id, user_id)
+        if not job or job['status'] in FINAL_STATUSES or time.monotonic() >= deadline:
+            return job
+        await asyncio.sleep(STATUS_POLL_INTERVAL)
+
+
+def get_queue_stats() -> Dict[str, Any]:
+    """Размер очереди по статусам и возраст самой старой незавершенной задачи"""
+    with database.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT status, COUNT(*) AS count FROM provisioning_jobs GROUP BY status")
+        counts = {row['status']: row['count'] for row in cursor.fetchall()}
+        cursor.execute("""
+            SELECT CAST(strftime('%s', 'now') - strftime('%s', MIN(created_at)) AS INTEGER)
+            FROM provisioning_jobs WHERE status IN ('pending', 'processing')
+        """)
+        oldest = cursor.fetchone()[0]
+    return {
+        'pending': counts.get('pending', 0),
+        'processing': counts.get('processing', 0),
+        'done': counts.get('done', 0),
+        'failed': counts.get('failed', 0),
+        'oldest_active_seconds': oldest,
+    }
+
+
+def _claim_batch(limit: int) -> List[Dict[str, Any]]:
+    """Забрать задачи, которым пора выполняться, и задачи с истекшей блокировкой"""
+    now = time.time()
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT * FROM provisioning_jobs
+            WHERE status IN ('pending', 'processing')
+              AND CASE status WHEN 'pending' THEN next_attempt_at ELSE locked_until END <= ?
+            ORDER BY id
+            LIMIT ?
+        """, (now, limit))
+        jobs = [dict(row) for row in cursor.fetchall()]
+        cursor.executemany("""
+            UPDATE provisioning_jobs
+            SET status = 'processing', attempts = attempts + 1, locked_until = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        """, [(now + PROVISION_LOCK_TTL, job['id']) for job in jobs])
+    for job in jobs:
+        job['attempts'] += 1
+    return jobs
+
+
+def _remember_username(job_id: int, remnawave_username: str):
+    with database.transaction() as conn:
+        conn.execute("UPDATE provisioning_jobs SET remnawave_username = ? WHERE id = ?", (remnawave_username, job_id))
+
+
+async def _find_or_create_user(api: remnawave.RemnaWaveAPI, job: Dict[str, Any], squad_uuids: list,
+                               base_username: str, username: str):
+    """Пользователь Remnawave для задачи: созданный прошлой попыткой или новый"""
+    telegram_id = job['telegram_id']
+    if job['remnawave_username']:
+        username = job['remnawave_username']
+        expected = remnawave.sanitize_remnawave_username(username, telegram_id)
+        for user in await api.get_user_by_telegram_id(telegram_id):
+            if user.username == expected:
+                logger.info(f"Provisioning job #{job['id']}: reusing Remnawave user {user.uuid}")
+                return user
+    else:
+        await database.run_async(_remember_username, job['id'], username)
+
+    async def create(remnawave_username: str):
+        return await api.create_user(
+            remnawave.sanitize_remnawave_username(remnawave_username, telegram_id),
+            datetime.now() + timedelta(days=job['days']),
+            telegram_id=telegram_id,
+            traffic_limit_bytes=job['traffic_limit'] or 0,
+            active_internal_squads=squad_uuids or None
+        )
+
+    try:
+        return await create(username)
+    except remnawave.RemnaWaveAPIError as e:
+        if not core._is_username_collision(e):
+            raise
+        username = core._collision_username(base_username, telegram_id)
+        await database.run_async(_remember_username, job['id'], username)
+        return await create(username)
+
+
+def _complete(job: Dict[str, Any], result: Dict[str, Any]) -> bool:
+    """Завершить задачу и записать транзакцию подписки (одна транзакция БД)"""
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE provisioning_jobs
+            SET status = 'done', result = ?, error = NULL, updated_at = CURRENT_TIMESTAMP, finished_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'processing'
+        """, (json.dumps(result, ensure_ascii=False, default=str), job['id']))
+        if cursor.rowcount == 0:
+            # Задачу уже завершил другой воркер (истекла блокировка)
+            return False
+        if job['payment_source'] != SOURCE_AUTO_PAY:
+            cursor.execute("""
+                INSERT INTO transactions (user_id, type, amount, status, description, payment_method)
+                VALUES (?, ?, ?, 'Success', ?, 'Balance')
+            """, (job['user_id'], 'trial' if job['payment_source'] == SOURCE_TRIAL else 'subscription',
+                  -job['price'], job['description']))
+    logger.info(f"Provisioning job #{job['id']} done after {job['attempts']} attempt(s)")
+    return True
+
+
+def _fail(job: Dict[str, Any], error: str) -> bool:
+    """Перевести задачу в 'failed' и компенсировать оплату в той же транзакции"""
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE provisioning_jobs
+            SET status = 'failed', error = ?, updated_at = CURRENT_TIMESTAMP, finished_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'processing'
+        """, (error, job['id']))
+        if cursor.rowcount == 0:
+            return False
+        if job['payment_source'] == SOURCE_BALANCE:
+            database.update_user_balance(job['user_id'], job['price'])
+        elif job['payment_source'] == SOURCE_TRIAL:
+            cursor.execute("UPDATE users SET trial_used = 0 WHERE id = ?", (job['user_id'],))
+    logger.error(f"Provisioning job #{job['id']} failed after {job['attempts']} attempt(s): {error}")
+
+    if job['payment_source'] == SOURCE_BALANCE:
+        core.send_notification_to_user(
+            job['telegram_id'], f"❌ Не удалось создать подписку. {job['price']:.2f} ₽ возвращены на баланс."
+        )
+    elif job['payment_source'] == SOURCE_AUTO_PAY:
+        # Автоплатеж уже прошел, вернуть его автоматически нельзя
+        core.send_notification_to_admin(
+            f"⚠️ Подписка по автоплатежу не создана (задача #{job['id']}, пользователь {job['telegram_id']}, "
+            f"{job['price']:.2f} ₽): {error}"
+        )
+    return True
+
+
+def _retry(job: Dict[str, Any], error: str):
+    delay = min(PROVISION_MAX_BACKOFF, 2 ** job['attempts'])
+    with database.transaction() as conn:
+        conn.execute("""
+            UPDATE provisioning_jobs
+            SET status = 'pending', error = ?, next_attempt_at = ?, locked_until = 0, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'processing'
+        """, (error, time.time() + delay, job['id']))
+    logger.warning(f"Provisioning job #{job['id']} attempt {job['attempts']} failed, retry in {delay} s: {error}")
+
+
+def _is_permanent(error: Exception) -> bool:
+    """Ошибки 4xx Remnawave (кроме 408/429) повторять бессмысленно"""
+    status = getattr(error, 'status_code', None)
+    return isinstance(error, remnawave.RemnaWaveAPIError) and status is not None \
+        and 400 <= status < 500 and status not in (408, 429)
+
+
+async def _process(api: remnawave.RemnaWaveAPI, job: Dict[str, Any]):
+    """Выполнить задачу: запросы к Remnawave - в цикле событий, работа с БД - в пуле потоков database.run_async"""
+    try:
+        prepared = await database.run_async(
+            core._prepare_subscription, job['telegram_id'], job['username'], plan_type=job['plan_type']
+        )
+        remnawave_user = await _find_or_create_user(
+            api, job, prepared['squad_uuids'], prepared['base_username'], prepared['username']
+        )
+        if not remnawave_user:
+            raise RuntimeError('Remnawave returned no user')
+        # Повторная запись после сбоя безопасна: ключ ищется по (user_id, key_uuid)
+        result = await database.run_async(
+            core._save_subscription, prepared['user_id'], remnawave_user, job['days'], job['traffic_limit'],
+            job['plan_type']
+        )
+        await database.run_async(_complete, job, result)
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+        try:
+            if _is_permanent(e) or job['attempts'] >= PROVISION_MAX_ATTEMPTS:
+                await database.run_async(_fail, job, error)
+            else:
+                await database.run_async(_retry, job, error)
+        except Exception as db_error:
+            # Задачу заберет другой воркер после истечения блокировки
+            logger.error(f"Provisioning job #{job['id']}: failed to record error: {db_error}")
+
+
+async def _dispatch_loop():
+    api = await remnawave.get_remnawave_api().open(
+        limit=PROVISION_CONCURRENCY * 2,
+        limit_per_host=PROVISION_CONCURRENCY * 2,
+        keepalive_timeout=remnawave.REMWAVE_KEEPALIVE_TIMEOUT,
+    )
+    running = set()
+    try:
+        while not _stop_event.is_set():
+            try:
+                free = PROVISION_CONCURRENCY - len(running)
+                jobs = await database.run_async(_claim_batch, free) if free > 0 else []
+            except Exception as e:
+                logger.error(f"Ошибка выбора задач provisioning: {e}")
+                jobs = []
+            for job in jobs:
+                task = asyncio.ensure_future(_process(api, job))
+                running.add(task)
+                task.add_done_callback(running.discard)
+
+            if not jobs:
+                _wakeup.clear()
+                if running:
+                    await asyncio.wait(running, timeout=IDLE_POLL_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+                else:
+                    await asyncio.get_running_loop().run_in_executor(None, _wakeup.wait, IDLE_POLL_INTERVAL)
+        if running:
+            # Незавершенные задачи заберет другой воркер после истечения блокировки
+            await asyncio.wait(running, timeout=PROVISION_LOCK_TTL)
+    finally:
+        await api.close()
+        database.release_thread_connection()
+
+
+def _dispatcher_worker():
+    """Рабочий поток provisioning"""
+    asyncio.run(_dispatch_loop())
+
+
+def start_provisioning_dispatcher() -> bool:
+    """Запустить фоновое создание подписок (повторный вызов ничего не делает)"""
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return False
+    _stop_event.clear()
+    _thread = threading.Thread(target=_dispatcher_worker, name='provisioning-dispatcher', daemon=True)
+    _thread.start()
+    logger.info(f"Provisioning dispatcher started (concurrency={PROVISION_CONCURRENCY})")
+    return True
+
+
+def stop_provisioning_dispatcher(timeout: float = 10.0):
+    """Остановить диспетчер после текущих задач"""
+    _stop_event.set()
+    _wakeup.set()
+    if _thread is not None:
+        _thread.join(timeout)
+
+
+def cleanup_jobs() -> Dict[str, int]:
+    """Удалить завершенные задачи старше PROVISION_RETENTION_DAYS (неуспешные остаются для разбора)"""
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            DELETE FROM provisioning_jobs
+            WHERE status = 'done' AND finished_at < datetime('now', ?)
+        """, (f'-{PROVISION_RETENTION_DAYS} days',))
+        deleted = cursor.rowcount
+    return {'deleted': deleted}
+
+
+def register_jobs():
+    """Зарегистрировать очистку очереди provisioning в планировщике"""
+    from backend.core import scheduler
+    scheduler.register_job('provisioning_jobs_cleanup', cleanup_jobs, 3600, initial_delay=600)
@@ -0,0 +1,255 @@
+"""
+Инкрементальная сверка vpn_keys с пользователями Remnawave
+
+За один проход строится разница по каждому ключу (срок, трафик, лимит,
+статус), изменившиеся строки записываются короткими пакетными транзакциями.
+Водяной знак (максимальный updatedAt из Remnawave) хранится в sync_state:
+для пользователей, не менявшихся в Remnawave с прошлого запуска, обновляется
+только трафик, а расхождения остальных полей лишь попадают в отчет
+(local_ahead) - значит, их изменил бот и Remnawave еще не догнал.
+Ключи, обновление которых не прошло из-за параллельного изменения (conflicts),
+сохраняются в sync_state (retry_uuids) и в следующем запуске сверяются
+как измененные в Remnawave, даже если водяной знак уже ушел вперед.
+Запускается планировщиком в фоне, API при этом не блокируется.
+"""
+import os
+import time
+import logging
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+from backend.database import database
+from backend.api import remnawave
+from backend.core import core
+
+logger = logging.getLogger(__name__)
+
+SYNC_NAME = 'remnawave_keys'
+REMWAVE_RECONCILE_INTERVAL = int(os.getenv('REMWAVE_RECONCILE_INTERVAL', '900'))
+REMWAVE_RECONCILE_BATCH_SIZE = int(os.getenv('REMWAVE_RECONCILE_BATCH_SIZE', '500'))
+
+# Статус в Remnawave -> статус ключа в БД бота
+STATUS_MAP = {
+    'ACTIVE': 'Active',
+    'EXPIRED': 'Expired',
+    'DISABLED': 'Disabled',
+    'LIMITED': 'Limited',
+}
+# Локальные статусы, которые сверка не перезаписывает
+PROTECTED_STATUSES = {'Banned'}
+EXPIRY_TOLERANCE_SECONDS = 1
+SAMPLE_SIZE = 50
+
+FIELDS = ('expiry_date', 'traffic_used', 'traffic_limit', 'status')
+
+
+def _parse_local_datetime(value) -> Optional[datetime]:
+    """Срок из БД: naive-время считается локальным (так его пишет core)"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.astimezone()
+    return parsed
+
+
+def _format_expiry(value: datetime) -> str:
+    """Срок в формате, в котором его пишет core (локальное naive-время)"""
+    return value.astimezone().replace(tzinfo=None).isoformat()
+
+
+def _diff_key(row, user, upstream_changed: bool) -> Dict[str, Any]:
+    """
+    Поля ключа, которые надо обновить, и поля, в которых бот опережает Remnawave.
+
+    Returns:
+        Dict с 'changes' (поле -> новое значение) и 'local_ahead' (список полей)
+    """
+    changes = {}
+    local_ahead = []
+
+    traffic_used = user.user_traffic.used_traffic_bytes if user.user_traffic else 0
+    if float(row['traffic_used'] or 0) != float(traffic_used):
+        changes['traffic_used'] = traffic_used
+
+    upstream = {}
+    local_expiry = _parse_local_datetime(row['expiry_date'])
+    if local_expiry is None or abs((local_expiry - user.expire_at).total_seconds()) > EXPIRY_TOLERANCE_SECONDS:
+        upstream['expiry_date'] = _format_expiry(user.expire_at)
+    if float(row['traffic_limit'] or 0) != float(user.traffic_limit_bytes or 0):
+        upstream['traffic_limit'] = user.traffic_limit_bytes or 0
+    status = STATUS_MAP.get(user.status.value)
+    if status and row['status'] != status and row['status'] not in PROTECTED_STATUSES:
+        upstream['status'] = status
+
+    if upstream_changed:
+        changes.update(upstream)
+    else:
+        local_ahead = sorted(upstream)
+    return {'changes': changes, 'local_ahead': local_ahead}
+
+
+def _apply_updates(updates: List[tuple]) -> Dict[str, Any]:
+    """
+    Записать обновления пакетами, каждый пакет - отдельная короткая транзакция.
+    Строка обновляется, только если срок и статус не изменились с момента чтения
+    (иначе ключ успели продлить или забанить, и он будет сверен в следующий раз).
+
+    Returns:
+        Dict с количеством обновленных строк, конфликтов и id ключей с конфликтом
+    """
+    updated = 0
+    conflicted_ids = []
+    for start in range(0, len(updates), REMWAVE_RECONCILE_BATCH_SIZE):
+        batch = updates[start:start + REMWAVE_RECONCILE_BATCH_SIZE]
+        with database.transaction() as conn:
+            cursor = conn.cursor()
+            for update in batch:
+                # rowcount не учитывает строки, записанные триггерами счетчиков и поиска
+                cursor.execute("""
+                    UPDATE vpn_keys SET expiry_date = ?, traffic_used = ?, traffic_limit = ?, status = ?
+                    WHERE id = ? AND expiry_date IS ? AND status IS ?
+                """, update)
+                if cursor.rowcount:
+                    updated += 1
+                else:
+                    conflicted_ids.append(update[4])
+    return {'updated': updated, 'conflicts': len(updates) - updated, 'conflicted_ids': conflicted_ids}
+
+
+def reconcile_keys_with_remnawave(full: bool = False, dry_run: bool = False) -> Dict[str, Any]:
+    """
+    Сверить ключи с Remnawave и обновить срок, трафик, лимит и статус.
+
+    Args:
+        full: Игнорировать водяной знак и перенести из Remnawave все расхождения
+        dry_run: Только посчитать расхождения, ничего не записывать
+
+    Returns:
+        Dict с количеством обновленных и расходящихся ключей и временем этапов
+    """
+    timings = {}
+    started = time.monotonic()
+
+    state = database.get_sync_state(SYNC_NAME)
+    watermark = None
+    retry_uuids = set()
+    if state and state['watermark'] and not full:
+        watermark = datetime.fromisoformat(state['watermark'])
+        retry_uuids = set(state['details'].get('retry_uuids') or [])
+
+    result = remnawave.remnawave_api.get_all_users_concurrently_sync(
+        page_size=core.REMWAVE_SYNC_PAGE_SIZE, concurrency=core.REMWAVE_SYNC_CONCURRENCY
+    )
+    users = {user.uuid: user for user in result['users']}
+    timings['fetch_ms'] = int((time.monotonic() - started) * 1000)
+
+    step = time.monotonic()
+    with database.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, key_uuid, expiry_date, traffic_used, traffic_limit, status
+            FROM vpn_keys WHERE key_uuid IS NOT NULL
+        """)
+        rows = cursor.fetchall()
+
+    updates = []
+    uuid_by_id = {}
+    retried = 0
+    changed_fields = dict.fromkeys(FIELDS, 0)
+    local_ahead = []
+    local_ahead_count = 0
+    missing_upstream = []
+    seen = set()
+    for row in rows:
+        user = users.get(row['key_uuid'])
+        if user is None:
+            missing_upstream.append(row['id'])
+            continue
+        seen.add(row['key_uuid'])
+        upstream_changed = watermark is None or user.updated_at > watermark
+        if not upstream_changed and row['key_uuid'] in retry_uuids:
+            upstream_changed = True
+            retried += 1
+        diff = _diff_key(row, user, upstream_changed)
+        if diff['local_ahead']:
+            local_ahead_count += 1
+            if len(local_ahead) < SAMPLE_SIZE:
+                local_ahead.append({'id': row['id'], 'key_uuid': row['key_uuid'], 'fields': diff['local_ahead']})
+        changes = diff['changes']
+        if not changes:
+            continue
+        for field in changes:
+            changed_fields[field] += 1
+        uuid_by_id[row['id']] = row['key_uuid']
+        updates.append((
+            changes.get('expiry_date', row['expiry_date']),
+            changes.get('traffic_used', row['traffic_used']),
+            changes.get('traffic_limit', row['traffic_limit']),
+            changes.get('status', row['status']),
+            row['id'], row['expiry_date'], row['status'],
+        ))
+    missing_local = len(users.keys() - seen)
+    timings['diff_ms'] = int((time.monotonic() - step) * 1000)
+
+    step = time.monotonic()
+    applied = {'updated': 0, 'conflicts': 0, 'conflicted_ids': []}
+    if not dry_run and updates:
+        applied = _apply_updates(updates)
+    timings['apply_ms'] = int((time.monotonic() - step) * 1000)
+
+    new_watermark = max((user.updated_at for user in users.values()), default=watermark)
+    # Если часть страниц потерялась, водяной знак не двигаем: пропущенные пользователи
+    # иначе не попадут в следующий инкрементальный запуск
+    complete = len(users) >= result['total']
+    timings['total_ms'] = int((time.monotonic() - started) * 1000)
+
+    report = {
+        'success': True,
+        'full': full or watermark is None,
+        'dry_run': dry_run,
+        'remnawave_users': len(users),
+        'pages': result['pages'],
+        'local_keys': len(rows),
+        'pending_updates': len(updates),
+        'updated': applied['updated'],
+        'conflicts': applied['conflicts'],
+        'retried': retried,
+        'changed_fields': changed_fields,
+        'local_ahead': local_ahead_count,
+        'local_ahead_sample': local_ahead,
+        'missing_upstream': len(missing_upstream),
+        'missing_upstream_sample': missing_upstream[:SAMPLE_SIZE],
+        'missing_local': missing_local,
+        'complete': complete,
+        'watermark': new_watermark.isoformat() if new_watermark else None,
+        'timings': timings,
+    }
+    if not dry_run:
+        stored_watermark = report['watermark'] if complete else (state or {}).get('watermark')
+        details = {key: value for key, value in report.items() if not key.endswith('_sample')}
+        # Конфликтные ключи повторяются в следующем запуске; при неполной загрузке
+        # водяной знак не сдвинут, но прошлые повторы могли не попасть в выборку
+        retry_next = {uuid_by_id[key_id] for key_id in applied['conflicted_ids']}
+        if not complete:
+            retry_next |= retry_uuids - seen
+        details['retry_uuids'] = sorted(retry_next)
+        database.set_sync_state(SYNC_NAME, stored_watermark, details)
+
+    logger.info(
+        f"Reconcile {'dry run' if dry_run else 'completed'}: {applied['updated']}/{len(updates)} keys updated, "
+        f"{local_ahead_count} local ahead, {len(missing_upstream)} missing in Remnawave, "
+        f"{missing_local} missing locally ({timings})"
+    )
+    return report
+
+
+def register_jobs():
+    """Зарегистрировать периодическую сверку в планировщике (REMWAVE_RECONCILE_INTERVAL=0 отключает)"""
+    if REMWAVE_RECONCILE_INTERVAL <= 0:
+        return
+    from backend.core import scheduler
+    scheduler.register_job('remnawave_reconcile', reconcile_keys_with_remnawave,
+                           REMWAVE_RECONCILE_INTERVAL, initial_delay=120)
@@ -0,0 +1,204 @@
+"""
+Планировщик периодических фоновых задач
+
+Задачи регистрируются через register_job() и запускаются фоновым потоком.
+Чтобы задача не выполнялась одновременно в нескольких процессах (API, бот,
+несколько воркеров), перед запуском берется аренда в таблице scheduler_jobs:
+аренда действует один интервал, поэтому задача выполняется раз за интервал
+на все процессы.
+"""
+import os
+import socket
+import logging
+import time
+import threading
+from datetime import datetime
+from typing import Callable, Dict, Any, List, Optional
+from backend.database import database
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', '1') == '1'
+TICK_INTERVAL = 1.0  # Как часто проверять, не пора ли запустить задачу
+
+_jobs: Dict[str, Dict[str, Any]] = {}
+_lock = threading.Lock()
+_stop_event = threading.Event()
+_thread: Optional[threading.Thread] = None
+
+
+def _owner_id() -> str:
+    """Идентификатор процесса-владельца аренды"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def register_job(name: str, func: Callable[[], Any], interval_seconds: float,
+                 initial_delay: float = 0.0, exclusive: bool = True):
+    """
+    Зарегистрировать периодическую задачу.
+
+    Args:
+        name: Уникальное имя задачи
+        func: Функция без аргументов; результат сохраняется в статусе задачи
+        interval_seconds: Интервал между запусками
+        initial_delay: Задержка перед первым запуском
+        exclusive: Выполнять только в одном процессе за интервал (через аренду в БД)
+    """
+    with _lock:
+        _jobs[name] = {
+            'func': func,
+            'interval': float(interval_seconds),
+            'exclusive': exclusive,
+            'next_run': time.monotonic() + initial_delay,
+            'running': False,
+            'runs': 0,
+            'failures': 0,
+            'last_result': None,
+        }
+
+
+def acquire_lease(name: str, ttl_seconds: float) -> bool:
+    """Взять аренду задачи, если она свободна или уже принадлежит этому процессу"""
+    now = time.time()
+    owner = _owner_id()
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO scheduler_jobs (name, owner, lease_expires_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                owner = excluded.owner,
+                lease_expires_at = excluded.lease_expires_at
+            WHERE scheduler_jobs.lease_expires_at <= ? OR scheduler_jobs.owner = excluded.owner
+        """, (name, owner, now + ttl_seconds, now))
+        return cursor.rowcount == 1
+
+
+def release_lease(name: str):
+    """Освободить аренду, взятую этим процессом, не дожидаясь ее истечения"""
+    with database.transaction() as conn:
+        conn.execute("UPDATE scheduler_jobs SET lease_expires_at = 0 WHERE name = ? AND owner = ?",
+                     (name, _owner_id()))
+
+
+def _record_run(name: str, started_at: datetime, duration_ms: int, status: str, error: str = None):
+    with database.transaction() as conn:
+        conn.execute("""
+            INSERT INTO scheduler_jobs (name, last_started_at, last_finished_at, last_duration_ms, last_status, last_error)
+            VALUES (?, ?, CURRENT_TIMESTAMP, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                last_started_at = excluded.last_started_at,
+                last_finished_at = excluded.last_finished_at,
+                last_duration_ms = excluded.last_duration_ms,
+                last_status = excluded.last_status,
+                last_error = excluded.last_error
+        """, (name, started_at.strftime('%Y-%m-%d %H:%M:%S'), duration_ms, status, error))
+
+
+def run_job(name: str) -> Any:
+    """Выполнить задачу немедленно в текущем потоке (без аренды)"""
+    job = _jobs[name]
+    started_at = datetime.utcnow()
+    start = time.monotonic()
+    try:
+        result = job['func']()
+        duration_ms = int((time.monotonic() - start) * 1000)
+        job['runs'] += 1
+        job['last_result'] = result
+        _record_run(name, started_at, duration_ms, 'ok')
+        logger.info(f"Задача {name} выполнена за {duration_ms} мс: {result}")
+        return result
+    except Exception as e:
+        duration_ms = int((time.monotonic() - start) * 1000)
+        job['failures'] += 1
+        logger.error(f"Ошибка задачи {name}: {e}")
+        try:
+            _record_run(name, started_at, duration_ms, 'error', str(e))
+        except Exception as record_error:
+            logger.error(f"Не удалось сохранить статус задачи {name}: {record_error}")
+        raise
+    finally:
+        database.release_thread_connection()
+
+
+def _run_in_thread(name: str):
+    job = _jobs[name]
+    try:
+        run_job(name)
+    except Exception:
+        pass
+    finally:
+        job['running'] = False
+
+
+def _scheduler_worker():
+    """Рабочий поток планировщика"""
+    while not _stop_event.is_set():
+        now = time.monotonic()
+        with _lock:
+            due = [name for name, job in _jobs.items() if not job['running'] and job['next_run'] <= now]
+
+        for name in due:
+            job = _jobs[name]
+            job['next_run'] = now + job['interval']
+            try:
+                if job['exclusive'] and not acquire_lease(name, job['interval']):
+                    continue
+            except Exception as e:
+                logger.warning(f"Не удалось взять аренду задачи {name}: {e}")
+                continue
+            finally:
+                database.release_thread_connection()
+
+            job['running'] = True
+            threading.Thread(target=_run_in_thread, args=(name,), name=f"job-{name}", daemon=True).start()
+
+        _stop_event.wait(TICK_INTERVAL)
+
+
+def start_scheduler() -> bool:
+    """Запустить планировщик в отдельном потоке (повторный вызов ничего не делает)"""
+    global _thread
+    if not SCHEDULER_ENABLED:
+        logger.info("Планировщик отключен (SCHEDULER_ENABLED=0)")
+        return False
+    with _lock:
+        if _thread is not None and _thread.is_alive():
+            return False
+        _stop_event.clear()
+        _thread = threading.Thread(target=_scheduler_worker, name='scheduler', daemon=True)
+        _thread.start()
+    logger.info(f"Scheduler started: {', '.join(sorted(_jobs))}")
+    return True
+
+
+def stop_scheduler(timeout: float = 5.0):
+    """Остановить планировщик (выполняющиеся задачи завершаются сами)"""
+    _stop_event.set()
+    if _thread is not None:
+        _thread.join(timeout)
+
+
+def get_jobs_status() -> List[Dict[str, Any]]:
+    """Состояние зарегистрированных задач вместе с последним запуском из БД"""
+    with database.db_connection() as conn:
+        rows = {row['name']: dict(row) for row in conn.execute("SELECT * FROM scheduler_jobs")}
+
+    result = []
+    for name, job in sorted(_jobs.items()):
+        stored = rows.get(name, {})
+        result.append({
+            'name': name,
+            'interval_seconds': job['interval'],
+            'running': job['running'],
+            'runs': job['runs'],
+            'failures': job['failures'],
+            'last_result': job['last_result'],
+            'owner': stored.get('owner'),
+            'last_started_at': stored.get('last_started_at'),
+            'last_finished_at': stored.get('last_finished_at'),
+            'last_duration_ms': stored.get('last_duration_ms'),
+            'last_status': stored.get('last_status'),
+            'last_error': stored.get('last_error'),
+        })
+    return result
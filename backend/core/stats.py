@@ -0,0 +1,138 @@
+"""
+Чтение статистики для дашбордов панели из роллапов
+
+Роллапы (stats_event_buckets, stats_tx_buckets, stats_counters) обновляются
+триггерами БД, поэтому запросы здесь не зависят от размера users,
+vpn_keys и transactions. Периодический компактор удаляет старые часовые
+бакеты и пересчитывает счетчики.
+"""
+import os
+import logging
+from datetime import datetime, timedelta, date
+from typing import Dict, Any, List, Sequence
+from backend.database import database
+
+logger = logging.getLogger(__name__)
+
+STATS_COMPACT_INTERVAL = int(os.getenv('STATS_COMPACT_INTERVAL', '3600'))
+
+
+def get_counters() -> Dict[str, float]:
+    """Все счетчики текущего состояния"""
+    with database.db_connection() as conn:
+        return {row['name']: row['value'] for row in conn.execute("SELECT name, value FROM stats_counters")}
+
+
+def last_days(days: int) -> List[date]:
+    """Последние N дней (UTC), включая сегодня"""
+    today = datetime.utcnow().date()
+    return [today - timedelta(days=days - 1 - i) for i in range(days)]
+
+
+def event_daily_series(event: str, days: Sequence[date]) -> List[int]:
+    """Количество событий по дням"""
+    with database.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT bucket, cnt FROM stats_event_buckets
+            WHERE granularity = 'day' AND event = ? AND bucket >= ? AND bucket <= ?
+        """, (event, str(days[0]), str(days[-1])))
+        by_day = {row['bucket']: row['cnt'] for row in cursor.fetchall()}
+    return [by_day.get(str(d), 0) for d in days]
+
+
+def event_count_since(event: str, since: datetime) -> int:
+    """Количество событий с момента since (по часовым бакетам)"""
+    with database.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT COALESCE(SUM(cnt), 0) AS total FROM stats_event_buckets
+            WHERE granularity = 'hour' AND event = ? AND bucket >= ?
+        """, (event, since.strftime('%Y-%m-%d %H:00')))
+        return cursor.fetchone()['total'] or 0
+
+
+def tx_totals(types: Sequence[str] = None, status: str = None,
+              since: date = None, until: date = None) -> Dict[str, float]:
+    """
+    Суммы по транзакциям из дневных бакетов.
+
+    Args:
+        types: Типы транзакций (None - все)
+        status: Статус (None - любой)
+        since: Начальный день включительно
+        until: Конечный день не включительно
+
+    Returns:
+        Dict с cnt, amount, debit_cnt, debit_amount (debit - операции с отрицательной суммой)
+    """
+    conditions = ["granularity = 'day'"]
+    params: List[Any] = []
+    if types:
+        conditions.append(f"type IN ({', '.join('?' * len(types))})")
+        params.extend(types)
+    if status is not None:
+        conditions.append("status = ?")
+        params.append(status)
+    if since is not None:
+        conditions.append("bucket >= ?")
+        params.append(str(since))
+    if until is not None:
+        conditions.append("bucket < ?")
+        params.append(str(until))
+
+    with database.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT COALESCE(SUM(cnt), 0) AS cnt, COALESCE(SUM(amount), 0) AS amount,
+                   COALESCE(SUM(debit_cnt), 0) AS debit_cnt, COALESCE(SUM(debit_amount), 0) AS debit_amount
+            FROM stats_tx_buckets
+            WHERE {' AND '.join(conditions)}
+        """, params)
+        row = cursor.fetchone()
+    return {
+        'cnt': row['cnt'] or 0,
+        'amount': float(row['amount'] or 0),
+        'debit_cnt': row['debit_cnt'] or 0,
+        'debit_amount': float(row['debit_amount'] or 0),
+    }
+
+
+def tx_daily_amounts(tx_type: str, status: str, days: Sequence[date]) -> List[float]:
+    """Сумма транзакций по дням"""
+    with database.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT bucket, SUM(amount) AS total FROM stats_tx_buckets
+            WHERE granularity = 'day' AND type = ? AND status = ? AND bucket >= ? AND bucket <= ?
+            GROUP BY bucket
+        """, (tx_type, status, str(days[0]), str(days[-1])))
+        by_day = {row['bucket']: float(row['total'] or 0) for row in cursor.fetchall()}
+    return [by_day.get(str(d), 0.0) for d in days]
+
+
+def tx_by_method(tx_type: str, status: str) -> List[Dict[str, Any]]:
+    """Количество и сумма транзакций в разрезе способа оплаты"""
+    with database.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT method, SUM(cnt) AS cnt, SUM(amount) AS amount FROM stats_tx_buckets
+            WHERE granularity = 'day' AND type = ? AND status = ?
+            GROUP BY method
+            HAVING SUM(cnt) > 0
+        """, (tx_type, status))
+        return [
+            {'method': row['method'] or None, 'cnt': row['cnt'], 'amount': float(row['amount'] or 0)}
+            for row in cursor.fetchall()
+        ]
+
+
+def compact() -> Dict[str, int]:
+    """Задача компактора роллапов"""
+    return database.compact_stats_rollups()
+
+
+def register_jobs():
+    """Зарегистрировать периодические задачи статистики в планировщике"""
+    from backend.core import scheduler
+    scheduler.register_job('stats_compact', compact, STATS_COMPACT_INTERVAL, initial_delay=60)
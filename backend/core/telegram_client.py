@@ -0,0 +1,102 @@
+"""
+Асинхронный клиент Telegram Bot API для фоновых отправок
+Общая сессия aiohttp, token bucket под лимиты Telegram и разбор ответов 429
+"""
+import os
+import time
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Optional, Dict, Any
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+TELEGRAM_REQUEST_TIMEOUT = float(os.getenv('TELEGRAM_REQUEST_TIMEOUT', '10'))
+
+
+@dataclass
+class SendResult:
+    """Результат отправки сообщения"""
+    ok: bool
+    retry_after: Optional[float] = None  # Telegram попросил подождать (429)
+    permanent: bool = False  # Повторять бессмысленно (бот заблокирован, чат не найден)
+    error: Optional[str] = None
+
+
+class TokenBucket:
+    """Ограничитель скорости: не более rate операций в секунду со всплеском до capacity"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Приостановить выдачу токенов (ответ 429 с retry_after)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    self._updated = time.monotonic()
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def create_session(limit: int = 100) -> aiohttp.ClientSession:
+    """Создать сессию с пулом соединений (должна жить столько же, сколько цикл событий)"""
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=limit),
+        timeout=aiohttp.ClientTimeout(total=TELEGRAM_REQUEST_TIMEOUT),
+    )
+
+
+async def call(session: aiohttp.ClientSession, token: str, method: str, payload: Dict[str, Any]) -> SendResult:
+    """Вызвать метод Bot API и разобрать ответ"""
+    url = f"{TELEGRAM_API_URL}/bot{token}/{method}"
+    try:
+        async with session.post(url, json=payload) as response:
+            try:
+                data = await response.json(content_type=None)
+            except ValueError:
+                data = {}
+            if response.status == 200 and data.get('ok'):
+                return SendResult(ok=True)
+
+            error_code = data.get('error_code', response.status)
+            description = data.get('description') or f"HTTP {response.status}"
+            if error_code == 429:
+                retry_after = (data.get('parameters') or {}).get('retry_after', 1)
+                return SendResult(ok=False, retry_after=float(retry_after), error=description)
+            # 400 (чат не найден и т.п.) и 403 (бот заблокирован) повторять бессмысленно
+            return SendResult(ok=False, permanent=error_code in (400, 403), error=description)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return SendResult(ok=False, error=str(e) or e.__class__.__name__)
+
+
+async def send_message(session: aiohttp.ClientSession, token: str, chat_id: int, text: str,
+                       reply_markup: Dict = None, photo: str = None, parse_mode: str = 'HTML') -> SendResult:
+    """Отправить сообщение (или фото с подписью, если передан photo)"""
+    if photo:
+        method = 'sendPhoto'
+        payload = {'chat_id': chat_id, 'photo': photo, 'caption': text, 'parse_mode': parse_mode}
+    else:
+        method = 'sendMessage'
+        payload = {'chat_id': chat_id, 'text': text, 'parse_mode': parse_mode}
+    if reply_markup:
+        payload['reply_markup'] = reply_markup
+    return await call(session, token, method, payload)
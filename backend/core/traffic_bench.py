@@ -0,0 +1,111 @@
+"""
+Бенчмарк приема показаний трафика: ключи/с пакетной записи приростов и проверки лимита
+
+    python -m backend.core.traffic_bench --db /tmp/traffic.db --keys 100000
+    python -m backend.core.traffic_bench --db /tmp/traffic.db --keys 100000 --batch-size 5000 --rounds 3
+
+Первый проход задает точку отсчета (traffic_snapshots), следующие --rounds
+проходов пишут приросты в traffic_stats; доля --abusers ключей превышает
+MAX_DAILY_TRAFFIC_GB и попадает в to_ban (бан не применяется, Remnawave не
+вызывается). Бенчмарк создает синтетических пользователей и ключи, поэтому
+работает только с отдельным файлом БД (--db).
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from typing import Any, Dict, List
+
+BENCH_TELEGRAM_ID_BASE = 9_000_000_000
+
+
+def _seed(keys: int) -> List[tuple]:
+    """Синтетические пользователи с одним ключом каждый; возвращает (vpn_key_id, user_id)"""
+    from backend.database import database
+    with database.transaction() as conn:
+        existing = conn.execute("SELECT COUNT(*) FROM users WHERE telegram_id > ?",
+                                (BENCH_TELEGRAM_ID_BASE,)).fetchone()[0]
+        if existing < keys:
+            conn.execute("""
+                WITH RECURSIVE n(i) AS (SELECT ? UNION ALL SELECT i + 1 FROM n WHERE i < ?)
+                INSERT INTO users (telegram_id, username) SELECT ? + i, 'traffic_bench_' || i FROM n
+            """, (existing + 1, keys, BENCH_TELEGRAM_ID_BASE))
+            conn.execute("""
+                INSERT INTO vpn_keys (user_id, key_uuid, status, expiry_date, traffic_used)
+                SELECT u.id, 'traffic-bench-' || u.id, 'Active', datetime('now', '+30 days'), 0
+                FROM users u
+                WHERE u.telegram_id > ? AND NOT EXISTS (SELECT 1 FROM vpn_keys k WHERE k.user_id = u.id)
+            """, (BENCH_TELEGRAM_ID_BASE,))
+        return [tuple(row) for row in conn.execute("""
+            SELECT k.id, k.user_id FROM vpn_keys k JOIN users u ON u.id = k.user_id
+            WHERE u.telegram_id > ?
+            ORDER BY k.id
+            LIMIT ?
+        """, (BENCH_TELEGRAM_ID_BASE, keys))]
+
+
+def run(keys: int, rounds: int, abusers: float) -> Dict[str, Any]:
+    """Принять rounds + 1 проходов показаний по keys ключам и замерить каждый"""
+    from backend.core import abuse_detected
+
+    seed_started = time.monotonic()
+    key_rows = _seed(keys)
+    seed_seconds = time.monotonic() - seed_started
+    # Прирост за проход: обычные ключи - 100 МБ, нарушители - с запасом над суточным лимитом
+    step = 100 * 1024 ** 2
+    abuse_step = (abuse_detected.MAX_DAILY_TRAFFIC_GB + 1) * 1024 ** 3 / max(rounds, 1)
+    abuser_every = int(1 / abusers) if abusers > 0 else 0
+    # Накопительные счетчики продолжаются с прошлых запусков бенчмарка на той же БД
+    counters = {key_id: float(time.time()) for key_id, _ in key_rows}
+
+    passes = []
+    for round_index in range(rounds + 1):
+        snapshots = []
+        for index, (key_id, user_id) in enumerate(key_rows):
+            if round_index:
+                counters[key_id] += abuse_step if abuser_every and index % abuser_every == 0 else step
+            snapshots.append(abuse_detected.TrafficSnapshot(key_id, user_id, counters[key_id]))
+        report = abuse_detected.ingest_traffic_snapshots(snapshots)
+        passes.append({
+            'pass': 'baseline' if round_index == 0 else f"round_{round_index}",
+            'keys': report['keys'],
+            'deltas': report['deltas'],
+            'to_ban': len(report['to_ban']),
+            'duration_ms': report['duration_ms'],
+            'keys_per_second': report['keys_per_second'],
+        })
+
+    timed = [item for item in passes[1:] if item['duration_ms']] or passes
+    return {
+        'keys': len(key_rows),
+        'batch_size': abuse_detected.TRAFFIC_INGEST_BATCH_SIZE,
+        'seed_seconds': round(seed_seconds, 2),
+        'passes': passes,
+        'keys_per_second': int(sum(item['keys'] for item in timed) * 1000 / max(1, sum(item['duration_ms'] for item in timed))),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m backend.core.traffic_bench')
+    parser.add_argument('--db', required=True, help='Отдельный файл БД для бенчмарка (не рабочая БД)')
+    parser.add_argument('--keys', type=int, default=100_000, help='Число ключей (недостающие создаются)')
+    parser.add_argument('--rounds', type=int, default=1, help='Проходов с приростами после точки отсчета')
+    parser.add_argument('--batch-size', type=int, help='TRAFFIC_INGEST_BATCH_SIZE')
+    parser.add_argument('--abusers', type=float, default=0.01, help='Доля ключей над суточным лимитом')
+    args = parser.parse_args(argv)
+    # БД задается до импорта database: импорт выполняет init_database() по DB_PATH
+    os.environ['DB_PATH'] = args.db
+    if args.batch_size:
+        os.environ['TRAFFIC_INGEST_BATCH_SIZE'] = str(args.batch_size)
+    from backend.database import database
+    database.DB_PATH = args.db
+    database.init_database()
+
+    report = run(args.keys, args.rounds, args.abusers)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
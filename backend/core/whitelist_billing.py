@@ -2,9 +2,13 @@
 Модуль для обработки биллинга whitelist bypass
 Обрабатывает превышение лимита трафика и списание средств
 """
+import os
+import json
+import time
+import asyncio
 import logging
 from datetime import datetime, timedelta
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List
 from backend.database import database
 from backend.core import core
 
@@ -18,6 +22,13 @@ AUTO_PAY_THRESHOLD_MB = 100
 AUTO_PAY_MIN_BALANCE = 15.0
 # Максимальный отрицательный баланс
 MAX_NEGATIVE_BALANCE = -15.0
+# Объем трафика, добавляемый одним автоплатежом
+AUTO_PAY_TRAFFIC_BYTES = 1024 ** 3
+
+AUTO_PAY_INTERVAL = int(os.getenv('WHITELIST_AUTO_PAY_INTERVAL', '300'))
+AUTO_PAY_BATCH_SIZE = int(os.getenv('WHITELIST_AUTO_PAY_BATCH_SIZE', '200'))
+AUTO_PAY_PUSH_CONCURRENCY = int(os.getenv('WHITELIST_AUTO_PAY_PUSH_CONCURRENCY', '8'))
+AUTO_PAY_NOTIFY_RATE = float(os.getenv('WHITELIST_AUTO_PAY_NOTIFY_RATE', '25'))
 
 def calculate_whitelist_price(gb: int, subscription_fee: float = 100.0, price_per_gb: float = 15.0) -> float:
     """
@@ -164,3 +175,188 @@ def process_whitelist_overage(user_id: int, vpn_key_id: int, traffic_bytes: floa
     
     return {'overage_detected': False, 'auto_pay_checked': True}
 
+
+
+# ========== Планировщик автоплатежей ==========
+
+def _auto_pay_settings() -> Dict[str, Any]:
+    """Включенность автоплатежей и порог остатка из whitelist_settings"""
+    row = database.get_whitelist_settings()
+    if not row:
+        return {'enabled': True, 'threshold_mb': AUTO_PAY_THRESHOLD_MB}
+    return {
+        'enabled': bool(row['auto_pay_enabled']),
+        'threshold_mb': row['auto_pay_threshold_mb'] or AUTO_PAY_THRESHOLD_MB,
+    }
+
+
+def _auto_pay_refusal(balance: float, charge_amount: float) -> Optional[str]:
+    """Причина отказа в автоплатеже (те же правила, что в check_and_process_auto_payment)"""
+    if balance - charge_amount < MAX_NEGATIVE_BALANCE:
+        return 'negative_limit'
+    if 0 <= balance < AUTO_PAY_MIN_BALANCE:
+        return 'min_balance'
+    return None
+
+
+def _scan_candidates(threshold_bytes: float) -> List[int]:
+    """Активные whitelist-ключи с остатком меньше порога (по индексу idx_vpn_keys_plan_remaining)"""
+    with database.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id FROM vpn_keys
+            WHERE plan_type = 'whitelist' AND status = 'Active' AND traffic_limit > 0
+              AND (traffic_limit - traffic_used) < ?
+            ORDER BY id
+        """, (threshold_bytes,))
+        return [row['id'] for row in cursor.fetchall()]
+
+
+def _charge_batch(key_ids: List[int], threshold_bytes: float, metrics: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Списать автоплатежи по пачке ключей одной транзакцией BEGIN IMMEDIATE.
+    Ключи и балансы перечитываются внутри транзакции, баланс пользователя
+    с несколькими ключами учитывается нарастающим итогом.
+    """
+    charge_amount = AUTO_PAY_PRICE_PER_GB
+    charges = []
+    with database.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT k.id, k.user_id, k.key_uuid, k.traffic_used, k.traffic_limit,
+                   u.balance, u.telegram_id
+            FROM vpn_keys k
+            JOIN users u ON u.id = k.user_id
+            WHERE k.id IN (SELECT value FROM json_each(?))
+              AND k.plan_type = 'whitelist' AND k.status = 'Active' AND k.traffic_limit > 0
+              AND (k.traffic_limit - k.traffic_used) < ?
+            ORDER BY k.id
+        """, (json.dumps(key_ids), threshold_bytes))
+        rows = cursor.fetchall()
+        metrics['skipped']['changed'] += len(key_ids) - len(rows)
+
+        balances: Dict[int, float] = {}
+        for row in rows:
+            balance = balances.get(row['user_id'], row['balance'] or 0)
+            refusal = _auto_pay_refusal(balance, charge_amount)
+            if refusal:
+                metrics['skipped'][refusal] += 1
+                continue
+            balances[row['user_id']] = balance - charge_amount
+            remaining_mb = (row['traffic_limit'] - (row['traffic_used'] or 0)) / (1024 ** 2)
+            charges.append({
+                'vpn_key_id': row['id'],
+                'user_id': row['user_id'],
+                'key_uuid': row['key_uuid'],
+                'telegram_id': row['telegram_id'],
+                'new_limit': row['traffic_limit'] + AUTO_PAY_TRAFFIC_BYTES,
+                'new_balance': balances[row['user_id']],
+                'remaining_mb': remaining_mb,
+            })
+
+        cursor.executemany(
+            "UPDATE users SET balance = balance - ? WHERE id = ?",
+            [(charge_amount, charge['user_id']) for charge in charges]
+        )
+        cursor.executemany(
+            "UPDATE vpn_keys SET traffic_limit = traffic_limit + ? WHERE id = ?",
+            [(AUTO_PAY_TRAFFIC_BYTES, charge['vpn_key_id']) for charge in charges]
+        )
+        cursor.executemany("""
+            INSERT INTO transactions (user_id, type, amount, status, description, payment_method)
+            VALUES (?, 'whitelist_auto_pay', ?, 'Success', ?, 'Balance')
+        """, [
+            (charge['user_id'], -charge_amount,
+             f"Автоплатеж whitelist: +1 ГБ (остаток был {charge['remaining_mb']:.2f} МБ)")
+            for charge in charges
+        ])
+    return charges
+
+
+async def _send_notifications(notifications: List[tuple]) -> int:
+    """Отправить уведомления об автоплатежах с ограничением скорости"""
+    from backend.core import telegram_client
+    bucket = telegram_client.TokenBucket(AUTO_PAY_NOTIFY_RATE)
+
+    async def send(session, chat_id: int, text: str) -> bool:
+        await bucket.acquire()
+        result = await telegram_client.send_message(session, core.TELEGRAM_BOT_TOKEN, chat_id, text)
+        if result.retry_after:
+            bucket.pause(result.retry_after)
+        return result.ok
+
+    async with telegram_client.create_session() as session:
+        results = await asyncio.gather(*(send(session, chat_id, text) for chat_id, text in notifications))
+    return sum(results)
+
+
+def run_auto_payments() -> Dict[str, Any]:
+    """
+    Задача планировщика: автоплатежи по всем whitelist-ключам с остатком меньше порога.
+
+    Кандидаты выбираются одним индексированным запросом, списание идет пачками
+    в транзакциях BEGIN IMMEDIATE. Новые лимиты отправляются в Remnawave
+    параллельно, уведомления - после коммита.
+
+    Returns:
+        Метрики запуска: scanned, charged, skipped (по причинам), pushed,
+        push_failed, notified, duration_ms
+    """
+    started = time.monotonic()
+    metrics: Dict[str, Any] = {
+        'scanned': 0, 'charged': 0, 'charged_amount': 0.0,
+        'skipped': {'changed': 0, 'negative_limit': 0, 'min_balance': 0},
+        'pushed': 0, 'push_failed': 0, 'notified': 0,
+    }
+    settings = _auto_pay_settings()
+    if not settings['enabled']:
+        metrics['disabled'] = True
+        metrics['duration_ms'] = int((time.monotonic() - started) * 1000)
+        return metrics
+
+    threshold_bytes = settings['threshold_mb'] * 1024 ** 2
+    key_ids = _scan_candidates(threshold_bytes)
+    metrics['scanned'] = len(key_ids)
+
+    charges = []
+    for start in range(0, len(key_ids), AUTO_PAY_BATCH_SIZE):
+        charges.extend(_charge_batch(key_ids[start:start + AUTO_PAY_BATCH_SIZE], threshold_bytes, metrics))
+    metrics['charged'] = len(charges)
+    metrics['charged_amount'] = len(charges) * AUTO_PAY_PRICE_PER_GB
+
+    limits = {charge['key_uuid']: int(charge['new_limit']) for charge in charges if charge['key_uuid']}
+    if limits:
+        from backend.api import remnawave
+        try:
+            errors = remnawave.remnawave_api.set_traffic_limits_sync(limits, AUTO_PAY_PUSH_CONCURRENCY)
+        except Exception as e:
+            errors = {uuid: str(e) for uuid in limits}
+        failed = {uuid: error for uuid, error in errors.items() if error}
+        metrics['pushed'] = len(limits) - len(failed)
+        metrics['push_failed'] = len(failed)
+        if failed:
+            # Лимит в БД уже увеличен; расхождение попадет в отчет сверки с Remnawave (local_ahead)
+            logger.error(f"Auto-pay: failed to push {len(failed)} limits to Remnawave: {list(failed.items())[:20]}")
+
+    notifications = [
+        (charge['telegram_id'],
+         f"💳 Автоплатеж: добавлено 1 ГБ трафика за {AUTO_PAY_PRICE_PER_GB}₽. "
+         f"Остаток баланса: {charge['new_balance']:.2f}₽")
+        for charge in charges if charge['telegram_id']
+    ]
+    if notifications and core.TELEGRAM_BOT_TOKEN:
+        try:
+            metrics['notified'] = asyncio.run(_send_notifications(notifications))
+        except Exception as e:
+            logger.error(f"Auto-pay: failed to send notifications: {e}")
+
+    metrics['duration_ms'] = int((time.monotonic() - started) * 1000)
+    return metrics
+
+
+def register_jobs():
+    """Зарегистрировать автоплатежи в планировщике (WHITELIST_AUTO_PAY_INTERVAL=0 отключает)"""
+    if AUTO_PAY_INTERVAL <= 0:
+        return
+    from backend.core import scheduler
+    scheduler.register_job('whitelist_auto_pay', run_auto_payments, AUTO_PAY_INTERVAL, initial_delay=150)
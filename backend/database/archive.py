@@ -0,0 +1,344 @@
+"""
+Архивация старых строк transactions, traffic_stats и ticket_messages по месяцам
+
+Строки старше ARCHIVE_AFTER_MONTHS переносятся в файлы-партиции
+ARCHIVE_DIR/blinvpn_archive_YYYY_MM.db (один файл на месяц, таблицы с теми же
+колонками), которые подключаются к соединению через ATTACH. Перенос идет
+пачками по ARCHIVE_BATCH_SIZE: сначала строки копируются в архив
+(INSERT OR IGNORE по id), затем отдельной транзакцией удаляются из основной БД
+только те, что уже есть в архиве. В режиме WAL транзакция над несколькими
+базами атомарна только для каждой базы отдельно, поэтому при сбое между
+шагами строка может временно оказаться в обеих базах, но не потеряется:
+следующий запуск доделает удаление, а query() отбрасывает дубли по id.
+
+В основной БД остаются сводки, которые нужны без архива:
+- stats_tx_buckets - дневные роллапы транзакций (триггеры не уменьшают их при удалении);
+- archive_user_deposits - пополнения по пользователям для агрегатов рефералов;
+- traffic_stats_monthly - трафик ключей по месяцам;
+- archive_partitions и archive_state - строки по месяцам и граница архивации.
+
+Не архивируются ожидающие оплаты транзакции и сообщения незакрытых тикетов.
+История целиком (основная БД + архив) читается через query().
+"""
+import os
+import json
+import heapq
+import sqlite3
+import logging
+from datetime import date
+from typing import Any, Dict, List, Optional, Sequence
+from backend.database import database, pagination
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR') or os.path.join(os.path.dirname(os.path.abspath(database.DB_PATH)), 'archive')
+ARCHIVE_AFTER_MONTHS = int(os.getenv('ARCHIVE_AFTER_MONTHS', '6'))
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', '5000'))
+ARCHIVE_INTERVAL = 24 * 3600
+FILE_PREFIX = 'blinvpn_archive_'
+SCHEMA = 'archive'
+
+# Таблица -> колонка даты, условие отбора строк для архива, индексы архива, фильтры query()
+ARCHIVE_TABLES: Dict[str, Dict[str, Any]] = {
+    'transactions': {
+        'date_column': 'created_at',
+        'condition': "COALESCE(status, '') != 'Pending'",
+        'indexes': ['user_id', 'created_at'],
+        'filters': {'user_id': int, 'type': str, 'status': str, 'payment_provider': str},
+    },
+    'traffic_stats': {
+        'date_column': 'date',
+        'condition': "1",
+        'indexes': ['vpn_key_id', 'user_id', 'date'],
+        'filters': {'user_id': int, 'vpn_key_id': int},
+    },
+    'ticket_messages': {
+        'date_column': 'created_at',
+        'condition': "ticket_id IN (SELECT id FROM main.tickets WHERE status = 'Closed')",
+        'indexes': ['ticket_id', 'created_at'],
+        'filters': {'ticket_id': int, 'user_id': int},
+    },
+}
+
+# Сводки в основной БД по удаляемой пачке (в той же транзакции, что и удаление); {ids} - id пачки
+SUMMARIES: Dict[str, List[str]] = {
+    'transactions': ["""
+        INSERT INTO archive_user_deposits (user_id, deposits_total, deposits_count)
+        SELECT user_id, COALESCE(SUM(amount), 0), COUNT(*) FROM main.transactions
+        WHERE id IN ({ids}) AND type = 'deposit' AND user_id IS NOT NULL
+        GROUP BY user_id
+        ON CONFLICT(user_id) DO UPDATE SET
+            deposits_total = deposits_total + excluded.deposits_total,
+            deposits_count = deposits_count + excluded.deposits_count
+    """],
+    'traffic_stats': ["""
+        INSERT INTO traffic_stats_monthly (vpn_key_id, user_id, month, traffic_bytes, days, max_unique_hwids)
+        SELECT vpn_key_id, user_id, strftime('%Y-%m', date), COALESCE(SUM(traffic_bytes), 0), COUNT(*),
+               MAX(COALESCE(unique_hwids, 0))
+        FROM main.traffic_stats
+        WHERE id IN ({ids})
+        GROUP BY vpn_key_id, strftime('%Y-%m', date)
+        ON CONFLICT(vpn_key_id, month) DO UPDATE SET
+            traffic_bytes = traffic_bytes + excluded.traffic_bytes,
+            days = days + excluded.days,
+            max_unique_hwids = MAX(max_unique_hwids, excluded.max_unique_hwids)
+    """],
+    'ticket_messages': [],
+}
+
+
+def archive_cutoff(today: Optional[date] = None, months: int = ARCHIVE_AFTER_MONTHS) -> str:
+    """Первый день месяца, раньше которого строки переносятся в архив (YYYY-MM-DD)"""
+    today = today or date.today()
+    index = today.year * 12 + today.month - 1 - months
+    return date(index // 12, index % 12 + 1, 1).isoformat()
+
+
+def _month_bounds(month: str) -> tuple:
+    """'YYYY-MM' -> (первый день месяца, первый день следующего)"""
+    year, number = map(int, month.split('-'))
+    index = year * 12 + number
+    return f"{month}-01", date(index // 12, index % 12 + 1, 1).isoformat()
+
+
+def partition_path(month: str) -> str:
+    return os.path.join(ARCHIVE_DIR, f"{FILE_PREFIX}{month.replace('-', '_')}.db")
+
+
+def _columns(conn, schema: str, table: str) -> List[str]:
+    return [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({table})").fetchall()]
+
+
+def _ensure_archive_table(conn, table: str) -> List[str]:
+    """Таблица в подключенном архиве с колонками основной (без внешних ключей); список колонок"""
+    columns = _columns(conn, 'main', table)
+    existing = _columns(conn, SCHEMA, table)
+    if not existing:
+        conn.execute(f"CREATE TABLE {SCHEMA}.{table} AS SELECT * FROM main.{table} WHERE 0")
+    else:
+        # В основной таблице появились новые колонки
+        for column in columns:
+            if column not in existing:
+                conn.execute(f"ALTER TABLE {SCHEMA}.{table} ADD COLUMN {column}")
+    conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {SCHEMA}.ux_{table}_id ON {table}(id)")
+    for column in ARCHIVE_TABLES[table]['indexes']:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {SCHEMA}.idx_{table}_{column} ON {table}({column})")
+    return columns
+
+
+def _archive_month(conn, table: str, month: str) -> int:
+    """Перенести строки таблицы за месяц в подключенный архив; количество перенесенных строк"""
+    spec = ARCHIVE_TABLES[table]
+    start, end = _month_bounds(month)
+    column_list = ', '.join(_ensure_archive_table(conn, table))
+    moved = 0
+    while True:
+        ids = [row[0] for row in conn.execute(f"""
+            SELECT id FROM main.{table}
+            WHERE {spec['date_column']} >= ? AND {spec['date_column']} < ? AND {spec['condition']}
+            ORDER BY id LIMIT ?
+        """, (start, end, ARCHIVE_BATCH_SIZE)).fetchall()]
+        if not ids:
+            return moved
+        ids_json = json.dumps(ids)
+        batch_ids = "SELECT value FROM json_each(?)"
+
+        with database.transaction() as tx:
+            tx.execute(f"""
+                INSERT OR IGNORE INTO {SCHEMA}.{table} ({column_list})
+                SELECT {column_list} FROM main.{table} WHERE id IN ({batch_ids})
+            """, (ids_json,))
+
+        # Удаляются только строки, уже сохраненные в архиве
+        archived_ids = f"SELECT id FROM {SCHEMA}.{table} WHERE id IN ({batch_ids})"
+        with database.transaction() as tx:
+            for sql in SUMMARIES[table]:
+                tx.execute(sql.format(ids=archived_ids), (ids_json,))
+            cursor = tx.cursor()
+            cursor.execute(f"DELETE FROM main.{table} WHERE id IN ({archived_ids})", (ids_json,))
+            deleted = cursor.rowcount
+            tx.execute("""
+                INSERT INTO archive_partitions (table_name, month, row_count, updated_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(table_name, month) DO UPDATE SET
+                    row_count = row_count + excluded.row_count,
+                    updated_at = CURRENT_TIMESTAMP
+            """, (table, month, deleted))
+        moved += deleted
+
+
+def archive_table(table: str, cutoff: Optional[str] = None) -> Dict[str, int]:
+    """
+    Перенести в архив строки таблицы старше cutoff (по умолчанию archive_cutoff()).
+
+    Returns:
+        Dict месяц -> количество перенесенных строк
+    """
+    spec = ARCHIVE_TABLES[table]
+    cutoff = cutoff or archive_cutoff()
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    result = {}
+    conn = database.get_db_connection()
+    try:
+        months = [row[0] for row in conn.execute(f"""
+            SELECT DISTINCT strftime('%Y-%m', {spec['date_column']}) AS month FROM main.{table}
+            WHERE {spec['date_column']} < ? AND {spec['condition']} AND month IS NOT NULL
+            ORDER BY month
+        """, (cutoff,)).fetchall()]
+        for month in months:
+            conn.execute(f"ATTACH DATABASE ? AS {SCHEMA}", (partition_path(month),))
+            try:
+                result[month] = _archive_month(conn, table, month)
+            finally:
+                conn.execute(f"DETACH DATABASE {SCHEMA}")
+
+        with database.transaction() as tx:
+            tx.execute("""
+                INSERT INTO archive_state (table_name, archived_before, rows_archived, last_run_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(table_name) DO UPDATE SET
+                    archived_before = MAX(COALESCE(archived_before, ''), excluded.archived_before),
+                    rows_archived = rows_archived + excluded.rows_archived,
+                    last_run_at = CURRENT_TIMESTAMP
+            """, (table, cutoff, sum(result.values())))
+    finally:
+        conn.close()
+    return result
+
+
+def run_archival() -> Dict[str, Any]:
+    """Архивировать все таблицы; количество перенесенных строк по таблицам"""
+    cutoff = archive_cutoff()
+    result = {}
+    for table in ARCHIVE_TABLES:
+        moved = archive_table(table, cutoff)
+        result[table] = sum(moved.values())
+        if moved:
+            logger.info(f"Archived {table} before {cutoff}: {moved}")
+    return result
+
+
+def archived_before(table: str) -> Optional[str]:
+    """Граница архивации таблицы (строки раньше нее могут быть в архиве) или None"""
+    with database.db_connection() as conn:
+        row = conn.execute("SELECT archived_before FROM archive_state WHERE table_name = ?", (table,)).fetchone()
+    return row['archived_before'] if row else None
+
+
+def get_status() -> Dict[str, Any]:
+    """Граница архивации, строки по партициям и размер файлов"""
+    with database.db_connection() as conn:
+        state = {row['table_name']: dict(row) for row in conn.execute("SELECT * FROM archive_state")}
+        partitions = [dict(row) for row in conn.execute(
+            "SELECT table_name, month, row_count, updated_at FROM archive_partitions ORDER BY month DESC, table_name")]
+        hot = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ARCHIVE_TABLES}
+    months = sorted({partition['month'] for partition in partitions}, reverse=True)
+    files = {month: os.path.getsize(partition_path(month)) for month in months if os.path.exists(partition_path(month))}
+    return {
+        'archive_dir': ARCHIVE_DIR,
+        'after_months': ARCHIVE_AFTER_MONTHS,
+        'next_cutoff': archive_cutoff(),
+        'tables': {
+            table: {
+                'hot_rows': hot[table],
+                'archived_rows': sum(p['row_count'] for p in partitions if p['table_name'] == table),
+                'archived_before': state.get(table, {}).get('archived_before'),
+                'last_run_at': state.get(table, {}).get('last_run_at'),
+            }
+            for table in ARCHIVE_TABLES
+        },
+        'partitions': partitions,
+        'files': [{'month': month, 'size': size} for month, size in files.items()],
+    }
+
+
+def build_conditions(table: str, args: Dict[str, Any]) -> tuple:
+    """Условия query() из аргументов запроса; ValueError при неверном фильтре или таблице"""
+    spec = ARCHIVE_TABLES.get(table)
+    if spec is None:
+        raise ValueError(f"Unknown table: {table}")
+    conditions, params = [], []
+    for column, cast in spec['filters'].items():
+        value = args.get(column)
+        if value not in (None, ''):
+            try:
+                params.append(cast(value))
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid {column}: {value}")
+            conditions.append(f"{column} = ?")
+    return conditions, params
+
+
+def _partition_months(table: str, date_from: Optional[str], date_to: Optional[str]) -> List[str]:
+    """Месяцы архива таблицы, пересекающиеся с диапазоном дат"""
+    sql = "SELECT month FROM archive_partitions WHERE table_name = ? AND row_count > 0"
+    params: List[Any] = [table]
+    if date_from:
+        sql += " AND month >= ?"
+        params.append(date.fromisoformat(date_from).strftime('%Y-%m'))
+    if date_to:
+        sql += " AND month <= ?"
+        params.append(date.fromisoformat(date_to).strftime('%Y-%m'))
+    with database.db_connection() as conn:
+        return [row['month'] for row in conn.execute(sql + " ORDER BY month DESC", params).fetchall()]
+
+
+def query(table: str, conditions: Sequence[str] = (), params: Sequence[Any] = (),
+          date_from: Optional[str] = None, date_to: Optional[str] = None,
+          limit: int = pagination.DEFAULT_PAGE_SIZE) -> List[Dict[str, Any]]:
+    """
+    Строки таблицы из основной БД и архива, новые первыми.
+
+    Запрос выполняется отдельно в основной БД и в каждой партиции, попадающей
+    в диапазон дат (партиции вне диапазона не открываются), результаты
+    сливаются по (дата, id).
+
+    Args:
+        conditions: Условия по колонкам таблицы (без префикса схемы)
+        date_from: Начальная дата YYYY-MM-DD включительно
+        date_to: Конечная дата YYYY-MM-DD включительно
+
+    Returns:
+        Не более limit строк; ValueError при неверной дате
+    """
+    spec = ARCHIVE_TABLES[table]
+    date_column = spec['date_column']
+    date_conditions, date_params = pagination.date_range(date_column, date_from, date_to)
+    where = list(conditions) + date_conditions
+    sql = f"SELECT * FROM {table}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {date_column} DESC, id DESC LIMIT ?"
+    args = list(params) + date_params + [limit]
+
+    with database.db_connection() as conn:
+        sources = [[dict(row) for row in conn.execute(sql, args).fetchall()]]
+    for month in _partition_months(table, date_from, date_to):
+        path = partition_path(month)
+        if not os.path.exists(path):
+            continue
+        archive_conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        archive_conn.row_factory = sqlite3.Row
+        try:
+            sources.append([dict(row) for row in archive_conn.execute(sql, args).fetchall()])
+        except sqlite3.OperationalError as e:
+            # В партиции нет этой таблицы (другие таблицы за месяц)
+            logger.debug(f"Archive {month} skipped for {table}: {e}")
+        finally:
+            archive_conn.close()
+
+    rows, seen = [], set()
+    for row in heapq.merge(*sources, key=lambda item: (str(item[date_column] or ''), item['id']), reverse=True):
+        if row['id'] in seen:
+            continue
+        seen.add(row['id'])
+        rows.append(row)
+        if len(rows) >= limit:
+            break
+    return rows
+
+
+def register_jobs():
+    """Зарегистрировать ежедневную архивацию в планировщике"""
+    from backend.core import scheduler
+    scheduler.register_job('archive_old_rows', run_archival, ARCHIVE_INTERVAL, initial_delay=3600)
@@ -0,0 +1,132 @@
+"""
+Бенчмарк bootstrap_user (/start бота и /api/user/info мини-приложения): задержки p50/p95/p99 по сценариям
+
+    python -m backend.database.bootstrap_bench --db /tmp/bootstrap.db --users 10000 --requests 20000 --concurrency 16
+
+Сценарии:
+- existing: пользователь уже есть и обновлять нечего (один SELECT);
+- new: регистрация нового пользователя;
+- referral: регистрация по реферальной ссылке одного реферера (привязка и рейт-лимит
+  в одной транзакции; после лимита за окно привязка отклоняется).
+
+Бенчмарк создает синтетических пользователей, поэтому работает только
+с отдельным файлом БД (--db).
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+
+BENCH_TELEGRAM_ID_BASE = 8_000_000_000
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _measure(calls: List[Callable[[], Any]], concurrency: int) -> Dict[str, Any]:
+    """Выполнить calls в concurrency потоков и посчитать задержки"""
+    from backend.database import database
+
+    lock = threading.Lock()
+    latencies: List[float] = []
+
+    def call(func: Callable[[], Any]):
+        started = time.perf_counter()
+        func()
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            latencies.append(elapsed)
+
+    def worker(chunk: List[Callable[[], Any]]):
+        try:
+            for func in chunk:
+                call(func)
+        finally:
+            database.release_thread_connection()
+
+    chunks = [calls[index::concurrency] for index in range(concurrency)]
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, chunks))
+    elapsed = time.monotonic() - started
+
+    latencies.sort()
+    return {
+        'requests': len(calls),
+        'seconds': round(elapsed, 2),
+        'rps': round(len(calls) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(_percentile(latencies, 0.50), 3),
+        'p95_ms': round(_percentile(latencies, 0.95), 3),
+        'p99_ms': round(_percentile(latencies, 0.99), 3),
+        'max_ms': round(latencies[-1], 3) if latencies else 0.0,
+    }
+
+
+def run(users: int, requests: int, concurrency: int) -> Dict[str, Any]:
+    """Засеять users пользователей и замерить по requests вызовов каждого сценария"""
+    from backend.database import database
+
+    with database.transaction() as conn:
+        existing = conn.execute("SELECT COUNT(*) FROM users WHERE telegram_id BETWEEN ? AND ?",
+                                (BENCH_TELEGRAM_ID_BASE, BENCH_TELEGRAM_ID_BASE + users)).fetchone()[0]
+        if existing < users:
+            conn.execute("""
+                WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?)
+                INSERT OR IGNORE INTO users (telegram_id, username, full_name, referral_code)
+                SELECT ? + i, 'bootstrap_bench_' || i, 'Bench ' || i, 'REF' || (? + i) FROM n
+            """, (users, BENCH_TELEGRAM_ID_BASE, BENCH_TELEGRAM_ID_BASE))
+
+    # Новые пользователи - за диапазоном засеянных, свой диапазон на каждый запуск
+    fresh_base = BENCH_TELEGRAM_ID_BASE + users + int(time.time() * 1000) % 10 ** 8 * 10
+    referrer = BENCH_TELEGRAM_ID_BASE + 1
+
+    existing_calls = [
+        (lambda telegram_id=BENCH_TELEGRAM_ID_BASE + 1 + index % users:
+         database.bootstrap_user(telegram_id, full_name='Bench'))
+        for index in range(requests)
+    ]
+    new_calls = [
+        (lambda telegram_id=fresh_base + index: database.bootstrap_user(telegram_id, f"bench_new_{telegram_id}"))
+        for index in range(requests)
+    ]
+    referral_calls = [
+        (lambda telegram_id=fresh_base + requests + index:
+         database.bootstrap_user(telegram_id, f"bench_ref_{telegram_id}", referrer_telegram_id=referrer))
+        for index in range(requests)
+    ]
+    return {
+        'users': users,
+        'concurrency': concurrency,
+        'existing': _measure(existing_calls, concurrency),
+        'new': _measure(new_calls, concurrency),
+        'referral': _measure(referral_calls, concurrency),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m backend.database.bootstrap_bench')
+    parser.add_argument('--db', required=True, help='Отдельный файл БД для бенчмарка (не рабочая БД)')
+    parser.add_argument('--users', type=int, default=10_000, help='Засеянных пользователей (недостающие создаются)')
+    parser.add_argument('--requests', type=int, default=10_000, help='Вызовов на сценарий')
+    parser.add_argument('--concurrency', type=int, default=8, help='Число параллельных потоков')
+    args = parser.parse_args(argv)
+    # БД задается до импорта database: импорт выполняет init_database() по DB_PATH
+    os.environ['DB_PATH'] = args.db
+    from backend.database import database
+    database.DB_PATH = args.db
+    database.init_database()
+
+    report = run(args.users, args.requests, args.concurrency)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,34 +1,423 @@
 """
 Модуль для работы с базой данных SQLite
-Создает все необходимые таблицы и предоставляет функции для работы с данными
+Создает все необходимые таблицы и предоставляет функции для работы с данными.
+Соединения выдаются из общего пула процесса (get_db_connection / db_connection / transaction)
 """
 import sqlite3
 import os
+import copy
+import json
 import logging
+import threading
+import time
+import weakref
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from typing import Optional, List, Dict, Any
 import hashlib
 
+try:
+    import fcntl
+except ImportError:  # Windows: межпроцессная блокировка инициализации недоступна
+    fcntl = None
+
 logger = logging.getLogger(__name__)
 
 DB_PATH = os.getenv('DB_PATH', 'data.db')
+# Максимальное число одновременно открытых соединений в пуле процесса
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '16'))
+# Сколько секунд ждать свободное соединение, прежде чем выдать ошибку
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', '5000'))
+# Потоки для запросов к БД из асинхронного кода (не больше DB_POOL_SIZE)
+DB_ASYNC_WORKERS = int(os.getenv('DB_ASYNC_WORKERS', '8'))
+# Применять непримененные миграции при старте процесса (0 - только командой migrate при деплое)
+DB_AUTO_MIGRATE = os.getenv('DB_AUTO_MIGRATE', '1') == '1'
+
+
+class PooledConnection:
+    """
+    Обёртка над sqlite3.Connection из пула.
+    close() не закрывает соединение, а возвращает его в пул,
+    поэтому существующий код (conn = get_db_connection(); ...; conn.close()) работает без изменений.
+    """
+    __slots__ = ('_raw', '_pool')
+
+    def __init__(self, raw: sqlite3.Connection, pool: 'ConnectionPool'):
+        object.__setattr__(self, '_raw', raw)
+        object.__setattr__(self, '_pool', pool)
+
+    def close(self):
+        self._pool.release(self)
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._raw, name, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+class ConnectionPool:
+    """
+    Пул SQLite соединений с повторным использованием внутри потока.
+    - Вложенные вызовы get_db_connection() в одном потоке получают то же соединение
+    - PRAGMA выполняются один раз при создании соединения
+    - Соединения потоков, завершившихся без close(), возвращаются в пул автоматически
+    """
+
+    def __init__(self, path: str, max_size: int = DB_POOL_SIZE, timeout: float = DB_POOL_TIMEOUT):
+        self.path = path
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._lock = threading.Condition(threading.Lock())
+        self._idle: List[sqlite3.Connection] = []
+        self._in_use: Dict[int, tuple] = {}
+        self._local = threading.local()
+        self._stats = {
+            'acquired': 0,
+            'hits': 0,
+            'nested': 0,
+            'created': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'max_wait': 0.0,
+            'timeouts': 0,
+            'reclaimed': 0,
+            'rollbacks_on_release': 0,
+        }
+
+        # Создаем директорию для базы данных, если её нет
+        db_dir = os.path.dirname(os.path.abspath(path))
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir, exist_ok=True)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        # Настройки для стабильности при параллельных запросах
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS};")
+        return conn
+
+    def _reclaim_dead_owners(self):
+        """Вернуть в пул соединения потоков, которые завершились, не вызвав close() (под локом)"""
+        for key, (raw, owner_ref) in list(self._in_use.items()):
+            owner = owner_ref()
+            if raw is not None and (owner is None or not owner.is_alive()):
+                del self._in_use[key]
+                try:
+                    if raw.in_transaction:
+                        raw.rollback()
+                    self._idle.append(raw)
+                except sqlite3.Error:
+                    raw.close()
+                self._stats['reclaimed'] += 1
+
+    def acquire(self) -> PooledConnection:
+        current = getattr(self._local, 'conn', None)
+        if current is not None:
+            self._local.depth += 1
+            with self._lock:
+                self._stats['acquired'] += 1
+                self._stats['hits'] += 1
+                self._stats['nested'] += 1
+            return current
+
+        started = time.monotonic()
+        waited = False
+        with self._lock:
+            while True:
+                if self._idle:
+                    raw = self._idle.pop()
+                    self._stats['hits'] += 1
+                    break
+                if len(self._in_use) < self.max_size:
+                    raw = None
+                    break
+                self._reclaim_dead_owners()
+                if self._idle:
+                    continue
+                remaining = self.timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise sqlite3.OperationalError(
+                        f"Пул соединений исчерпан: {self.max_size} соединений занято дольше {self.timeout}с"
+                    )
+                waited = True
+                self._lock.wait(min(remaining, 1.0))
+            # Резервируем слот до открытия соединения, чтобы не превысить лимит
+            placeholder = object()
+            self._in_use[id(placeholder)] = (None, weakref.ref(threading.current_thread()))
+
+        try:
+            if raw is None:
+                raw = self._connect()
+                created = True
+            else:
+                created = False
+        except Exception:
+            with self._lock:
+                del self._in_use[id(placeholder)]
+                self._lock.notify()
+            raise
+
+        wait_time = time.monotonic() - started
+        with self._lock:
+            del self._in_use[id(placeholder)]
+            self._in_use[id(raw)] = (raw, weakref.ref(threading.current_thread()))
+            self._stats['acquired'] += 1
+            if created:
+                self._stats['created'] += 1
+            if waited:
+                self._stats['waits'] += 1
+                self._stats['wait_time'] += wait_time
+                self._stats['max_wait'] = max(self._stats['max_wait'], wait_time)
+
+        wrapper = PooledConnection(raw, self)
+        self._local.conn = wrapper
+        self._local.depth = 1
+        return wrapper
+
+    def release(self, wrapper: PooledConnection, force: bool = False):
+        current = getattr(self._local, 'conn', None)
+        if current is not wrapper:
+            # Соединение уже возвращено (повторный close()) или принадлежит другому потоку
+            return
+        self._local.depth -= 1
+        if self._local.depth > 0 and not force:
+            return
+
+        self._local.conn = None
+        self._local.depth = 0
+        raw = wrapper._raw
+        with self._lock:
+            self._in_use.pop(id(raw), None)
+            try:
+                if raw.in_transaction:
+                    # Незавершенная транзакция не должна держать блокировку записи
+                    raw.rollback()
+                    self._stats['rollbacks_on_release'] += 1
+                self._idle.append(raw)
+            except sqlite3.Error:
+                raw.close()
+            self._lock.notify()
+
+    def release_thread_connection(self):
+        """Принудительно вернуть соединение текущего потока (например, в конце HTTP-запроса)"""
+        current = getattr(self._local, 'conn', None)
+        if current is not None:
+            self.release(current, force=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_use'] = len(self._in_use)
+            stats['idle'] = len(self._idle)
+        stats['max_size'] = self.max_size
+        stats['hit_rate'] = round(stats['hits'] / stats['acquired'], 4) if stats['acquired'] else 0.0
+        stats['avg_wait_ms'] = round(stats['wait_time'] / stats['waits'] * 1000, 3) if stats['waits'] else 0.0
+        stats['wait_time_ms'] = round(stats.pop('wait_time') * 1000, 3)
+        stats['max_wait_ms'] = round(stats.pop('max_wait') * 1000, 3)
+        return stats
+
+    def close_all(self):
+        with self._lock:
+            for raw in self._idle:
+                raw.close()
+            self._idle.clear()
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """Получить пул соединений текущего процесса (пересоздается после fork или смены DB_PATH)"""
+    global _pool
+    pool = _pool
+    if pool is not None and pool.pid == os.getpid() and pool.path == DB_PATH:
+        return pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid() or _pool.path != DB_PATH:
+            if _pool is not None and _pool.pid == os.getpid():
+                _pool.close_all()
+            _pool = ConnectionPool(DB_PATH)
+        return _pool
+
 
 def get_db_connection():
-    """Получить соединение с базой данных (WAL, таймаут)"""
-    # Создаем директорию для базы данных, если её нет
-    db_dir = os.path.dirname(os.path.abspath(DB_PATH))
-    if db_dir and not os.path.exists(db_dir):
-        os.makedirs(db_dir, exist_ok=True)
-    
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
-    conn.row_factory = sqlite3.Row
-    # Настройки для стабильности при параллельных запросах
-    conn.execute("PRAGMA journal_mode=WAL;")
-    conn.execute("PRAGMA busy_timeout=5000;")
-    return conn
-
-def init_database():
-    """Инициализация базы данных - создание всех таблиц"""
+    """Получить соединение с базой данных из пула (WAL, таймаут). close() возвращает его в пул"""
+    return get_pool().acquire()
+
+
+@contextmanager
+def db_connection():
+    """Контекстный менеджер: соединение из пула, автоматически возвращаемое при выходе"""
+    conn = get_db_connection()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+@contextmanager
+def transaction(immediate: bool = True):
+    """
+    Транзакция на соединении из пула.
+    Если в потоке уже открыта транзакция, используется SAVEPOINT.
+    """
+    conn = get_db_connection()
+    try:
+        if conn.in_transaction:
+            savepoint = f"sp_{threading.get_ident()}_{time.monotonic_ns()}"
+            conn.execute(f"SAVEPOINT {savepoint}")
+            try:
+                yield conn
+                conn.execute(f"RELEASE {savepoint}")
+            except BaseException:
+                conn.execute(f"ROLLBACK TO {savepoint}")
+                conn.execute(f"RELEASE {savepoint}")
+                raise
+        else:
+            conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+    finally:
+        conn.close()
+
+
+def release_thread_connection():
+    """Вернуть в пул соединение текущего потока, если оно не было закрыто"""
+    if _pool is not None and _pool.pid == os.getpid():
+        _pool.release_thread_connection()
+
+
+def get_pool_stats() -> Dict[str, Any]:
+    """Статистика пула соединений (hit rate, ожидание, занятые/свободные соединения)"""
+    return get_pool().stats()
+
+
+def check_pool_health() -> Dict[str, Any]:
+    """Проверка здоровья пула: тестовый запрос и статистика"""
+    started = time.monotonic()
+    try:
+        with db_connection() as conn:
+            conn.execute("SELECT 1").fetchone()
+        healthy = True
+        error = None
+    except sqlite3.Error as e:
+        healthy = False
+        error = str(e)
+    return {
+        'healthy': healthy,
+        'error': error,
+        'latency_ms': round((time.monotonic() - started) * 1000, 3),
+        'stats': get_pool_stats(),
+    }
+
+_async_executor: Optional[ThreadPoolExecutor] = None
+_async_executor_pid: Optional[int] = None
+
+
+def _get_async_executor() -> ThreadPoolExecutor:
+    global _async_executor, _async_executor_pid
+    if _async_executor is None or _async_executor_pid != os.getpid():
+        with _pool_lock:
+            if _async_executor is None or _async_executor_pid != os.getpid():
+                _async_executor = ThreadPoolExecutor(max_workers=DB_ASYNC_WORKERS, thread_name_prefix='db-async')
+                _async_executor_pid = os.getpid()
+    return _async_executor
+
+
+def _run_and_release(func, args, kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        release_thread_connection()
+
+
+async def run_async(func, *args, **kwargs):
+    """
+    Выполнить синхронную функцию работы с БД в ограниченном пуле потоков
+    и не блокировать цикл событий. Соединение потока возвращается в пул после вызова.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _get_async_executor(), functools.partial(_run_and_release, func, args, kwargs)
+    )
+
+
+def close_pool():
+    """Закрыть свободные соединения пула текущего процесса (перед fork и при остановке)"""
+    global _pool, _async_executor
+    if _async_executor is not None and _async_executor_pid == os.getpid():
+        _async_executor.shutdown(wait=True)
+    _async_executor = None
+    with _pool_lock:
+        if _pool is not None and _pool.pid == os.getpid():
+            _pool.close_all()
+        _pool = None
+
+
+@contextmanager
+def _init_lock():
+    """Межпроцессная блокировка инициализации: воркеры и сервисы, стартующие одновременно, не выполняют DDL параллельно"""
+    if fcntl is None:
+        yield
+        return
+    lock_path = os.path.abspath(DB_PATH) + '.init.lock'
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+_initialized_path: Optional[str] = None
+
+
+def init_database(force: bool = False):
+    """
+    Проверка версии схемы при старте процесса (см. backend/database/migrations.py).
+    Если схема актуальна, выполняется только чтение schema_version - без DDL и блокировки записи.
+    Непримененные миграции выполняются здесь, если включен DB_AUTO_MIGRATE или передан force;
+    иначе их применяет команда `manage schema migrate` при деплое.
+    Выполняется один раз на процесс (и наследуется дочерними процессами после fork).
+    """
+    global _initialized_path
+    if _initialized_path == DB_PATH and not force:
+        return
+    from backend.database import migrations
+    version = migrations.current_version()
+    if version < migrations.LATEST_VERSION:
+        if DB_AUTO_MIGRATE or force:
+            with _init_lock():
+                migrations.migrate()
+        else:
+            logger.warning(f"Схема БД устарела (версия {version}, нужна {migrations.LATEST_VERSION}): "
+                           f"выполните python -m backend.database.manage schema migrate")
+    _initialized_path = DB_PATH
+
+
+def _init_schema():
+    """Базовая схема (миграция 1). Новые изменения схемы - только новыми миграциями в migrations.py"""
     conn = get_db_connection()
     cursor = conn.cursor()
     
@@ -187,6 +576,15 @@ def init_database():
             )
         """)
         
+        # Последние показания счетчиков трафика ключей (для расчета приростов)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS traffic_snapshots (
+                vpn_key_id INTEGER PRIMARY KEY,
+                used_bytes REAL NOT NULL DEFAULT 0,
+                taken_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
         # Таблица черного списка
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS blacklist (
@@ -306,6 +704,26 @@ def init_database():
             )
         """)
         
+        # Журнал платежей из webhook'ов: первичный ключ (провайдер, payment_id) гарантирует,
+        # что повторная или параллельная доставка одного платежа не зачислит его дважды
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS payment_ledger (
+                payment_provider TEXT NOT NULL,
+                payment_id TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                amount REAL NOT NULL,
+                transaction_id INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (payment_provider, payment_id)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            INSERT OR IGNORE INTO payment_ledger (payment_provider, payment_id, user_id, amount, transaction_id, created_at)
+            SELECT payment_provider, payment_id, user_id, amount, id, created_at FROM transactions
+            WHERE payment_provider IS NOT NULL AND payment_id IS NOT NULL
+            ORDER BY id
+        """)
+
         # Таблица настроек платежных провайдеров (для настройки из панели)
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS payment_provider_settings (
@@ -329,6 +747,94 @@ def init_database():
             )
         """)
         
+        # Материализованные агрегаты рефералов (поддерживаются триггерами, см. ниже)
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'referral_aggregates'")
+        referral_aggregates_existed = cursor.fetchone() is not None
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS referral_aggregates (
+                referrer_id INTEGER PRIMARY KEY,
+                referrals_count INTEGER NOT NULL DEFAULT 0,
+                referrals_spent REAL NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (referrer_id) REFERENCES users(id)
+            )
+        """)
+        
+        # Сумма пополнений по каждому пользователю (для списка рефералов)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS referral_user_spend (
+                user_id INTEGER PRIMARY KEY,
+                deposits_total REAL NOT NULL DEFAULT 0,
+                deposits_count INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            )
+        """)
+        
+        # Роллапы статистики для дашбордов панели (поддерживаются триггерами, см. ниже)
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stats_counters'")
+        stats_rollups_existed = cursor.fetchone() is not None
+        
+        # События по дням/часам: регистрации, созданные ключи
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS stats_event_buckets (
+                granularity TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                event TEXT NOT NULL,
+                cnt INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (granularity, event, bucket)
+            ) WITHOUT ROWID
+        """)
+        
+        # Транзакции по дням/часам в разрезе типа, статуса и способа оплаты
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS stats_tx_buckets (
+                granularity TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                type TEXT NOT NULL,
+                status TEXT NOT NULL,
+                method TEXT NOT NULL,
+                cnt INTEGER NOT NULL DEFAULT 0,
+                amount REAL NOT NULL DEFAULT 0,
+                debit_cnt INTEGER NOT NULL DEFAULT 0,
+                debit_amount REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (granularity, type, status, bucket, method)
+            ) WITHOUT ROWID
+        """)
+        
+        # Текущие значения счетчиков (пользователи по статусам, ключи, тикеты, балансы)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS stats_counters (
+                name TEXT PRIMARY KEY,
+                value REAL NOT NULL DEFAULT 0
+            ) WITHOUT ROWID
+        """)
+        
+        # Аренды и состояние периодических задач планировщика
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS scheduler_jobs (
+                name TEXT PRIMARY KEY,
+                owner TEXT,
+                lease_expires_at REAL DEFAULT 0,
+                last_started_at TIMESTAMP,
+                last_finished_at TIMESTAMP,
+                last_duration_ms INTEGER,
+                last_status TEXT,
+                last_error TEXT
+            )
+        """)
+        
+        # Состояние инкрементальных синхронизаций (водяные знаки)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_state (
+                name TEXT PRIMARY KEY,
+                watermark TEXT,
+                last_run_at TIMESTAMP,
+                details TEXT
+            )
+        """)
+        
         # Миграция: добавляем поля в mailings если их нет
         try:
             cursor.execute("ALTER TABLE mailings ADD COLUMN button_type TEXT")
@@ -342,7 +848,186 @@ def init_database():
             cursor.execute("ALTER TABLE mailings ADD COLUMN image_url TEXT")
         except sqlite3.OperationalError:
             pass
+        for column in ("total_count INTEGER DEFAULT 0", "failed_count INTEGER DEFAULT 0",
+                       "started_at TIMESTAMP", "finished_at TIMESTAMP"):
+            try:
+                cursor.execute(f"ALTER TABLE mailings ADD COLUMN {column}")
+            except sqlite3.OperationalError:
+                pass
+        
+        # Миграция: тип подписки ключа (vpn / whitelist), нужен планировщику автоплатежей
+        try:
+            cursor.execute("ALTER TABLE vpn_keys ADD COLUMN plan_type TEXT DEFAULT 'vpn'")
+            cursor.execute("""
+                UPDATE vpn_keys SET plan_type = 'whitelist'
+                WHERE id IN (SELECT vpn_key_id FROM devices WHERE name = 'Whitelist подписка')
+            """)
+        except sqlite3.OperationalError:
+            pass
+        
+        # Очередь доставки рассылок (по получателю)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS mailing_recipients (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                mailing_id INTEGER NOT NULL,
+                user_id INTEGER,
+                telegram_id INTEGER NOT NULL,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL DEFAULT 0,
+                error TEXT,
+                sent_at TIMESTAMP,
+                UNIQUE(mailing_id, telegram_id),
+                FOREIGN KEY (mailing_id) REFERENCES mailings(id)
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_mailing_recipients_pending ON mailing_recipients(mailing_id, status, id)")
+
+        # Очередь уведомлений (outbox): вызывающий код только вставляет строку,
+        # отправкой занимается фоновый диспетчер (backend/core/notifications.py)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS notification_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                bot TEXT NOT NULL DEFAULT 'main',
+                fallback_bot TEXT,
+                chat_id TEXT NOT NULL,
+                text TEXT NOT NULL,
+                parse_mode TEXT DEFAULT 'HTML',
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL DEFAULT 0,
+                error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                sent_at TIMESTAMP
+            )
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_notification_outbox_pending
+            ON notification_outbox(chat_id, id) WHERE status = 'pending'
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_notification_outbox_status ON notification_outbox(status, id)")
+        
+        # Очередь создания подписок в Remnawave (backend/core/provisioning.py)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS provisioning_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                telegram_id INTEGER NOT NULL,
+                username TEXT,
+                plan_type TEXT NOT NULL DEFAULT 'vpn',
+                days INTEGER NOT NULL,
+                traffic_limit INTEGER DEFAULT 0,
+                price REAL DEFAULT 0,
+                payment_source TEXT NOT NULL DEFAULT 'balance',
+                description TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL DEFAULT 0,
+                locked_until REAL DEFAULT 0,
+                remnawave_username TEXT,
+                result TEXT,
+                error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            )
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_provisioning_jobs_active
+            ON provisioning_jobs(id) WHERE status IN ('pending', 'processing')
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_provisioning_jobs_status ON provisioning_jobs(status, id)")
+        
+        # Массовые действия над пользователями и их прогресс (backend/core/mass_actions.py)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS mass_actions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                action TEXT NOT NULL,
+                value TEXT,
+                notify INTEGER DEFAULT 0,
+                status TEXT NOT NULL DEFAULT 'Queued',
+                total_count INTEGER DEFAULT 0,
+                processed_count INTEGER DEFAULT 0,
+                notified_count INTEGER DEFAULT 0,
+                remnawave_total INTEGER DEFAULT 0,
+                remnawave_failed INTEGER DEFAULT 0,
+                error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                started_at TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        """)
         
+        # Кеш зашифрованных ссылок Happ (backend/api/happ.py)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS happ_link_cache (
+                url_hash TEXT PRIMARY KEY,
+                encrypted_link TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            ) WITHOUT ROWID
+        """)
+
+        # История резервных копий БД (backend/core/backups.py)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS backup_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                trigger TEXT NOT NULL DEFAULT 'manual',
+                status TEXT NOT NULL DEFAULT 'running',
+                file_name TEXT,
+                db_bytes INTEGER,
+                compressed_bytes INTEGER,
+                copy_ms INTEGER,
+                verify_ms INTEGER,
+                compress_ms INTEGER,
+                duration_ms INTEGER,
+                bytes_per_second INTEGER,
+                integrity TEXT,
+                sent_to_admin INTEGER DEFAULT 0,
+                error TEXT,
+                started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        """)
+
+        # Архивация старых строк по месяцам и сводки по архиву (backend/database/archive.py)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS archive_state (
+                table_name TEXT PRIMARY KEY,
+                archived_before TEXT,
+                rows_archived INTEGER DEFAULT 0,
+                last_run_at TIMESTAMP
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS archive_partitions (
+                table_name TEXT NOT NULL,
+                month TEXT NOT NULL,
+                row_count INTEGER DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (table_name, month)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS archive_user_deposits (
+                user_id INTEGER PRIMARY KEY,
+                deposits_total REAL DEFAULT 0,
+                deposits_count INTEGER DEFAULT 0
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS traffic_stats_monthly (
+                vpn_key_id INTEGER NOT NULL,
+                user_id INTEGER,
+                month TEXT NOT NULL,
+                traffic_bytes REAL DEFAULT 0,
+                days INTEGER DEFAULT 0,
+                max_unique_hwids INTEGER DEFAULT 0,
+                PRIMARY KEY (vpn_key_id, month)
+            ) WITHOUT ROWID
+        """)
+
         # Инициализация дефолтных тарифов VPN
         cursor.execute("SELECT COUNT(*) FROM tariff_plans WHERE plan_type = 'vpn'")
         if cursor.fetchone()[0] == 0:
@@ -393,14 +1078,125 @@ def init_database():
         # Индексы для оптимизации
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_telegram_id ON users(telegram_id)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_referral_code ON users(referral_code)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users(referred_by, registration_date)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_user_id ON vpn_keys(user_id)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_status ON vpn_keys(status)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_status_expiry ON vpn_keys(status, expiry_date)")
+        # Остаток трафика ключей по типу подписки (скан автоплатежей whitelist)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_vpn_keys_plan_remaining
+            ON vpn_keys(plan_type, status, (traffic_limit - traffic_used))
+        """)
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_devices_hwid ON devices(hwid_hash)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_id ON transactions(user_id)")
+        # Курсорная пагинация списков панели: (created_at, id) и фильтры перед ними
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_created ON transactions(created_at, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_status_created ON transactions(status, created_at, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_type_created ON transactions(type, created_at, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_provider_created ON transactions(payment_provider, created_at, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_created ON transactions(user_id, created_at, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_created ON vpn_keys(created_at, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_vpn_keys_status_created ON vpn_keys(status, created_at, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_status_created ON users(status, created_at, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tickets_user_id ON tickets(user_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tickets_activity ON tickets(COALESCE(last_message_time, created_at), id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tickets_status_activity ON tickets(status, COALESCE(last_message_time, created_at), id)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_traffic_stats_date ON traffic_stats(date)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_blacklist_telegram_id ON blacklist(telegram_id)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_payment_provider_settings ON payment_provider_settings(provider, setting_key)")
         
+        
+        # Триггеры агрегатов рефералов: выполняются в той же транзакции, что и вставка пополнения
+        # или привязка реферера, поэтому любой путь записи (webhook'и, админка, mass_user_action)
+        # обновляет агрегаты атомарно
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_referral_deposit_insert
+            AFTER INSERT ON transactions
+            WHEN NEW.type = 'deposit'
+            BEGIN
+                INSERT INTO referral_user_spend (user_id, deposits_total, deposits_count)
+                VALUES (NEW.user_id, COALESCE(NEW.amount, 0), 1)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    deposits_total = deposits_total + excluded.deposits_total,
+                    deposits_count = deposits_count + 1,
+                    updated_at = CURRENT_TIMESTAMP;
+                UPDATE referral_aggregates
+                SET referrals_spent = referrals_spent + COALESCE(NEW.amount, 0),
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE referrer_id = (SELECT referred_by FROM users WHERE id = NEW.user_id);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_referral_user_insert
+            AFTER INSERT ON users
+            WHEN NEW.referred_by IS NOT NULL
+            BEGIN
+                INSERT INTO referral_aggregates (referrer_id, referrals_count, referrals_spent)
+                VALUES (NEW.referred_by, 1, 0)
+                ON CONFLICT(referrer_id) DO UPDATE SET
+                    referrals_count = referrals_count + 1,
+                    updated_at = CURRENT_TIMESTAMP;
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_referral_user_update
+            AFTER UPDATE OF referred_by ON users
+            WHEN OLD.referred_by IS NOT NEW.referred_by
+            BEGIN
+                UPDATE referral_aggregates
+                SET referrals_count = referrals_count - 1,
+                    referrals_spent = referrals_spent - COALESCE(
+                        (SELECT deposits_total FROM referral_user_spend WHERE user_id = NEW.id), 0),
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE referrer_id = OLD.referred_by;
+                INSERT INTO referral_aggregates (referrer_id, referrals_count, referrals_spent)
+                SELECT NEW.referred_by, 1,
+                       COALESCE((SELECT deposits_total FROM referral_user_spend WHERE user_id = NEW.id), 0)
+                WHERE NEW.referred_by IS NOT NULL
+                ON CONFLICT(referrer_id) DO UPDATE SET
+                    referrals_count = referrals_count + 1,
+                    referrals_spent = referrals_spent + excluded.referrals_spent,
+                    updated_at = CURRENT_TIMESTAMP;
+            END
+        """)
+        
+        # Первичное заполнение агрегатов для существующей базы
+        if not referral_aggregates_existed:
+            _rebuild_referral_aggregates(cursor)
+        
+        # Версия конфигурации: любое изменение таблиц настроек увеличивает ее,
+        # процессы сверяют одно число и сбрасывают кэш конфигурации
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS config_version (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        cursor.execute("INSERT OR IGNORE INTO config_version (id, version) VALUES (1, 0)")
+        for table in CONFIG_TABLES:
+            for operation in ('INSERT', 'UPDATE', 'DELETE'):
+                cursor.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS trg_config_version_{table}_{operation.lower()}
+                    AFTER {operation} ON {table}
+                    BEGIN
+                        UPDATE config_version SET version = version + 1 WHERE id = 1;
+                    END
+                """)
+        
+        # Триггеры роллапов статистики
+        _create_stats_triggers(cursor)
+        
+        # Первичное заполнение роллапов для существующей базы
+        if not stats_rollups_existed:
+            _rebuild_stats_rollups(cursor)
+        
+        # Полнотекстовый поиск для панели (FTS5, поддерживается триггерами)
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'search_index'")
+        search_index_existed = cursor.fetchone() is not None
+        if _create_search_index(cursor) and not search_index_existed:
+            _rebuild_search_index(cursor)
+        
         conn.commit()
         logger.info("База данных успешно инициализирована")
     except Exception as e:
@@ -468,29 +1264,21 @@ def update_user_balance(user_id: int, amount: float, ensure_non_negative: bool =
     Обновить баланс пользователя.
     Если ensure_non_negative=True, операция не выполнится, если баланс станет отрицательным.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute("BEGIN IMMEDIATE")
+    with transaction() as conn:
+        cursor = conn.cursor()
         cursor.execute("SELECT balance FROM users WHERE id = ?", (user_id,))
         row = cursor.fetchone()
         if not row:
-            conn.rollback()
             return False
         new_balance = (row["balance"] or 0) + amount
         if ensure_non_negative and new_balance < 0:
-            conn.rollback()
             return False
         cursor.execute("""
             UPDATE users 
             SET balance = ?, updated_at = CURRENT_TIMESTAMP
             WHERE id = ?
         """, (new_balance, user_id))
-        conn.commit()
         return cursor.rowcount > 0
-    finally:
-        conn.close()
 
 def update_user_full_name(telegram_id: int, full_name: str) -> bool:
     """Обновить полное имя пользователя (first_name из Telegram)"""
@@ -524,16 +1312,145 @@ def hash_hwid(hwid: str) -> str:
     """Хешировать HWID для безопасного хранения"""
     return hashlib.sha256(hwid.encode()).hexdigest()
 
+# ========== Платежи из webhook'ов ==========
+
+def record_deposit(payment_provider: str, payment_id: str, user_id: int, amount: float,
+                   payment_method: str, description: str = None,
+                   saved_method: Dict[str, Any] = None) -> Optional[Dict[str, Any]]:
+    """
+    Зачислить пополнение из webhook одной транзакцией: запись в журнал платежей,
+    начисление баланса, транзакция и сохранение способа оплаты фиксируются вместе.
+
+    Args:
+        saved_method: Способ оплаты для автоплатежей (payment_method_id, payment_method_type,
+                      card_last4, card_brand)
+
+    Returns:
+        Dict со status: 'credited' (с transaction_id и пользователем для уведомлений после коммита),
+        'duplicate' (платеж уже зачислен) или 'user_not_found' (ничего не записано, нужна ручная проверка)
+    """
+    with transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, telegram_id, username FROM users WHERE id = ?", (user_id,))
+        user = cursor.fetchone()
+        if not user:
+            return {'status': 'user_not_found'}
+
+        cursor.execute("""
+            INSERT INTO payment_ledger (payment_provider, payment_id, user_id, amount)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(payment_provider, payment_id) DO NOTHING
+        """, (payment_provider, payment_id, user_id, amount))
+        if cursor.rowcount == 0:
+            return {'status': 'duplicate'}
+
+        cursor.execute("""
+            UPDATE users SET balance = COALESCE(balance, 0) + ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        """, (amount, user_id))
+        cursor.execute("""
+            INSERT INTO transactions (user_id, type, amount, status, payment_method, payment_provider, payment_id, description)
+            VALUES (?, 'deposit', ?, 'Success', ?, ?, ?, ?)
+        """, (user_id, amount, payment_method, payment_provider, payment_id, description))
+        transaction_id = cursor.lastrowid
+        cursor.execute("""
+            UPDATE payment_ledger SET transaction_id = ? WHERE payment_provider = ? AND payment_id = ?
+        """, (transaction_id, payment_provider, payment_id))
+
+        if saved_method and saved_method.get('payment_method_id'):
+            cursor.execute("""
+                INSERT INTO saved_payment_methods
+                (user_id, payment_provider, payment_method_id, payment_method_type, card_last4, card_brand, is_active)
+                VALUES (?, ?, ?, ?, ?, ?, 1)
+                ON CONFLICT(user_id, payment_provider, payment_method_id) DO UPDATE SET
+                    payment_method_type = excluded.payment_method_type,
+                    card_last4 = excluded.card_last4,
+                    card_brand = excluded.card_brand,
+                    is_active = 1,
+                    updated_at = CURRENT_TIMESTAMP
+            """, (
+                user_id, payment_provider, saved_method['payment_method_id'],
+                saved_method.get('payment_method_type'), saved_method.get('card_last4'),
+                saved_method.get('card_brand'),
+            ))
+    return {'status': 'credited', 'transaction_id': transaction_id, 'user': dict(user)}
+
+
+# ========== Кэш конфигурации ==========
+
+# Таблицы, изменение которых сбрасывает кэш конфигурации во всех процессах
+CONFIG_TABLES = ('system_settings', 'tariff_plans', 'whitelist_settings', 'payment_fees', 'public_pages')
+# Как часто сверять версию конфигурации с БД (секунды)
+CONFIG_CACHE_CHECK_INTERVAL = float(os.getenv('CONFIG_CACHE_CHECK_INTERVAL', '1.0'))
+
+_config_cache: Dict[str, Any] = {}
+_config_cache_version: Optional[int] = None
+_config_cache_checked_at = 0.0
+_config_cache_lock = threading.Lock()
+
+
+def get_config_version() -> int:
+    """Текущая версия конфигурации в БД"""
+    with db_connection() as conn:
+        row = conn.execute("SELECT version FROM config_version WHERE id = 1").fetchone()
+    return row[0] if row else 0
+
+
+def invalidate_config_cache():
+    """Сбросить кэш конфигурации этого процесса (после записи настроек)"""
+    global _config_cache_version, _config_cache_checked_at
+    with _config_cache_lock:
+        _config_cache.clear()
+        _config_cache_version = None
+        _config_cache_checked_at = 0.0
+
+
+def cached_config(name: str, loader, copy_value: bool = True):
+    """
+    Значение конфигурации из кэша процесса или из loader().
+
+    Версия в config_version сверяется не чаще CONFIG_CACHE_CHECK_INTERVAL;
+    если она изменилась (запись в другом процессе), кэш сбрасывается целиком.
+    По умолчанию возвращается копия, поэтому ее можно изменять.
+    """
+    global _config_cache_version, _config_cache_checked_at
+    now = time.monotonic()
+    if now - _config_cache_checked_at >= CONFIG_CACHE_CHECK_INTERVAL:
+        version = get_config_version()
+        with _config_cache_lock:
+            if version != _config_cache_version:
+                _config_cache.clear()
+                _config_cache_version = version
+            _config_cache_checked_at = now
+
+    with _config_cache_lock:
+        if name in _config_cache:
+            value = _config_cache[name]
+            return copy.deepcopy(value) if copy_value else value
+        version = _config_cache_version
+    value = loader()
+    with _config_cache_lock:
+        # Если за время загрузки версия сменилась, значение могло устареть - не кэшируем
+        if version == _config_cache_version:
+            _config_cache[name] = value
+    return copy.deepcopy(value) if copy_value else value
+
+
+def _load_system_settings() -> Dict[str, str]:
+    with db_connection() as conn:
+        return {row['setting_key']: row['setting_value']
+                for row in conn.execute("SELECT setting_key, setting_value FROM system_settings")}
+
+
+def get_system_settings() -> Dict[str, str]:
+    """Все системные настройки (из кэша конфигурации)"""
+    return cached_config('system_settings', _load_system_settings)
+
+
 def get_system_setting(key: str, default: str = None) -> Optional[str]:
     """Получить системную настройку"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        cursor.execute("SELECT setting_value FROM system_settings WHERE setting_key = ?", (key,))
-        row = cursor.fetchone()
-        return row['setting_value'] if row else default
-    finally:
-        conn.close()
+    # Значения - строки, копировать словарь ради одного ключа не нужно
+    return cached_config('system_settings', _load_system_settings, copy_value=False).get(key, default)
 
 def set_system_setting(key: str, value: str) -> bool:
     """Установить системную настройку"""
@@ -551,10 +1468,10 @@ def set_system_setting(key: str, value: str) -> bool:
         return False
     finally:
         conn.close()
+        invalidate_config_cache()
 
 def get_default_squads(plan_type: str = 'vpn') -> List[str]:
     """Получить список UUID сквадов по умолчанию для типа подписки"""
-    import json
     key = f'default_squads_{plan_type}'  # default_squads_vpn или default_squads_whitelist
     value = get_system_setting(key, '[]')
     try:
@@ -564,11 +1481,51 @@ def get_default_squads(plan_type: str = 'vpn') -> List[str]:
 
 def set_default_squads(squad_uuids: List[str], plan_type: str = 'vpn') -> bool:
     """Установить список UUID сквадов по умолчанию для типа подписки"""
-    import json
     key = f'default_squads_{plan_type}'  # default_squads_vpn или default_squads_whitelist
     return set_system_setting(key, json.dumps(squad_uuids))
 
 
+def get_tariff_plans() -> List[Dict[str, Any]]:
+    """Активные тарифные планы (из кэша конфигурации)"""
+    def load():
+        with db_connection() as conn:
+            return [dict(row) for row in conn.execute(
+                "SELECT * FROM tariff_plans WHERE is_active = 1 ORDER BY plan_type, sort_order"
+            )]
+    return cached_config('tariff_plans', load)
+
+
+def get_whitelist_settings() -> Optional[Dict[str, Any]]:
+    """Текущие настройки whitelist bypass или None (из кэша конфигурации)"""
+    def load():
+        with db_connection() as conn:
+            row = conn.execute("SELECT * FROM whitelist_settings ORDER BY id DESC LIMIT 1").fetchone()
+        return dict(row) if row else None
+    return cached_config('whitelist_settings', load)
+
+
+def get_payment_fees() -> Dict[str, Dict[str, float]]:
+    """Комиссии платежных систем по способу оплаты (из кэша конфигурации)"""
+    def load():
+        with db_connection() as conn:
+            return {
+                row['payment_method']: {'fee_percent': float(row['fee_percent']), 'fee_fixed': float(row['fee_fixed'])}
+                for row in conn.execute("SELECT * FROM payment_fees")
+            }
+    return cached_config('payment_fees', load)
+
+
+def get_public_pages() -> Dict[str, Dict[str, Any]]:
+    """Публичные страницы по типу (из кэша конфигурации)"""
+    def load():
+        with db_connection() as conn:
+            return {
+                row['page_type']: {'id': row['id'], 'content': row['content'], 'updated_at': row['updated_at']}
+                for row in conn.execute("SELECT id, page_type, content, updated_at FROM public_pages")
+            }
+    return cached_config('public_pages', load)
+
+
 # ========== Функции для рейт-лимитинга рефералов ==========
 
 def check_referral_rate_limit(referrer_telegram_id: int, limit: int = 25, window_seconds: int = 60) -> bool:
@@ -657,6 +1614,624 @@ def get_user_by_referral_code(referral_code: str) -> Optional[Dict[str, Any]]:
         conn.close()
 
 
+# ========== Агрегаты рефералов ==========
+
+def get_referral_aggregate(referrer_id: int) -> Dict[str, Any]:
+    """Количество рефералов и сумма их пополнений (из материализованных агрегатов)"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT referrals_count, referrals_spent
+            FROM referral_aggregates
+            WHERE referrer_id = ?
+        """, (referrer_id,))
+        row = cursor.fetchone()
+    
+    if not row:
+        return {'referrals_count': 0, 'referrals_spent': 0.0}
+    return {'referrals_count': row['referrals_count'], 'referrals_spent': float(row['referrals_spent'] or 0)}
+
+
+def get_referrals_with_spend(referrer_id: int) -> List[Dict[str, Any]]:
+    """Список рефералов с суммой пополнений каждого, одним запросом"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT u.id, u.username, u.full_name, u.registration_date,
+                   COALESCE(s.deposits_total, 0) AS spent
+            FROM users u
+            LEFT JOIN referral_user_spend s ON s.user_id = u.id
+            WHERE u.referred_by = ?
+            ORDER BY u.registration_date DESC
+        """, (referrer_id,))
+        return [dict(row) for row in cursor.fetchall()]
+
+
+# Пополнения пользователей: строки transactions и сводка по перенесенным в архив
+_DEPOSITS_WITH_ARCHIVE = """
+    SELECT user_id, amount AS total, 1 AS cnt FROM transactions
+    WHERE type = 'deposit' AND user_id IS NOT NULL
+    UNION ALL
+    SELECT user_id, deposits_total, deposits_count FROM archive_user_deposits
+"""
+
+
+def _rebuild_referral_aggregates(cursor) -> Dict[str, int]:
+    """Пересчитать агрегаты рефералов из transactions (с архивом) и users (в текущей транзакции)"""
+    cursor.execute("DELETE FROM referral_user_spend")
+    cursor.execute(f"""
+        INSERT INTO referral_user_spend (user_id, deposits_total, deposits_count)
+        SELECT user_id, COALESCE(SUM(total), 0), COALESCE(SUM(cnt), 0)
+        FROM ({_DEPOSITS_WITH_ARCHIVE})
+        GROUP BY user_id
+    """)
+    users_count = cursor.rowcount
+    
+    cursor.execute("DELETE FROM referral_aggregates")
+    cursor.execute("""
+        INSERT INTO referral_aggregates (referrer_id, referrals_count, referrals_spent)
+        SELECT u.referred_by, COUNT(*), COALESCE(SUM(s.deposits_total), 0)
+        FROM users u
+        LEFT JOIN referral_user_spend s ON s.user_id = u.id
+        WHERE u.referred_by IS NOT NULL
+        GROUP BY u.referred_by
+    """)
+    return {'referrers': cursor.rowcount, 'users': users_count}
+
+
+def rebuild_referral_aggregates() -> Dict[str, int]:
+    """Полностью пересчитать агрегаты рефералов"""
+    with transaction() as conn:
+        result = _rebuild_referral_aggregates(conn.cursor())
+    logger.info(f"Агрегаты рефералов пересчитаны: {result}")
+    return result
+
+
+def verify_referral_aggregates(tolerance: float = 0.005) -> Dict[str, Any]:
+    """
+    Сверить материализованные агрегаты рефералов с transactions (с учетом архива).
+    
+    Returns:
+        Dict с ok и списками расхождений по реферерам (referrers) и пользователям (users)
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            WITH spend AS (
+                SELECT user_id, SUM(total) AS total, SUM(cnt) AS cnt
+                FROM ({_DEPOSITS_WITH_ARCHIVE})
+                GROUP BY user_id
+            )
+            SELECT COALESCE(sp.user_id, s.user_id) AS user_id,
+                   COALESCE(sp.total, 0) AS expected_spent, COALESCE(sp.cnt, 0) AS expected_count,
+                   s.deposits_total AS stored_spent, s.deposits_count AS stored_count
+            FROM spend sp
+            LEFT JOIN referral_user_spend s ON s.user_id = sp.user_id
+            WHERE s.user_id IS NULL OR s.deposits_count != sp.cnt OR ABS(s.deposits_total - sp.total) > ?
+            UNION ALL
+            SELECT s.user_id, 0, 0, s.deposits_total, s.deposits_count
+            FROM referral_user_spend s
+            WHERE s.user_id NOT IN (SELECT user_id FROM spend)
+              AND (s.deposits_count != 0 OR ABS(s.deposits_total) > ?)
+        """, (tolerance, tolerance))
+        users = [dict(row) for row in cursor.fetchall()]
+        
+        cursor.execute(f"""
+            WITH spend AS (
+                SELECT user_id, SUM(total) AS total
+                FROM ({_DEPOSITS_WITH_ARCHIVE})
+                GROUP BY user_id
+            ),
+            expected AS (
+                SELECT u.referred_by AS referrer_id, COUNT(*) AS cnt, COALESCE(SUM(sp.total), 0) AS spent
+                FROM users u
+                LEFT JOIN spend sp ON sp.user_id = u.id
+                WHERE u.referred_by IS NOT NULL
+                GROUP BY u.referred_by
+            )
+            SELECT e.referrer_id, e.cnt AS expected_count, e.spent AS expected_spent,
+                   a.referrals_count AS stored_count, a.referrals_spent AS stored_spent
+            FROM expected e
+            LEFT JOIN referral_aggregates a ON a.referrer_id = e.referrer_id
+            WHERE a.referrer_id IS NULL OR a.referrals_count != e.cnt OR ABS(a.referrals_spent - e.spent) > ?
+            UNION ALL
+            SELECT a.referrer_id, 0, 0, a.referrals_count, a.referrals_spent
+            FROM referral_aggregates a
+            WHERE a.referrer_id NOT IN (SELECT referrer_id FROM expected)
+              AND (a.referrals_count != 0 OR ABS(a.referrals_spent) > ?)
+        """, (tolerance, tolerance))
+        referrers = [dict(row) for row in cursor.fetchall()]
+    
+    return {'ok': not users and not referrers, 'referrers': referrers, 'users': users}
+
+
+# ========== Роллапы статистики ==========
+
+STATS_HOURLY_RETENTION_DAYS = int(os.getenv('STATS_HOURLY_RETENTION_DAYS', '30'))
+
+# Бакеты: день 'YYYY-MM-DD' и час 'YYYY-MM-DD HH:00' (UTC, как CURRENT_TIMESTAMP)
+_STATS_DAY_EXPR = "COALESCE(date({ts}), date('now'))"
+_STATS_HOUR_EXPR = "COALESCE(strftime('%Y-%m-%d %H:00', {ts}), strftime('%Y-%m-%d %H:00', 'now'))"
+
+# Событийные бакеты: (таблица, событие, колонка времени)
+_STATS_EVENTS = [
+    ('users', 'user_registered', 'registration_date'),
+    ('vpn_keys', 'key_created', 'created_at'),
+]
+
+# Счетчики текущего состояния: таблица -> (колонки для UPDATE-триггера, [(имя, значение)])
+# {r} заменяется на NEW/OLD в триггерах и на имя таблицы при пересчете
+_STATS_COUNTERS = {
+    'users': (
+        'status, is_banned, trial_used, referred_by, is_partner, balance, total_earned',
+        [
+            ("'users_total'", "1"),
+            ("'users_status:' || COALESCE({r}.status, '')", "1"),
+            ("'users_banned'", "COALESCE({r}.is_banned, 0) != 0"),
+            ("'users_trial_used'", "COALESCE({r}.trial_used, 0) = 1"),
+            ("'users_trial_converted'", "COALESCE({r}.trial_used, 0) = 1 AND {r}.status = 'Active'"),
+            ("'users_referred'", "{r}.referred_by IS NOT NULL"),
+            ("'users_partners'", "COALESCE({r}.is_partner, 0) = 1"),
+            ("'users_balance'", "COALESCE({r}.balance, 0)"),
+            ("'users_total_earned'", "COALESCE({r}.total_earned, 0)"),
+        ],
+    ),
+    'vpn_keys': (
+        'status',
+        [
+            ("'keys_total'", "1"),
+            ("'keys_status:' || COALESCE({r}.status, '')", "1"),
+        ],
+    ),
+    'tickets': (
+        'status',
+        [
+            ("'tickets_total'", "1"),
+            ("'tickets_status:' || COALESCE({r}.status, '')", "1"),
+        ],
+    ),
+}
+
+
+def _stats_tx_values(ref: str, sign: str) -> str:
+    """VALUES для дневного и часового бакета транзакции NEW/OLD"""
+    ts = f"{ref}.created_at"
+    row = (
+        f"COALESCE({ref}.type, ''), COALESCE({ref}.status, ''), COALESCE({ref}.payment_method, ''), "
+        f"{sign}1, {sign}COALESCE({ref}.amount, 0), "
+        f"{sign}(COALESCE({ref}.amount, 0) < 0), "
+        f"{sign}(CASE WHEN {ref}.amount < 0 THEN -{ref}.amount ELSE 0 END)"
+    )
+    return (
+        f"('day', {_STATS_DAY_EXPR.format(ts=ts)}, {row}), "
+        f"('hour', {_STATS_HOUR_EXPR.format(ts=ts)}, {row})"
+    )
+
+
+def _create_stats_triggers(cursor):
+    """Создать триггеры, инкрементально обновляющие роллапы статистики"""
+    tx_upsert = """
+        ON CONFLICT(granularity, type, status, bucket, method) DO UPDATE SET
+            cnt = cnt + excluded.cnt,
+            amount = amount + excluded.amount,
+            debit_cnt = debit_cnt + excluded.debit_cnt,
+            debit_amount = debit_amount + excluded.debit_amount;
+    """
+    tx_insert = "INSERT INTO stats_tx_buckets (granularity, bucket, type, status, method, cnt, amount, debit_cnt, debit_amount) VALUES "
+    
+    # Транзакции: история не уменьшается при удалении (архивация), но корректируется при изменении
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_stats_transactions_insert
+        AFTER INSERT ON transactions
+        BEGIN
+            {tx_insert} {_stats_tx_values('NEW', '')} {tx_upsert}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_stats_transactions_update
+        AFTER UPDATE OF type, status, payment_method, amount ON transactions
+        BEGIN
+            {tx_insert} {_stats_tx_values('OLD', '-')}, {_stats_tx_values('NEW', '')} {tx_upsert}
+        END
+    """)
+    
+    for table, event, ts_column in _STATS_EVENTS:
+        ts = f"NEW.{ts_column}"
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_stats_{table}_event
+            AFTER INSERT ON {table}
+            BEGIN
+                INSERT INTO stats_event_buckets (granularity, bucket, event, cnt)
+                VALUES ('day', {_STATS_DAY_EXPR.format(ts=ts)}, '{event}', 1),
+                       ('hour', {_STATS_HOUR_EXPR.format(ts=ts)}, '{event}', 1)
+                ON CONFLICT(granularity, event, bucket) DO UPDATE SET cnt = cnt + excluded.cnt;
+            END
+        """)
+    
+    for table, (update_columns, counters) in _STATS_COUNTERS.items():
+        def deltas(ref: str, sign: str) -> List[str]:
+            return [
+                f"SELECT {name.format(r=ref)} AS name, {sign}({value.format(r=ref)}) AS delta"
+                for name, value in counters
+            ]
+        
+        def upsert(rows: List[str]) -> str:
+            return f"""
+                INSERT INTO stats_counters (name, value)
+                SELECT name, SUM(delta) FROM ({' UNION ALL '.join(rows)})
+                GROUP BY name HAVING SUM(delta) != 0
+                ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+            """
+        
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_stats_{table}_counters_insert
+            AFTER INSERT ON {table}
+            BEGIN {upsert(deltas('NEW', ''))} END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_stats_{table}_counters_update
+            AFTER UPDATE OF {update_columns} ON {table}
+            BEGIN {upsert(deltas('OLD', '-') + deltas('NEW', ''))} END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_stats_{table}_counters_delete
+            AFTER DELETE ON {table}
+            BEGIN {upsert(deltas('OLD', '-'))} END
+        """)
+
+
+def _recompute_stats_counters(cursor):
+    """Пересчитать счетчики текущего состояния из исходных таблиц"""
+    cursor.execute("DELETE FROM stats_counters")
+    for table, (_, counters) in _STATS_COUNTERS.items():
+        rows = ' UNION ALL '.join(
+            f"SELECT {name.format(r=table)} AS name, ({value.format(r=table)}) AS delta FROM {table}"
+            for name, value in counters
+        )
+        cursor.execute(f"""
+            INSERT INTO stats_counters (name, value)
+            SELECT name, SUM(delta) FROM ({rows})
+            GROUP BY name
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+        """)
+
+
+def _rebuild_stats_rollups(cursor) -> Dict[str, int]:
+    """Построить все роллапы статистики заново из истории (в текущей транзакции)"""
+    hourly_since = (datetime.utcnow() - timedelta(days=STATS_HOURLY_RETENTION_DAYS)).strftime('%Y-%m-%d %H:00')
+    
+    cursor.execute("DELETE FROM stats_event_buckets")
+    for table, event, ts_column in _STATS_EVENTS:
+        for granularity, expr in (('day', _STATS_DAY_EXPR), ('hour', _STATS_HOUR_EXPR)):
+            bucket = expr.format(ts=ts_column)
+            cursor.execute(f"""
+                INSERT INTO stats_event_buckets (granularity, bucket, event, cnt)
+                SELECT ?, {bucket} AS b, ?, COUNT(*)
+                FROM {table}
+                GROUP BY b
+                HAVING ? = 'day' OR b >= ?
+            """, (granularity, event, granularity, hourly_since))
+    
+    # Дневные бакеты до границы архивации остаются: этих транзакций уже нет в таблице
+    cursor.execute("SELECT archived_before FROM archive_state WHERE table_name = 'transactions'")
+    row = cursor.fetchone()
+    archived_before = row[0] if row and row[0] else ''
+    cursor.execute("DELETE FROM stats_tx_buckets WHERE granularity = 'hour' OR bucket >= ?", (archived_before,))
+    for granularity, expr in (('day', _STATS_DAY_EXPR), ('hour', _STATS_HOUR_EXPR)):
+        bucket = expr.format(ts='created_at')
+        cursor.execute(f"""
+            INSERT INTO stats_tx_buckets (granularity, bucket, type, status, method, cnt, amount, debit_cnt, debit_amount)
+            SELECT ?, {bucket} AS b, COALESCE(type, ''), COALESCE(status, ''), COALESCE(payment_method, ''),
+                   COUNT(*), COALESCE(SUM(amount), 0),
+                   SUM(COALESCE(amount, 0) < 0),
+                   COALESCE(SUM(CASE WHEN amount < 0 THEN -amount ELSE 0 END), 0)
+            FROM transactions
+            GROUP BY b, COALESCE(type, ''), COALESCE(status, ''), COALESCE(payment_method, '')
+            HAVING (? = 'day' OR b >= ?) AND b >= ?
+        """, (granularity, granularity, hourly_since, archived_before))
+    
+    _recompute_stats_counters(cursor)
+    
+    cursor.execute("SELECT COUNT(*) FROM stats_event_buckets")
+    event_buckets = cursor.fetchone()[0]
+    cursor.execute("SELECT COUNT(*) FROM stats_tx_buckets")
+    tx_buckets = cursor.fetchone()[0]
+    return {'event_buckets': event_buckets, 'tx_buckets': tx_buckets}
+
+
+def rebuild_stats_rollups() -> Dict[str, int]:
+    """Полностью пересчитать роллапы статистики из истории (backfill)"""
+    with transaction() as conn:
+        result = _rebuild_stats_rollups(conn.cursor())
+    logger.info(f"Роллапы статистики пересчитаны: {result}")
+    return result
+
+
+def compact_stats_rollups() -> Dict[str, int]:
+    """
+    Периодическое обслуживание роллапов: удаление часовых бакетов старше
+    STATS_HOURLY_RETENTION_DAYS и пустых бакетов. Счетчики stats_counters
+    ведут триггеры; полный пересчет (сканирование users, vpn_keys и tickets)
+    выполняется только в rebuild_stats_rollups (manage stats backfill),
+    чтобы не держать блокировку записи на время сканирования каждый час.
+    """
+    cutoff = (datetime.utcnow() - timedelta(days=STATS_HOURLY_RETENTION_DAYS)).strftime('%Y-%m-%d %H:00')
+    with transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM stats_event_buckets WHERE granularity = 'hour' AND bucket < ?", (cutoff,))
+        pruned = cursor.rowcount
+        cursor.execute("DELETE FROM stats_tx_buckets WHERE granularity = 'hour' AND bucket < ?", (cutoff,))
+        pruned += cursor.rowcount
+        # Пустые бакеты, оставшиеся после смены статуса транзакций
+        cursor.execute("DELETE FROM stats_tx_buckets WHERE cnt = 0 AND debit_cnt = 0 AND ABS(amount) < 0.000001")
+        pruned += cursor.rowcount
+    return {'pruned_buckets': pruned}
+
+
+# ========== Полнотекстовый поиск ==========
+
+# Виды документов индекса; rowid документа = id строки * SEARCH_KIND_SLOTS + код вида,
+# поэтому триггеры удаляют и заменяют документ по rowid без сканирования индекса
+SEARCH_KINDS = {
+    'user': 1,
+    'key': 2,
+    'transaction': 3,
+    'ticket': 4,
+    'ticket_message': 5,
+}
+SEARCH_KIND_SLOTS = 8
+
+# Источник документов: (таблица, колонки, на изменение которых реагирует триггер,
+# выражение заголовка, выражение текста). Заголовок весит больше при ранжировании.
+_SEARCH_SOURCES = {
+    'user': (
+        'users', ('username', 'full_name', 'telegram_id', 'referral_code'),
+        "COALESCE({r}.username, '') || ' ' || COALESCE({r}.full_name, '')",
+        "COALESCE({r}.telegram_id, '') || ' ' || COALESCE({r}.referral_code, '')",
+    ),
+    'key': (
+        'vpn_keys', ('key_uuid', 'key_config'),
+        "COALESCE({r}.key_uuid, '')",
+        "COALESCE({r}.key_config, '')",
+    ),
+    'transaction': (
+        'transactions', ('payment_id', 'hash'),
+        "COALESCE({r}.payment_id, '')",
+        "COALESCE({r}.hash, '')",
+    ),
+    'ticket': (
+        'tickets', ('user_id',),
+        "COALESCE((SELECT username FROM users WHERE id = {r}.user_id), '')",
+        "COALESCE((SELECT telegram_id FROM users WHERE id = {r}.user_id), '')",
+    ),
+    'ticket_message': (
+        'ticket_messages', ('message_text',),
+        "''",
+        "COALESCE({r}.message_text, '')",
+    ),
+}
+
+
+def _create_search_index(cursor) -> bool:
+    """Создать FTS5-индекс и триггеры; False, если SQLite собран без FTS5"""
+    try:
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+                title, body,
+                tokenize = 'unicode61 remove_diacritics 2',
+                prefix = '2 3'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        logger.warning(f"FTS5 недоступен, поиск в панели отключен: {e}")
+        return False
+
+    for kind, (table, columns, title, body) in _SEARCH_SOURCES.items():
+        code = SEARCH_KINDS[kind]
+        insert = f"""
+            INSERT INTO search_index (rowid, title, body)
+            VALUES (NEW.id * {SEARCH_KIND_SLOTS} + {code}, {title.format(r='NEW')}, {body.format(r='NEW')});
+        """
+        delete = f"DELETE FROM search_index WHERE rowid = OLD.id * {SEARCH_KIND_SLOTS} + {code};"
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_search_{kind}_insert AFTER INSERT ON {table}
+            BEGIN {insert} END
+        """)
+        changed = ' OR '.join(f"OLD.{column} IS NOT NEW.{column}" for column in columns)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_search_{kind}_update AFTER UPDATE OF {', '.join(columns)} ON {table}
+            WHEN {changed}
+            BEGIN {delete} {insert} END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_search_{kind}_delete AFTER DELETE ON {table}
+            BEGIN {delete} END
+        """)
+
+    # Смена username или telegram_id меняет документы тикетов пользователя
+    ticket = SEARCH_KINDS['ticket']
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_search_ticket_user_update AFTER UPDATE OF username, telegram_id ON users
+        WHEN OLD.username IS NOT NEW.username OR OLD.telegram_id IS NOT NEW.telegram_id
+        BEGIN
+            DELETE FROM search_index
+            WHERE rowid IN (SELECT id * {SEARCH_KIND_SLOTS} + {ticket} FROM tickets WHERE user_id = NEW.id);
+            INSERT INTO search_index (rowid, title, body)
+            SELECT id * {SEARCH_KIND_SLOTS} + {ticket}, COALESCE(NEW.username, ''), COALESCE(NEW.telegram_id, '')
+            FROM tickets WHERE user_id = NEW.id;
+        END
+    """)
+    return True
+
+
+def _rebuild_search_index(cursor) -> Dict[str, int]:
+    """Заново заполнить поисковый индекс из таблиц"""
+    cursor.execute("DELETE FROM search_index")
+    counts = {}
+    for kind, (table, _, title, body) in _SEARCH_SOURCES.items():
+        cursor.execute(f"""
+            INSERT INTO search_index (rowid, title, body)
+            SELECT t.id * {SEARCH_KIND_SLOTS} + {SEARCH_KINDS[kind]}, {title.format(r='t')}, {body.format(r='t')}
+            FROM {table} t
+        """)
+        counts[kind] = cursor.rowcount
+    cursor.execute("INSERT INTO search_index (search_index) VALUES ('optimize')")
+    return counts
+
+
+def rebuild_search_index() -> Dict[str, int]:
+    """Полностью перестроить поисковый индекс панели"""
+    with transaction() as conn:
+        result = _rebuild_search_index(conn.cursor())
+    logger.info(f"Поисковый индекс перестроен: {result}")
+    return result
+
+
+def optimize_search_index() -> Dict[str, Any]:
+    """Слить сегменты FTS5-индекса (ускоряет запросы после массовых вставок)"""
+    with transaction() as conn:
+        conn.execute("INSERT INTO search_index (search_index) VALUES ('optimize')")
+    return {'optimized': True}
+
+
+# ========== Состояние синхронизаций ==========
+
+def get_sync_state(name: str) -> Optional[Dict[str, Any]]:
+    """Водяной знак и детали последнего запуска синхронизации"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT name, watermark, last_run_at, details FROM sync_state WHERE name = ?", (name,))
+        row = cursor.fetchone()
+    if not row:
+        return None
+    state = dict(row)
+    state['details'] = json.loads(state['details']) if state['details'] else {}
+    return state
+
+
+def set_sync_state(name: str, watermark: Optional[str], details: Dict[str, Any] = None):
+    """Сохранить водяной знак и детали запуска синхронизации"""
+    with transaction() as conn:
+        conn.execute("""
+            INSERT INTO sync_state (name, watermark, last_run_at, details)
+            VALUES (?, ?, CURRENT_TIMESTAMP, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                watermark = excluded.watermark,
+                last_run_at = excluded.last_run_at,
+                details = excluded.details
+        """, (name, watermark, json.dumps(details or {}, ensure_ascii=False, default=str)))
+
+
+# ========== Загрузка пользователя для мини-приложения и бота ==========
+
+BOOTSTRAP_BAN_REASON = 'Превышен лимит забаненных ключей (3+)'
+
+def _select_bootstrap_row(cursor, telegram_id: int) -> Optional[Dict[str, Any]]:
+    """Пользователь вместе со статистикой рефералов одним запросом"""
+    cursor.execute("""
+        SELECT u.*,
+               COALESCE(ra.referrals_count, 0) AS referrals_count,
+               COALESCE(ra.referrals_spent, 0) AS referrals_spent
+        FROM users u
+        LEFT JOIN referral_aggregates ra ON ra.referrer_id = u.id
+        WHERE u.telegram_id = ?
+    """, (telegram_id,))
+    row = cursor.fetchone()
+    return dict(row) if row else None
+
+
+def bootstrap_user(telegram_id: int, username: str = None, full_name: str = None,
+                   referrer_telegram_id: int = None, referral_limit: int = 25,
+                   referral_window_seconds: int = 60, max_banned_keys: int = 3) -> Dict[str, Any]:
+    """
+    Получить или зарегистрировать пользователя за один проход.
+    
+    Для существующего пользователя, которому нечего обновлять, выполняется один SELECT.
+    Иначе в одной транзакции: создание пользователя, привязка реферера (с рейт-лимитом),
+    сохранение имени, проверка бана по числу забаненных ключей и итоговый SELECT.
+    
+    Args:
+        telegram_id: Telegram ID пользователя
+        username: Username (используется только при создании)
+        full_name: Имя из Telegram (сохраняется, если еще не задано)
+        referrer_telegram_id: Telegram ID пригласившего
+        referral_limit: Максимум рефералов у одного реферера за окно
+        referral_window_seconds: Окно рейт-лимита в секундах
+        max_banned_keys: Число забаненных ключей, после которого аккаунт блокируется
+        
+    Returns:
+        Dict с полями пользователя и referrals_count, referrals_spent,
+        is_new_user, referral_applied, newly_banned
+    """
+    if referrer_telegram_id == telegram_id:
+        referrer_telegram_id = None
+    
+    with db_connection() as conn:
+        user = _select_bootstrap_row(conn.cursor(), telegram_id)
+    
+    if user is not None:
+        needs_referral = bool(referrer_telegram_id) and user['referred_by'] is None
+        needs_name = bool(full_name) and not user.get('full_name')
+        needs_ban = (user['banned_keys_count'] or 0) >= max_banned_keys and not user['is_banned']
+        if not (needs_referral or needs_name or needs_ban):
+            user.update(is_new_user=False, referral_applied=False, newly_banned=False)
+            return user
+    
+    with transaction() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute("""
+            INSERT OR IGNORE INTO users (telegram_id, username, full_name, referral_code)
+            VALUES (?, ?, ?, ?)
+        """, (telegram_id, username, full_name, f"REF{telegram_id}"))
+        is_new_user = cursor.rowcount == 1
+        
+        referral_applied = False
+        if referrer_telegram_id:
+            # Рейт-лимит: не более referral_limit новых рефералов за окно
+            cursor.execute("""
+                UPDATE users
+                SET referred_by = (SELECT id FROM users WHERE telegram_id = :ref),
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE telegram_id = :tid
+                  AND referred_by IS NULL
+                  AND EXISTS (SELECT 1 FROM users WHERE telegram_id = :ref)
+                  AND (
+                      SELECT COUNT(*) FROM users
+                      WHERE referred_by = (SELECT id FROM users WHERE telegram_id = :ref)
+                        AND registration_date > datetime('now', :window)
+                  ) < :limit
+            """, {
+                'ref': referrer_telegram_id,
+                'tid': telegram_id,
+                'window': f'-{int(referral_window_seconds)} seconds',
+                'limit': referral_limit,
+            })
+            referral_applied = cursor.rowcount == 1
+            if referral_applied:
+                logger.info(f"Referral accepted: user {telegram_id} referred by {referrer_telegram_id}")
+            else:
+                logger.info(f"Referral for {telegram_id} from {referrer_telegram_id} not applied (already set, unknown referrer or rate limit)")
+        
+        if full_name and not is_new_user:
+            cursor.execute("""
+                UPDATE users SET full_name = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE telegram_id = ? AND (full_name IS NULL OR full_name = '')
+            """, (full_name, telegram_id))
+        
+        cursor.execute("""
+            UPDATE users
+            SET is_banned = 1, ban_reason = ?
+            WHERE telegram_id = ? AND banned_keys_count >= ? AND is_banned = 0
+        """, (BOOTSTRAP_BAN_REASON, telegram_id, max_banned_keys))
+        newly_banned = cursor.rowcount == 1
+        
+        user = _select_bootstrap_row(cursor, telegram_id)
+    
+    user.update(is_new_user=is_new_user, referral_applied=referral_applied, newly_banned=newly_banned)
+    return user
+
+
 # Инициализация при импорте
 if __name__ != "__main__":
     init_database()
@@ -0,0 +1,165 @@
+"""
+Потоковая выгрузка таблиц панели в CSV / NDJSON
+
+Строки читаются одним запросом через fetchmany(EXPORT_BATCH_SIZE) и сразу
+отдаются клиенту кусками, поэтому память не зависит от размера таблицы:
+в процессе одновременно находится только одна пачка строк. Запрос идет по
+индексам (created_at, id), в режиме WAL читающий запрос не блокирует запись.
+Сжатие gzip - потоковое (zlib.compressobj), результат - файл .gz.
+
+Бенчмарк на синтетической таблице transactions - backend/database/export_bench.py.
+"""
+import io
+import os
+import csv
+import json
+import zlib
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Tuple
+from backend.database import database, pagination
+
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '2000'))
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+# Выгрузка -> запрос без WHERE/ORDER BY, колонка даты для date_from/date_to, фильтры (аргумент -> колонка)
+EXPORTS: Dict[str, Dict[str, Any]] = {
+    'users': {
+        'sql': """
+            SELECT id, telegram_id, username, full_name, balance, status, paid_until, referral_code, referred_by,
+                   is_partner, partner_rate, partner_balance, total_earned, trial_used, is_banned, ban_reason,
+                   created_at
+            FROM users
+        """,
+        'date_column': 'created_at',
+        'order': ('created_at', 'id'),
+        'filters': {'status': ('status', str), 'is_banned': ('is_banned', int), 'is_partner': ('is_partner', int)},
+    },
+    'keys': {
+        'sql': """
+            SELECT vk.id, vk.user_id, u.telegram_id, u.username, vk.key_uuid, vk.key_config, vk.status,
+                   vk.expiry_date, vk.traffic_used, vk.traffic_limit, vk.devices_limit, vk.server_location,
+                   vk.created_at
+            FROM vpn_keys vk
+            LEFT JOIN users u ON vk.user_id = u.id
+        """,
+        'date_column': 'vk.created_at',
+        'order': ('vk.created_at', 'vk.id'),
+        'filters': {'status': ('vk.status', str), 'user_id': ('vk.user_id', int)},
+    },
+    'transactions': {
+        'sql': """
+            SELECT t.id, t.user_id, u.telegram_id, u.username, t.type, t.amount, t.status, t.payment_method,
+                   t.payment_provider, t.payment_id, t.description, t.hash, t.created_at
+            FROM transactions t
+            LEFT JOIN users u ON t.user_id = u.id
+        """,
+        'date_column': 't.created_at',
+        'order': ('t.created_at', 't.id'),
+        'filters': {
+            'status': ('t.status', str),
+            'type': ('t.type', str),
+            'provider': ('t.payment_provider', str),
+            'user_id': ('t.user_id', int),
+        },
+    },
+}
+
+
+def build_query(name: str, args: Dict[str, Any]) -> Tuple[str, List[Any]]:
+    """
+    SQL выгрузки с фильтрами из аргументов запроса.
+
+    Args:
+        name: Выгрузка ('users', 'keys', 'transactions')
+        args: Аргументы запроса: фильтры выгрузки, date_from, date_to (YYYY-MM-DD)
+
+    Returns:
+        (sql, параметры); ValueError при неизвестной выгрузке или неверном фильтре
+    """
+    spec = EXPORTS.get(name)
+    if spec is None:
+        raise ValueError(f"Unknown export: {name}")
+    conditions, params = [], []
+    for arg, (column, cast) in spec['filters'].items():
+        value = args.get(arg)
+        if value not in (None, ''):
+            try:
+                params.append(cast(value))
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid {arg}: {value}")
+            conditions.append(f"{column} = ?")
+    date_conditions, date_params = pagination.date_range(spec['date_column'], args.get('date_from'), args.get('date_to'))
+    conditions += date_conditions
+    params += date_params
+
+    sql = spec['sql']
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY " + ", ".join(spec['order'])
+    return sql, params
+
+
+def _encode_batches(batches: Iterator[Tuple[List[str], List[Any]]], fmt: str) -> Iterator[bytes]:
+    """Пачки строк -> куски CSV (с заголовком) или NDJSON"""
+    header_written = False
+    for columns, rows in batches:
+        buffer = io.StringIO()
+        if fmt == 'csv':
+            writer = csv.writer(buffer)
+            if not header_written:
+                writer.writerow(columns)
+                header_written = True
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str))
+                buffer.write('\n')
+        yield buffer.getvalue().encode('utf-8')
+
+
+def _gzip(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    """Потоковое сжатие gzip"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _fetch_batches(sql: str, params: List[Any], batch_size: int) -> Iterator[Tuple[List[str], List[Any]]]:
+    """Строки запроса пачками по batch_size; соединение возвращается в пул по окончании или обрыве"""
+    with database.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        columns = [description[0] for description in cursor.description]
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield columns, rows
+        finally:
+            cursor.close()
+
+
+def stream_export(name: str, args: Dict[str, Any], fmt: str = 'csv', gzip: bool = False,
+                  batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[bytes]:
+    """
+    Генератор кусков выгрузки для потокового ответа.
+
+    Фильтры проверяются сразу (ValueError до первого куска), строки читаются
+    по мере того, как клиент забирает ответ.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format: {fmt}")
+    sql, params = build_query(name, args)
+    chunks = _encode_batches(_fetch_batches(sql, params, batch_size), fmt)
+    return _gzip(chunks) if gzip else chunks
+
+
+def export_filename(name: str, fmt: str, gzip: bool = False) -> str:
+    return f"blinvpn_{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}{'.gz' if gzip else ''}"
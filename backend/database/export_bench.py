@@ -0,0 +1,79 @@
+"""
+Бенчмарк потоковой выгрузки на синтетической таблице transactions (строки/с и пик памяти)
+
+    python -m backend.database.export_bench --db /tmp/export_bench.db --rows 1000000 --format csv --gzip
+    python -m backend.database.export_bench --db /tmp/export_bench.db --format ndjson --trace-memory
+
+Бенчмарк пишет синтетические строки, поэтому работает только с отдельным файлом БД (--db).
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+
+def run(rows: int, fmt: str, gzip: bool, batch_size: int, trace_memory: bool = False) -> Dict[str, Any]:
+    """Выгрузить transactions из rows синтетических строк и замерить строки/с (и пик памяти Python)"""
+    from backend.database import database, export
+    with database.transaction() as conn:
+        existing = conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+        if existing < rows:
+            conn.execute("INSERT OR IGNORE INTO users (id, telegram_id, username) VALUES (1, 1, 'benchmark')")
+            conn.execute("""
+                WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?)
+                INSERT INTO transactions (user_id, type, amount, status, payment_method, payment_provider,
+                                          payment_id, description, created_at)
+                SELECT 1, CASE i % 3 WHEN 0 THEN 'deposit' WHEN 1 THEN 'purchase' ELSE 'withdraw' END,
+                       (i % 1000) + 0.5, 'Success', 'SBP', 'yookassa', 'pay_' || i, 'Benchmark row ' || i,
+                       datetime('2025-01-01', '+' || (i % 365) || ' days', '+' || (i % 86400) || ' seconds')
+                FROM n
+            """, (rows - existing,))
+
+    if trace_memory:
+        tracemalloc.start()
+    started = time.monotonic()
+    total_bytes = 0
+    for chunk in export.stream_export('transactions', {}, fmt, gzip, batch_size):
+        total_bytes += len(chunk)
+    elapsed = time.monotonic() - started
+    peak = None
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    with database.db_connection() as conn:
+        exported = conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+    return {
+        'rows': exported,
+        'seconds': round(elapsed, 2),
+        'rows_per_second': int(exported / elapsed) if elapsed else None,
+        'output_bytes': total_bytes,
+        'peak_memory_bytes': peak,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m backend.database.export_bench',
+                                     description="Бенчмарк потоковой выгрузки transactions")
+    parser.add_argument('--db', required=True, help="Отдельный файл БД для бенчмарка (не рабочая БД)")
+    parser.add_argument('--rows', type=int, default=1_000_000, help="Строк в transactions (недостающие добавляются)")
+    parser.add_argument('--format', choices=['csv', 'ndjson'], default='csv')
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('--batch-size', type=int, help="EXPORT_BATCH_SIZE")
+    parser.add_argument('--trace-memory', action='store_true', help="Пик памяти через tracemalloc (замедляет выгрузку)")
+    args = parser.parse_args(argv)
+    # БД задается до импорта database: импорт выполняет init_database() по DB_PATH
+    os.environ['DB_PATH'] = args.db
+    from backend.database import database, export
+    database.DB_PATH = args.db
+    database.init_database()
+
+    report = run(args.rows, args.format, args.gzip, args.batch_size or export.EXPORT_BATCH_SIZE, args.trace_memory)
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
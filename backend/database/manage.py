@@ -0,0 +1,129 @@
+"""
+Служебные команды для обслуживания базы данных
+
+Запуск:
+    python -m backend.database.manage referrals verify
+    python -m backend.database.manage referrals rebuild
+    python -m backend.database.manage stats backfill
+    python -m backend.database.manage stats compact
+    python -m backend.database.manage search rebuild
+    python -m backend.database.manage search bench
+    python -m backend.database.manage archive status
+    python -m backend.database.manage archive run
+    python -m backend.database.manage schema status
+    python -m backend.database.manage schema migrate
+"""
+import argparse
+import json
+import logging
+import sys
+
+from backend.database import database
+
+logger = logging.getLogger(__name__)
+
+
+def cmd_referrals(args) -> int:
+    """Сверка или пересчет агрегатов рефералов"""
+    if args.action == 'rebuild':
+        result = database.rebuild_referral_aggregates()
+        print(json.dumps(result, ensure_ascii=False))
+        return 0
+
+    result = database.verify_referral_aggregates()
+    print(json.dumps(result, ensure_ascii=False, indent=2, default=str))
+    if not result['ok'] and args.fix:
+        print(json.dumps(database.rebuild_referral_aggregates(), ensure_ascii=False))
+        return 0
+    return 0 if result['ok'] else 1
+
+
+def cmd_stats(args) -> int:
+    """Построение роллапов статистики из истории или их обслуживание"""
+    if args.action == 'backfill':
+        result = database.rebuild_stats_rollups()
+    else:
+        result = database.compact_stats_rollups()
+    print(json.dumps(result, ensure_ascii=False))
+    return 0
+
+
+def cmd_search(args) -> int:
+    """Обслуживание полнотекстового индекса и замер задержек поиска"""
+    if args.action == 'rebuild':
+        result = database.rebuild_search_index()
+    elif args.action == 'optimize':
+        result = database.optimize_search_index()
+    else:
+        from backend.database import search
+        queries = args.query or search.sample_queries(args.samples)
+        result = search.benchmark(queries, repeat=args.repeat)
+    print(json.dumps(result, ensure_ascii=False))
+    return 0
+
+
+def cmd_archive(args) -> int:
+    """Перенос старых строк в архивные партиции по месяцам или их состояние"""
+    from backend.database import archive
+    if args.action == 'run':
+        if args.table:
+            result = archive.archive_table(args.table, args.before)
+        else:
+            result = {table: archive.archive_table(table, args.before) for table in archive.ARCHIVE_TABLES}
+    else:
+        result = archive.get_status()
+    print(json.dumps(result, ensure_ascii=False, indent=2, default=str))
+    return 0
+
+
+def cmd_schema(args) -> int:
+    """Версия схемы или применение непримененных миграций"""
+    from backend.database import migrations
+    if args.action == 'migrate':
+        with database._init_lock():
+            applied = migrations.migrate(args.target)
+        print(json.dumps({'applied': applied, 'version': migrations.current_version()}, ensure_ascii=False))
+        return 0
+    result = migrations.status()
+    print(json.dumps(result, ensure_ascii=False, indent=2, default=str))
+    return 0 if not result['pending'] else 1
+
+
+def main(argv=None) -> int:
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(prog='python -m backend.database.manage')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    referrals = subparsers.add_parser('referrals', help='Агрегаты рефералов')
+    referrals.add_argument('action', choices=['verify', 'rebuild'])
+    referrals.add_argument('--fix', action='store_true', help='Пересчитать при обнаружении расхождений')
+    referrals.set_defaults(func=cmd_referrals)
+
+    stats = subparsers.add_parser('stats', help='Роллапы статистики для дашбордов')
+    stats.add_argument('action', choices=['backfill', 'compact'])
+    stats.set_defaults(func=cmd_stats)
+
+    search = subparsers.add_parser('search', help='Полнотекстовый поиск панели')
+    search.add_argument('action', choices=['rebuild', 'optimize', 'bench'])
+    search.add_argument('--query', action='append', help='Запрос для bench (можно несколько)')
+    search.add_argument('--samples', type=int, default=50, help='Число запросов из данных БД для bench')
+    search.add_argument('--repeat', type=int, default=3)
+    search.set_defaults(func=cmd_search)
+
+    archive = subparsers.add_parser('archive', help='Архивация старых строк по месяцам')
+    archive.add_argument('action', choices=['run', 'status'])
+    archive.add_argument('--table', choices=['transactions', 'traffic_stats', 'ticket_messages'])
+    archive.add_argument('--before', help='Граница YYYY-MM-DD (по умолчанию ARCHIVE_AFTER_MONTHS назад)')
+    archive.set_defaults(func=cmd_archive)
+
+    schema = subparsers.add_parser('schema', help='Версионированные миграции схемы')
+    schema.add_argument('action', choices=['status', 'migrate'])
+    schema.add_argument('--target', type=int, help='Применить миграции до этой версии включительно')
+    schema.set_defaults(func=cmd_schema)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
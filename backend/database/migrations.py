@@ -0,0 +1,187 @@
+"""
+Версионированные миграции схемы БД
+
+Примененные миграции записываются в schema_version. При старте процесса
+init_database() только читает MAX(version) и, если схема актуальна, больше
+ничего не делает: без DDL и без блокировки записи. Миграции выполняются один
+раз при деплое (сервис migrate в docker-compose):
+
+    python -m backend.database.manage schema migrate
+    python -m backend.database.manage schema status
+
+Миграция 1 (baseline) - прежняя инициализация _init_schema: она идемпотентна
+(IF NOT EXISTS, ALTER TABLE с проверкой), поэтому применяется и к новым, и к
+уже существующим базам. Новые изменения схемы добавляются только новыми
+миграциями в конец MIGRATIONS, а не в _init_schema.
+
+Индексы создаются через ensure_index(): если в таблице уже есть индекс,
+начинающийся с тех же колонок, новый не создается (лишний индекс замедляет
+запись и не ускоряет чтение). После миграций с индексами выполняется ANALYZE,
+чтобы планировщик запросов сразу их учитывал.
+"""
+import time
+import logging
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence
+from backend.database import database
+
+logger = logging.getLogger(__name__)
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[Any], None]
+    transactional: bool = True  # False - миграция сама управляет транзакциями (baseline)
+    analyze: bool = False
+
+
+def _covering_index(cursor, table: str, columns: Sequence[str]) -> Optional[str]:
+    """Имя существующего индекса таблицы, чьи первые колонки совпадают с columns"""
+    for index in cursor.execute(f"PRAGMA index_list({table})").fetchall():
+        index_columns = [row['name'] for row in cursor.execute(f"PRAGMA index_info({index['name']})").fetchall()]
+        if index_columns[:len(columns)] == list(columns):
+            return index['name']
+    return None
+
+
+def ensure_index(cursor, name: str, table: str, columns: Sequence[str]) -> bool:
+    """Создать индекс, если его колонки не покрыты существующим; True, если индекс создан"""
+    existing = _covering_index(cursor, table, columns)
+    if existing:
+        logger.info(f"Index {name} skipped: {table}({', '.join(columns)}) is covered by {existing}")
+        return False
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table}({', '.join(columns)})")
+    return True
+
+
+def _baseline(cursor):
+    database._init_schema()
+
+
+def _hot_path_indexes(cursor):
+    # Поиск платежа по провайдеру и id в webhook'ах и сверке
+    ensure_index(cursor, 'idx_transactions_provider_payment', 'transactions', ['payment_provider', 'payment_id'])
+    # Финансовая статистика и списки по типу и статусу за период
+    ensure_index(cursor, 'idx_transactions_type_status_created', 'transactions', ['type', 'status', 'created_at'])
+    # Рефералы пользователя по дате регистрации
+    ensure_index(cursor, 'idx_users_referred_by', 'users', ['referred_by', 'registration_date'])
+    ensure_index(cursor, 'idx_vpn_keys_created', 'vpn_keys', ['created_at'])
+    # Сообщения из топиков поддержки -> тикет
+    ensure_index(cursor, 'idx_tickets_topic', 'tickets', ['telegram_topic_id'])
+    # Устройства пользователя по ключу
+    ensure_index(cursor, 'idx_devices_user_key', 'devices', ['user_id', 'vpn_key_id'])
+
+
+def _mass_action_resume(cursor):
+    # Позиция и пульс массового действия: после перезапуска воркера оно продолжается с last_id
+    cursor.execute("ALTER TABLE mass_actions ADD COLUMN last_id INTEGER DEFAULT 0")
+    cursor.execute("ALTER TABLE mass_actions ADD COLUMN remnawave_last_id INTEGER DEFAULT 0")
+    cursor.execute("ALTER TABLE mass_actions ADD COLUMN heartbeat_at TIMESTAMP")
+    # Список пользователей действия (раньше - временная таблица соединения, терялась с процессом)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS mass_action_targets (
+            action_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (action_id, user_id)
+        ) WITHOUT ROWID
+    """)
+
+
+def _mailing_recipient_locks(cursor):
+    # Получатели забранной пачки помечаются 'sending' до locked_until: другой процесс
+    # не отправит их повторно, пока отправка пачки ждет паузу 429
+    cursor.execute("ALTER TABLE mailing_recipients ADD COLUMN locked_until REAL DEFAULT 0")
+
+
+def _notification_outbox_locks(cursor):
+    # Забранные головы очереди помечаются 'sending' до locked_until (см. mailing_recipient_locks)
+    cursor.execute("ALTER TABLE notification_outbox ADD COLUMN locked_until REAL DEFAULT 0")
+    # Голова чата выбирается среди неотправленных и отправляемых сообщений
+    cursor.execute("DROP INDEX IF EXISTS idx_notification_outbox_pending")
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_notification_outbox_active
+        ON notification_outbox(chat_id, id) WHERE status IN ('pending', 'sending')
+    """)
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, 'baseline', _baseline, transactional=False),
+    Migration(2, 'hot_path_indexes', _hot_path_indexes, analyze=True),
+    Migration(3, 'mass_action_resume', _mass_action_resume),
+    Migration(4, 'mailing_recipient_locks', _mailing_recipient_locks),
+    Migration(5, 'notification_outbox_locks', _notification_outbox_locks),
+]
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def current_version() -> int:
+    """Версия схемы БД (0 - БД создана до миграций или пустая); только чтение"""
+    with database.db_connection() as conn:
+        try:
+            row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+        except database.sqlite3.OperationalError:
+            return 0
+    return row[0] or 0
+
+
+def pending() -> List[Migration]:
+    version = current_version()
+    return [migration for migration in MIGRATIONS if migration.version > version]
+
+
+def migrate(target: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Применить непримененные миграции по порядку (до target включительно).
+    Вызывающий держит межпроцессную блокировку (database._init_lock).
+
+    Returns:
+        Примененные миграции с длительностью
+    """
+    with database.transaction() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                duration_ms INTEGER,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+    applied = []
+    for migration in pending():
+        if target is not None and migration.version > target:
+            break
+        started = time.monotonic()
+        if migration.transactional:
+            with database.transaction() as conn:
+                migration.apply(conn.cursor())
+                duration_ms = int((time.monotonic() - started) * 1000)
+                conn.execute("INSERT INTO schema_version (version, name, duration_ms) VALUES (?, ?, ?)",
+                             (migration.version, migration.name, duration_ms))
+        else:
+            migration.apply(None)
+            duration_ms = int((time.monotonic() - started) * 1000)
+            with database.transaction() as conn:
+                conn.execute("INSERT INTO schema_version (version, name, duration_ms) VALUES (?, ?, ?)",
+                             (migration.version, migration.name, duration_ms))
+        if migration.analyze:
+            with database.db_connection() as conn:
+                conn.execute("ANALYZE")
+        logger.info(f"Миграция {migration.version} ({migration.name}) применена за {duration_ms} мс")
+        applied.append({'version': migration.version, 'name': migration.name, 'duration_ms': duration_ms})
+    return applied
+
+
+def status() -> Dict[str, Any]:
+    """Текущая версия, примененные и ожидающие миграции"""
+    history = []
+    with database.db_connection() as conn:
+        try:
+            history = [dict(row) for row in conn.execute("SELECT * FROM schema_version ORDER BY version")]
+        except database.sqlite3.OperationalError:
+            pass
+    return {
+        'version': history[-1]['version'] if history else 0,
+        'latest': LATEST_VERSION,
+        'applied': history,
+        'pending': [{'version': m.version, 'name': m.name} for m in pending()],
+    }
@@ -0,0 +1,135 @@
+"""
+Курсорная (keyset) пагинация для списков панели
+
+Вместо LIMIT/OFFSET следующая страница выбирается условием
+(ключ сортировки, id) < (значения последней строки), поэтому при наличии
+составного индекса по тем же колонкам время ответа не зависит от глубины.
+Курсор непрозрачен для клиента: это base64 от JSON со значениями ключа.
+"""
+import json
+import base64
+from datetime import date, timedelta
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    """Курсор из значений ключа сортировки последней строки"""
+    raw = json.dumps(list(values), separators=(',', ':'), default=str).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, size: int) -> List[Any]:
+    """Значения ключа из курсора; ValueError, если курсор поврежден"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def page_size(value: Optional[int]) -> int:
+    """Размер страницы в допустимых пределах"""
+    if not value or value < 1:
+        return DEFAULT_PAGE_SIZE
+    return min(value, MAX_PAGE_SIZE)
+
+
+def date_range(column: str, date_from: Optional[str], date_to: Optional[str]) -> Tuple[List[str], List[Any]]:
+    """
+    Условия диапазона дат для колонки с датой/временем в формате SQLite.
+
+    Args:
+        date_from: Начальная дата YYYY-MM-DD включительно
+        date_to: Конечная дата YYYY-MM-DD включительно
+
+    Returns:
+        (условия, параметры); ValueError при неверной дате
+    """
+    conditions = []
+    params = []
+    if date_from:
+        conditions.append(f"{column} >= ?")
+        params.append(date.fromisoformat(date_from).isoformat())
+    if date_to:
+        # Сравнение строк: все время последнего дня меньше следующей даты
+        conditions.append(f"{column} < ?")
+        params.append((date.fromisoformat(date_to) + timedelta(days=1)).isoformat())
+    return conditions, params
+
+
+def _select(cursor, select_sql: str, expressions: Sequence[str], conditions: List[str],
+            params: List[Any], limit: int, offset: int = 0) -> List[Dict[str, Any]]:
+    sql = select_sql
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY " + ", ".join(f"{expression} DESC" for expression in expressions)
+    sql += " LIMIT ? OFFSET ?"
+    cursor.execute(sql, list(params) + [limit, offset])
+    return [dict(row) for row in cursor.fetchall()]
+
+
+def fetch_page(cursor, select_sql: str, order: Sequence[Tuple[str, str]],
+               conditions: List[str], params: List[Any],
+               after: Optional[str], limit: int, offset: int = 0) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Выбрать страницу по убыванию ключа сортировки.
+
+    Первый ключ может быть NULL (например, created_at у старых строк): такие
+    строки идут в конце списка, как в ORDER BY ... DESC у SQLite, и между собой
+    упорядочены по остальным ключам. Остальные ключи NULL быть не должны.
+
+    Args:
+        cursor: Курсор БД
+        select_sql: SELECT ... FROM ... [JOIN ...] без WHERE, ORDER BY и LIMIT
+        order: Пары (выражение SQL, имя колонки в результате); последняя пара -
+               уникальный id, выбранные колонки должны входить в SELECT
+        conditions: Условия фильтров (объединяются через AND)
+        params: Параметры условий
+        after: Курсор предыдущей страницы (None - первая страница)
+        limit: Размер страницы
+        offset: Смещение для старых клиентов без курсора (глубокие страницы медленные)
+
+    Returns:
+        (строки, курсор следующей страницы или None, если страница последняя)
+    """
+    expressions = [expression for expression, _ in order]
+    first, rest = expressions[0], expressions[1:]
+    rest_tuple = f"({', '.join(rest)})"
+    # Одна лишняя строка показывает, есть ли следующая страница
+    if not after:
+        rows = _select(cursor, select_sql, expressions, conditions, params, limit + 1, offset)
+    else:
+        values = decode_cursor(after, len(order))
+        if values[0] is None:
+            # Курсор уже в хвосте строк с NULL первым ключом: дальше только по остальным ключам
+            rows = _select(
+                cursor, select_sql, rest,
+                list(conditions) + [f"{first} IS NULL", f"{rest_tuple} < ({', '.join('?' * len(rest))})"],
+                list(params) + values[1:], limit + 1
+            )
+        else:
+            # Отдельное условие на первый ключ дает диапазон по индексу и для индексов по выражению
+            rows = _select(
+                cursor, select_sql, expressions,
+                list(conditions) + [f"{first} <= ?", f"({', '.join(expressions)}) < ({', '.join('?' * len(values))})"],
+                list(params) + [values[0]] + values, limit + 1
+            )
+            if len(rows) <= limit:
+                # Сравнение с NULL ложно: строки с NULL первым ключом добираются отдельным запросом
+                rows += _select(
+                    cursor, select_sql, rest, list(conditions) + [f"{first} IS NULL"],
+                    params, limit + 1 - len(rows)
+                )
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1][key] for _, key in order])
+    return rows, next_cursor
@@ -0,0 +1,184 @@
+"""
+Полнотекстовый поиск по пользователям, ключам, транзакциям и тикетам для панели
+
+Индекс search_index (FTS5) поддерживается триггерами БД (см. database.init_database),
+здесь - разбор запроса, ранжированная выборка и подготовка результатов к показу.
+"""
+import re
+import json
+import time
+import logging
+from typing import Any, Dict, List, Optional, Sequence
+from backend.database import database
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+MIN_QUERY_LENGTH = 2
+# Вес заголовка и текста документа в bm25
+TITLE_WEIGHT = 10.0
+BODY_WEIGHT = 1.0
+
+_KIND_BY_CODE = {code: kind for kind, code in database.SEARCH_KINDS.items()}
+
+
+def build_match_query(query: str) -> Optional[str]:
+    """
+    Выражение MATCH из пользовательского ввода: каждое слово ищется как префикс,
+    все слова должны встретиться. Спецсимволы FTS5 в запрос не попадают.
+    """
+    terms = re.findall(r'\w+', query.lower())
+    if not terms or sum(len(term) for term in terms) < MIN_QUERY_LENGTH:
+        return None
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def _hydrate(kind: str, ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    """Поля для показа найденных документов одного вида одним запросом"""
+    queries = {
+        'user': """
+            SELECT id, id AS user_id, username, telegram_id, status, balance FROM users
+            WHERE id IN (SELECT value FROM json_each(?))
+        """,
+        'key': """
+            SELECT k.id, k.user_id, k.key_uuid, k.status, k.expiry_date, u.username FROM vpn_keys k
+            LEFT JOIN users u ON u.id = k.user_id
+            WHERE k.id IN (SELECT value FROM json_each(?))
+        """,
+        'transaction': """
+            SELECT t.id, t.user_id, t.payment_id, t.amount, t.status, t.type, t.payment_provider, t.created_at, u.username
+            FROM transactions t
+            LEFT JOIN users u ON u.id = t.user_id
+            WHERE t.id IN (SELECT value FROM json_each(?))
+        """,
+        'ticket': """
+            SELECT t.id, t.user_id, t.status, t.last_message, u.username, u.telegram_id FROM tickets t
+            LEFT JOIN users u ON u.id = t.user_id
+            WHERE t.id IN (SELECT value FROM json_each(?))
+        """,
+        'ticket_message': """
+            SELECT m.id, m.ticket_id, m.user_id, m.is_admin, m.created_at, u.username FROM ticket_messages m
+            LEFT JOIN users u ON u.id = m.user_id
+            WHERE m.id IN (SELECT value FROM json_each(?))
+        """,
+    }
+    with database.db_connection() as conn:
+        return {row['id']: dict(row) for row in conn.execute(queries[kind], (json.dumps(ids),))}
+
+
+def _present(kind: str, row: Dict[str, Any]) -> Dict[str, Any]:
+    """Заголовок и подзаголовок результата для панели"""
+    username = row.get('username')
+    user = f"@{username}" if username else f"user_{row.get('user_id')}"
+    if kind == 'user':
+        return {'title': user, 'subtitle': f"{row['telegram_id']} · {row['status']} · {row['balance'] or 0:.2f}₽"}
+    if kind == 'key':
+        return {'title': row['key_uuid'] or f"key_{row['id']}", 'subtitle': f"{user} · {row['status']} · {row['expiry_date'] or ''}"}
+    if kind == 'transaction':
+        return {'title': row['payment_id'] or f"#{row['id']}",
+                'subtitle': f"{user} · {row['type']} · {row['amount']} · {row['status']} · {row['payment_provider'] or ''}"}
+    if kind == 'ticket':
+        return {'title': f"Тикет #{row['id']}", 'subtitle': f"{user} · {row['status']} · {row['last_message'] or ''}"}
+    return {'title': f"Тикет #{row['ticket_id']}", 'subtitle': f"{'Поддержка' if row['is_admin'] else user} · {row['created_at']}"}
+
+
+def search(query: str, limit: int = DEFAULT_LIMIT, kinds: Sequence[str] = None) -> Dict[str, Any]:
+    """
+    Ранжированный поиск по всем видам документов.
+
+    Args:
+        query: Строка поиска (username, Telegram ID, payment_id, UUID ключа, текст тикета)
+        limit: Максимум результатов
+        kinds: Ограничить видами документов (user, key, transaction, ticket, ticket_message)
+
+    Returns:
+        Dict с results (type, id, user_id, title, subtitle, snippet, score) и took_ms
+    """
+    started = time.monotonic()
+    match = build_match_query(query)
+    if not match:
+        return {'results': [], 'took_ms': 0}
+    limit = max(1, min(limit or DEFAULT_LIMIT, MAX_LIMIT))
+
+    conditions = ["search_index MATCH ?"]
+    params: List[Any] = [match]
+    if kinds:
+        codes = [database.SEARCH_KINDS[kind] for kind in kinds if kind in database.SEARCH_KINDS]
+        if not codes:
+            return {'results': [], 'took_ms': 0}
+        conditions.append(f"rowid % {database.SEARCH_KIND_SLOTS} IN ({', '.join('?' * len(codes))})")
+        params.extend(codes)
+
+    with database.db_connection() as conn:
+        rows = conn.execute(f"""
+            SELECT rowid, bm25(search_index, {TITLE_WEIGHT}, {BODY_WEIGHT}) AS score,
+                   snippet(search_index, -1, '[', ']', '…', 12) AS snippet
+            FROM search_index
+            WHERE {' AND '.join(conditions)}
+            ORDER BY score
+            LIMIT ?
+        """, params + [limit]).fetchall()
+
+    hits = []
+    by_kind: Dict[str, List[int]] = {}
+    for row in rows:
+        kind = _KIND_BY_CODE.get(row['rowid'] % database.SEARCH_KIND_SLOTS)
+        ref_id = row['rowid'] // database.SEARCH_KIND_SLOTS
+        if kind:
+            hits.append((kind, ref_id, row['score'], row['snippet']))
+            by_kind.setdefault(kind, []).append(ref_id)
+
+    details = {kind: _hydrate(kind, ids) for kind, ids in by_kind.items()}
+    results = []
+    for kind, ref_id, score, snippet in hits:
+        row = details[kind].get(ref_id)
+        if not row:
+            continue
+        results.append({
+            'type': kind,
+            'id': ref_id,
+            'user_id': row.get('user_id'),
+            'ticket_id': row.get('ticket_id'),
+            **_present(kind, row),
+            'snippet': snippet,
+            'score': round(-score, 4),
+        })
+    return {'results': results, 'took_ms': round((time.monotonic() - started) * 1000, 2)}
+
+
+def benchmark(queries: Sequence[str], repeat: int = 3, limit: int = DEFAULT_LIMIT) -> Dict[str, Any]:
+    """Задержки поиска по набору запросов на текущей БД (p50/p95/max в мс)"""
+    timings = []
+    for _ in range(repeat):
+        for query in queries:
+            started = time.perf_counter()
+            search(query, limit)
+            timings.append((time.perf_counter() - started) * 1000)
+    if not timings:
+        return {'queries': 0}
+    timings.sort()
+    with database.db_connection() as conn:
+        documents = conn.execute("SELECT COUNT(*) FROM search_index").fetchone()[0]
+    return {
+        'documents': documents,
+        'queries': len(timings),
+        'p50_ms': round(timings[len(timings) // 2], 2),
+        'p95_ms': round(timings[int(len(timings) * 0.95) - 1 if len(timings) > 1 else 0], 2),
+        'max_ms': round(timings[-1], 2),
+    }
+
+
+def sample_queries(count: int = 50) -> List[str]:
+    """Запросы для бенчмарка из реальных данных: usernames, Telegram ID, payment_id, UUID ключей"""
+    per_kind = max(1, count // 4)
+    with database.db_connection() as conn:
+        queries = []
+        for sql in (
+            "SELECT username FROM users WHERE username IS NOT NULL ORDER BY random() LIMIT ?",
+            "SELECT CAST(telegram_id AS TEXT) FROM users ORDER BY random() LIMIT ?",
+            "SELECT payment_id FROM transactions WHERE payment_id IS NOT NULL ORDER BY random() LIMIT ?",
+            "SELECT key_uuid FROM vpn_keys WHERE key_uuid IS NOT NULL ORDER BY random() LIMIT ?",
+        ):
+            queries.extend(row[0] for row in conn.execute(sql, (per_kind,)))
+    return queries
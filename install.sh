@@ -212,6 +212,15 @@ server {
         proxy_set_header X-Forwarded-Proto \$scheme;
     }
 
+    # Горячие маршруты мини-приложения - в асинхронный API
+    location ~ ^/api/(user/(info|devices|history)|subscription/(create|status)|payment/create)\$ {
+        proxy_pass http://127.0.0.1:8002;
+        proxy_set_header Host \$host;
+        proxy_set_header X-Real-IP \$remote_addr;
+        proxy_set_header X-Forwarded-For \$proxy_add_x_forwarded_for;
+        proxy_set_header X-Forwarded-Proto \$scheme;
+    }
+
     location /api {
         proxy_pass http://127.0.0.1:8000;
         proxy_set_header Host \$host;
@@ -46,6 +46,32 @@ async function miniApiFetch(path: string, options: RequestInit = {}): Promise<an
   }
 }
 
+// Подписка создается фоновой задачей: ждем ее завершения через long polling статуса
+async function createSubscription(body: Record<string, any>): Promise<any> {
+  const res = await miniApiFetch('/subscription/create', {
+    method: 'POST',
+    body: JSON.stringify(body),
+  });
+  if (!res || !res.job_id) return res;
+
+  const deadline = Date.now() + 120000;
+  while (Date.now() < deadline) {
+    const job = await miniApiFetch(`/subscription/status?job_id=${res.job_id}&user_id=${body.user_id}&wait=20`);
+    if (job?.status === 'done') {
+      return { success: true, subscription: job.subscription };
+    }
+    if (job?.status === 'failed') {
+      return {
+        success: false,
+        error: job.refunded
+          ? 'Не удалось создать подписку, средства возвращены на баланс'
+          : 'Не удалось создать подписку',
+      };
+    }
+  }
+  return { success: false, error: 'Подписка создается дольше обычного, проверьте раздел устройств позже' };
+}
+
 // ==========================================
 // 1. TYPES & INTERFACES
 // ==========================================
@@ -1136,15 +1162,12 @@ export default function App() {
     }
     
     try {
-      const res = await miniApiFetch('/subscription/create', {
-        method: 'POST',
-        body: JSON.stringify({
-          user_id: currentUserId,
-          days: 30,
-          type: 'whitelist',
-          whitelist_gb: finalGB,
-          price: price,
-        }),
+      const res = await createSubscription({
+        user_id: currentUserId,
+        days: 30,
+        type: 'whitelist',
+        whitelist_gb: finalGB,
+        price: price,
       });
       
       if (res && res.success) {
@@ -1176,15 +1199,12 @@ export default function App() {
         if (wizardPlan.isTrial) {
             // Активируем триал через API
             try {
-              const res = await miniApiFetch('/subscription/create', {
-                method: 'POST',
-                body: JSON.stringify({
-                  user_id: currentUserId,
-                  days: wizardPlan.days || 1,
-                  type: 'vpn',
-                  is_trial: true,
-                  price: 0,
-                }),
+              const res = await createSubscription({
+                user_id: currentUserId,
+                days: wizardPlan.days || 1,
+                type: 'vpn',
+                is_trial: true,
+                price: 0,
               });
               
               if (res && res.success) {
@@ -1224,17 +1244,14 @@ export default function App() {
     // Если используется автоплатеж для whitelist, создаем платеж с сохраненным способом оплаты
     if (wizardType === 'whitelist' && useAutoPay && selectedPaymentMethodId) {
       try {
-        await miniApiFetch('/subscription/create', {
-          method: 'POST',
-          body: JSON.stringify({
-            user_id: currentUserId,
-            days: 30,
-            type: 'whitelist',
-            whitelist_gb: whitelistGB,
-            use_auto_pay: true,
-            payment_method_id: selectedPaymentMethodId,
-            price: price,
-          }),
+        await createSubscription({
+          user_id: currentUserId,
+          days: 30,
+          type: 'whitelist',
+          whitelist_gb: whitelistGB,
+          use_auto_pay: true,
+          payment_method_id: selectedPaymentMethodId,
+          price: price,
         });
         addHistoryItem('buy_dev', name, -price);
         await refreshAll();
@@ -1247,15 +1264,12 @@ export default function App() {
     }
     
     try {
-      const res = await miniApiFetch('/subscription/create', {
-        method: 'POST',
-        body: JSON.stringify({
-          user_id: currentUserId,
-          days: wizardType === 'vpn' ? wizardPlan?.days : 30,
-          type: wizardType,
-          whitelist_gb: wizardType === 'whitelist' ? whitelistGB : undefined,
-          price: price,
-        }),
+      const res = await createSubscription({
+        user_id: currentUserId,
+        days: wizardType === 'vpn' ? wizardPlan?.days : 30,
+        type: wizardType,
+        whitelist_gb: wizardType === 'whitelist' ? whitelistGB : undefined,
+        price: price,
       });
       
       if (res && res.success) {
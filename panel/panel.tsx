@@ -27,6 +27,11 @@ const rawEnv: any =
 
 const API_BASE_URL: string = rawEnv.VITE_API_URL || rawEnv.REACT_APP_API_URL || '/api';
 const BOT_USERNAME: string = rawEnv.VITE_BOT_USERNAME || rawEnv.REACT_APP_BOT_USERNAME || 'blnnnbot';
+// Сколько ждать прогресса массового действия, прежде чем перестать опрашивать сервер
+// (больше MASS_ACTION_STALE_SECONDS + интервал продолжения на сервере)
+const MASS_ACTION_POLL_STALL_MS = 10 * 60 * 1000;
+// Размер страницы списка тикетов; следующие страницы - по курсору из X-Next-Cursor
+const TICKETS_PAGE_SIZE = 500;
 
 // Получаем секрет из localStorage (сохраняется при входе)
 function getPanelSecret(): string {
@@ -48,7 +53,7 @@ function clearPanelSecret(): void {
   }
 }
 
-async function apiFetch(path: string, options: RequestInit = {}): Promise<any> {
+async function apiResponse(path: string, options: RequestInit = {}): Promise<Response> {
   // Всегда используем относительный путь /api - nginx проксирует на backend
   const cleanPath = path.startsWith('/') ? path : `/${path}`;
   const url = `/api${cleanPath}`;
@@ -80,6 +85,11 @@ async function apiFetch(path: string, options: RequestInit = {}): Promise<any> {
     const text = await res.text();
     throw new Error(text || `Request failed with status ${res.status}`);
   }
+  return res;
+}
+
+async function apiFetch(path: string, options: RequestInit = {}): Promise<any> {
+  const res = await apiResponse(path, options);
   try {
     return await res.json();
   } catch {
@@ -87,6 +97,47 @@ async function apiFetch(path: string, options: RequestInit = {}): Promise<any> {
   }
 }
 
+// Страница списка и курсор следующей (null - страница последняя)
+async function apiFetchPage(path: string): Promise<{ items: any[]; nextCursor: string | null }> {
+  const res = await apiResponse(path);
+  const items = await res.json();
+  return { items: Array.isArray(items) ? items : [], nextCursor: res.headers.get('X-Next-Cursor') };
+}
+
+function mapTicket(t: any): Ticket {
+  return {
+    id: t.id,
+    user: t.user,
+    status: t.status as TicketStatus,
+    lastMsg: t.lastMsg,
+    time: t.time
+      ? new Date(t.time).toLocaleString('ru-RU', { day: '2-digit', month: '2-digit', hour: '2-digit', minute: '2-digit' })
+      : '',
+    unread: t.unread ?? 0,
+    avatar: (t.user || '?').charAt(1).toUpperCase(),
+    balance: t.balance ?? 0,
+    sub: t.sub || '',
+  };
+}
+
+// Скачать потоковую выгрузку панели (users, keys, transactions) файлом
+async function downloadExport(name: string, params: Record<string, string> = {}): Promise<void> {
+  const query = new URLSearchParams({ format: 'csv', gzip: '1', ...params }).toString();
+  const res = await fetch(`/api/panel/export/${name}?${query}`, {
+    headers: { 'Authorization': `Bearer ${getPanelSecret() || ''}` },
+  });
+  if (!res.ok) {
+    throw new Error(await res.text() || `Export failed with status ${res.status}`);
+  }
+  const match = /filename="([^"]+)"/.exec(res.headers.get('Content-Disposition') || '');
+  const url = URL.createObjectURL(await res.blob());
+  const link = document.createElement('a');
+  link.href = url;
+  link.download = match ? match[1] : `${name}.csv.gz`;
+  link.click();
+  URL.revokeObjectURL(url);
+}
+
 // ==========================================
 // 1. TYPES & INTERFACES
 // ==========================================
@@ -1062,6 +1113,7 @@ function AuthenticatedApp({ onLogout }: { onLogout: () => void }) {
   const [promos, setPromos] = useState<Promo[]>([]);
   const [plans, setPlans] = useState<Plan[]>([]);
   const [tickets, setTickets] = useState<Ticket[]>([]);
+  const [ticketsCursor, setTicketsCursor] = useState<string | null>(null);
   const [totalRevenue, setTotalRevenue] = useState<number>(0);
   
   // UI States
@@ -1182,28 +1234,17 @@ function AuthenticatedApp({ onLogout }: { onLogout: () => void }) {
 
         // Тикеты
         try {
-          const ticketsFromApi = await apiFetch('/panel/tickets');
-          if (!cancelled && Array.isArray(ticketsFromApi)) {
-            const mappedTickets: Ticket[] = ticketsFromApi.map((t: any) => ({
-              id: t.id,
-              user: t.user,
-              status: t.status as TicketStatus,
-              lastMsg: t.lastMsg,
-              time: t.time
-                ? new Date(t.time).toLocaleString('ru-RU', { day: '2-digit', month: '2-digit', hour: '2-digit', minute: '2-digit' })
-                : '',
-              unread: t.unread ?? 0,
-              avatar: (t.user || '?').charAt(1).toUpperCase(),
-              balance: t.balance ?? 0,
-              sub: t.sub || '',
-            }));
-            setTickets(mappedTickets);
+          const page = await apiFetchPage(`/panel/tickets?limit=${TICKETS_PAGE_SIZE}`);
+          if (!cancelled) {
+            setTickets(page.items.map(mapTicket));
+            setTicketsCursor(page.nextCursor);
           }
         } catch (e) {
           console.error('Failed to load tickets from API', e);
           if (!cancelled) {
             addToast('Ошибка', 'Не удалось загрузить тикеты', 'error');
             setTickets([]);
+            setTicketsCursor(null);
           }
         }
 
@@ -1267,6 +1308,21 @@ function AuthenticatedApp({ onLogout }: { onLogout: () => void }) {
     };
   }, []);
 
+  const loadMoreTickets = async () => {
+      if (!ticketsCursor) return;
+      try {
+          const page = await apiFetchPage(`/panel/tickets?limit=${TICKETS_PAGE_SIZE}&cursor=${encodeURIComponent(ticketsCursor)}`);
+          setTickets(prev => {
+              const seen = new Set(prev.map(t => t.id));
+              return [...prev, ...page.items.map(mapTicket).filter(t => !seen.has(t.id))];
+          });
+          setTicketsCursor(page.nextCursor);
+      } catch (e) {
+          console.error('Failed to load more tickets', e);
+          addToast('Ошибка', 'Не удалось загрузить тикеты', 'error');
+      }
+  };
+
   const handleUpdateKey = (id: number, newExpiry: number) => {
       setKeys(prev => prev.map(k => k.id === id ? { ...k, expiry: newExpiry, status: newExpiry > 0 ? 'Active' : 'Expired' } : k));
       setEditingKey(null);
@@ -1303,11 +1359,31 @@ function AuthenticatedApp({ onLogout }: { onLogout: () => void }) {
       {editingKey && (<KeyEditModal keyItem={editingKey} onClose={() => setEditingKey(null)} onSave={handleUpdateKey} onDelete={handleDeleteKey} />)}
       {massActionType && <UserActionModal type={massActionType} onClose={() => setMassActionType(null)} onConfirm={async (val, notify) => { 
         try {
-          await apiFetch('/panel/users/mass-action', {
+          const started = await apiFetch('/panel/users/mass-action', {
             method: 'POST',
             body: JSON.stringify({ action: massActionType, value: val, notify })
           });
-          addToast('Массовое действие', 'Задача успешно выполнена', 'success'); 
+          addToast('Массовое действие', 'Задача запущена', 'success');
+          // Действие выполняется в фоне пачками - ждем завершения, но не дольше
+          // MASS_ACTION_POLL_STALL_MS без прогресса (прерванное действие продолжит сервер)
+          let status = started;
+          let processed = -1;
+          let deadline = Date.now() + MASS_ACTION_POLL_STALL_MS;
+          while (status && status.action_id && !['Completed', 'Failed'].includes(status.status) && Date.now() < deadline) {
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            status = { action_id: started.action_id, ...(await apiFetch(`/panel/users/mass-action/${started.action_id}`)) };
+            if (status.processed !== processed) {
+              processed = status.processed;
+              deadline = Date.now() + MASS_ACTION_POLL_STALL_MS;
+            }
+          }
+          if (status?.status === 'Failed') {
+            addToast('Ошибка', status.error || 'Не удалось выполнить действие', 'error');
+          } else if (status?.status === 'Completed') {
+            addToast('Массовое действие', `Задача выполнена: ${status?.processed ?? 0} польз.`, 'success');
+          } else {
+            addToast('Массовое действие', `Задача еще выполняется: ${status?.processed ?? 0} из ${status?.total ?? 0} польз.`, 'info');
+          }
         } catch (e) {
           addToast('Ошибка', 'Не удалось выполнить действие', 'error');
         }
@@ -1349,7 +1425,7 @@ function AuthenticatedApp({ onLogout }: { onLogout: () => void }) {
             {activePage === 'Ключи' && <KeysPage keys={keys} keySearch={keySearch} setKeySearch={setKeySearch} setIsCreateKeyOpen={setIsCreateKeyOpen} setEditingKey={setEditingKey} />}
             {activePage === 'Рассылка' && <MailingPage onToast={addToast} />}
             {activePage === 'Тарифы' && <TariffsPage promos={promos} plans={plans} setPlans={setPlans} onToast={addToast} />}
-            {activePage === 'Тикеты' && <TicketsPage tickets={tickets} activeTicketId={activeTicketId} setActiveTicketId={setActiveTicketId} ticketMsg={ticketMsg} setTicketMsg={setTicketMsg} setSelectedUser={setSelectedUser} users={users} onToast={addToast} />}
+            {activePage === 'Тикеты' && <TicketsPage tickets={tickets} hasMoreTickets={ticketsCursor !== null} onLoadMoreTickets={loadMoreTickets} activeTicketId={activeTicketId} setActiveTicketId={setActiveTicketId} ticketMsg={ticketMsg} setTicketMsg={setTicketMsg} setSelectedUser={setSelectedUser} users={users} onToast={addToast} />}
             {activePage === 'Публичные страницы' && <PublicPages onToast={addToast} />}
             {activePage === 'Настройки' && <SettingsPage onToast={addToast} />}
         </div>
@@ -1485,6 +1561,13 @@ const FinancePage: React.FC<FinancePageProps> = ({ transactions, onSelectTransac
     return (
         <div className="space-y-6 animate-in fade-in slide-in-from-bottom-4 duration-500">
             <div className="flex flex-col md:flex-row md:items-center justify-between gap-4"><div><h2 className="text-2xl font-bold text-white">Финансы</h2><p className="text-gray-400 mt-1">Управление доходами</p></div>
+                <button
+                    onClick={() => downloadExport('transactions').catch(e => console.error('Failed to export transactions', e))}
+                    className="px-4 py-2 bg-gray-800 hover:bg-gray-700 text-white rounded-xl text-sm font-medium transition-colors flex items-center"
+                >
+                    <Download size={16} className="mr-2" />
+                    Экспорт CSV
+                </button>
             </div>
             <div className="grid grid-cols-1 md:grid-cols-3 gap-6">
                 <StatCard 
@@ -1964,7 +2047,7 @@ const MailingPage: React.FC<MailingPageProps> = ({ onToast }) => {
                                                 ? 'bg-green-500/10 text-green-400 border-green-500/20' 
                                                 : 'bg-gray-500/10 text-gray-400 border-gray-500/20'
                                         }`}>
-                                            {item.status === 'Completed' ? 'Отправлено' : item.status}
+                                            {item.status === 'Completed' ? 'Отправлено' : item.status === 'Queued' ? 'В очереди' : item.status === 'Sending' ? `Отправляется ${item.sent_count || 0}/${item.total_count || 0}` : item.status}
                                         </span>
                                         <span className="text-xs text-gray-400 flex items-center">
                                             <Users size={12} className="mr-1"/> {item.sent_count || 0}
@@ -2748,6 +2831,8 @@ const PublicPages: React.FC<PublicPagesProps> = ({ onToast }) => {
 
 interface TicketsPageProps {
     tickets: Ticket[];
+    hasMoreTickets: boolean;
+    onLoadMoreTickets: () => Promise<void>;
     activeTicketId: number | null;
     setActiveTicketId: (id: number | null) => void;
     ticketMsg: string;
@@ -2757,8 +2842,18 @@ interface TicketsPageProps {
     onToast: (title: string, msg: string, type: ToastType) => void;
 }
 
-const TicketsPage: React.FC<TicketsPageProps> = ({ tickets, activeTicketId, setActiveTicketId, ticketMsg, setTicketMsg, setSelectedUser, users, onToast }) => {
+const TicketsPage: React.FC<TicketsPageProps> = ({ tickets, hasMoreTickets, onLoadMoreTickets, activeTicketId, setActiveTicketId, ticketMsg, setTicketMsg, setSelectedUser, users, onToast }) => {
     const activeTicket = tickets.find(t => t.id === activeTicketId);
+    const [loadingMore, setLoadingMore] = useState(false);
+
+    const handleLoadMore = async () => {
+        setLoadingMore(true);
+        try {
+            await onLoadMoreTickets();
+        } finally {
+            setLoadingMore(false);
+        }
+    };
     const [ticketMessages, setTicketMessages] = useState<any[]>([]);
     
     // Загружаем сообщения тикета при изменении activeTicketId
@@ -2818,6 +2913,9 @@ const TicketsPage: React.FC<TicketsPageProps> = ({ tickets, activeTicketId, setA
                             <div className="flex justify-between items-center"><span className={`text-[10px] px-2 py-0.5 rounded border ${t.status === 'Open' ? 'bg-green-500/10 text-green-400 border-green-500/20' : t.status === 'Pending' ? 'bg-yellow-500/10 text-yellow-400 border-yellow-500/20' : 'bg-gray-700 text-gray-400 border-gray-600'}`}>{t.status}</span>{t.unread > 0 && <span className="bg-blue-600 text-white text-[10px] font-bold px-1.5 py-0.5 rounded-full">{t.unread}</span>}</div>
                         </div>
                     ))}
+                    {hasMoreTickets && (
+                        <button onClick={handleLoadMore} disabled={loadingMore} className="w-full py-3 text-sm text-blue-400 hover:text-blue-300 hover:bg-gray-800/50 disabled:opacity-50 transition-colors">{loadingMore ? 'Загрузка...' : 'Загрузить еще'}</button>
+                    )}
                 </div>
             </div>
             <div className="w-2/3 bg-gray-900 border border-gray-800 rounded-2xl flex flex-col overflow-hidden">
@@ -3070,6 +3168,7 @@ const BackupSettingsTab: React.FC<{ onToast: (title: string, msg: string, type:
     const [backupEnabled, setBackupEnabled] = useState(false);
     const [backupInterval, setBackupInterval] = useState('12');
     const [lastBackup, setLastBackup] = useState<string | null>(null);
+    const [lastRun, setLastRun] = useState<any>(null);
     const [creating, setCreating] = useState(false);
 
     useEffect(() => {
@@ -3083,7 +3182,9 @@ const BackupSettingsTab: React.FC<{ onToast: (title: string, msg: string, type:
                 setBackupEnabled(data.enabled || false);
                 setBackupInterval(data.interval_hours?.toString() || '12');
                 setLastBackup(data.last_backup || null);
+                setLastRun(data.last_run || null);
             }
+            return data;
         } catch (e) {
             console.error('Failed to load backup status', e);
         }
@@ -3092,9 +3193,20 @@ const BackupSettingsTab: React.FC<{ onToast: (title: string, msg: string, type:
     const handleCreateBackup = async () => {
         setCreating(true);
         try {
-            await apiFetch('/panel/backups/create', { method: 'POST' });
-            onToast('Успех', 'Резервная копия создана и отправлена администратору', 'success');
-            loadBackupStatus();
+            const started = await apiFetch('/panel/backups/create', { method: 'POST' });
+            // Копия создается в фоне - ждем завершения запуска
+            let run = null;
+            while (started?.id) {
+                await new Promise(resolve => setTimeout(resolve, 2000));
+                const data = await loadBackupStatus();
+                run = data?.history?.find((item: any) => item.id === started.id);
+                if (!run || run.status !== 'running') break;
+            }
+            if (run && run.status !== 'ok') {
+                onToast('Ошибка', run.error || 'Не удалось создать резервную копию', 'error');
+            } else {
+                onToast('Успех', run?.sent_to_admin ? 'Резервная копия создана и отправлена администратору' : 'Резервная копия создана', 'success');
+            }
         } catch (e) {
             onToast('Ошибка', 'Не удалось создать резервную копию', 'error');
         }
@@ -3145,6 +3257,16 @@ const BackupSettingsTab: React.FC<{ onToast: (title: string, msg: string, type:
                     </div>
                 )}
 
+                {lastRun && lastRun.status === 'ok' && (
+                    <div className="p-3 bg-gray-950 rounded-xl border border-gray-800 text-sm">
+                        <span className="text-gray-500">Последний запуск: </span>
+                        <span className="text-white">
+                            {(lastRun.db_bytes / 1048576).toFixed(1)} МБ → {(lastRun.compressed_bytes / 1048576).toFixed(1)} МБ,{' '}
+                            {(lastRun.duration_ms / 1000).toFixed(1)} с, {(lastRun.bytes_per_second / 1048576).toFixed(1)} МБ/с
+                        </span>
+                    </div>
+                )}
+
                 <div className="p-4 bg-blue-900/20 border border-blue-500/30 rounded-xl flex items-start">
                     <Cloud className="text-blue-400 mr-3 mt-0.5" size={20} />
                     <div>
@@ -73,44 +73,19 @@ async def cmd_start(message: types.Message):
     if referral_id == telegram_id:
         referral_id = None
     
-    # Получаем или создаем пользователя
-    user = database.get_user_by_telegram_id(telegram_id)
-    if not user:
-        # Создаем нового пользователя
-        username = message.from_user.username
-        full_name = message.from_user.full_name
-        
-        # Проверяем referral и рейт-лимит
-        referred_by = None
-        if referral_id:
-            ref_user = database.get_user_by_telegram_id(referral_id)
-            if ref_user:
-                # Проверяем рейт-лимит: не более 25 рефералов в минуту
-                if database.check_referral_rate_limit(referral_id, limit=25, window_seconds=60):
-                    referred_by = ref_user['id']
-                    logger.info(f"Referral accepted: user {telegram_id} referred by {referral_id}")
-                else:
-                    logger.warning(f"Referral rate limit exceeded for referrer {referral_id}")
-        
-        user_id = database.create_user(telegram_id, username, full_name, referred_by)
-        user = database.get_user_by_id(user_id)
-    else:
-        # Пользователь уже существует - попробуем установить реферера, если его нет
-        if referral_id and user.get('referred_by') is None:
-            ref_user = database.get_user_by_telegram_id(referral_id)
-            if ref_user:
-                # Проверяем рейт-лимит
-                if database.check_referral_rate_limit(referral_id, limit=25, window_seconds=60):
-                    if database.set_referrer_for_user(user['id'], ref_user['id']):
-                        logger.info(f"Referral set for existing user {telegram_id} -> {referral_id}")
-                        # Обновляем данные пользователя
-                        user = database.get_user_by_telegram_id(telegram_id)
-                else:
-                    logger.warning(f"Referral rate limit exceeded for referrer {referral_id}")
+    # Получаем или создаем пользователя (реферал и проверка бана в одной транзакции)
+    user = database.bootstrap_user(
+        telegram_id,
+        message.from_user.username,
+        full_name=message.from_user.full_name,
+        referrer_telegram_id=referral_id,
+        referral_limit=25,
+        referral_window_seconds=60,
+        max_banned_keys=abuse_detected.MAX_BANNED_KEYS_FOR_BAN,
+    )
     
     # Проверяем статус бана
-    ban_status = abuse_detected.check_user_ban_status(user['id'])
-    if ban_status.get('banned'):
+    if user.get('is_banned'):
         await message.answer(
             "❌ Ваш аккаунт заблокирован.\n\n"
             "Если вы считаете, что это ошибка, свяжитесь со службой поддержки.",
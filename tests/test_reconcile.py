@@ -0,0 +1,101 @@
+"""
+Сверка vpn_keys с Remnawave: подсчет обновлений и конфликтов при записи
+
+    python -m pytest tests/test_reconcile.py
+"""
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from unittest import mock
+
+# БД теста задается до импорта database: импорт выполняет init_database() по DB_PATH
+_tmp = tempfile.TemporaryDirectory()
+os.environ['DB_PATH'] = os.path.join(_tmp.name, 'reconcile.db')
+
+from backend.database import database  # noqa: E402
+from backend.core import reconcile  # noqa: E402
+
+
+def _remnawave_user(key_uuid: str, expire_at: datetime, status: str, updated_at: datetime):
+    return SimpleNamespace(
+        uuid=key_uuid,
+        expire_at=expire_at,
+        traffic_limit_bytes=0,
+        status=SimpleNamespace(value=status),
+        user_traffic=SimpleNamespace(used_traffic_bytes=0),
+        updated_at=updated_at,
+    )
+
+
+class ApplyUpdatesTest(unittest.TestCase):
+
+    def setUp(self):
+        with database.transaction() as conn:
+            conn.execute("DELETE FROM vpn_keys")
+            conn.execute("DELETE FROM sync_state")
+        user = database.bootstrap_user(1000, 'reconcile_test')
+        self.user_id = user['id']
+        self.now = datetime.now(timezone.utc).replace(microsecond=0)
+        self.expiry = reconcile._format_expiry(self.now + timedelta(days=10))
+        self.key_ids = []
+        with database.transaction() as conn:
+            for index in range(4):
+                cursor = conn.execute(
+                    "INSERT INTO vpn_keys (user_id, key_uuid, status, expiry_date, traffic_used, traffic_limit) "
+                    "VALUES (?, ?, 'Active', ?, 0, 0)",
+                    (self.user_id, f"uuid-{index}", self.expiry)
+                )
+                self.key_ids.append(cursor.lastrowid)
+
+    def _expire_all(self):
+        """Обновления сверки: все ключи Active -> Expired с прежним сроком"""
+        return [(self.expiry, 0, 0, 'Expired', key_id, self.expiry, 'Active') for key_id in self.key_ids]
+
+    def test_status_change_with_conflict(self):
+        updates = self._expire_all()
+        # Ключ продлили после чтения сверкой: CAS по сроку не проходит
+        with database.transaction() as conn:
+            conn.execute("UPDATE vpn_keys SET expiry_date = ? WHERE id = ?",
+                         (reconcile._format_expiry(self.now + timedelta(days=40)), self.key_ids[1]))
+
+        result = reconcile._apply_updates(updates)
+
+        self.assertEqual(result, {'updated': 3, 'conflicts': 1, 'conflicted_ids': [self.key_ids[1]]})
+        with database.db_connection() as conn:
+            statuses = dict(conn.execute("SELECT id, status FROM vpn_keys").fetchall())
+        self.assertEqual(statuses[self.key_ids[1]], 'Active')
+        self.assertEqual([statuses[key_id] for key_id in self.key_ids if key_id != self.key_ids[1]], ['Expired'] * 3)
+
+    def test_conflicted_key_is_retried_on_next_run(self):
+        expire_at = self.now - timedelta(days=1)
+        users = [_remnawave_user(f"uuid-{index}", expire_at, 'EXPIRED', self.now) for index in range(4)]
+        fetched = {'users': users, 'total': len(users), 'pages': 1}
+        real_apply = reconcile._apply_updates
+
+        def apply_with_conflict(updates):
+            # Параллельный бан одного ключа между чтением и записью сверки
+            with database.transaction() as conn:
+                conn.execute("UPDATE vpn_keys SET status = 'Disabled' WHERE id = ?", (self.key_ids[2],))
+            return real_apply(updates)
+
+        with mock.patch.object(reconcile.remnawave.remnawave_api, 'get_all_users_concurrently_sync',
+                               return_value=fetched):
+            with mock.patch.object(reconcile, '_apply_updates', side_effect=apply_with_conflict):
+                first = reconcile.reconcile_keys_with_remnawave()
+            self.assertEqual((first['updated'], first['conflicts']), (3, 1))
+            state = database.get_sync_state(reconcile.SYNC_NAME)
+            self.assertEqual(state['details']['retry_uuids'], ['uuid-2'])
+
+            # Remnawave с тех пор не менялся, но конфликтный ключ сверяется снова
+            second = reconcile.reconcile_keys_with_remnawave()
+        self.assertEqual((second['retried'], second['updated'], second['conflicts']), (1, 1, 0))
+        self.assertEqual(database.get_sync_state(reconcile.SYNC_NAME)['details']['retry_uuids'], [])
+        with database.db_connection() as conn:
+            status = conn.execute("SELECT status FROM vpn_keys WHERE id = ?", (self.key_ids[2],)).fetchone()[0]
+        self.assertEqual(status, 'Expired')
+
+
+if __name__ == '__main__':
+    unittest.main()